@@ -0,0 +1,892 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: the nipype Task classes for MINC.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Use these through minc (minc.ConvertTask and so on), which imports this
+# module, and with it nipype, only when a Task class is first needed.
+
+import os
+
+from nipype.interfaces.base import (
+    TraitedSpec,
+    CommandLineInputSpec,
+    CommandLine,
+    StdOutCommandLineInputSpec,
+    StdOutCommandLine,
+    File,
+    InputMultiPath,
+    isdefined,
+    traits,
+)
+
+from minc import (DEFAULT_CHUNK_SIZE, _StdOutStream, _require_numpy, _stdout_argv, convert_profile_file,
+                  image_layout, load_convert_profile, minc_dtype, np, warn)
+
+class MincTaskMixin(object):
+    """
+    Hooks shared by the MINC Task classes. A Task does its actual work
+    in _execute(); _run_interface() wraps it.
+
+    Result caching (see minc_cache): pass cache=<directory or
+    minc_cache.ResultCache>, or set $MINC_RESULT_CACHE, and a run whose
+    inputs, command line and toolchain match an earlier one restores
+    that run's outputs instead of running the tool. cache=False turns it
+    off. _cache_inputs and _cache_outputs name the traits holding input
+    and output files.
+
+    Scratch space (see minc_scratch): pass scratch=<directory or
+    minc_scratch.Scratch>, or set $MINC_SCRATCH_DIR, to stage the inputs
+    named in _stage_inputs on local disk and write generated outputs
+    there. scratch=False turns it off.
+
+    Resource accounting (see minc_profile): every run, cached or not,
+    is recorded in the registered sinks.
+
+    _precheck() runs before anything else, even a cache lookup, to
+    reject inputs that cannot work before any data is read or staged.
+
+    _runs_in_process() says whether _execute() does the work itself
+    rather than run the command line, so that code that runs the
+    command line on its own (minc_async) knows to call run() instead.
+    """
+
+    _cache_inputs = ('input_file',)
+    _cache_outputs = ('output_file',)
+    _stage_inputs = ('input_file',)
+
+    cache = None
+    scratch = None
+
+    def __init__(self, cache=None, scratch=None, **inputs):
+        super(MincTaskMixin, self).__init__(**inputs)
+        self.cache = cache
+        self.scratch = scratch
+
+    def _scratch_name(self, fname):
+        """
+        Where a generated output that would be fname goes: fname, or its
+        place in scratch.
+        """
+        import minc_scratch
+        scratch = minc_scratch.get_scratch(self.scratch)
+        return fname if scratch is None else scratch.output_path(fname)
+
+    def _cache_input_paths(self):
+        """
+        The files whose content the result depends on.
+        """
+        paths = []
+        for name in self._cache_inputs:
+            v = getattr(self.inputs, name)
+            if isdefined(v):
+                paths += list(v) if isinstance(v, (list, tuple)) else [v]
+        return paths
+
+    def _precheck(self):
+        pass
+
+    def _runs_in_process(self):
+        return False
+
+    def _execute(self, runtime):
+        return super(MincTaskMixin, self)._run_interface(runtime)
+
+    def _run_interface(self, runtime):
+        import minc_cache
+        import minc_profile
+        import minc_scratch
+        self._precheck()
+        cache = minc_cache.get_cache(self.cache)
+        if cache is None:
+            execute = self._execute
+        else:
+            execute = lambda runtime: cache.run(self, runtime)
+        scratch = minc_scratch.get_scratch(self.scratch)
+        if scratch is not None:
+            run = execute
+            execute = lambda runtime: scratch.run(self, runtime, run)
+        return minc_profile.run(self, runtime, execute)
+
+class ToRawInputSpec(StdOutCommandLineInputSpec):
+    """
+    For the MINC command minctoraw.
+    """
+
+    input_file = File(
+                    desc='input file',
+                    exists=True,
+                    mandatory=True,
+                    argstr='%s',
+                    position=-2,)
+
+    write_byte = traits.Bool(
+                desc='Write out data as bytes',
+                argstr='-byte',)
+
+    write_short = traits.Bool(
+                desc='Write out data as short integers',
+                argstr='-short',)
+
+    write_int = traits.Bool(
+                desc='Write out data as 32-bit integers',
+                argstr='-int',)
+
+    write_long = traits.Bool(
+                desc='Superseded by -int',
+                argstr='-long',)
+
+    write_float = traits.Bool(
+                desc='Write out data as single precision floating-point values',
+                argstr='-float',)
+
+    write_double = traits.Bool(
+                desc='Write out data as double precision floating-point values',
+                argstr='-double',)
+
+    write_signed = traits.Bool(
+                desc='Write out signed data',
+                argstr='-signed',)
+
+    write_unsigned = traits.Bool(
+                desc='Write out unsigned data',
+                argstr='-unsigned',)
+
+    write_range = traits.Tuple(
+                traits.Float, traits.Float, argstr='-range %s %s',
+                desc='Specify the range of output values\nDefault value: 1.79769e+308 1.79769e+308',) # FIXME minctoraw output is missing a negative?
+
+    _xor_normalize = ('normalize', 'nonormalize',)
+
+    normalize = traits.Bool(
+                    desc='Normalize integer pixel values to file max and min',
+                    argstr='-normalize',
+                    xor=_xor_normalize,
+                    mandatory=True)
+
+    nonormalize = traits.Bool(
+                    desc='Turn off pixel normalization',
+                    argstr='-nonormalize',
+                    xor=_xor_normalize,
+                    mandatory=True)
+
+class ToRawOutputSpec(TraitedSpec):
+    # FIXME Not sure if I'm defining the outout specs correctly.
+
+    output_file = File(
+                    desc='output file',
+                    exists=True,
+                    genfile=True,)
+
+class ToRawTask(MincTaskMixin, StdOutCommandLine):
+    input_spec  = ToRawInputSpec
+    output_spec = ToRawOutputSpec
+    cmd = 'minctoraw'
+
+    _cache_outputs = ('out_file',)
+
+    def _gen_outfilename(self):
+        """
+        Convert foo.mnc to foo.raw (in scratch, if there is one).
+        """
+        return self._scratch_name(os.path.splitext(self.inputs.input_file)[0] + '.raw')
+
+    def raw_dtype(self, layout=None):
+        """
+        numpy dtype of the data written by minctoraw with the current
+        inputs.
+        """
+        if layout is None:
+            layout = image_layout(self.inputs.input_file)
+
+        # ParseArgv lets the last type flag win, and the flags appear on
+        # the command line sorted by trait name.
+        vartype = None
+        for name, t in [('write_byte',      'byte'),
+                        ('write_double',    'double'),
+                        ('write_float',     'float'),
+                        ('write_int',       'int'),
+                        ('write_long',      'int'),
+                        ('write_short',     'short'),
+                       ]:
+            if getattr(self.inputs, name) is True:
+                vartype = t
+
+        signtype = None
+        for name, t in [('write_signed', 'signed'), ('write_unsigned', 'unsigned')]:
+            if getattr(self.inputs, name) is True:
+                signtype = t
+
+        if vartype is None:
+            vartype = layout.vartype
+            if signtype is None:
+                signtype = layout.signtype
+        elif signtype is None:
+            signtype = 'unsigned' if vartype == 'byte' else 'signed'
+
+        return minc_dtype(vartype, signtype)
+
+    def _hdf5_volume(self, backend):
+        """
+        Open the input with the in-process MINC2 reader if backend allows
+        it ('auto' or 'hdf5'), or return None to use minctoraw.
+        """
+        if backend not in ('auto', 'hdf5', 'subprocess'):
+            raise ValueError('unknown backend %r' % backend)
+        if backend == 'subprocess':
+            return None
+
+        import minc_io
+        if backend == 'auto' and not (minc_io.available() and minc_io.is_minc2(self.inputs.input_file)):
+            return None
+        return minc_io.Minc2Volume(self.inputs.input_file)
+
+    def _raw_options(self, layout):
+        """
+        Arguments for minc_io.Minc2Volume.to_raw() equivalent to the
+        current inputs.
+        """
+        return {'dtype':        self.raw_dtype(layout),
+                'normalize':    self.inputs.normalize is True,
+                'out_range':    self.inputs.write_range if isdefined(self.inputs.write_range) else None,
+               }
+
+    def to_array(self, chunk_size=DEFAULT_CHUNK_SIZE, backend='auto'):
+        """
+        Run minctoraw and read its output straight from the pipe into a
+        numpy array, instead of going through foo.raw. The array has the
+        shape of the image variable, slowest-varying dimension first.
+
+        With backend 'auto' (the default) MINC2 files are read in-process
+        through HDF5 when h5py is installed, and everything else goes
+        through minctoraw; 'hdf5' and 'subprocess' force one or the other.
+        """
+        _require_numpy()
+        self._check_mandatory_inputs()
+
+        vol = self._hdf5_volume(backend)
+        if vol is not None:
+            with vol:
+                return vol.to_raw(**self._raw_options(vol.layout()))
+
+        layout = image_layout(self.inputs.input_file)
+        data = np.empty(layout.shape, dtype=self.raw_dtype(layout))
+
+        stream = _StdOutStream(_stdout_argv(self), chunk_size)
+        try:
+            stream.readinto(data)
+            stream.finish()
+        except:
+            stream.kill()
+            raise
+        return data
+
+    def to_store(self, path=None, chunks=None, compression='zlib', header=None, threads=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, backend='auto'):
+        """
+        Write the voxels as a chunked store (see minc_store) instead of a
+        flat .raw file, for fast access to slices and regions. path
+        defaults to foo.chunks for foo.mnc (in scratch, if there is one);
+        header (a MincHeader, read from the input if not given) supplies
+        the voxel to world information. Memory use is bounded by one row
+        of chunks. Returns the minc_store.Store.
+        """
+        import minc_header
+        import minc_store
+        self._check_mandatory_inputs()
+
+        if path is None:
+            path = self._scratch_name(os.path.splitext(self.inputs.input_file)[0] + '.chunks')
+        if header is None:
+            header = minc_header.read_header(self.inputs.input_file)
+
+        vol = self._hdf5_volume(backend)
+        if vol is None:
+            layout = image_layout(self.inputs.input_file)
+        else:
+            with vol:
+                layout = vol.layout()
+        slices = self.iter_slices(slice_dims=len(layout.shape) - 1, chunk_size=chunk_size, backend=backend)
+        return minc_store.write_store(path, slices, layout.shape, self.raw_dtype(layout), chunks=chunks,
+                                      compression=compression, header=header, threads=threads)
+
+    def _slice_shape(self, layout, slice_dims):
+        """
+        The leading and slice dimensions of layout for iter_slices().
+        """
+        if not 0 < slice_dims <= len(layout.shape):
+            raise ValueError('slice_dims must be between 1 and %d' % len(layout.shape))
+        nlead = len(layout.shape) - slice_dims
+        return layout.shape[:nlead], layout.shape[nlead:]
+
+    def iter_slices(self, slice_dims=2, chunk_size=DEFAULT_CHUNK_SIZE, backend='auto'):
+        """
+        Like to_array(), but yield (index, array) pairs one slice at a
+        time, so that memory use is bounded by the size of one slice.
+        Each slice spans the last slice_dims dimensions: 2 gives 2D
+        slices, 3 gives whole volumes of a 4D series. index is the
+        position of the slice in the leading dimensions.
+        """
+        _require_numpy()
+        self._check_mandatory_inputs()
+
+        vol = self._hdf5_volume(backend)
+        if vol is not None:
+            # Closed however we leave, checks failing included.
+            with vol:
+                layout = vol.layout()
+                lead, tail = self._slice_shape(layout, slice_dims)
+                options = self._raw_options(layout)
+                nlead = len(lead)
+                for index in np.ndindex(*lead):
+                    start = tuple(index) + (0,) * slice_dims
+                    count = (1,) * nlead + tuple(tail)
+                    yield index, vol.to_raw(start=start, count=count, **options).reshape(tail)
+            return
+
+        layout = image_layout(self.inputs.input_file)
+        lead, tail = self._slice_shape(layout, slice_dims)
+        dtype = self.raw_dtype(layout)
+        stream = _StdOutStream(_stdout_argv(self), chunk_size)
+        try:
+            for index in np.ndindex(*lead):
+                data = np.empty(tail, dtype=dtype)
+                stream.readinto(data)
+                yield index, data
+            stream.finish()
+        finally:
+            # Also reached if the consumer stops early.
+            if stream.proc.returncode is None:
+                stream.kill()
+
+class ConvertInputSpec(CommandLineInputSpec):
+    input_file = File(
+                    desc='input file for converting',
+                    exists=True,
+                    mandatory=True,
+                    argstr='%s',
+                    position=-2,)
+
+    output_file = File(
+                    desc='output file',
+                    mandatory=True,
+                    genfile=False,
+                    argstr='%s',
+                    position=-1,)
+
+    clobber = traits.Bool(
+                desc='Overwrite existing file.',
+                argstr='-clobber',)
+
+    two = traits.Bool(
+                desc='Create a MINC 2 output file.',
+                argstr='-2',)
+
+    template = traits.Bool(
+                desc='Create a template file.',
+                argstr='-template',)
+
+    compression = traits.Enum(0, 1, 2, 3, 4, 5, 6, 7, 8, 9,
+                            argstr='-compress %s',
+                            desc='Set the compression level, from 0 (disabled) to 9 (maximum).',)
+
+    chunk = traits.Trait(traits.TraitRange(0, None),
+                        desc='Set the target block size for chunking (0 default, >1 block size).',
+                        default=0,
+                        usedefault=False,
+                        argstr='-chunk %d',)
+
+class ConvertOutputSpec(TraitedSpec):
+    # FIXME Am I defining the output spec correctly?
+    output_file = File(
+                    desc='output file',
+                    exists=True,)
+
+class ConvertTask(MincTaskMixin, CommandLine):
+    """
+    Wrap mincconvert.
+
+    Pass profile=True to take compression and chunk from the profile
+    saved by minc_tune (or profile='some/file.json' for another one).
+    Values given explicitly always win over the profile.
+    """
+
+    input_spec  = ConvertInputSpec
+    output_spec = ConvertOutputSpec
+    cmd = 'mincconvert'
+
+    def __init__(self, profile=None, **inputs):
+        super(ConvertTask, self).__init__(**inputs)
+        if profile:
+            self.apply_profile(None if profile is True else profile)
+
+    def apply_profile(self, fname=None):
+        """
+        Set compression and chunk from a saved profile, unless they are
+        already set. Returns the profile, or None if there is none.
+        """
+        profile = load_convert_profile(fname)
+        if profile is None:
+            warn('No MINC conversion profile at %s' % (fname or convert_profile_file(),))
+            return None
+        for name in ('compression', 'chunk'):
+            if profile.get(name) is not None and not isdefined(getattr(self.inputs, name)):
+                setattr(self.inputs, name, profile[name])
+        return profile
+
+    def _list_outputs(self):
+        # FIXME seems generic, is this necessary?
+        outputs = self.output_spec().get()
+        outputs['output_file'] = self.inputs.output_file
+        return outputs
+
+class CopyInputSpec(CommandLineInputSpec):
+    """
+    Implement minccopy? Its man page says:
+
+        NOTE: This program is intended primarily for use with scripts such
+        as mincedit.  It does not follow the typical design rules of most MINC
+        command-line tools and therefore should be  used only with caution.
+
+    It doesn't run on a standard MNC file, e.g.
+
+        $ minccopy /home/carlo/tmp/foo.mnc /tmp/foo_copy.mnc
+        (from miopen): Can't write compressed file
+        ncvarid: ncid -1: NetCDF: Not a valid ID
+
+    """
+
+    input_file = File(
+                    desc='input file to copy',
+                    exists=True,
+                    mandatory=True,
+                    argstr='%s',
+                    position=-2,)
+
+    output_file = File(
+                    desc='output file',
+                    mandatory=True,
+                    genfile=False,
+                    argstr='%s',
+                    position=-1,)
+
+    pixel_values = traits.Bool(
+                desc='Copy pixel values as is.',
+                argstr='-pixel_values',)
+
+    real_values = traits.Bool(
+                desc='Copy real pixel intensities (default).',
+                argstr='-real_values',
+                usedefault=True,)
+
+class CopyOutputSpec(TraitedSpec):
+    # FIXME Am I defining the output spec correctly?
+    output_file = File(
+                    desc='output file',
+                    exists=True,)
+
+class CopyTask(MincTaskMixin, CommandLine):
+    input_spec  = CopyInputSpec
+    output_spec = CopyOutputSpec
+    cmd = 'minccopy'
+
+    def _list_outputs(self):
+        # FIXME seems generic, is this necessary?
+        outputs = self.output_spec().get()
+        outputs['output_file'] = self.inputs.output_file
+        return outputs
+
+class ToEcatInputSpec(CommandLineInputSpec):
+    input_file = File(
+                    desc='input file to convert',
+                    exists=True,
+                    mandatory=True,
+                    argstr='%s',
+                    position=-2,)
+
+    output_file = File(
+                    desc='output file',
+                    mandatory=False,
+                    genfile=True,
+                    argstr='%s',
+                    position=-1,)
+
+    ignore_patient_variable = traits.Bool(
+                    desc='Ignore informations from the minc patient variable.',
+                    argstr='-ignore_patient_variable',)
+
+    ignore_study_variable = traits.Bool(
+                    desc='Ignore informations from the minc study variable.',
+                    argstr='-ignore_study_variable',)
+
+    ignore_acquisition_variable = traits.Bool(
+                    desc='Ignore informations from the minc acquisition variable.',
+                    argstr='-ignore_acquisition_variable',)
+
+    ignore_ecat_acquisition_variable = traits.Bool(
+                    desc='Ignore informations from the minc ecat_acquisition variable.',
+                    argstr='-ignore_ecat_acquisition_variable',)
+
+    ignore_ecat_main = traits.Bool(
+                    desc='Ignore informations from the minc ecat-main variable.',
+                    argstr='-ignore_ecat_main',)
+
+    ignore_ecat_subheader_variable = traits.Bool(
+                    desc='Ignore informations from the minc ecat-subhdr variable.',
+                    argstr='-ignore_ecat_subheader_variable',)
+
+    no_decay_corr_fctr = traits.Bool(
+                    desc='Do not compute the decay correction factors',
+                    argstr='-no_decay_corr_fctr',)
+
+    voxels_as_integers = traits.Bool(
+                    desc='Voxel values are treated as integers, scale and calibration factors are set to unity',
+                    argstr='-label',)
+
+    frames_per_job = traits.Int(
+                    desc='Convert a dynamic series this many frames at a time in a process pool and join the results (minc_ecat.to_ecat).',)
+
+    frame_processes = traits.Int(desc='Size of the process pool for frames_per_job (default: number of CPUs).', requires=('frames_per_job',))
+
+class ToEcatOutputSpec(TraitedSpec):
+    # FIXME Am I defining the output spec correctly?
+    output_file = File(
+                    desc='output file',
+                    exists=True,)
+
+class ToEcatTask(MincTaskMixin, CommandLine):
+    input_spec  = ToEcatInputSpec
+    output_spec = ToEcatOutputSpec
+    cmd = 'minctoecat'
+
+    def _runs_in_process(self):
+        return isdefined(self.inputs.frames_per_job)
+
+    def _execute(self, runtime):
+        if isdefined(self.inputs.frames_per_job):
+            import minc_ecat
+            output_file = self.inputs.output_file
+            if not isdefined(output_file):
+                output_file = self._gen_filename('output_file')
+            minc_ecat.run_task(self.inputs, output_file)
+            runtime.returncode = 0
+            return runtime
+        return super(ToEcatTask, self)._execute(runtime)
+
+    def _list_outputs(self):
+        # FIXME seems generic, is this necessary?
+        outputs = self.output_spec().get()
+        outputs['output_file'] = self.inputs.output_file
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'output_file':
+            return self._scratch_name(os.path.splitext(self.inputs.input_file)[0] + '.v')
+        return None
+
+class DumpInputSpec(StdOutCommandLineInputSpec):
+    """
+    For the MINC command mincdump.
+    """
+
+    input_file = File(
+                    desc='input file',
+                    exists=True,
+                    mandatory=True,
+                    argstr='%s',
+                    position=-2,)
+
+    _xor_coords_or_header = ('coordinate_data', 'header_data',)
+
+    coordinate_data = traits.Bool(
+                    desc='Coordinate variable data and header information',
+                    argstr='-c',
+                    xor=_xor_coords_or_header,)
+
+    header_data = traits.Bool(
+                    desc='Header information only, no data',
+                    argstr='-h',
+                    xor=_xor_coords_or_header,)
+
+    _xor_annotations = ('annotations_brief', 'annotations_full',)
+
+    # FIXME Instead of an enum, make a separate Bool trait called fortran_indices and another
+    # called c_indices?
+
+    annotations_brief = traits.Enum('c', 'f',
+                            argstr='-b %s',
+                            desc='Brief annotations for C or Fortran indices in data',
+                            xor=_xor_annotations)
+
+    annotations_full = traits.Enum('c', 'f',
+                            argstr='-f %s',
+                            desc='Full annotations for C or Fortran indices in data',
+                            xor=_xor_annotations)
+
+    variables = InputMultiPath(
+                            traits.Str,
+                            desc='Output data for specified variables only',
+                            sep=',',
+                            argstr='-v %s',)
+
+    line_length = traits.Trait(traits.TraitRange(0, None),
+                        desc='Line length maximum in data section (default 80)',
+                        default=0,
+                        usedefault=False,
+                        argstr='-l %d',)
+
+    netcdf_name = traits.Str(
+                        desc='Name for netCDF (default derived from file name)',
+                        argstr='-n %s',)
+
+    precision = traits.Either(
+                        traits.Int(),
+                        traits.Tuple(traits.Int, traits.Int),
+                        desc='Display floating-point values with less precision',
+                        argstr='%s',)
+
+class DumpOutputSpec(TraitedSpec):
+    # FIXME Not sure if I'm defining the outout specs correctly.
+
+    output_file = File(
+                    desc='output file',
+                    exists=True,
+                    genfile=True,)
+
+def _format_precision(value):
+    if isinstance(value, int):
+        return '-p %d' % value
+    elif isinstance(value, tuple):
+        return '-p %d,%d' % (value[0], value[1],)
+    else:
+        raise NotImplemented # FIXME some other exception?
+
+class DumpTask(MincTaskMixin, StdOutCommandLine):
+    input_spec  = DumpInputSpec
+    output_spec = DumpOutputSpec
+    cmd = 'mincdump'
+
+    _cache_outputs = ('out_file',)
+
+    # Inputs formatted here rather than by their argstr (minc_argv uses
+    # these too).
+    _arg_formatters = {'precision': _format_precision}
+
+    def _format_arg(self, name, spec, value):
+        if name in self._arg_formatters:
+            return self._arg_formatters[name](value)
+        return super(DumpTask, self)._format_arg(name, spec, value)
+
+    # Output need not go to a file: minc_pipe runs any StdOutCommandLine
+    # task without the redirection, piped into other commands or Python.
+    def _gen_outfilename(self):
+        """
+        Dump foo.mnc to foo.txt (in scratch, if there is one).
+        """
+        return self._scratch_name(os.path.splitext(self.inputs.input_file)[0] + '.txt')
+
+    def header(self, backend='auto'):
+        """
+        The header of the input file as a minc_header.MincHeader, parsed
+        from mincdump -h read straight from the pipe (or through HDF5
+        for MINC2, see minc_header.read_header). The other inputs are
+        ignored.
+        """
+        import minc_header
+        return minc_header.read_header(self.inputs.input_file, backend)
+
+    def iter_variables(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Run mincdump with the current inputs and yield (name, value) for
+        each variable in its data section, parsed into numpy arrays (see
+        minc_dump) straight from the pipe. Nothing is written to
+        out_file, and the text is never held in memory beyond chunk_size
+        bytes.
+        """
+        import minc_dump
+        self._check_mandatory_inputs()
+        return minc_dump.iter_variables(_stdout_argv(self), chunk_size)
+
+    def to_arrays(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        iter_variables() collected into an OrderedDict.
+        """
+        from collections import OrderedDict
+        return OrderedDict(self.iter_variables(chunk_size))
+
+class AverageInputSpec(CommandLineInputSpec):
+    _xor_input_files = ('input_files', 'foo',)
+
+    input_files = InputMultiPath(
+                    traits.File,
+                    desc='input file(s) for averaging',
+                    exists=True,
+                    mandatory=True,
+                    xor=_xor_input_files,
+                    sep=' ', # FIXME test with files that contain spaces - does InputMultiPath do the right thing?
+                    argstr='%s',
+                    position=-2,) # FIXME test with multiple files, is order ok?
+
+    output_file = File(
+                    desc='output file',
+                    mandatory=True,
+                    genfile=False,
+                    argstr='%s',
+                    position=-1,)
+
+    two = traits.Bool(desc='Produce a MINC 2.0 format output file', argstr='-2')
+
+    _xor_clobber = ('clobber', 'no_clobber')
+
+    clobber     = traits.Bool(desc='Overwrite existing file.',                  argstr='-clobber',      xor=_xor_clobber)
+    no_clobber  = traits.Bool(desc='Don\'t overwrite existing file (default).', argstr='-noclobber',    xor=_xor_clobber)
+
+    _xor_verbose = ('verbose', 'quiet',)
+
+    verbose = traits.Bool(desc='Print out log messages (default).', argstr='-verbose',  xor=_xor_verbose)
+    quiet   = traits.Bool(desc='Do not print out log messages.',    argstr='-quiet',    xor=_xor_verbose)
+
+    debug   = traits.Bool(desc='Print out debugging messages.', argstr='-debug')
+
+    # FIXME How to handle stdin option here? Not relevant?
+    foo = traits.File(desc='Specify the name of a file containing input file names (- for stdin).', argstr='-filelist %s', xor=_xor_input_files,)
+
+    _xor_check_dimensions = ('check_dimensions', 'no_check_dimensions',)
+
+    check_dimensions    = traits.Bool(desc='Check that dimension info matches across files (default).', argstr='-check_dimensions',     xor=_xor_check_dimensions)
+    no_check_dimensions = traits.Bool(desc='Do not check dimension info.',                              argstr='-nocheck_dimensions',   xor=_xor_check_dimensions)
+
+
+    # FIXME mincaverage seems to accept more than one of these options; I assume
+    # that it takes the last one, and it makes more sense for these to be
+    # put into an xor case.
+
+    _xor_format = ('format_filetype', 'format_byte', 'format_short',
+                   'format_int', 'format_long', 'format_float', 'format_double',
+                   'format_signed', 'format_unsigned',)
+
+    format_filetype     = traits.Bool(desc='Use data type of first file (default).',                    argstr='-filetype', xor=_xor_format)
+    format_byte         = traits.Bool(desc='Write out byte data.',                                      argstr='-byte',     xor=_xor_format)
+    format_short        = traits.Bool(desc='Write out short integer data.',                             argstr='-short',    xor=_xor_format)
+    format_int          = traits.Bool(desc='Write out 32-bit integer data.',                            argstr='-int',      xor=_xor_format)
+    format_long         = traits.Bool(desc='Superseded by -int.',                                       argstr='-long',     xor=_xor_format)
+    format_float        = traits.Bool(desc='Write out single-precision floating-point data.',           argstr='-float',    xor=_xor_format)
+    format_double       = traits.Bool(desc='Write out double-precision floating-point data.',           argstr='-double',   xor=_xor_format)
+    format_signed       = traits.Bool(desc='Write signed integer data.',                                argstr='-signed',   xor=_xor_format)
+    format_unsigned     = traits.Bool(desc='Write unsigned integer data (default if type specified).',  argstr='-unsigned', xor=_xor_format) # FIXME mark with default=?
+
+
+    max_buffer_size_in_kb = traits.Trait(traits.TraitRange(0, None),
+                                desc='Specify the maximum size of the internal buffers (in kbytes).',
+                                default=4096, # FIXME is this doing what I think it's doing? Write some tests.
+                                usedefault=False,
+                                argstr='-max_buffer_size_in_kb %d',)
+
+    _xor_normalize = ('normalize', 'nonormalize',)
+    normalize   = traits.Bool(desc='Normalize data sets for mean intensity.', argstr='-normalize', xor=_xor_normalize)
+    nonormalize = traits.Bool(desc='Do not normalize data sets (default).',   argstr='-nonormalize', xor=_xor_normalize, default=True) # FIXME check default=? behaviour
+
+    voxel_range = traits.Tuple(
+                traits.Int, traits.Int, argstr='-range %d %d',
+                desc='Valid range for output data.',)
+
+    sdfile = traits.File(
+                desc='Specify an output sd file (default=none).',
+                argstr='-sdfile %s',)
+
+    _xor_copy_header = ('copy_header', 'no_copy_header',)
+
+    copy_header     = traits.Bool(desc='Copy all of the header from the first file (default for one file).',            argstr='-copy_header',   xor=_xor_copy_header)
+    no_copy_header  = traits.Bool(desc='Do not copy all of the header from the first file (default for many files)).',  argstr='-nocopy_header', xor=_xor_copy_header)
+
+    avgdim = traits.Str(desc='Specify a dimension along which we wish to average.', argstr='-avgdim %s')
+
+    binarize = traits.Bool(desc='Binarize the volume by looking for values in a given range.', argstr='-binarize')
+
+    binrange = traits.Tuple(
+                traits.Float, traits.Float, argstr='-binrange %s %s',
+                desc='Specify a range for binarization. Default value: 1.79769e+308 -1.79769e+308.') # FIXME shouldn't that be -1.79769e+308 1.79769e+308? Min then max?
+
+    binvalue = traits.Float(desc='Specify a target value (+/- 0.5) for binarization. Default value: -1.79769e+308', argstr='-binvalue %s')
+		
+    weights = InputMultiPath(
+                            traits.Str,
+                            desc='Specify weights for averaging ("<w1>,<w2>,...").',
+                            sep=',',
+                            argstr='-weights %s',)
+
+    width_weighted = traits.Bool(desc='Weight by dimension widths when -avgdim is used.', argstr='-width_weighted', requires=('avgdim',))
+
+    engine = traits.Enum('binary', 'numpy',
+                desc='Run mincaverage (binary), or average in-process with minc_average (numpy).',
+                usedefault=True,)
+
+    tree_shard_size = traits.Int(
+                desc='Average shards of this many files in a process pool and combine them in a reduction tree (minc_average.tree_average).',)
+
+    tree_fanin = traits.Int(desc='Number of shards merged at each node of the reduction tree (default 2).', requires=('tree_shard_size',))
+
+    tree_processes = traits.Int(desc='Size of the process pool for tree mode (default: number of CPUs).', requires=('tree_shard_size',))
+
+    check_geometry = traits.Bool(
+                desc='Before averaging, read the headers of all inputs in parallel and fail unless they match the geometry of the first (minc_header.check_geometry).',)
+
+    stats_prefix = File(
+                desc='Keep the running statistics of the average in <stats_prefix>.json and .npy files, and on later runs read only the inputs added or removed since (minc_average.Cohort). Cannot be used with normalize.',
+                xor=('tree_shard_size',),)
+
+class AverageOutputSpec(TraitedSpec):
+    # FIXME Am I defining the output spec correctly?
+    output_file = File(
+                    desc='output file',
+                    exists=True,)
+
+class AverageTask(MincTaskMixin, CommandLine):
+    input_spec  = AverageInputSpec
+    output_spec = AverageOutputSpec
+    cmd = 'mincaverage'
+
+    _cache_inputs = ('input_files', 'foo',)
+    _cache_outputs = ('output_file', 'sdfile',)
+    _stage_inputs = ('input_files',)
+
+    def _cache_input_paths(self):
+        import minc_average
+        return minc_average.input_file_list(self.inputs)
+
+    def _precheck(self):
+        if self.inputs.check_geometry is True and self.inputs.no_check_dimensions is not True:
+            import minc_average
+            import minc_header
+            minc_header.check_geometry(minc_average.input_file_list(self.inputs))
+
+    def _runs_in_process(self):
+        inputs = self.inputs
+        return (isdefined(inputs.stats_prefix) or isdefined(inputs.tree_shard_size)
+                or inputs.engine != 'binary')
+
+    def _execute(self, runtime):
+        if isdefined(self.inputs.stats_prefix):
+            import minc_average
+            minc_average.run_task_incremental(self.inputs)
+            runtime.returncode = 0
+            return runtime
+        if isdefined(self.inputs.tree_shard_size):
+            import minc_average
+            minc_average.run_task_tree(self.inputs)
+            runtime.returncode = 0
+            return runtime
+        if self.inputs.engine == 'numpy':
+            import minc_average
+            minc_average.run_task(self.inputs)
+            runtime.returncode = 0
+            return runtime
+        return super(AverageTask, self)._execute(runtime)
+
+    def _list_outputs(self):
+        # FIXME seems generic, is this necessary?
+        outputs = self.output_spec().get()
+        outputs['output_file'] = self.inputs.output_file
+        return outputs
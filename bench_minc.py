@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: benchmarks for every Task class, on synthetic MINC volumes.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Usage:
+#
+#     python bench_minc.py [--quick] [--history bench_history.jsonl]
+#                          [--baseline previous|<run id>|<file.json>]
+#     python bench_minc.py --cmdlines 100000
+#     python bench_minc.py --ecat-frames 8,16,32 [--processes 4]
+#
+# Fixtures are generated locally (with h5py, or rawtominc if h5py is
+# missing) over a range of sizes, datatypes and dimensionalities. Each
+# case runs in a forked child so that its peak RSS, CPU time (including
+# that of the MINC tool it starts) and wall time are its own. The time
+# to build the command line is measured separately from the run, so a
+# regression in the Python wrapper is not hidden by the tool.
+#
+# Every run is appended as one JSON line to the history file; --baseline
+# compares this run with an earlier one and lists the cases that got
+# slower than --threshold.
+#
+# The time to import minc and a few other modules in a fresh interpreter
+# is recorded with the cases (task 'import'; --task import selects just
+# these), so that a change that makes them pull in nipype again shows up
+# as a regression.
+#
+# --cmdlines N instead times building N command lines per Task class,
+# through the Tasks and with minc_argv.
+#
+# --ecat-frames 8,16,32 instead times ToEcatTask on a 4D series of each
+# number of frames, serially and frame-parallel (minc_ecat), and checks
+# that the two outputs are byte-identical.
+
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import minc
+import minc_io
+from minc import _which
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HISTORY_VERSION = 1
+
+SIZES = [('small',  (16, 16, 16)),
+         ('medium', (64, 64, 64)),
+         ('large',  (128, 128, 128)),
+        ]
+
+DTYPES = ['uint8', 'int16', 'float32']
+
+# (vartype, signtype) for rawtominc, when h5py is not available.
+_raw_types = {'uint8':      ('byte', 'unsigned'),
+              'int16':      ('short', 'signed'),
+              'float32':    ('float', None),
+             }
+
+FRAMES = 5
+
+class Fixture(object):
+    def __init__(self, name, fname, shape, dtype):
+        self.name = name
+        self.fname = fname
+        self.shape = shape
+        self.dtype = dtype
+
+    @property
+    def nbytes(self):
+        return os.path.getsize(self.fname)
+
+def _write_fixture(fname, data, dtype):
+    if minc_io.available():
+        minc_io.write_minc2(fname, data, dtype=dtype)
+        return
+    if _which('rawtominc') is None:
+        raise RuntimeError('need h5py or rawtominc to generate fixtures')
+    ndim = data.ndim
+    dimnames = ['zspace', 'yspace', 'xspace'] if ndim == 3 else ['time', 'zspace', 'yspace', 'xspace']
+    vartype, signtype = _raw_types[dtype]
+    w = minc_io.RawToMincWriter(fname, dimnames, data.shape, vartype=vartype,
+                                signtype=signtype, two=True, clobber=True)
+    try:
+        for i in range(data.shape[0]):
+            w.write(data[i:i + 1])
+        w.close()
+    except:
+        w.abort()
+        raise
+
+def make_fixtures(workdir, sizes=SIZES, dtypes=DTYPES, frames=FRAMES):
+    """
+    Smooth random volumes, one per (size, dtype), plus a 4D series of
+    frames volumes per size in the first dtype.
+    """
+    if np is None:
+        raise ImportError('numpy is required to generate fixtures')
+    rng = np.random.RandomState(0)
+    fixtures = []
+    for (size, shape) in sizes:
+        base = rng.uniform(0, 1000, size=shape)
+        for dtype in dtypes:
+            name = '%s-3d-%s' % (size, dtype,)
+            fname = os.path.join(workdir, name + '.mnc')
+            _write_fixture(fname, base, dtype)
+            fixtures.append(Fixture(name, fname, shape, dtype))
+
+        shape4 = (frames,) + shape
+        name = '%s-4d-%s' % (size, dtypes[0],)
+        fname = os.path.join(workdir, name + '.mnc')
+        _write_fixture(fname, rng.uniform(0, 1000, size=shape4), dtypes[0])
+        fixtures.append(Fixture(name, fname, shape4, dtypes[0]))
+    return fixtures
+
+class Case(object):
+    """
+    One benchmark: build(fixture, outdir) returns a Task; run(task)
+    runs it and returns the number of bytes it produced. tool is the
+    MINC binary it needs, if any; hdf5 is whether it needs h5py.
+    """
+
+    def __init__(self, task, backend, build, run, tool=None, hdf5=False):
+        self.task = task
+        self.backend = backend
+        self.build = build
+        self.run = run
+        self.tool = tool
+        self.hdf5 = hdf5
+
+    def missing(self):
+        if self.tool is not None and _which(self.tool) is None:
+            return self.tool
+        if self.hdf5 and not minc_io.available():
+            return 'h5py'
+        return None
+
+def _out(outdir, suffix='.mnc'):
+    fd, fname = tempfile.mkstemp(dir=outdir, suffix=suffix)
+    os.close(fd)
+    os.remove(fname)
+    return fname
+
+def _run_task(task):
+    runtime = task.run().runtime
+    if runtime.returncode != 0:
+        raise RuntimeError('%s failed (exit code %s): %s'
+                           % (task.cmdline, runtime.returncode, runtime.stderr,))
+    out = task._list_outputs()
+    fname = out.get('output_file') or out.get('out_file')
+    return os.path.getsize(fname) if fname and os.path.exists(fname) else 0
+
+AVERAGE_INPUTS = 4
+
+def cases():
+    toraw = lambda fx, d: minc.ToRawTask(input_file=fx.fname, nonormalize=True, out_file=_out(d, '.raw'))
+    dump = lambda fx, d: minc.DumpTask(input_file=fx.fname, header_data=True, out_file=_out(d, '.cdl'))
+    average = lambda engine: lambda fx, d: minc.AverageTask(input_files=[fx.fname] * AVERAGE_INPUTS,
+                                                            output_file=_out(d), clobber=True,
+                                                            engine=engine)
+
+    return [Case('ToRawTask', 'file', toraw, _run_task, tool='minctoraw'),
+            Case('ToRawTask', 'pipe', toraw,
+                 lambda t: t.to_array(backend='subprocess').nbytes, tool='minctoraw'),
+            Case('ToRawTask', 'hdf5', toraw,
+                 lambda t: t.to_array(backend='hdf5').nbytes, hdf5=True),
+            Case('ConvertTask', 'binary',
+                 lambda fx, d: minc.ConvertTask(input_file=fx.fname, output_file=_out(d),
+                                                two=True, clobber=True),
+                 _run_task, tool='mincconvert'),
+            Case('CopyTask', 'binary',
+                 lambda fx, d: minc.CopyTask(input_file=fx.fname, output_file=_out(d)),
+                 _run_task, tool='minccopy'),
+            Case('ToEcatTask', 'binary',
+                 lambda fx, d: minc.ToEcatTask(input_file=fx.fname, output_file=_out(d, '.v')),
+                 _run_task, tool='minctoecat'),
+            Case('DumpTask', 'binary', dump, _run_task, tool='mincdump'),
+            Case('DumpTask', 'hdf5', dump,
+                 lambda t: len(json.dumps(t.header(backend='hdf5').to_dict())), hdf5=True),
+            Case('AverageTask', 'binary', average('binary'), _run_task, tool='mincaverage'),
+            Case('AverageTask', 'numpy', average('numpy'), _run_task, tool='rawtominc', hdf5=True),
+           ]
+
+def cmdline_seconds(task, repeats=100):
+    """
+    Mean time to build task.cmdline.
+    """
+    t0 = time.time()
+    for _ in range(repeats):
+        task.cmdline
+    return (time.time() - t0) / repeats
+
+# Modules whose import time is tracked, and the child that measures one.
+IMPORT_MODULES = ['minc', 'minc_cli', 'minc_io', 'minc_argv']
+
+_IMPORT_PROBE = """
+import json, os, resource, sys, time
+t0 = time.time()
+c0 = os.times()
+import %s
+c1 = os.times()
+print json.dumps({'wall_seconds': time.time() - t0, 'cpu_seconds': sum(c1[:2]) - sum(c0[:2]),
+                  'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'nipype': 'nipype' in sys.modules})
+"""
+
+def import_result(module, repeats=5):
+    """
+    Time to import module in a fresh interpreter (the best of repeats),
+    as a result record with task 'import'.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = {'task': 'import', 'backend': module, 'fixture': '-', 'shape': [], 'dtype': None,
+              'cmdline_seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0}
+    try:
+        runs = [json.loads(subprocess.check_output([sys.executable, '-c', _IMPORT_PROBE % module], cwd=here))
+                for _ in range(repeats)]
+    except subprocess.CalledProcessError as e:
+        result.update(status='failed', error=str(e))
+        return result
+    best = min(runs, key=lambda r: r['wall_seconds'])
+    result.update(best, status='ok')
+    return result
+
+def import_results(modules=IMPORT_MODULES, progress=None):
+    results = []
+    for module in modules:
+        results.append(import_result(module))
+        if progress is not None:
+            progress(results[-1])
+    return results
+
+def cmdline_batch_seconds(task_class, batch):
+    """
+    Seconds to render the command lines for batch (a list of input
+    dicts) by building each Task, and with minc_argv.
+    """
+    import minc_argv
+    t0 = time.time()
+    expected = [task_class(**params).cmdline for params in batch]
+    t1 = time.time()
+    got = minc_argv.cmdlines(task_class, batch)
+    t2 = time.time()
+    if got != expected:
+        raise AssertionError('minc_argv disagrees with %s.cmdline' % task_class.__name__)
+    return {'task': t1 - t0, 'minc_argv': t2 - t1}
+
+def _child(case, fixture, outdir, conn):
+    try:
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        task = case.build(fixture, outdir)
+        cmdline = cmdline_seconds(task)
+
+        t0 = time.time()
+        c0 = os.times()
+        bytes_out = case.run(task)
+        c1 = os.times()
+        wall = time.time() - t0
+
+        rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        n_in = AVERAGE_INPUTS if case.task == 'AverageTask' else 1
+        conn.send({'status':            'ok',
+                   'wall_seconds':      wall,
+                   'cpu_seconds':       sum(c1[:4]) - sum(c0[:4]),
+                   'cmdline_seconds':   cmdline,
+                   'peak_rss_kb':       max(rss_self, rss_children),
+                   'start_rss_kb':      rss_start,
+                   'bytes_in':          fixture.nbytes * n_in,
+                   'bytes_out':         bytes_out,
+                  })
+    except Exception:
+        conn.send({'status': 'failed', 'error': traceback.format_exc()})
+    finally:
+        conn.close()
+
+def measure(case, fixture, outdir):
+    """
+    Run one case in a forked child and return its measurements.
+    """
+    result = {'task': case.task, 'backend': case.backend, 'fixture': fixture.name,
+              'shape': list(fixture.shape), 'dtype': fixture.dtype}
+
+    missing = case.missing()
+    if missing is not None:
+        result.update(status='skipped', error='%s not available' % missing)
+        return result
+
+    parent, child = multiprocessing.Pipe(duplex=False)
+    p = multiprocessing.Process(target=_child, args=(case, fixture, outdir, child))
+    p.start()
+    child.close()
+    try:
+        result.update(parent.recv())
+    except EOFError:
+        result.update(status='failed', error='benchmark process died')
+    p.join()
+    return result
+
+def run(fixtures, outdir, selected=None, progress=None):
+    results = []
+    for fixture in fixtures:
+        for case in cases():
+            if selected and case.task not in selected:
+                continue
+            r = measure(case, fixture, outdir)
+            for f in os.listdir(outdir):
+                os.remove(os.path.join(outdir, f))
+            results.append(r)
+            if progress is not None:
+                progress(r)
+    return results
+
+def environment():
+    return {'python':       platform.python_version(),
+            'platform':     platform.platform(),
+            'host':         platform.node(),
+            'minc':         minc.Info.version(),
+            'h5py':         minc_io.available(),
+           }
+
+def append_history(fname, record):
+    with open(fname, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+def read_history(fname):
+    records = []
+    if not os.path.exists(fname):
+        return records
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+def find_baseline(spec, history):
+    """
+    A run record from 'previous' (the last run in the history), a run
+    id in the history, or a JSON file holding one record.
+    """
+    if spec == 'previous':
+        return history[-1] if history else None
+    for record in history:
+        if record['run_id'] == spec:
+            return record
+    if os.path.exists(spec):
+        with open(spec) as f:
+            return json.load(f)
+    raise ValueError('no baseline %r' % spec)
+
+# Differences smaller than these are noise, whatever the ratio.
+METRICS = {'wall_seconds':      0.01,
+           'cpu_seconds':       0.01,
+           'cmdline_seconds':   1e-4,
+           'peak_rss_kb':       1024,
+          }
+
+def _key(r):
+    return (r['task'], r['backend'], r['fixture'])
+
+def compare(results, baseline, threshold=0.25, metrics=METRICS):
+    """
+    (key, metric, old, new) for each metric of each case that grew by
+    more than threshold relative to the baseline run, and by more than
+    the noise floor in METRICS.
+    """
+    old = dict((_key(r), r) for r in baseline['results'] if r.get('status') == 'ok')
+    regressions = []
+    for r in results:
+        b = old.get(_key(r))
+        if b is None or r.get('status') != 'ok':
+            continue
+        for (m, floor) in sorted(metrics.items()):
+            if r[m] > b[m] * (1.0 + threshold) and r[m] - b[m] > floor:
+                regressions.append((_key(r), m, b[m], r[m]))
+    return regressions
+
+def format_result(r):
+    name = '%-12s %-7s %-22s' % (r['task'], r['backend'], r['fixture'],)
+    if r['status'] != 'ok':
+        return '%s %s: %s' % (name, r['status'], r['error'].strip().split('\n')[-1],)
+    mb = (r['bytes_in'] + r['bytes_out']) / 1e6
+    return ('%s wall %8.4fs  cpu %8.4fs  cmdline %7.1fus  rss %7dkB  %8.2fMB'
+            % (name, r['wall_seconds'], r['cpu_seconds'], r['cmdline_seconds'] * 1e6,
+               r['peak_rss_kb'], mb,))
+
+def cmdline_batch_main(n, workdir=None):
+    tmpdir = workdir or tempfile.mkdtemp(prefix='bench-minc-')
+    try:
+        inputs = [os.path.join(tmpdir, 'in%d.mnc' % i) for i in range(10)]
+        for f in inputs:
+            open(f, 'w').close()
+        batches = [(minc.ConvertTask, [dict(input_file=inputs[i % 10], output_file='out%d.mnc' % i,
+                                            two=True, clobber=True, compression=i % 10) for i in range(n)]),
+                   (minc.AverageTask, [dict(input_files=inputs[:1 + i % 10], output_file='avg%d.mnc' % i,
+                                            clobber=True, nonormalize=True, sdfile='sd%d.mnc' % i)
+                                       for i in range(n)]),
+                   (minc.DumpTask, [dict(input_file=inputs[i % 10], precision=(4, 8), variables=['image'],
+                                         out_file='dump%d.txt' % i) for i in range(n)]),
+                  ]
+        for (task_class, batch) in batches:
+            t = cmdline_batch_seconds(task_class, batch)
+            print '%-12s %d cmdlines: Task %.3fs, minc_argv %.3fs (%.0fx)' \
+                  % (task_class.__name__, n, t['task'], t['minc_argv'], t['task'] / max(t['minc_argv'], 1e-9),)
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return 0
+
+def ecat_speedup(fname, outdir, frames_per_job=None, processes=None):
+    """
+    Convert fname with ToEcatTask serially and frame-parallel; returns
+    the wall times, the speed-up and whether the outputs are the same.
+    """
+    serial, parallel = _out(outdir, '.v'), _out(outdir, '.v')
+    if frames_per_job is None:
+        # The frames split evenly over the pool.
+        layout = minc.image_layout(fname)
+        nframes = layout.shape[layout.dimnames.index('time')]
+        frames_per_job = -(-nframes // (processes or multiprocessing.cpu_count()))
+    kwargs = {'frames_per_job': frames_per_job}
+    if processes is not None:
+        kwargs['frame_processes'] = processes
+    try:
+        t0 = time.time()
+        _run_task(minc.ToEcatTask(input_file=fname, output_file=serial))
+        t1 = time.time()
+        _run_task(minc.ToEcatTask(input_file=fname, output_file=parallel, **kwargs))
+        t2 = time.time()
+        with open(serial, 'rb') as a:
+            with open(parallel, 'rb') as b:
+                identical = a.read() == b.read()
+    finally:
+        for f in (serial, parallel):
+            if os.path.exists(f):
+                os.remove(f)
+    return {'serial_seconds':   t1 - t0,
+            'parallel_seconds': t2 - t1,
+            'speedup':          (t1 - t0) / max(t2 - t1, 1e-9),
+            'identical':        identical,
+           }
+
+def ecat_main(frame_counts, processes=None, workdir=None):
+    if np is None:
+        raise ImportError('numpy is required to generate fixtures')
+    tmpdir = workdir or tempfile.mkdtemp(prefix='bench-minc-')
+    status = 0
+    try:
+        rng = np.random.RandomState(0)
+        shape = SIZES[1][1]
+        for n in frame_counts:
+            fname = os.path.join(tmpdir, 'ecat-%d.mnc' % n)
+            _write_fixture(fname, rng.uniform(0, 1000, size=(n,) + shape), 'int16')
+            r = ecat_speedup(fname, tmpdir, processes=processes)
+            print '%4d frames: serial %.2fs, parallel %.2fs (%.1fx), %s' \
+                  % (n, r['serial_seconds'], r['parallel_seconds'], r['speedup'],
+                     'identical' if r['identical'] else 'OUTPUTS DIFFER',)
+            sys.stdout.flush()
+            if not r['identical']:
+                status = 1
+            os.remove(fname)
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return status
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the MINC Task classes.')
+    parser.add_argument('--quick', action='store_true', help='small fixtures only')
+    parser.add_argument('--task', action='append', help="only benchmark this Task class ('import' for import times)")
+    parser.add_argument('--history', default='bench_history.jsonl', help='JSON lines file of runs')
+    parser.add_argument('--baseline', help="'previous', a run id from the history, or a JSON file")
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown fraction')
+    parser.add_argument('--workdir', help='where to put fixtures (default: a temporary directory)')
+    parser.add_argument('--cmdlines', type=int, metavar='N',
+                        help='only time rendering N command lines per Task class, with and without minc_argv')
+    parser.add_argument('--ecat-frames', metavar='N,N,...',
+                        help='only time serial against frame-parallel ToEcatTask for these frame counts')
+    parser.add_argument('--processes', type=int, help='process pool size for --ecat-frames')
+    args = parser.parse_args(argv)
+
+    if args.cmdlines:
+        return cmdline_batch_main(args.cmdlines, args.workdir)
+    if args.ecat_frames:
+        return ecat_main([int(n) for n in args.ecat_frames.split(',')], args.processes, args.workdir)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench-minc-')
+    outdir = os.path.join(workdir, 'out')
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    try:
+        sizes = SIZES[:1] if args.quick else SIZES
+        fixtures = make_fixtures(workdir, sizes=sizes)
+
+        def progress(r):
+            print format_result(r)
+            sys.stdout.flush()
+
+        results = []
+        if not args.task or 'import' in args.task:
+            results += import_results(progress=progress)
+        results += run(fixtures, outdir, args.task, progress)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    history = read_history(args.history)
+    baseline = find_baseline(args.baseline, history) if args.baseline else None
+
+    record = {'history_version':    HISTORY_VERSION,
+              'run_id':             time.strftime('%Y%m%dT%H%M%S') + '-%d' % os.getpid(),
+              'time':               time.time(),
+              'environment':        environment(),
+              'results':            results,
+             }
+    append_history(args.history, record)
+    print 'run %s appended to %s' % (record['run_id'], args.history,)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for (key, metric, old, new) in regressions:
+            print 'REGRESSION %s %s: %g -> %g' % (' '.join(key), metric, old, new,)
+        if regressions:
+            return 1
+        print 'no regressions against %s' % baseline['run_id']
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,18 +7,27 @@
 
 # TODO Check exit-code behaviour of minc commands.
 
-from nipype.interfaces.base import (
-    TraitedSpec,
-    CommandLineInputSpec,
-    CommandLine,
-    StdOutCommandLineInputSpec,
-    StdOutCommandLine,
-    File,
-    InputMultiPath,
-    traits,
-)
-
+# The Task classes need nipype, which takes most of a second to import,
+# so they live in _minc_tasks and this module loads it the first time
+# one of them is used (see _LazyModule at the end). Info, check_minc(),
+# image_layout() and the other helpers here work without nipype.
+
+import hashlib
+import io
+import json
 import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import types
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import warnings
 warn = warnings.warn
@@ -30,543 +39,540 @@ def check_minc():
 def no_minc():
     return not check_minc()
 
-class Info(object):
-    """Handle MINC version information.
+# Binaries wrapped by the Task classes below. Their command-line flags are
+# recorded by the toolchain probe so that capability checks are free.
+WRAPPED_COMMANDS = ['mincconvert', 'minctoraw', 'minccopy', 'minctoecat',
+                    'mincdump', 'mincaverage',]
 
-    version refers to the version of MINC on the system
+PROBE_CACHE_VERSION = 1
 
+def _which(cmd, path=None):
+    """
+    Resolve cmd against path (default $PATH), like which(1). Returns
+    the real path of the first executable match or None.
+    """
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+    for d in path.split(os.pathsep):
+        candidate = os.path.join(d, cmd)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.realpath(candidate)
+    return None
+
+def _parse_version(out):
+    """
+    Parse the output of 'mincinfo -version'.
     """
 
-    @staticmethod
-    def version():
-        """Check for minc version on the system
+    def read_program_version(s):
+        if 'program' in s:
+            return s.split(':')[1].strip()
+        return None
 
-        Parameters
-        ----------
-        None
+    def read_libminc_version(s):
+        if 'libminc' in s:
+            return s.split(':')[1].strip()
+        return None
 
-        Returns
-        -------
-        version : str
-           Version number as string or None if MINC not found
+    def read_netcdf_version(s):
+        if 'netcdf' in s:
+            return ' '.join(s.split(':')[1:]).strip()
+        return None
 
-        """
-        try:
-            clout = CommandLine(command='mincinfo',
-                                args='-version',
-                                terminal_output='allatonce').run()
-        except IOError:
-            return None
+    def read_hdf5_version(s):
+        if 'HDF5' in s:
+            return s.split(':')[1].strip()
+        return None
 
-        out = clout.runtime.stdout
+    versions = {'minc':    None,
+                'libminc': None,
+                'netcdf':  None,
+                'hdf5':    None,
+               }
 
-        def read_program_version(s):
-            if 'program' in s:
-                return s.split(':')[1].strip()
-            return None
+    for l in out.split('\n'):
+        for (name, f) in [('minc',      read_program_version),
+                          ('libminc',   read_libminc_version),
+                          ('netcdf',    read_netcdf_version),
+                          ('hdf5',      read_hdf5_version),
+                         ]:
+            if f(l) is not None: versions[name] = f(l)
 
-        def read_libminc_version(s):
-            if 'libminc' in s:
-                return s.split(':')[1].strip()
-            return None
+    return versions
 
-        def read_netcdf_version(s):
-            if 'netcdf' in s:
-                return ' '.join(s.split(':')[1:]).strip()
-            return None
+_flag_re = re.compile(r'(?:^|[\s\[|(])(-[A-Za-z0-9][A-Za-z0-9_]*)(?=[\s:,|\]]|$)', re.M)
 
-        def read_hdf5_version(s):
-            if 'HDF5' in s:
-                return s.split(':')[1].strip()
-            return None
+def _parse_flags(out):
+    """
+    Pull the set of flags out of the help text of a MINC command. This
+    copes with both the ParseArgv layout used by most tools
+
+        -clobber:       Overwrite existing file.
 
-        versions = {'minc':    None,
-                    'libminc': None,
-                    'netcdf':  None,
-                    'hdf5':    None,
-                   }
+    and the getopt usage line printed by mincdump
 
-        for l in out.split('\n'):
-            for (name, f) in [('minc',      read_program_version),
-                              ('libminc',   read_libminc_version),
-                              ('netcdf',    read_netcdf_version),
-                              ('hdf5',      read_hdf5_version),
-                             ]:
-                if f(l) is not None: versions[name] = f(l)
+        mincdump [-c|-h] [-v var1[,...]] [-b lang] ... file
 
-        return versions
+    """
+    return sorted(set(_flag_re.findall(out)))
 
-class ToRawInputSpec(StdOutCommandLineInputSpec):
+def _run_for_output(argv):
     """
-    For the MINC command minctoraw.
+    Run argv and return its combined stdout/stderr, or None if it
+    could not be started. Exit codes are ignored: most MINC tools exit
+    non-zero after printing their help.
     """
+    try:
+        proc = subprocess.Popen(argv,
+                                stdin=open(os.devnull),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    except OSError:
+        return None
+    out, _ = proc.communicate()
+    return out.decode('utf-8', 'replace')
 
-    input_file = File(
-                    desc='input file',
-                    exists=True,
-                    mandatory=True,
-                    argstr='%s',
-                    position=-2,)
+class Info(object):
+    """Handle MINC version information.
 
-    write_byte = traits.Bool(
-                desc='Write out data as bytes',
-                argstr='-byte',)
+    version refers to the version of MINC on the system
 
-    write_short = traits.Bool(
-                desc='Write out data as short integers',
-                argstr='-short',)
+    The toolchain is probed at most once per process. The result of the
+    probe (versions, plus the flags accepted by each of the wrapped
+    commands) is also persisted in a small JSON file, keyed by the
+    resolved path of mincinfo, its mtime and $PATH, so that later
+    processes do not need to fork anything at all. Set
+    $MINC_PROBE_CACHE_DIR to move the cache, or to an empty string to
+    disable it.
 
-    write_int = traits.Bool(
-                desc='Write out data as 32-bit integers',
-                argstr='-int',)
+    """
 
-    write_long = traits.Bool(
-                desc='Superseded by -int',
-                argstr='-long',)
+    _probe = None
+    _probe_key = None
 
-    write_float = traits.Bool(
-                desc='Write out data as single precision floating-point values',
-                argstr='-float',)
+    @staticmethod
+    def cache_dir():
+        d = os.environ.get('MINC_PROBE_CACHE_DIR')
+        if d is None:
+            d = os.path.join(os.path.expanduser('~'), '.cache', 'nipype-minc')
+        return d
 
-    write_double = traits.Bool(
-                desc='Write out data as double precision floating-point values',
-                argstr='-double',)
+    @staticmethod
+    def _key():
+        path = os.environ.get('PATH', os.defpath)
+        mincinfo = _which('mincinfo', path)
 
-    write_signed = traits.Bool(
-                desc='Write out signed data',
-                argstr='-signed',)
+        if mincinfo is None:
+            return None, None
 
-    write_unsigned = traits.Bool(
-                desc='Write out unsigned data',
-                argstr='-unsigned',)
+        mtime = os.stat(mincinfo).st_mtime
+        h = hashlib.sha1()
+        h.update(repr((PROBE_CACHE_VERSION, mincinfo, mtime, path)).encode('utf-8'))
+        return mincinfo, h.hexdigest()
 
-    write_range = traits.Tuple(
-                traits.Float, traits.Float, argstr='-range %s %s',
-                desc='Specify the range of output values\nDefault value: 1.79769e+308 1.79769e+308',) # FIXME minctoraw output is missing a negative?
+    @staticmethod
+    def _cache_file(key):
+        d = Info.cache_dir()
+        if not d:
+            return None
+        return os.path.join(d, 'probe-%s.json' % key)
 
-    _xor_normalize = ('normalize', 'nonormalize',)
+    @staticmethod
+    def _load(key):
+        fname = Info._cache_file(key)
+        if fname is None:
+            return None
+        try:
+            with open(fname) as f:
+                probe = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if probe.get('cache_version') != PROBE_CACHE_VERSION:
+            return None
+        return probe
 
-    normalize = traits.Bool(
-                    desc='Normalize integer pixel values to file max and min',
-                    argstr='-normalize',
-                    xor=_xor_normalize,
-                    mandatory=True)
+    @staticmethod
+    def _save(key, probe):
+        fname = Info._cache_file(key)
+        if fname is None:
+            return
+        try:
+            d = os.path.dirname(fname)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            # Write then rename so that concurrent workers never see a
+            # half-written file.
+            fd, tmp = tempfile.mkstemp(dir=d, prefix='.probe-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(probe, f, indent=1, sort_keys=True)
+            os.rename(tmp, fname)
+        except (IOError, OSError) as e:
+            warn('Could not save MINC toolchain probe to %s: %s' % (fname, e,))
 
-    nonormalize = traits.Bool(
-                    desc='Turn off pixel normalization',
-                    argstr='-nonormalize',
-                    xor=_xor_normalize,
-                    mandatory=True)
+    @staticmethod
+    def _run_probe(mincinfo):
+        bindir = os.path.dirname(mincinfo)
 
-class ToRawOutputSpec(TraitedSpec):
-    # FIXME Not sure if I'm defining the outout specs correctly.
+        out = _run_for_output([mincinfo, '-version'])
+        if out is None:
+            return None
 
-    output_file = File(
-                    desc='output file',
-                    exists=True,
-                    genfile=True,)
+        flags = {}
+        for cmd in WRAPPED_COMMANDS:
+            # Prefer the binary that sits next to mincinfo so that the
+            # flags match the toolchain we got the version from.
+            exe = os.path.join(bindir, cmd)
+            if not os.access(exe, os.X_OK):
+                exe = _which(cmd)
+            if exe is None:
+                flags[cmd] = None
+                continue
+            help_out = _run_for_output([exe, '-help'])
+            flags[cmd] = None if help_out is None else _parse_flags(help_out)
+
+        return {'cache_version':    PROBE_CACHE_VERSION,
+                'mincinfo':         mincinfo,
+                'versions':         _parse_version(out),
+                'flags':            flags,
+               }
 
-class ToRawTask(StdOutCommandLine):
-    input_spec  = ToRawInputSpec
-    output_spec = ToRawOutputSpec
-    cmd = 'minctoraw'
+    @staticmethod
+    def probe():
+        """Probe the MINC toolchain on the system.
 
-    def _gen_outfilename(self):
-        """
-        Convert foo.mnc to foo.raw.
-        """
-        return os.path.splitext(self.inputs.input_file)[0] + '.raw'
-
-class ConvertInputSpec(CommandLineInputSpec):
-    input_file = File(
-                    desc='input file for converting',
-                    exists=True,
-                    mandatory=True,
-                    argstr='%s',
-                    position=-2,)
-
-    output_file = File(
-                    desc='output file',
-                    mandatory=True,
-                    genfile=False,
-                    argstr='%s',
-                    position=-1,)
-
-    clobber = traits.Bool(
-                desc='Overwrite existing file.',
-                argstr='-clobber',)
-
-    two = traits.Bool(
-                desc='Create a MINC 2 output file.',
-                argstr='-2',)
-
-    template = traits.Bool(
-                desc='Create a template file.',
-                argstr='-template',)
-
-    compression = traits.Enum(0, 1, 2, 3, 4, 5, 6, 7, 8, 9,
-                            argstr='-compress %s',
-                            desc='Set the compression level, from 0 (disabled) to 9 (maximum).',)
-
-    chunk = traits.Trait(traits.TraitRange(0, None),
-                        desc='Set the target block size for chunking (0 default, >1 block size).',
-                        default=0,
-                        usedefault=False,
-                        argstr='-chunk %d',)
-
-class ConvertOutputSpec(TraitedSpec):
-    # FIXME Am I defining the output spec correctly?
-    output_file = File(
-                    desc='output file',
-                    exists=True,)
-
-class ConvertTask(CommandLine):
-    input_spec  = ConvertInputSpec
-    output_spec = ConvertOutputSpec
-    cmd = 'mincconvert'
-
-    def _list_outputs(self):
-        # FIXME seems generic, is this necessary?
-        outputs = self.output_spec().get()
-        outputs['output_file'] = self.inputs.output_file
-        return outputs
-
-class CopyInputSpec(CommandLineInputSpec):
-    """
-    Implement minccopy? Its man page says:
-
-        NOTE: This program is intended primarily for use with scripts such
-        as mincedit.  It does not follow the typical design rules of most MINC
-        command-line tools and therefore should be  used only with caution.
-
-    It doesn't run on a standard MNC file, e.g.
-
-        $ minccopy /home/carlo/tmp/foo.mnc /tmp/foo_copy.mnc
-        (from miopen): Can't write compressed file
-        ncvarid: ncid -1: NetCDF: Not a valid ID
-
-    """
-
-    input_file = File(
-                    desc='input file to copy',
-                    exists=True,
-                    mandatory=True,
-                    argstr='%s',
-                    position=-2,)
-
-    output_file = File(
-                    desc='output file',
-                    mandatory=True,
-                    genfile=False,
-                    argstr='%s',
-                    position=-1,)
-
-    pixel_values = traits.Bool(
-                desc='Copy pixel values as is.',
-                argstr='-pixel_values',)
-
-    real_values = traits.Bool(
-                desc='Copy real pixel intensities (default).',
-                argstr='-real_values',
-                usedefault=True,)
-
-class CopyOutputSpec(TraitedSpec):
-    # FIXME Am I defining the output spec correctly?
-    output_file = File(
-                    desc='output file',
-                    exists=True,)
-
-class CopyTask(CommandLine):
-    input_spec  = CopyInputSpec
-    output_spec = CopyOutputSpec
-    cmd = 'minccopy'
-
-    def _list_outputs(self):
-        # FIXME seems generic, is this necessary?
-        outputs = self.output_spec().get()
-        outputs['output_file'] = self.inputs.output_file
-        return outputs
-
-class ToEcatInputSpec(CommandLineInputSpec):
-    input_file = File(
-                    desc='input file to convert',
-                    exists=True,
-                    mandatory=True,
-                    argstr='%s',
-                    position=-2,)
-
-    output_file = File(
-                    desc='output file',
-                    mandatory=False,
-                    genfile=True,
-                    argstr='%s',
-                    position=-1,)
-
-    ignore_patient_variable = traits.Bool(
-                    desc='Ignore informations from the minc patient variable.',
-                    argstr='-ignore_patient_variable',)
-
-    ignore_study_variable = traits.Bool(
-                    desc='Ignore informations from the minc study variable.',
-                    argstr='-ignore_study_variable',)
-
-    ignore_acquisition_variable = traits.Bool(
-                    desc='Ignore informations from the minc acquisition variable.',
-                    argstr='-ignore_acquisition_variable',)
-
-    ignore_ecat_acquisition_variable = traits.Bool(
-                    desc='Ignore informations from the minc ecat_acquisition variable.',
-                    argstr='-ignore_ecat_acquisition_variable',)
-
-    ignore_ecat_main = traits.Bool(
-                    desc='Ignore informations from the minc ecat-main variable.',
-                    argstr='-ignore_ecat_main',)
-
-    ignore_ecat_subheader_variable = traits.Bool(
-                    desc='Ignore informations from the minc ecat-subhdr variable.',
-                    argstr='-ignore_ecat_subheader_variable',)
-
-    no_decay_corr_fctr = traits.Bool(
-                    desc='Do not compute the decay correction factors',
-                    argstr='-no_decay_corr_fctr',)
-
-    voxels_as_integers = traits.Bool(
-                    desc='Voxel values are treated as integers, scale and calibration factors are set to unity',
-                    argstr='-label',)
-
-class ToEcatOutputSpec(TraitedSpec):
-    # FIXME Am I defining the output spec correctly?
-    output_file = File(
-                    desc='output file',
-                    exists=True,)
-
-class ToEcatTask(CommandLine):
-    input_spec  = ToEcatInputSpec
-    output_spec = ToEcatOutputSpec
-    cmd = 'minctoecat'
-
-    def _list_outputs(self):
-        # FIXME seems generic, is this necessary?
-        outputs = self.output_spec().get()
-        outputs['output_file'] = self.inputs.output_file
-        return outputs
-
-    def _gen_filename(self, name):
-        if name == 'output_file':
-            return os.path.splitext(self.inputs.input_file)[0] + '.v'
-        return None
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        probe : dict
+           Keys 'mincinfo' (resolved path), 'versions' (as returned
+           by version()) and 'flags' (command name -> sorted list of
+           supported flags, or None if the command is missing); None
+           if MINC is not found.
 
-class DumpInputSpec(StdOutCommandLineInputSpec):
-    """
-    For the MINC command mincdump.
-    """
-
-    input_file = File(
-                    desc='input file',
-                    exists=True,
-                    mandatory=True,
-                    argstr='%s',
-                    position=-2,)
-
-    _xor_coords_or_header = ('coordinate_data', 'header_data',)
-
-    coordinate_data = traits.Bool(
-                    desc='Coordinate variable data and header information',
-                    argstr='-c',
-                    xor=_xor_coords_or_header,)
-
-    header_data = traits.Bool(
-                    desc='Header information only, no data',
-                    argstr='-h',
-                    xor=_xor_coords_or_header,)
-
-    _xor_annotations = ('annotations_brief', 'annotations_full',)
-
-    # FIXME Instead of an enum, make a separate Bool trait called fortran_indices and another
-    # called c_indices?
-
-    annotations_brief = traits.Enum('c', 'f',
-                            argstr='-b %s',
-                            desc='Brief annotations for C or Fortran indices in data',
-                            xor=_xor_annotations)
-
-    annotations_full = traits.Enum('c', 'f',
-                            argstr='-f %s',
-                            desc='Full annotations for C or Fortran indices in data',
-                            xor=_xor_annotations)
-
-    variables = InputMultiPath(
-                            traits.Str,
-                            desc='Output data for specified variables only',
-                            sep=',',
-                            argstr='-v %s',)
-
-    line_length = traits.Trait(traits.TraitRange(0, None),
-                        desc='Line length maximum in data section (default 80)',
-                        default=0,
-                        usedefault=False,
-                        argstr='-l %d',)
-
-    netcdf_name = traits.Str(
-                        desc='Name for netCDF (default derived from file name)',
-                        argstr='-n %s',)
-
-    precision = traits.Either(
-                        traits.Int(),
-                        traits.Tuple(traits.Int, traits.Int),
-                        desc='Display floating-point values with less precision',
-                        argstr='%s',)
-
-class DumpOutputSpec(TraitedSpec):
-    # FIXME Not sure if I'm defining the outout specs correctly.
-
-    output_file = File(
-                    desc='output file',
-                    exists=True,
-                    genfile=True,)
-
-class DumpTask(StdOutCommandLine):
-    input_spec  = DumpInputSpec
-    output_spec = DumpOutputSpec
-    cmd = 'mincdump'
-
-    def _format_arg(self, name, spec, value):
-        if name == 'precision':
-            if isinstance(value, int):
-                return '-p %d' % value
-            elif isinstance(value, tuple):
-                return '-p %d,%d' % (value[0], value[1],)
-            else:
-                raise NotImplemented # FIXME some other exception?
-        return super(DumpTask, self)._format_arg(name, spec, value)
-
-    # FIXME Are we forced to send outout to a file? Can we pipe it
-    # to another minc command directly?
-    def _gen_outfilename(self):
-        """
-        Dump foo.mnc to foo.txt.
         """
-        return os.path.splitext(self.inputs.input_file)[0] + '.txt'
+        mincinfo, key = Info._key()
 
-class AverageInputSpec(CommandLineInputSpec):
-    input_files = InputMultiPath(
-                    traits.File,
-                    desc='input file(s) for averaging',
-                    exists=True,
-                    mandatory=True,
-                    sep=' ', # FIXME test with files that contain spaces - does InputMultiPath do the right thing?
-                    argstr='%s',
-                    position=-2,) # FIXME test with multiple files, is order ok?
+        if key is not None and key == Info._probe_key:
+            return Info._probe
 
-    output_file = File(
-                    desc='output file',
-                    mandatory=True,
-                    genfile=False,
-                    argstr='%s',
-                    position=-1,)
+        if key is None:
+            probe = None
+        else:
+            probe = Info._load(key)
+            if probe is None:
+                probe = Info._run_probe(mincinfo)
+                if probe is not None:
+                    Info._save(key, probe)
 
-    two = traits.Bool(desc='Produce a MINC 2.0 format output file', argstr='-2')
+        Info._probe, Info._probe_key = probe, key
+        return probe
 
-    _xor_clobber = ('clobber', 'no_clobber')
+    @staticmethod
+    def clear_cache(disk=False):
+        """Forget the probe result of this process, and optionally the
+        files persisted in cache_dir().
+        """
+        Info._probe, Info._probe_key = None, None
 
-    clobber     = traits.Bool(desc='Overwrite existing file.',                  argstr='-clobber',      xor=_xor_clobber)
-    no_clobber  = traits.Bool(desc='Don\'t overwrite existing file (default).', argstr='-noclobber',    xor=_xor_clobber)
+        if disk:
+            d = Info.cache_dir()
+            if d and os.path.isdir(d):
+                for f in os.listdir(d):
+                    if f.startswith('probe-') and f.endswith('.json'):
+                        os.remove(os.path.join(d, f))
 
-    _xor_verbose = ('verbose', 'quiet',)
+    @staticmethod
+    def version():
+        """Check for minc version on the system
 
-    verbose = traits.Bool(desc='Print out log messages (default).', argstr='-verbose',  xor=_xor_verbose)
-    quiet   = traits.Bool(desc='Do not print out log messages.',    argstr='-quiet',    xor=_xor_verbose)
+        Parameters
+        ----------
+        None
 
-    debug   = traits.Bool(desc='Print out debugging messages.', argstr='-debug')
+        Returns
+        -------
+        version : str
+           Version number as string or None if MINC not found
 
-    # FIXME How to handle stdin option here? Not relevant?
-    foo = traits.File(desc='Specify the name of a file containing input file names (- for stdin).', argstr='-filelist %s',)
+        """
+        probe = Info.probe()
+        if probe is None:
+            return None
+        return probe['versions']
 
-    _xor_check_dimensions = ('check_dimensions', 'no_check_dimensions',)
+    @staticmethod
+    def supports(cmd, flag):
+        """Check whether a wrapped MINC command accepts a flag, e.g.
 
-    check_dimensions    = traits.Bool(desc='Check that dimension info matches across files (default).', argstr='-check_dimensions',     xor=_xor_check_dimensions)
-    no_check_dimensions = traits.Bool(desc='Do not check dimension info.',                              argstr='-nocheck_dimensions',   xor=_xor_check_dimensions)
+            Info.supports('mincconvert', '-compress')
 
+        Answered from the probe, so this does not run anything.
+        """
+        probe = Info.probe()
+        if probe is None:
+            return False
+        flags = probe['flags'].get(cmd)
+        return flags is not None and flag in flags
 
-    # FIXME mincaverage seems to accept more than one of these options; I assume
-    # that it takes the last one, and it makes more sense for these to be
-    # put into an xor case.
+ImageLayout = namedtuple('ImageLayout', ['dimnames', 'shape', 'vartype', 'signtype'])
 
-    _xor_format = ('format_filetype', 'format_byte', 'format_short',
-                   'format_int', 'format_long', 'format_float', 'format_double',
-                   'format_signed', 'format_unsigned',)
+def image_layout(input_file):
+    """
+    Dimension names, shape, storage type and sign of the image variable
+    of a MINC file, slowest-varying dimension first, as reported by
+    mincinfo.
+    """
 
-    format_filetype     = traits.Bool(desc='Use data type of first file (default).',                    argstr='-filetype', xor=_xor_format)
-    format_byte         = traits.Bool(desc='Write out byte data.',                                      argstr='-byte',     xor=_xor_format)
-    format_short        = traits.Bool(desc='Write out short integer data.',                             argstr='-short',    xor=_xor_format)
-    format_int          = traits.Bool(desc='Write out 32-bit integer data.',                            argstr='-int',      xor=_xor_format)
-    format_long         = traits.Bool(desc='Superseded by -int.',                                       argstr='-long',     xor=_xor_format)
-    format_float        = traits.Bool(desc='Write out single-precision floating-point data.',           argstr='-float',    xor=_xor_format)
-    format_double       = traits.Bool(desc='Write out double-precision floating-point data.',           argstr='-double',   xor=_xor_format)
-    format_signed       = traits.Bool(desc='Write signed integer data.',                                argstr='-signed',   xor=_xor_format)
-    format_unsigned     = traits.Bool(desc='Write unsigned integer data (default if type specified).',  argstr='-unsigned', xor=_xor_format) # FIXME mark with default=?
+    def mincinfo(args):
+        proc = subprocess.Popen(['mincinfo', '-error_string', ''] + args + [input_file],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError('mincinfo failed on %s: %s' % (input_file, err.strip(),))
+        return out.decode('utf-8').split('\n')
+
+    lines = mincinfo(['-vardims', 'image', '-vartype', 'image', '-attvalue', 'image:signtype'])
+    dimnames = lines[0].split()
+    vartype  = lines[1].strip()
+    signtype = lines[2].strip() or ('unsigned' if vartype == 'byte' else 'signed')
+
+    args = []
+    for d in dimnames:
+        args += ['-dimlength', d]
+    shape = tuple(int(l) for l in mincinfo(args)[:len(dimnames)])
+
+    return ImageLayout(dimnames, shape, vartype, signtype)
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for in-memory MINC data')
+
+# numpy type codes for MINC/NetCDF types, as (signed, unsigned).
+_minc_dtypes = {'byte':   ('i1', 'u1'),
+                'short':  ('i2', 'u2'),
+                'int':    ('i4', 'u4'),
+                'long':   ('i4', 'u4'),
+                'float':  ('f4', 'f4'),
+                'double': ('f8', 'f8'),
+               }
+
+def minc_dtype(vartype, signtype):
+    """
+    numpy dtype, in native byte order, of a MINC type and sign.
+    """
+    _require_numpy()
+    signed, unsigned = _minc_dtypes[vartype]
+    return np.dtype(unsigned if signtype == 'unsigned' else signed)
 
+# A value that shlex would split or unquote.
+_unsafe_value = re.compile(r'[\s\'"\\]')
 
-    max_buffer_size_in_kb = traits.Trait(traits.TraitRange(0, None),
-                                desc='Specify the maximum size of the internal buffers (in kbytes).',
-                                default=4096, # FIXME is this doing what I think it's doing? Write some tests.
-                                usedefault=False,
-                                argstr='-max_buffer_size_in_kb %d',)
+def _hide_values(value, placeholders):
+    """
+    value with each string that shlex would split or unquote replaced
+    by a placeholder token, recorded in placeholders.
+    """
+    if isinstance(value, (str, type(u''))) and _unsafe_value.search(value):
+        key = '\0%d\0' % len(placeholders)
+        placeholders[key] = value
+        return key
+    if isinstance(value, list):
+        return [_hide_values(v, placeholders) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_hide_values(v, placeholders) for v in value)
+    return value
+
+def _arg_tokens(arg, placeholders):
+    """
+    Split one formatted argument into argv tokens, putting back the
+    values _hide_values() took out.
+    """
+    tokens = shlex.split(arg)
+    for (key, value) in placeholders.items():
+        tokens = [t.replace(key, value) for t in tokens]
+    return tokens
 
-    _xor_normalize = ('normalize', 'nonormalize',)
-    normalize   = traits.Bool(desc='Normalize data sets for mean intensity.', argstr='-normalize', xor=_xor_normalize)
-    nonormalize = traits.Bool(desc='Do not normalize data sets (default).',   argstr='-nonormalize', xor=_xor_normalize, default=True) # FIXME check default=? behaviour
+def _parse_argv(task, skip=None):
+    """
+    task._parse_inputs(skip) as argv tokens. Each argument is formatted
+    with its string values hidden and split on its own, so that file
+    names with spaces or quotes come through whole. The free-form args
+    input is split as a command line.
+    """
+    format_arg = task._format_arg
+
+    def tokens(name, spec, value):
+        placeholders = {}
+        if name != 'args':
+            value = _hide_values(value, placeholders)
+        arg = format_arg(name, spec, value)
+        return None if arg is None else _arg_tokens(arg, placeholders)
+
+    task._format_arg = tokens
+    try:
+        args = task._parse_inputs(skip=skip)
+    finally:
+        del task._format_arg
+    return [t for arg in args for t in arg]
+
+def _stdout_argv(task):
+    """
+    The argv of a StdOutCommandLine task, without the '> outfile'
+    redirection.
+    """
+    task._check_mandatory_inputs()
+    return shlex.split(task.cmd) + _parse_argv(task, skip=['out_file'])
 
-    voxel_range = traits.Tuple(
-                traits.Int, traits.Int, argstr='-range %d %d',
-                desc='Valid range for output data.',)
+def _task_argv(task):
+    """
+    The argv of any other CommandLine task: task.cmdline, split.
+    """
+    task._check_mandatory_inputs()
+    return shlex.split(task.cmd) + _parse_argv(task)
 
-    sdfile = traits.File(
-                desc='Specify an output sd file (default=none).',
-                argstr='-sdfile %s',)
+# Reads from the pipe are done in pieces of this many bytes.
+DEFAULT_CHUNK_SIZE = 1 << 20
 
-    _xor_copy_header = ('copy_header, no_copy_header')
+class _StdOutStream(object):
+    """
+    A running StdOutCommandLine task whose stdout is read directly from
+    the pipe. stderr goes to an anonymous temporary file so that a chatty
+    command cannot block while we are reading stdout.
+    """
 
-    copy_header     = traits.Bool(desc='Copy all of the header from the first file (default for one file).',            argstr='-copy_header',   xor=_xor_copy_header)
-    no_copy_header  = traits.Bool(desc='Do not copy all of the header from the first file (default for many files)).',  argstr='-nocopy_header', xor=_xor_copy_header)
+    def __init__(self, argv, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.argv = argv
+        self.chunk_size = chunk_size
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=self.stderr)
+        self.stdout = io.open(self.proc.stdout.fileno(), 'rb', buffering=0, closefd=False)
 
-    avgdim = traits.Str(desc='Specify a dimension along which we wish to average.', argstr='-avgdim %s')
+    def readinto(self, buf):
+        """
+        Fill buf (anything supporting the buffer protocol, e.g. a
+        contiguous numpy array) from the pipe.
+        """
+        if np is not None and isinstance(buf, np.ndarray):
+            buf = buf.reshape(-1).view(np.uint8)
+        view = memoryview(buf)
+        total = len(view)
+        pos = 0
+        while pos < total:
+            n = self.stdout.readinto(view[pos:min(total, pos + self.chunk_size)])
+            if not n:
+                self._fail('expected %d bytes, got %d' % (total, pos,))
+            pos += n
+
+    def _fail(self, msg):
+        self.kill()
+        self.stderr.seek(0)
+        err = self.stderr.read().decode('utf-8', 'replace').strip()
+        raise RuntimeError('%s: %s\n%s' % (' '.join(self.argv), msg, err,))
+
+    def finish(self):
+        """
+        Check that the command produced no more output than expected and
+        exited cleanly.
+        """
+        extra = self.stdout.read(1)
+        if extra:
+            self._fail('more output than expected')
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            self._fail('exit code %d' % self.proc.returncode)
+        self.stderr.close()
 
-    binarize = traits.Bool(desc='Binarize the volume by looking for values in a given range.', argstr='-binarize')
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.stdout.close()
+        self.proc.wait()
 
-    binrange = traits.Tuple(
-                traits.Float, traits.Float, argstr='-binrange %s %s',
-                desc='Specify a range for binarization. Default value: 1.79769e+308 -1.79769e+308.') # FIXME shouldn't that be -1.79769e+308 1.79769e+308? Min then max?
 
-    binvalue = traits.Float(desc='Specify a target value (+/- 0.5) for binarization. Default value: -1.79769e+308', argstr='-binvalue %s')
-		
-    weights = InputMultiPath(
-                            traits.Str,
-                            desc='Specify weights for averaging ("<w1>,<w2>,...").',
-                            sep=',',
-                            argstr='-weights %s',)
+CONVERT_PROFILE_VERSION = 1
 
-    width_weighted = traits.Bool(desc='Weight by dimension widths when -avgdim is used.', argstr='-width_weighted', requires=('avgdim',))
+def convert_profile_file():
+    """
+    Where the conversion profile written by minc_tune lives by default:
+    $MINC_CONVERT_PROFILE, or convert-profile.json in Info.cache_dir().
+    """
+    fname = os.environ.get('MINC_CONVERT_PROFILE')
+    if fname:
+        return fname
+    d = Info.cache_dir()
+    return os.path.join(d, 'convert-profile.json') if d else None
 
-class AverageOutputSpec(TraitedSpec):
-    # FIXME Am I defining the output spec correctly?
-    output_file = File(
-                    desc='output file',
-                    exists=True,)
+def load_convert_profile(fname=None):
+    """
+    Load a conversion profile (see minc_tune), or None if there is none.
+    """
+    if fname is None:
+        fname = convert_profile_file()
+    if fname is None:
+        return None
+    try:
+        with open(fname) as f:
+            profile = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if profile.get('profile_version') != CONVERT_PROFILE_VERSION:
+        return None
+    return profile
+
+# Names that come from _minc_tasks: the Task and spec classes, and the
+# nipype names this module has always re-exported.
+_LAZY_NAMES = frozenset([
+    'TraitedSpec', 'CommandLineInputSpec', 'CommandLine', 'StdOutCommandLineInputSpec',
+    'StdOutCommandLine', 'File', 'InputMultiPath', 'isdefined', 'traits',
+    'MincTaskMixin',
+    'ToRawInputSpec', 'ToRawOutputSpec', 'ToRawTask',
+    'ConvertInputSpec', 'ConvertOutputSpec', 'ConvertTask',
+    'CopyInputSpec', 'CopyOutputSpec', 'CopyTask',
+    'ToEcatInputSpec', 'ToEcatOutputSpec', 'ToEcatTask',
+    'DumpInputSpec', 'DumpOutputSpec', 'DumpTask', '_format_precision',
+    'AverageInputSpec', 'AverageOutputSpec', 'AverageTask',
+])
+
+class _LazyModule(types.ModuleType):
+    """
+    Stands in for this module in sys.modules (Python 2 modules cannot
+    have a __getattr__ of their own) and imports _minc_tasks on the
+    first access to one of _LAZY_NAMES.
+    """
+
+    def __getattr__(self, name):
+        if name not in _LAZY_NAMES:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        import _minc_tasks
+        for n in _LAZY_NAMES:
+            setattr(self, n, getattr(_minc_tasks, n))
+        return getattr(_minc_tasks, name)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | _LAZY_NAMES)
 
-class AverageTask(CommandLine):
-    input_spec  = AverageInputSpec
-    output_spec = AverageOutputSpec
-    cmd = 'mincaverage'
+def tasks_loaded():
+    """
+    Whether the Task classes (and so nipype) have been imported yet.
+    """
+    return '_minc_tasks' in sys.modules
 
-    def _list_outputs(self):
-        # FIXME seems generic, is this necessary?
-        outputs = self.output_spec().get()
-        outputs['output_file'] = self.inputs.output_file
-        return outputs
+if __name__ != '__main__':
+    _module = _LazyModule(__name__)
+    _module.__dict__.update(globals())
+    # The functions above still look their globals up in this module's
+    # dictionary, which Python 2 clears when the module is freed.
+    _module._eager_module = sys.modules[__name__]
+    sys.modules[__name__] = _module
 
 
 if __name__ == '__main__':
+    from _minc_tasks import ConvertTask, ToRawTask, CopyTask, ToEcatTask, DumpTask, AverageTask
+
     convert = ConvertTask(input_file='/home/carlo/tmp/foo.mnc', output_file='/tmp/foo.mnc', two=True, clobber=True, compression=3, chunk=2, template=True)
     print convert.cmdline
     convert_result = convert.run()
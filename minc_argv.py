@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: render command lines for many Tasks without building them.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Building a Task just to read its .cmdline costs a traits validation
+# per input and a _format_arg dispatch per argument. To generate a large
+# batch of command lines (e.g. for a cluster submission) the renderer
+# below looks at the input spec once per Task class, and turns a plain
+# dict of inputs into the same string as
+#
+#     Task(**params).cmdline
+#
+# It follows nipype's _parse_inputs: traits with an argstr in name order,
+# positive positions first and negative ones last, bools as bare flags,
+# lists joined with sep, usedefault values, generated file names, and the
+# mandatory/xor/requires checks with nipype's messages. The checks and
+# the argument order only depend on which inputs are set, so they are
+# worked out once per distinct set of keys in a batch.
+#
+# Values are not validated against their traits: pass what the Task
+# would accept. A Task that overrides _format_arg must list the inputs it
+# formats itself in _arg_formatters, as DumpTask does for precision.
+
+import shlex
+
+from nipype.interfaces.base import CommandLine, StdOutCommandLine, Undefined, traits
+
+from minc import _arg_tokens, _hide_values
+
+class _Inputs(object):
+    """
+    Stands in for task.inputs when generating file names.
+    """
+
+    def __init__(self, params):
+        self.__dict__.update(params)
+
+    def __getattr__(self, name):
+        return Undefined
+
+class _TaskProxy(object):
+    """
+    Enough of a Task for its _gen_filename to run.
+    """
+
+    def __init__(self, task_class, params):
+        self._task_class = task_class
+        self.inputs = _Inputs(params)
+
+    def __getattr__(self, name):
+        attr = getattr(self._task_class, name)
+        if hasattr(attr, '__func__'):
+            return attr.__func__.__get__(self, self._task_class)
+        return attr
+
+def _bool_formatter(argstr):
+    return lambda value: argstr if value else None
+
+def _list_formatter(argstr, sep):
+    if argstr.endswith('...'):
+        argstr = argstr.replace('...', '')
+        return lambda value: sep.join([argstr % elt for elt in value])
+    return lambda value: argstr % sep.join([str(elt) for elt in value])
+
+def _multipath_formatter(argstr, sep):
+    fmt = _list_formatter(argstr, sep)
+    return lambda value: fmt(value if isinstance(value, (list, tuple)) else [value])
+
+def _compound_formatter(argstr, sep):
+    fmt = _list_formatter(argstr, sep)
+    return lambda value: fmt(value) if isinstance(value, list) else argstr % value
+
+def _plain_formatter(argstr):
+    return lambda value: argstr % value
+
+def _formatter(spec):
+    from nipype.interfaces.base import MultiPath
+    argstr = spec.argstr
+    sep = ' ' if spec.sep is None else spec.sep
+    if spec.is_trait_type(traits.Bool) and '%' not in argstr:
+        return _bool_formatter(argstr)
+    if spec.is_trait_type(MultiPath):
+        return _multipath_formatter(argstr, sep)
+    if spec.is_trait_type(traits.List):
+        return _list_formatter(argstr, sep)
+    if spec.is_trait_type(traits.TraitCompound):
+        return _compound_formatter(argstr, sep)
+    return _plain_formatter(argstr)
+
+class ArgvRenderer(object):
+    """
+    Command lines for task_class from dicts of inputs. Use renderer()
+    to get the shared instance for a class.
+    """
+
+    def __init__(self, task_class):
+        self.task_class = task_class
+        self.cmd = task_class.cmd
+        self._name = task_class.__name__
+        self._stdout = issubclass(task_class, StdOutCommandLine)
+
+        formatters = getattr(task_class, '_arg_formatters', {})
+        if task_class._format_arg.__func__ is not CommandLine._format_arg.__func__ and not formatters:
+            raise NotImplementedError('%s overrides _format_arg but has no _arg_formatters' % self._name)
+
+        spec = task_class.input_spec()
+        self.defaults = {}
+        self._genfile = set()
+        self._args = []
+        positions = {}
+        for (name, t) in sorted(spec.traits(argstr=lambda a: a is not None).items()):
+            if t.name_source:
+                raise NotImplementedError('%s.%s: name_source inputs are not supported' % (self._name, name,))
+            if t.usedefault:
+                self.defaults[name] = getattr(spec, name)
+            if t.genfile:
+                self._genfile.add(name)
+            if t.position is not None:
+                if t.position in positions:
+                    raise NotImplementedError('%s: %s and %s share position %d'
+                                              % (self._name, positions[t.position], name, t.position,))
+                positions[t.position] = name
+            self._args.append((name, t.position, formatters.get(name) or _formatter(t)))
+
+        self._mandatory = sorted((name, t.xor) for (name, t) in spec.traits(mandatory=True).items())
+        self._requires = sorted((name, t.requires)
+                                for (name, t) in spec.traits(transient=None).items() if t.requires)
+        self._xor = sorted((name, t.xor) for (name, t) in spec.traits().items() if t.xor)
+        self._plans = {}
+
+    def _check(self, defined):
+        for (name, xor) in self._xor:
+            if name in defined:
+                for other in xor:
+                    if other != name and other in defined and other < name:
+                        raise IOError('Input "%s" is mutually exclusive with input "%s", '
+                                      'which is already set' % (name, other,))
+        for (name, xor) in self._mandatory:
+            if xor and name not in defined and not any(x in defined for x in xor):
+                raise ValueError("%s requires a value for one of the inputs '%s'. "
+                                 "For a list of required inputs, see %s.help()"
+                                 % (self._name, ', '.join(xor), self._name,))
+            if not xor and name not in defined:
+                raise ValueError("%s requires a value for input '%s'. "
+                                 "For a list of required inputs, see %s.help()"
+                                 % (self._name, name, self._name,))
+        for (name, requires) in self._requires:
+            if name in defined and not all(r in defined for r in requires):
+                raise ValueError("%s requires a value for input '%s' because one of %s "
+                                 "is set. For a list of required inputs, see %s.help()"
+                                 % (self._name, name, ', '.join(requires), self._name,))
+
+    def _plan(self, keys):
+        """
+        The (name, formatter) pairs to apply, in command line order, when
+        exactly the inputs in keys are set.
+        """
+        plan = self._plans.get(keys)
+        if plan is None:
+            defined = set(keys) | set(self.defaults)
+            self._check(defined)
+            first, middle, last = [], [], []
+            for (name, pos, fmt) in self._args:
+                if name not in defined and name not in self._genfile:
+                    continue
+                if pos is None:
+                    middle.append((name, fmt))
+                else:
+                    (first if pos >= 0 else last).append((pos, name, fmt))
+            plan = ([(n, f) for (_, n, f) in sorted(first)] + middle
+                    + [(n, f) for (_, n, f) in sorted(last)])
+            self._plans[keys] = plan
+        return plan
+
+    def _value(self, params, name):
+        value = params.get(name, Undefined)
+        if value is Undefined or value is None:
+            if name in self._genfile:
+                return self._gen_filename(params, name)
+            return self.defaults.get(name, Undefined)
+        return value
+
+    def _gen_filename(self, params, name):
+        return _TaskProxy(self.task_class, params)._gen_filename(name)
+
+    def args(self, params, skip=(), split=False):
+        """
+        The formatted arguments, as nipype's _parse_inputs(skip) gives
+        them; with split, as argv tokens (as minc._parse_argv gives
+        them).
+        """
+        keys = frozenset(k for (k, v) in params.items() if v is not Undefined and v is not None)
+        result = []
+        for (name, fmt) in self._plan(keys):
+            if name in skip:
+                continue
+            value = self._value(params, name)
+            if value is Undefined:
+                continue
+            if split:
+                placeholders = {}
+                if name != 'args':
+                    value = _hide_values(value, placeholders)
+                arg = fmt(value)
+                if arg is not None:
+                    result += _arg_tokens(arg, placeholders)
+                continue
+            arg = fmt(value)
+            if arg is not None:
+                result.append(arg)
+        return result
+
+    def cmdline(self, params):
+        """
+        The same string as task_class(**params).cmdline.
+        """
+        return ' '.join([self.cmd] + self.args(params))
+
+    def argv(self, params):
+        """
+        The command line split into an argv list; for a StdOutCommandLine
+        task, without the output redirection (as minc._stdout_argv).
+        """
+        skip = ('out_file',) if self._stdout else ()
+        return shlex.split(self.cmd) + self.args(params, skip, split=True)
+
+    def cmdlines(self, batch):
+        return [self.cmdline(params) for params in batch]
+
+    def argvs(self, batch):
+        return [self.argv(params) for params in batch]
+
+_renderers = {}
+
+def renderer(task_class):
+    """
+    The ArgvRenderer for task_class, compiled on first use.
+    """
+    r = _renderers.get(task_class)
+    if r is None:
+        r = _renderers[task_class] = ArgvRenderer(task_class)
+    return r
+
+def cmdlines(task_class, batch):
+    """
+    [task_class(**params).cmdline for params in batch], without building
+    the Tasks.
+    """
+    return renderer(task_class).cmdlines(batch)
+
+def argvs(task_class, batch):
+    return renderer(task_class).argvs(batch)
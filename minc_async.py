@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: run MINC Tasks from an asyncio event loop.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# This is Python 2 code, so the event loop is trollius (the asyncio
+# backport) and coroutines are written in its style:
+#
+#     @asyncio.coroutine
+#     def main():
+#         outputs = yield From(minc_async.run(ConvertTask(...), timeout=60))
+#
+# Each run is an asyncio subprocess rather than a blocking thread. A
+# global semaphore (set_concurrency()) bounds how many tools run at once
+# per event loop. Cancelling the coroutine, or hitting the timeout, kills
+# the child before the error propagates. StdOut tasks write to the same
+# file as .run() would (out_file, or the name from _gen_filename), or
+# their stdout can be streamed to a callback with stream().
+#
+# Runs that do not go through a MINC binary (those whose Task says so
+# with _runs_in_process(): the numpy averaging engine, tree and
+# incremental averaging, frame-parallel minctoecat) or that use the
+# result cache or scratch space are passed to .run() in the loop's
+# default executor, so their behaviour is unchanged. They count against
+# the same semaphore, but a thread cannot be killed: on timeout or
+# cancellation the error propagates at once while the run (and any tool
+# it started) carries on to the end, holding its slot until then. The
+# subprocess
+# path bypasses nipype's run(), and with it the minc_profile hooks, but
+# not the Task's _precheck() (such as AverageTask's check_geometry).
+
+import os
+import sys
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+from nipype.interfaces.base import StdOutCommandLine, isdefined
+
+from minc import DEFAULT_CHUNK_SIZE, _stdout_argv, _task_argv
+
+DEFAULT_CONCURRENCY = 16
+
+_concurrency = DEFAULT_CONCURRENCY
+_semaphores = {}
+
+def _require():
+    if asyncio is None:
+        raise ImportError('trollius is required for the asyncio API')
+
+def set_concurrency(n):
+    """
+    Allow at most n tools to run at once in each event loop.
+    """
+    global _concurrency
+    if n < 1:
+        raise ValueError('concurrency must be at least 1')
+    _concurrency = n
+    _semaphores.clear()
+
+def _semaphore(loop):
+    # A semaphore refers to its loop, so weak keys would not let a loop
+    # go; drop those that have been closed instead.
+    for closed in [l for l in _semaphores if l.is_closed()]:
+        del _semaphores[closed]
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(_concurrency, loop=loop)
+    return _semaphores[loop]
+
+class TaskFailed(RuntimeError):
+    def __init__(self, cmdline, returncode, stderr):
+        self.cmdline = cmdline
+        self.returncode = returncode
+        self.stderr = stderr
+        RuntimeError.__init__(self, '%s failed (exit code %s): %s' % (cmdline, returncode, stderr,))
+
+def output_file(task):
+    """
+    Where a StdOut task's output goes: out_file, or the generated name.
+    """
+    out = task.inputs.out_file
+    if not isdefined(out):
+        out = task._gen_filename('out_file')
+    return os.path.abspath(out)
+
+def task_outputs(task):
+    """
+    The outputs .run() would report: _list_outputs(), with the stdout
+    file for StdOut tasks.
+    """
+    outputs = task._list_outputs() or {}
+    if isinstance(task, StdOutCommandLine):
+        outputs['output_file'] = output_file(task)
+    return outputs
+
+def _in_process(task):
+    import minc_cache
+    import minc_scratch
+    if minc_cache.get_cache(task.cache) is not None or minc_scratch.get_scratch(task.scratch) is not None:
+        return True
+    return task._runs_in_process()
+
+def _argv(task):
+    task._precheck()
+    if isinstance(task, StdOutCommandLine):
+        return _stdout_argv(task)
+    return _task_argv(task)
+
+def _run_task(task):
+    """
+    task.run(), with a tool's non-zero exit raised as TaskFailed, as on
+    the subprocess path. Other errors propagate as they are.
+    """
+    runtimes = []
+    run_interface = task._run_interface
+
+    def capture(runtime):
+        runtimes.append(runtime)
+        return run_interface(runtime)
+
+    task._run_interface = capture
+    try:
+        return task.run()
+    except Exception:
+        runtime = runtimes[-1] if runtimes else None
+        code = getattr(runtime, 'returncode', None)
+        if code in (None, 0):
+            raise
+        raise TaskFailed(getattr(runtime, 'cmdline', None) or task.cmd, code,
+                         getattr(runtime, 'stderr', None) or '')
+    finally:
+        del task._run_interface
+
+if asyncio is not None:
+
+    @asyncio.coroutine
+    def _kill(proc):
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            yield From(proc.wait())
+
+    @asyncio.coroutine
+    def _read(fd, n, loop):
+        """
+        One os.read() of fd once it is readable. Nothing is read ahead,
+        so the tool blocks on a full pipe until the consumer asks.
+        """
+        fut = asyncio.Future(loop=loop)
+
+        def ready():
+            loop.remove_reader(fd)
+            if fut.cancelled():
+                return
+            try:
+                fut.set_result(os.read(fd, n))
+            except OSError as e:
+                fut.set_exception(e)
+
+        loop.add_reader(fd, ready)
+        try:
+            data = yield From(fut)
+        except BaseException:
+            exc = sys.exc_info()
+            loop.remove_reader(fd)
+            raise exc[0], exc[1], exc[2]
+        raise Return(data)
+
+    @asyncio.coroutine
+    def _drain(fd, callback, chunk_size, loop):
+        while True:
+            chunk = yield From(_read(fd, chunk_size, loop))
+            if not chunk:
+                break
+            r = callback(chunk)
+            if asyncio.iscoroutine(r) or isinstance(r, asyncio.Future):
+                yield From(r)
+
+    @asyncio.coroutine
+    def _supervise(proc, work, timeout, loop):
+        """
+        Wait for work (a coroutine driving proc) with a timeout; kill
+        proc if we are cancelled or time out.
+        """
+        try:
+            result = yield From(asyncio.wait_for(work, timeout, loop=loop))
+        except BaseException:
+            # Yielding inside the handler loses the exception on Python 2,
+            # so keep it to re-raise.
+            exc = sys.exc_info()
+            yield From(_kill(proc))
+            raise exc[0], exc[1], exc[2]
+        raise Return(result)
+
+    @asyncio.coroutine
+    def _run_subprocess(argv, stdout, callback, chunk_size, timeout, loop):
+        """
+        Run argv with stdout going to a file object (or inherited, for
+        None) or, if callback is given, to callback in chunks.
+        """
+        rfd = None
+        if callback is not None:
+            # A plain pipe rather than the asyncio stream reader, which
+            # buffers ahead of the consumer.
+            rfd, wfd = os.pipe()
+            stdout = wfd
+        try:
+            proc = yield From(asyncio.create_subprocess_exec(*argv, stdout=stdout,
+                                                             stderr=asyncio.subprocess.PIPE,
+                                                             loop=loop))
+        finally:
+            if rfd is not None:
+                os.close(wfd)
+
+        @asyncio.coroutine
+        def work():
+            jobs = [proc.stderr.read()]
+            if callback is not None:
+                jobs.append(_drain(rfd, callback, chunk_size, loop))
+            results = yield From(asyncio.gather(*jobs, loop=loop))
+            yield From(proc.wait())
+            raise Return(results[0])
+
+        try:
+            stderr = yield From(_supervise(proc, work(), timeout, loop))
+        finally:
+            if rfd is not None:
+                os.close(rfd)
+        raise Return((proc.returncode, stderr.decode('utf-8', 'replace')))
+
+    @asyncio.coroutine
+    def _run_in_executor(task, timeout, loop):
+        """
+        task.run() in the loop's default executor, within the
+        concurrency limit. The run is shielded from the timeout and
+        cancellation, which cannot stop it, so it always releases its
+        slot when it finishes.
+        """
+        semaphore = _semaphore(loop)
+        yield From(semaphore.acquire())
+
+        def work():
+            try:
+                return _run_task(task)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(semaphore.release)
+                except RuntimeError:
+                    # The loop has been closed.
+                    pass
+
+        try:
+            fut = loop.run_in_executor(None, work)
+        except BaseException:
+            semaphore.release()
+            raise
+        result = yield From(asyncio.wait_for(asyncio.shield(fut, loop=loop), timeout, loop=loop))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def run(task, timeout=None, loop=None):
+        """
+        Run task as an asyncio subprocess and return its outputs, as
+        task_outputs() describes them. Raises TaskFailed on a non-zero
+        exit (also for tools run in the executor), asyncio.TimeoutError
+        after timeout seconds.
+        """
+        loop = loop or asyncio.get_event_loop()
+
+        if _in_process(task):
+            result = yield From(_run_in_executor(task, timeout, loop))
+            raise Return(result.outputs.get())
+
+        argv = _argv(task)
+        with (yield From(_semaphore(loop))):
+            if isinstance(task, StdOutCommandLine):
+                out = output_file(task)
+                with open(out, 'wb') as f:
+                    code, stderr = yield From(_run_subprocess(argv, f, None, None, timeout, loop))
+            else:
+                code, stderr = yield From(_run_subprocess(argv, None, None, None, timeout, loop))
+
+        if code != 0:
+            raise TaskFailed(' '.join(argv), code, stderr)
+        raise Return(task_outputs(task))
+
+    @asyncio.coroutine
+    def stream(task, callback, chunk_size=DEFAULT_CHUNK_SIZE, timeout=None, loop=None):
+        """
+        Run a StdOut task, passing its stdout to callback in chunks of at
+        most chunk_size bytes instead of writing a file. callback may be
+        a plain function or return a coroutine, which is waited for
+        before the next read (so a slow consumer slows the tool down,
+        rather than output piling up in memory). Returns the number of
+        bytes streamed.
+        """
+        loop = loop or asyncio.get_event_loop()
+        if not isinstance(task, StdOutCommandLine):
+            raise TypeError('only StdOutCommandLine tasks can be streamed')
+
+        counted = [0]
+
+        def count(chunk):
+            counted[0] += len(chunk)
+            return callback(chunk)
+
+        argv = _argv(task)
+        with (yield From(_semaphore(loop))):
+            code, stderr = yield From(_run_subprocess(argv, None, count, chunk_size, timeout, loop))
+        if code != 0:
+            raise TaskFailed(' '.join(argv), code, stderr)
+        raise Return(counted[0])
+
+    @asyncio.coroutine
+    def run_all(tasks, timeout=None, loop=None, return_exceptions=False):
+        """
+        Run tasks concurrently (within the concurrency limit) and return
+        their outputs in order.
+        """
+        loop = loop or asyncio.get_event_loop()
+        results = yield From(asyncio.gather(*[run(t, timeout, loop) for t in tasks],
+                                            loop=loop, return_exceptions=return_exceptions))
+        raise Return(results)
+
+def run_sync(coro, loop=None):
+    """
+    Drive a coroutine from blocking code.
+    """
+    _require()
+    loop = loop or asyncio.get_event_loop()
+    return loop.run_until_complete(coro)
@@ -0,0 +1,907 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: in-process averaging engine behind AverageTask, as an
+#           alternative to running mincaverage.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# The engine streams matching slabs (runs of whole slices along the
+# slowest dimension) from every input and keeps per-voxel running
+# statistics for the slab, so memory use is bounded by
+# max_buffer_size_in_kb no matter how many inputs there are. Means and
+# variances are accumulated in a single pass with the weighted version
+# of Welford's algorithm (West, 1979).
+#
+# For very long input lists, tree_average() splits the inputs into
+# shards, accumulates each shard in a process pool (in-process, or with
+# mincaverage -filelist) and merges the per-shard statistics pairwise in
+# a reduction tree. The statistics of a shard are kept on disk as
+# memory-mapped .npy files so that merging is also done in slabs.
+#
+# A Cohort keeps the same statistics next to an average whose inputs
+# change over time (AverageTask(stats_prefix=...)). When inputs are added
+# or removed, only those are read: their samples are folded in, or taken
+# back out, and the mean and standard deviation are written from the
+# updated statistics.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import warnings
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import minc_io
+from minc import isdefined
+
+warn = warnings.warn
+
+# Bytes of working memory per output voxel of a slab: the running
+# weight, count, mean and M2 accumulators plus temporaries.
+ACCUMULATOR_BYTES = 8 * 7
+
+class Accumulator(object):
+    """
+    Per-voxel weighted running mean and variance. NaNs are treated as
+    missing values and do not contribute.
+    """
+
+    def __init__(self, shape):
+        self.weight = np.zeros(shape)
+        self.count  = np.zeros(shape)
+        self.mean   = np.zeros(shape)
+        self.m2     = np.zeros(shape)
+
+    @classmethod
+    def from_arrays(cls, weight, count, mean, m2):
+        acc = cls.__new__(cls)
+        acc.weight, acc.count, acc.mean, acc.m2 = [np.array(a, dtype=np.float64)
+                                                   for a in (weight, count, mean, m2)]
+        return acc
+
+    def add(self, x, w=1.0):
+        valid = ~np.isnan(x)
+        w = np.where(valid, w, 0.0)
+        x = np.where(valid, x, 0.0)
+
+        weight = self.weight + w
+        delta = x - self.mean
+        ratio = np.zeros_like(weight)
+        np.divide(w, weight, out=ratio, where=weight > 0)
+        self.mean += ratio * delta
+        self.m2 += w * delta * (x - self.mean)
+        self.weight = weight
+        self.count += valid
+
+    def merge(self, other):
+        """
+        Fold in another accumulator over the same voxels (Chan et al.).
+        """
+        weight = self.weight + other.weight
+        delta = other.mean - self.mean
+        ratio = np.zeros_like(weight)
+        np.divide(other.weight, weight, out=ratio, where=weight > 0)
+        self.mean += delta * ratio
+        self.m2 += other.m2 + delta * delta * self.weight * ratio
+        self.weight = weight
+        self.count += other.count
+
+    def remove(self, x, w=1.0):
+        """
+        Undo add(x, w). Voxels left with no samples are reset exactly,
+        so that rounding does not accumulate there.
+        """
+        valid = ~np.isnan(x)
+        w = np.where(valid, w, 0.0)
+        x = np.where(valid, x, 0.0)
+
+        weight = self.weight - w
+        mean = np.zeros_like(weight)
+        np.divide(self.weight * self.mean - w * x, weight, out=mean, where=weight > 0)
+        self.m2 = np.maximum(self.m2 - w * (x - mean) * (x - self.mean), 0.0)
+        self.mean = mean
+        self.weight = weight
+        self.count -= valid
+
+        empty = self.count <= 0
+        for a in (self.weight, self.mean, self.m2):
+            a[empty] = 0.0
+
+    def sd(self):
+        """
+        Standard deviation, scaled to be unbiased for the number of
+        samples at each voxel. With equal weights this is the usual
+        sample standard deviation; voxels with fewer than two samples
+        get 0.
+        """
+        var = np.zeros_like(self.m2)
+        ok = (self.count > 1) & (self.weight > 0)
+        var[ok] = self.m2[ok] / self.weight[ok] * self.count[ok] / (self.count[ok] - 1)
+        return np.sqrt(np.maximum(var, 0.0))
+
+def slab_plan(shape, slab_axis, bytes_per_voxel, max_buffer_size_in_kb):
+    """
+    Split axis slab_axis of shape into (start, count) runs so that a
+    slab costs at most max_buffer_size_in_kb, at
+    bytes_per_voxel per voxel. A slab is never less than one slice.
+    """
+    per_slice = bytes_per_voxel
+    for (i, n) in enumerate(shape):
+        if i != slab_axis:
+            per_slice *= n
+    rows = max(1, int(max_buffer_size_in_kb * 1024 // max(1, per_slice)))
+    n = shape[slab_axis]
+    return [(s, min(rows, n - s)) for s in range(0, n, rows)]
+
+def norm_factors(means):
+    """
+    -normalize scales each input by the mean of all the input means
+    over its own mean.
+    """
+    grand = np.mean(means)
+    return [grand / m if m else 1.0 for m in means]
+
+def bin_range(binrange=None, binvalue=None):
+    """
+    The (min, max) range used by -binarize: -binvalue v means
+    v +/- 0.5, and -binvalue takes precedence over -binrange.
+    """
+    if binvalue is not None:
+        return (binvalue - 0.5, binvalue + 0.5)
+    if binrange is not None:
+        return (min(binrange), max(binrange))
+    raise ValueError('binarize needs binrange or binvalue')
+
+class AverageEngine(object):
+    """
+    Average a list of MINC volumes in slabs.
+
+    readers are open volumes from minc_io.open_volume(); weights is one
+    weight per input (default 1). avgdim, if given, is also averaged
+    over within each input, weighting each sample by its width when
+    width_weighted is set. norm_factors overrides the scale factors that
+    normalize would compute, for when the inputs are only part of the
+    set being averaged.
+
+    """
+
+    def __init__(self, readers, weights=None, normalize=False,
+                 binarize=False, binrange=None, binvalue=None,
+                 avgdim=None, width_weighted=False,
+                 max_buffer_size_in_kb=4096, check_dimensions=True,
+                 norm_factors=None):
+        if np is None:
+            raise ImportError('numpy is required for the averaging engine')
+        if not readers:
+            raise ValueError('nothing to average')
+
+        self.readers = readers
+        self.dimnames = list(readers[0].dimnames)
+        self.shape = tuple(readers[0].shape)
+        self.check(check_dimensions)
+
+        if weights is None:
+            weights = [1.0] * len(readers)
+        if len(weights) != len(readers):
+            raise ValueError('%d weights for %d input files' % (len(weights), len(readers),))
+        self.weights = [float(w) for w in weights]
+
+        self.binarize = binarize
+        self.bin_range = bin_range(binrange, binvalue) if binarize else None
+        self.max_buffer_size_in_kb = max_buffer_size_in_kb
+
+        if avgdim is not None:
+            if avgdim not in self.dimnames:
+                raise ValueError('no dimension %s to average over' % avgdim)
+            self.avg_axis = self.dimnames.index(avgdim)
+            widths = readers[0].dimension_widths(avgdim) if width_weighted else None
+            if width_weighted and widths is None:
+                warn('%s has no %s widths, using equal weights' % (readers[0].fname, avgdim,))
+            if widths is None:
+                widths = np.ones(self.shape[self.avg_axis])
+            self.avg_weights = widths
+        else:
+            self.avg_axis = None
+            self.avg_weights = None
+
+        self.out_dimnames = [d for (i, d) in enumerate(self.dimnames) if i != self.avg_axis]
+        self.out_shape = tuple(n for (i, n) in enumerate(self.shape) if i != self.avg_axis)
+        self.slab_axis = 1 if self.avg_axis == 0 else 0
+
+        if norm_factors is not None:
+            self.norm_factors = list(norm_factors)
+        else:
+            self.norm_factors = self._norm_factors() if normalize else None
+
+    def check(self, check_dimensions):
+        first = self.readers[0]
+        for r in self.readers[1:]:
+            if list(r.dimnames) != self.dimnames or tuple(r.shape) != self.shape:
+                raise ValueError('%s has dimensions %s %s, expected %s %s (from %s)'
+                                 % (r.fname, r.dimnames, r.shape, self.dimnames, self.shape, first.fname,))
+        if not check_dimensions:
+            return
+        for d in self.dimnames:
+            g0 = first.dimension(d)
+            for r in self.readers[1:]:
+                g = r.dimension(d)
+                for a in ('step', 'start'):
+                    if a in g0 and a in g and not np.allclose(g0[a], g[a]):
+                        raise ValueError('%s: %s:%s is %s, expected %s (from %s)'
+                                         % (r.fname, d, a, g[a], g0[a], first.fname,))
+
+    def geometry(self):
+        """
+        step/start/direction_cosines of the output dimensions, from the
+        first input.
+        """
+        return dict((d, self.readers[0].dimension(d)) for d in self.out_dimnames)
+
+    def _transform(self, x):
+        if self.binarize:
+            lo, hi = self.bin_range
+            x = np.where(np.isnan(x), np.nan, ((x >= lo) & (x <= hi)).astype(np.float64))
+        return x
+
+    def slabs(self):
+        """
+        (start, count) along the slab axis of the slabs to process, each
+        within max_buffer_size_in_kb.
+        """
+        per_voxel = ACCUMULATOR_BYTES
+        if self.avg_axis is not None:
+            per_voxel += 8 * self.shape[self.avg_axis]
+        else:
+            per_voxel += 8
+        return slab_plan(self.shape, self.slab_axis, per_voxel, self.max_buffer_size_in_kb)
+
+    def read(self, i, start, count):
+        """
+        Slab (start, count along the slab axis) of input i, in real
+        values, binarized if asked for.
+        """
+        rstart = [0] * len(self.shape)
+        rcount = list(self.shape)
+        rstart[self.slab_axis], rcount[self.slab_axis] = start, count
+        return self._transform(self.readers[i].read_real(rstart, rcount))
+
+    def input_mean(self, i):
+        """
+        Mean over all voxels of input i.
+        """
+        total, n = 0.0, 0
+        for (s, c) in self.slabs():
+            x = self.read(i, s, c)
+            total += np.nansum(x)
+            n += np.count_nonzero(~np.isnan(x))
+        return total / n if n else 0.0
+
+    def _norm_factors(self):
+        return norm_factors([self.input_mean(i) for i in range(len(self.readers))])
+
+    def _samples(self, i, x):
+        """
+        (values, weight) pairs contributed by slab x of input i.
+        """
+        w = self.weights[i]
+        if self.norm_factors is not None:
+            x = x * self.norm_factors[i]
+        if self.avg_axis is None:
+            yield x, w
+        else:
+            for k in range(x.shape[self.avg_axis]):
+                yield np.take(x, k, axis=self.avg_axis), w * self.avg_weights[k]
+
+    def accumulate(self, start, count, readers=None):
+        """
+        An Accumulator over one slab (start, count along the slab axis)
+        of the given inputs (default: all of them).
+        """
+        if readers is None:
+            readers = list(range(len(self.readers)))
+        out_count = list(self.out_shape)
+        out_count[0] = count
+        acc = Accumulator(tuple(out_count))
+
+        for i in readers:
+            for (v, w) in self._samples(i, self.read(i, start, count)):
+                acc.add(v, w)
+        return acc
+
+    def __iter__(self):
+        """
+        Yield (start, accumulator) for consecutive slabs of the output.
+        """
+        for (s, c) in self.slabs():
+            yield s, self.accumulate(s, c)
+
+def _open_writers(engine, output_file, sdfile, vartype, signtype, valid_range, two, clobber, first_reader):
+    if vartype is None:
+        layout = first_reader.layout()
+        vartype, signtype = layout.vartype, layout.signtype
+
+    writers = []
+    for f in [output_file, sdfile]:
+        if f is not None:
+            writers.append(minc_io.RawToMincWriter(f, engine.out_dimnames, engine.out_shape,
+                                                   geometry=engine.geometry(),
+                                                   vartype=vartype, signtype=signtype,
+                                                   valid_range=valid_range,
+                                                   two=two, clobber=clobber))
+    return writers
+
+def _write(writers, accumulators):
+    """
+    Write the mean (and standard deviation, if there are two writers)
+    of consecutive slabs.
+    """
+    try:
+        for acc in accumulators:
+            writers[0].write(acc.mean)
+            if len(writers) > 1:
+                writers[1].write(acc.sd())
+        for w in writers:
+            w.close()
+    except:
+        for w in writers:
+            w.abort()
+        raise
+
+def average(input_files, output_file, sdfile=None, weights=None, normalize=False,
+            binarize=False, binrange=None, binvalue=None, avgdim=None, width_weighted=False,
+            max_buffer_size_in_kb=4096, check_dimensions=True,
+            vartype=None, signtype=None, valid_range=None, two=False, clobber=False):
+    """
+    Average input_files into output_file (and the standard deviation
+    into sdfile), like mincaverage with the corresponding options. The
+    output type defaults to the type of the first input.
+    """
+    readers = [minc_io.open_volume(f) for f in input_files]
+    try:
+        engine = AverageEngine(readers, weights=weights, normalize=normalize,
+                               binarize=binarize, binrange=binrange, binvalue=binvalue,
+                               avgdim=avgdim, width_weighted=width_weighted,
+                               max_buffer_size_in_kb=max_buffer_size_in_kb,
+                               check_dimensions=check_dimensions)
+        writers = _open_writers(engine, output_file, sdfile, vartype, signtype,
+                                valid_range, two, clobber, readers[0])
+        _write(writers, (acc for (_, acc) in engine))
+    finally:
+        for r in readers:
+            r.close()
+
+# AverageInputSpec format_* traits and the output type they select.
+_format_types = [('format_byte',     ('byte',   None)),
+                 ('format_short',    ('short',  None)),
+                 ('format_int',      ('int',    None)),
+                 ('format_long',     ('int',    None)),
+                 ('format_float',    ('float',  None)),
+                 ('format_double',   ('double', None)),
+                 ('format_signed',   (None,     'signed')),
+                 ('format_unsigned', (None,     'unsigned')),
+                ]
+
+def input_file_list(inputs):
+    """
+    The input files of an AverageInputSpec: input_files followed by the
+    contents of the -filelist file, if any.
+    """
+    files = list(inputs.input_files) if isdefined(inputs.input_files) else []
+    if isdefined(inputs.foo):
+        if inputs.foo == '-':
+            raise ValueError('the averaging engine cannot read the file list from stdin')
+        with open(inputs.foo) as f:
+            files += [l.strip() for l in f if l.strip()]
+    return files
+
+def task_options(inputs):
+    """
+    The input files and keyword arguments of average() corresponding to
+    an AverageInputSpec.
+    """
+
+    def get(name, default=None):
+        v = getattr(inputs, name)
+        return v if isdefined(v) else default
+
+    vartype, signtype = None, None
+    for (name, (t, s)) in _format_types:
+        if get(name):
+            vartype, signtype = t, s
+    if signtype is not None and vartype is None:
+        warn('-signed/-unsigned without a type, ignored by the averaging engine')
+        signtype = None
+
+    if get('copy_header'):
+        warn('the averaging engine does not copy headers; only the geometry is copied')
+
+    weights = get('weights')
+    if weights is not None:
+        weights = [float(w) for ws in weights for w in str(ws).split(',') if w.strip()]
+
+    return input_file_list(inputs), {
+            'sdfile':                   get('sdfile'),
+            'weights':                  weights,
+            'normalize':                get('normalize', False),
+            'binarize':                 get('binarize', False),
+            'binrange':                 get('binrange'),
+            'binvalue':                 get('binvalue'),
+            'avgdim':                   get('avgdim'),
+            'width_weighted':           get('width_weighted', False),
+            'max_buffer_size_in_kb':    get('max_buffer_size_in_kb', 4096),
+            'check_dimensions':         not get('no_check_dimensions', False),
+            'vartype':                  vartype,
+            'signtype':                 signtype,
+            'valid_range':              get('voxel_range'),
+            'two':                      get('two', False),
+            'clobber':                  get('clobber', False),
+           }
+
+def run_task(inputs):
+    """
+    Run average() with the options of an AverageInputSpec.
+    """
+    files, kwargs = task_options(inputs)
+    average(files, inputs.output_file, **kwargs)
+
+class Partial(object):
+    """
+    The Accumulator state of a whole output volume, stored as
+    <prefix>.<field>.npy files and memory-mapped.
+    """
+
+    FIELDS = ('weight', 'count', 'mean', 'm2')
+
+    def __init__(self, prefix, mode='r'):
+        self.prefix = prefix
+        self.arrays = [np.load(self._fname(f), mmap_mode=mode) for f in self.FIELDS]
+        self.shape = self.arrays[0].shape
+
+    def _fname(self, field):
+        return '%s.%s.npy' % (self.prefix, field,)
+
+    @classmethod
+    def create(cls, prefix, shape):
+        for f in cls.FIELDS:
+            np.lib.format.open_memmap('%s.%s.npy' % (prefix, f,), mode='w+',
+                                      dtype=np.float64, shape=tuple(shape))
+        return cls(prefix, mode='r+')
+
+    def slab(self, start, count):
+        return Accumulator.from_arrays(*[a[start:start + count] for a in self.arrays])
+
+    def store(self, start, acc):
+        for (a, v) in zip(self.arrays, (acc.weight, acc.count, acc.mean, acc.m2)):
+            a[start:start + v.shape[0]] = v
+
+    def slabs(self, max_buffer_size_in_kb):
+        for (s, c) in slab_plan(self.shape, 0, 2 * ACCUMULATOR_BYTES, max_buffer_size_in_kb):
+            yield s, self.slab(s, c)
+
+    def close(self):
+        for a in self.arrays:
+            if isinstance(a, np.memmap):
+                a.flush()
+        self.arrays = None
+
+    def remove(self):
+        self.arrays = None
+        for f in self.FIELDS:
+            os.remove(self._fname(f))
+
+# Options of AverageEngine that are passed on to every shard.
+_engine_options = ('binarize', 'binrange', 'binvalue', 'avgdim', 'width_weighted',
+                   'max_buffer_size_in_kb', 'check_dimensions',)
+
+def _input_mean(job):
+    fname, options = job
+    reader = minc_io.open_volume(fname)
+    try:
+        return AverageEngine([reader], **options).input_mean(0)
+    finally:
+        reader.close()
+
+def _numpy_shard(job):
+    prefix, files, weights, factors, options = job
+    readers = [minc_io.open_volume(f) for f in files]
+    try:
+        engine = AverageEngine(readers, weights=weights, norm_factors=factors, **options)
+        partial = Partial.create(prefix, engine.out_shape)
+        for (s, acc) in engine:
+            partial.store(s, acc)
+        partial.close()
+    finally:
+        for r in readers:
+            r.close()
+    return prefix
+
+def _binary_shard(job):
+    """
+    Average a shard with mincaverage -filelist, in double precision, and
+    turn its mean and standard deviation back into accumulator state.
+    This assumes that every voxel of every input is valid.
+    """
+    import minc
+
+    prefix, files, weights, _, options = job
+    filelist = prefix + '.list'
+    with open(filelist, 'w') as f:
+        f.write('\n'.join(files) + '\n')
+
+    mean_file, sd_file = prefix + '_mean.mnc', prefix + '_sd.mnc'
+    task = minc.AverageTask(foo=filelist, output_file=mean_file, sdfile=sd_file,
+                            format_double=True, clobber=True, quiet=True)
+    for name in ('binarize', 'binrange', 'binvalue', 'max_buffer_size_in_kb'):
+        if options.get(name) not in (None, False):
+            setattr(task.inputs, name, options[name])
+    if not options.get('check_dimensions', True):
+        task.inputs.no_check_dimensions = True
+    if weights is not None:
+        task.inputs.weights = [','.join(repr(float(w)) for w in weights)]
+
+    result = task.run()
+    if result.runtime.returncode != 0:
+        raise RuntimeError('%s failed: %s' % (task.cmdline, result.runtime.stderr,))
+
+    n = float(len(files))
+    total = float(sum(weights)) if weights is not None else n
+    mean, sd = minc_io.open_volume(mean_file), minc_io.open_volume(sd_file)
+    try:
+        partial = Partial.create(prefix, mean.shape)
+        for (s, c) in slab_plan(mean.shape, 0, 2 * ACCUMULATOR_BYTES, options.get('max_buffer_size_in_kb', 4096)):
+            start = (s,) + (0,) * (len(mean.shape) - 1)
+            count = (c,) + tuple(mean.shape[1:])
+            m, d = mean.read_real(start, count), sd.read_real(start, count)
+            ones = np.ones_like(m)
+            m2 = d * d * total * (n - 1) / n if n > 1 else np.zeros_like(m)
+            partial.store(s, Accumulator.from_arrays(ones * total, ones * n, m, m2))
+        partial.close()
+    finally:
+        mean.close()
+        sd.close()
+        for f in (filelist, mean_file, sd_file):
+            os.remove(f)
+    return prefix
+
+def _merge(job):
+    prefix, parts, max_buffer_size_in_kb = job
+    inputs = [Partial(p) for p in parts]
+    out = Partial.create(prefix, inputs[0].shape)
+    for (s, c) in slab_plan(out.shape, 0, 2 * ACCUMULATOR_BYTES, max_buffer_size_in_kb):
+        acc = inputs[0].slab(s, c)
+        for p in inputs[1:]:
+            acc.merge(p.slab(s, c))
+        out.store(s, acc)
+    out.close()
+    for p in inputs:
+        p.remove()
+    return prefix
+
+def tree_reduce(input_files, workdir, weights=None, normalize=False,
+                shard_size=64, fanin=2, processes=None, engine='numpy', **options):
+    """
+    Accumulate input_files shard by shard in a process pool and merge
+    the shards in a reduction tree of the given fan-in. Returns the
+    prefix of the final Partial in workdir. engine 'numpy' accumulates
+    shards in-process; 'binary' runs mincaverage -filelist on each.
+    """
+    if np is None:
+        raise ImportError('numpy is required for the averaging engine')
+    if engine not in ('numpy', 'binary'):
+        raise ValueError('unknown engine %r' % engine)
+    if engine == 'binary' and (normalize or options.get('avgdim')):
+        raise ValueError('normalize and avgdim need the numpy engine in tree mode')
+    if shard_size < 1 or fanin < 2:
+        raise ValueError('shard_size must be at least 1 and fanin at least 2')
+    if weights is not None and len(weights) != len(input_files):
+        raise ValueError('%d weights for %d input files' % (len(weights), len(input_files),))
+
+    options = dict((k, v) for (k, v) in options.items() if k in _engine_options)
+    shards = [list(range(i, min(i + shard_size, len(input_files))))
+              for i in range(0, len(input_files), shard_size)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        factors = None
+        if normalize:
+            means = pool.map(_input_mean, [(f, options) for f in input_files])
+            factors = norm_factors(means)
+
+        worker = _numpy_shard if engine == 'numpy' else _binary_shard
+        jobs = []
+        for (k, shard) in enumerate(shards):
+            jobs.append((os.path.join(workdir, 'shard%d' % k),
+                         [input_files[i] for i in shard],
+                         None if weights is None else [weights[i] for i in shard],
+                         None if factors is None else [factors[i] for i in shard],
+                         options))
+        level = pool.map(worker, jobs)
+
+        depth = 0
+        while len(level) > 1:
+            depth += 1
+            groups = [level[i:i + fanin] for i in range(0, len(level), fanin)]
+            level = pool.map(_merge, [(os.path.join(workdir, 'level%d_%d' % (depth, k,)), g,
+                                       options.get('max_buffer_size_in_kb', 4096))
+                                      for (k, g) in enumerate(groups)])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return level[0]
+
+def tree_average(input_files, output_file, sdfile=None, weights=None, normalize=False,
+                 shard_size=64, fanin=2, processes=None, engine='numpy', workdir=None,
+                 vartype=None, signtype=None, valid_range=None, two=False, clobber=False,
+                 **options):
+    """
+    Like average(), but through tree_reduce(), for input lists too long
+    for one process or one command line. The result is the same as a
+    single-pass average, up to floating-point rounding.
+    """
+    # Check the geometry of the first file of every shard against the
+    # first file; each shard checks its own members.
+    heads = [minc_io.open_volume(f) for f in input_files[::shard_size]]
+    try:
+        head = AverageEngine(heads, avgdim=options.get('avgdim'),
+                             check_dimensions=options.get('check_dimensions', True))
+
+        tmp = tempfile.mkdtemp(dir=workdir, prefix='mincaverage-tree-')
+        try:
+            prefix = tree_reduce(input_files, tmp, weights=weights, normalize=normalize,
+                                 shard_size=shard_size, fanin=fanin, processes=processes,
+                                 engine=engine, **options)
+            final = Partial(prefix)
+            writers = _open_writers(head, output_file, sdfile, vartype, signtype,
+                                    valid_range, two, clobber, heads[0])
+            _write(writers, (acc for (_, acc) in
+                             final.slabs(options.get('max_buffer_size_in_kb', 4096))))
+            final.close()
+        finally:
+            shutil.rmtree(tmp)
+    finally:
+        for r in heads:
+            r.close()
+
+def run_task_tree(inputs):
+    """
+    Run tree_average() with the options of an AverageInputSpec.
+    """
+    files, kwargs = task_options(inputs)
+    kwargs['shard_size'] = inputs.tree_shard_size
+    if isdefined(inputs.tree_fanin):
+        kwargs['fanin'] = inputs.tree_fanin
+    if isdefined(inputs.tree_processes):
+        kwargs['processes'] = inputs.tree_processes
+    tree_average(files, inputs.output_file, engine=inputs.engine, **kwargs)
+
+# Options of AverageEngine that change the statistics of a Cohort, and
+# their defaults.
+_cohort_options = {'binarize':          False,
+                   'binrange':          None,
+                   'binvalue':          None,
+                   'avgdim':            None,
+                   'width_weighted':    False,
+                  }
+
+COHORT_VERSION = 1
+
+def _difference(a, b):
+    """
+    The items of list a not in list b, counting repeats, in order.
+    """
+    import collections
+    left = collections.Counter(b)
+    out = []
+    for x in a:
+        if left[x]:
+            left[x] -= 1
+        else:
+            out.append(x)
+    return out
+
+class Cohort(object):
+    """
+    The Accumulator state of an average over a set of inputs that
+    changes between runs: a Partial at <prefix>.<generation>, and
+    <prefix>.json listing the inputs (with their weights and (inode,
+    size, mtime)), the options the state was built with and the current
+    generation. An update writes the next generation and then replaces
+    the .json, so an interrupted update leaves the previous state.
+
+    update() brings the state to a new input list by reading only the
+    inputs added or removed since the last run, so adding or removing N
+    inputs costs N volume reads and one pass over the state. Removing
+    subtracts samples in floating point; pass rebuild=True to
+    incremental_average() now and then to start again from the inputs.
+    """
+
+    def __init__(self, prefix):
+        import json
+        self.prefix = prefix
+        with open(prefix + '.json') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != COHORT_VERSION:
+            raise ValueError('%s.json: unknown cohort version %r' % (prefix, manifest.get('version'),))
+        self.members = [(m['file'], m['weight'], tuple(m['key'])) for m in manifest['members']]
+        self.options = manifest['options']
+        self.generation = manifest['generation']
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.json')
+
+    @staticmethod
+    def _options(options):
+        import json
+        # As read back from the manifest, so that the two compare equal.
+        return json.loads(json.dumps(dict((k, options.get(k, v)) for (k, v) in _cohort_options.items())))
+
+    @classmethod
+    def create(cls, prefix, **options):
+        """
+        An empty cohort at prefix, replacing any there.
+        """
+        if cls.exists(prefix):
+            cls(prefix)._remove_state()
+        cohort = cls.__new__(cls)
+        cohort.prefix = prefix
+        cohort.members = []
+        cohort.options = cls._options(options)
+        cohort.generation = 0
+        cohort._save()
+        return cohort
+
+    def _state_prefix(self, generation=None):
+        return '%s.%d' % (self.prefix, self.generation if generation is None else generation,)
+
+    def _remove_state(self):
+        if self.generation > 0:
+            Partial(self._state_prefix()).remove()
+
+    def compatible(self, **options):
+        """
+        Was the state built with these options, from inputs that have
+        not changed since?
+        """
+        import minc_header
+        if self.options != self._options(options):
+            return False
+        try:
+            return all(minc_header.file_key(f) == key for (f, _, key) in self.members)
+        except OSError:
+            return False
+
+    def _save(self):
+        import json
+        tmp = '%s.json.tmp%d' % (self.prefix, os.getpid(),)
+        with open(tmp, 'w') as out:
+            json.dump({'version':   COHORT_VERSION,
+                       'members':   [{'file': f, 'weight': w, 'key': list(k)} for (f, w, k) in self.members],
+                       'options':   self.options,
+                       'generation': self.generation,
+                      }, out, indent=1)
+        os.rename(tmp, self.prefix + '.json')
+
+    def _engine(self, files, weights, max_buffer_size_in_kb=4096, check_dimensions=True):
+        readers = [minc_io.open_volume(f) for f in files]
+        try:
+            return AverageEngine(readers, weights=weights, max_buffer_size_in_kb=max_buffer_size_in_kb,
+                                 check_dimensions=check_dimensions, **self.options)
+        except:
+            for r in readers:
+                r.close()
+            raise
+
+    def update(self, input_files, weights=None, max_buffer_size_in_kb=4096, check_dimensions=True):
+        """
+        Bring the state to the average of input_files (with weights,
+        default 1). Returns the lists of files added and removed.
+        """
+        import minc_header
+
+        if weights is None:
+            weights = [1.0] * len(input_files)
+        if len(weights) != len(input_files):
+            raise ValueError('%d weights for %d input files' % (len(weights), len(input_files),))
+        new = [(os.path.abspath(f), float(w)) for (f, w) in zip(input_files, weights)]
+        if not new:
+            raise ValueError('nothing to average')
+        old = [(f, w) for (f, w, _) in self.members]
+        added, removed = _difference(new, old), _difference(old, new)
+        if not added and not removed:
+            return [], []
+
+        # The first input comes first so that the others are checked
+        # against it, as in a full average.
+        changed = [new[0]] + added + removed
+        engine = self._engine([f for (f, _) in changed], [w for (_, w) in changed],
+                              max_buffer_size_in_kb, check_dimensions)
+        try:
+            state = Partial(self._state_prefix()) if self.generation > 0 else None
+            if state is not None and state.shape != engine.out_shape:
+                raise ValueError('%s has shape %s, the cohort %s' % (new[0][0], engine.out_shape, state.shape,))
+
+            out = Partial.create(self._state_prefix(self.generation + 1), engine.out_shape)
+            n = len(added)
+            for (s, c) in engine.slabs():
+                acc = state.slab(s, c) if state is not None else engine.accumulate(s, c, readers=[])
+                for i in range(1, n + 1):
+                    for (v, w) in engine._samples(i, engine.read(i, s, c)):
+                        acc.add(v, w)
+                for i in range(n + 1, len(changed)):
+                    for (v, w) in engine._samples(i, engine.read(i, s, c)):
+                        acc.remove(v, w)
+                out.store(s, acc)
+            out.close()
+            if state is not None:
+                state.close()
+        finally:
+            for r in engine.readers:
+                r.close()
+
+        self.members = [(f, w, tuple(minc_header.file_key(f))) for (f, w) in new]
+        self.generation += 1
+        self._save()
+        if state is not None:
+            state.remove()
+        return [f for (f, _) in added], [f for (f, _) in removed]
+
+    def write(self, output_file, sdfile=None, max_buffer_size_in_kb=4096,
+              vartype=None, signtype=None, valid_range=None, two=False, clobber=False):
+        """
+        Write the mean (and standard deviation) of the current state,
+        with the geometry of the first input.
+        """
+        if not self.members:
+            raise ValueError('nothing to average')
+        engine = self._engine([self.members[0][0]], None, max_buffer_size_in_kb)
+        try:
+            state = Partial(self._state_prefix())
+            writers = _open_writers(engine, output_file, sdfile, vartype, signtype,
+                                    valid_range, two, clobber, engine.readers[0])
+            _write(writers, (acc for (_, acc) in state.slabs(max_buffer_size_in_kb)))
+            state.close()
+        finally:
+            engine.readers[0].close()
+
+def incremental_average(input_files, output_file, stats_prefix, sdfile=None, weights=None,
+                        normalize=False, rebuild=False, max_buffer_size_in_kb=4096,
+                        check_dimensions=True, vartype=None, signtype=None, valid_range=None,
+                        two=False, clobber=False, **options):
+    """
+    Like average(), keeping the statistics in a Cohort at stats_prefix
+    so that the next call only reads the inputs that have changed. The
+    state is rebuilt from all the inputs when there is none, when it
+    was built with other options or from inputs that have since
+    changed, or when rebuild is set. Returns the lists of files added
+    and removed.
+    """
+    if normalize:
+        raise ValueError('normalize depends on every input and cannot be averaged incrementally')
+    if Cohort.exists(stats_prefix) and not rebuild:
+        cohort = Cohort(stats_prefix)
+        if not cohort.compatible(**options):
+            warn('%s is out of date, rebuilding it from all the inputs' % stats_prefix)
+            cohort = Cohort.create(stats_prefix, **options)
+    else:
+        cohort = Cohort.create(stats_prefix, **options)
+    added, removed = cohort.update(input_files, weights, max_buffer_size_in_kb, check_dimensions)
+    cohort.write(output_file, sdfile, max_buffer_size_in_kb, vartype, signtype,
+                 valid_range, two, clobber)
+    return added, removed
+
+def run_task_incremental(inputs):
+    """
+    Run incremental_average() with the options of an AverageInputSpec.
+    """
+    files, kwargs = task_options(inputs)
+    incremental_average(files, inputs.output_file, inputs.stats_prefix, **kwargs)
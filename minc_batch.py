@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: make-style batch driver for ConvertTask: convert a whole
+#           directory tree (or a manifest of input/output pairs) with a
+#           bounded process pool.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Each output is written to a temporary name next to its final location
+# and renamed into place only when mincconvert succeeds, so an
+# interrupted batch never leaves a truncated file that looks up to date.
+# Outputs that are at least as new as their inputs are skipped, as make
+# would.
+
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+MINC_SUFFIXES = ('.mnc',)
+
+def plan_tree(src_root, dst_root, suffixes=MINC_SUFFIXES):
+    """
+    (input, output) pairs for every MINC file under src_root, mapped to
+    the same relative path under dst_root.
+    """
+    src_root = os.path.abspath(src_root)
+    dst_root = os.path.abspath(dst_root)
+    jobs = []
+    for (dirpath, dirnames, filenames) in os.walk(src_root):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(suffixes):
+                inp = os.path.join(dirpath, f)
+                jobs.append((inp, os.path.join(dst_root, os.path.relpath(inp, src_root))))
+    return jobs
+
+def read_manifest(fname):
+    """
+    (input, output) pairs from a manifest: either a JSON list of pairs
+    (or of {"input": ..., "output": ...} objects), or a text file with
+    one tab- or comma-separated pair per line. Relative paths are taken
+    relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(fname))
+
+    with open(fname) as f:
+        text = f.read()
+
+    if text.lstrip().startswith('['):
+        pairs = []
+        for item in json.loads(text):
+            if isinstance(item, dict):
+                pairs.append((item['input'], item['output']))
+            else:
+                pairs.append(tuple(item))
+    else:
+        dialect = 'excel-tab' if '\t' in text else 'excel'
+        pairs = [tuple(row[:2]) for row in csv.reader(text.splitlines(), dialect)
+                 if row and not row[0].startswith('#')]
+
+    return [(os.path.join(base, i), os.path.join(base, o)) for (i, o) in pairs]
+
+def up_to_date(input_file, output_file):
+    """
+    Is output_file at least as new as input_file?
+    """
+    try:
+        return os.stat(output_file).st_mtime >= os.stat(input_file).st_mtime
+    except OSError:
+        return False
+
+def temp_name(output_file):
+    """
+    The name output_file is written under until it is complete: hidden,
+    in the same directory (so the rename is atomic) and unique to this
+    process.
+    """
+    d, f = os.path.split(output_file)
+    return os.path.join(d, '.%s.tmp%d%s' % (os.path.splitext(f)[0], os.getpid(),
+                                            os.path.splitext(f)[1],))
+
+def convert_one(job):
+    """
+    Convert one (input, output, options) job with ConvertTask. Returns
+    a result dict with the status ('converted', 'skipped' or 'failed'),
+    timings and sizes.
+    """
+    import minc
+
+    input_file, output_file, options, force = job
+    result = {'input':      input_file,
+              'output':     output_file,
+              'status':     None,
+              'seconds':    0.0,
+              'in_bytes':   0,
+              'out_bytes':  0,
+              'error':      None,
+             }
+
+    if not force and up_to_date(input_file, output_file):
+        result['status'] = 'skipped'
+        return result
+
+    tmp = temp_name(output_file)
+    t0 = time.time()
+    try:
+        d = os.path.dirname(output_file)
+        if d and not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                # Another worker got there first.
+                if not os.path.isdir(d):
+                    raise
+
+        task = minc.ConvertTask(input_file=input_file, output_file=tmp, clobber=True, **options)
+        runtime = task.run().runtime
+        if runtime.returncode != 0 or not os.path.exists(tmp):
+            raise RuntimeError('%s failed (exit code %s): %s'
+                               % (task.cmdline, runtime.returncode, runtime.stderr,))
+        os.rename(tmp, output_file)
+
+        result['status'] = 'converted'
+        result['in_bytes'] = os.path.getsize(input_file)
+        result['out_bytes'] = os.path.getsize(output_file)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e,)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    result['seconds'] = time.time() - t0
+    return result
+
+class BatchReport(object):
+    """
+    Per-file results of a batch, and totals.
+    """
+
+    def __init__(self, results, wall):
+        self.results = results
+        self.wall = wall
+
+    def _with(self, status):
+        return [r for r in self.results if r['status'] == status]
+
+    @property
+    def converted(self):
+        return self._with('converted')
+
+    @property
+    def skipped(self):
+        return self._with('skipped')
+
+    @property
+    def failed(self):
+        return self._with('failed')
+
+    def summary(self):
+        done = self.converted
+        in_bytes = sum(r['in_bytes'] for r in done)
+        out_bytes = sum(r['out_bytes'] for r in done)
+        busy = sum(r['seconds'] for r in done)
+        return {'converted':        len(done),
+                'skipped':          len(self.skipped),
+                'failed':           len(self.failed),
+                'wall_seconds':     self.wall,
+                'busy_seconds':     busy,
+                'in_bytes':         in_bytes,
+                'out_bytes':        out_bytes,
+                'ratio':            float(out_bytes) / in_bytes if in_bytes else None,
+                'mb_per_second':    in_bytes / 1e6 / self.wall if self.wall > 0 else None,
+                'files_per_second': len(done) / self.wall if self.wall > 0 else None,
+               }
+
+    def format(self):
+        """
+        A plain-text report: one line per converted or failed file,
+        slowest first, then the totals.
+        """
+        lines = []
+        for r in sorted(self.converted, key=lambda r: -r['seconds']):
+            lines.append('%8.2fs %10d -> %10d  %s' % (r['seconds'], r['in_bytes'], r['out_bytes'], r['output'],))
+        for r in self.failed:
+            lines.append('  FAILED  %s: %s' % (r['input'], r['error'],))
+
+        s = self.summary()
+        lines.append('%d converted, %d skipped, %d failed in %.2fs'
+                     % (s['converted'], s['skipped'], s['failed'], s['wall_seconds'],))
+        if s['converted']:
+            lines.append('%.1f MB in, %.1f MB out (ratio %.2f), %.2f MB/s, %.2f files/s'
+                         % (s['in_bytes'] / 1e6, s['out_bytes'] / 1e6, s['ratio'] or 0.0,
+                            s['mb_per_second'] or 0.0, s['files_per_second'] or 0.0,))
+        return '\n'.join(lines)
+
+def convert_batch(jobs, processes=None, force=False, progress=None, **options):
+    """
+    Run ConvertTask over (input, output) pairs in a pool of at most
+    processes workers (default: number of CPUs). options are ConvertTask
+    inputs, e.g. two=True, compression=4. progress, if given, is called
+    with each result dict as it completes. Returns a BatchReport.
+    """
+    for k in ('input_file', 'output_file', 'clobber'):
+        if k in options:
+            raise ValueError('%s is set per job by convert_batch' % k)
+
+    work = [(i, o, options, force) for (i, o) in jobs]
+    results = []
+    t0 = time.time()
+
+    if processes == 1:
+        for job in work:
+            results.append(convert_one(job))
+            if progress is not None:
+                progress(results[-1])
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for r in pool.imap_unordered(convert_one, work):
+                results.append(r)
+                if progress is not None:
+                    progress(r)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    return BatchReport(results, time.time() - t0)
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: content-addressed cache of MINC Task results.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# A result is keyed by the content of the task's input files, its
+# command line with the input and output paths masked out, any inputs
+# that do not appear on the command line (such as the averaging engine)
+# and the MINC toolchain version. The same conversion of the same data
+# is therefore a hit even if the files have moved.
+#
+# Outputs are copied into the cache (by reflink where the filesystem
+# allows) and restored by reflink where possible (a plain copy
+# otherwise), so a restored output is the user's to overwrite. Cached
+# objects are made read-only. link='hardlink' restores by hardlink
+# instead, saving the copy: the restored output then *is* the cached
+# object. The cache remembers the inode of every object, and before it
+# runs a Task it removes those of the outputs that are one of its
+# objects, rather than let the tool open it in place; any other file is
+# left alone. A run without the cache does not know its objects, so
+# outputs restored by hardlink must not be written over by uncached
+# runs.
+#
+# Layout of the cache directory:
+#
+#     index.db                  SQLite: entries, file hash memo, counters
+#     objects/ab/abcdef.../     one directory per entry, one file per
+#                               output, named after the input trait
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+CACHE_VERSION = 1
+
+HASH_BLOCK = 1 << 20
+
+# Inputs that never change what a tool produces.
+IGNORED_INPUTS = ('environ', 'ignore_exception', 'terminal_output', 'args')
+
+# From linux/fs.h.
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """
+    Clone src to dst sharing extents (btrfs, XFS, ...). Raises OSError
+    or IOError if the filesystem cannot do it.
+    """
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except (IOError, OSError):
+                d.close()
+                os.remove(dst)
+                raise
+
+def link_or_copy(src, dst, link='hardlink'):
+    """
+    Make dst a copy of src as cheaply as possible: link is 'hardlink'
+    (falling back to reflink, then copy), 'reflink' (falling back to
+    copy) or 'copy'. Returns the method used.
+    """
+    if link not in ('hardlink', 'reflink', 'copy'):
+        raise ValueError('unknown link method %r' % link)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    if link in ('hardlink', 'reflink'):
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except (IOError, OSError):
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+def _file_digest(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def _listify(v):
+    return list(v) if isinstance(v, (list, tuple)) else [v]
+
+def output_paths(task):
+    """
+    name -> path of each output file of task, generated names included.
+    """
+    from nipype.interfaces.base import isdefined
+    paths = {}
+    traits = task.inputs.traits()
+    for name in task._cache_outputs:
+        v = getattr(task.inputs, name)
+        if not isdefined(v):
+            v = task._gen_filename(name) if traits[name].genfile else None
+        if v:
+            paths[name] = os.path.abspath(v)
+    return paths
+
+def _masked_cmdline(task, outputs):
+    """
+    task.cmdline with the paths of its inputs and outputs replaced by
+    placeholders.
+    """
+    from nipype.interfaces.base import isdefined
+    masks = []
+    for name in task._cache_inputs:
+        v = getattr(task.inputs, name)
+        if isdefined(v):
+            masks += [(p, '<%s:%d>' % (name, i,)) for (i, p) in enumerate(_listify(v))]
+    for (name, p) in outputs.items():
+        masks.append((p, '<%s>' % name))
+        masks.append((os.path.relpath(p), '<%s>' % name))
+
+    cmdline = task.cmdline
+    # Longest first, so that no path is masked inside a longer one.
+    for (p, placeholder) in sorted(masks, key=lambda m: -len(m[0])):
+        cmdline = cmdline.replace(p, placeholder)
+    return cmdline
+
+def _extras(task):
+    """
+    Defined inputs that are not on the command line but may change the
+    result.
+    """
+    skip = set(task._cache_inputs) | set(task._cache_outputs) | set(IGNORED_INPUTS)
+    traits = task.inputs.traits()
+    extras = []
+    for (name, value) in sorted(task.inputs.get_traitsfree().items()):
+        if name in skip or traits[name].argstr:
+            continue
+        extras.append((name, value))
+    return extras
+
+def get_cache(spec):
+    """
+    The ResultCache for a task's cache setting: a ResultCache, a
+    directory, False (no caching) or None, meaning $MINC_RESULT_CACHE if
+    set (with $MINC_RESULT_CACHE_SIZE as the size cap in bytes).
+    """
+    if spec is False:
+        return None
+    if isinstance(spec, ResultCache):
+        return spec
+    if spec is None:
+        spec = os.environ.get('MINC_RESULT_CACHE')
+        if not spec:
+            return None
+        size = os.environ.get('MINC_RESULT_CACHE_SIZE')
+        return _open_cache(spec, int(size) if size else None)
+    return _open_cache(spec, None)
+
+_caches = {}
+
+def _open_cache(root, max_bytes):
+    root = os.path.abspath(root)
+    key = (root, max_bytes)
+    if key not in _caches:
+        _caches[key] = ResultCache(root, max_bytes)
+    return _caches[key]
+
+class ResultCache(object):
+    """
+    A directory of cached Task outputs with an LRU size cap (max_bytes,
+    None for no cap). Safe to share between processes and threads.
+    """
+
+    def __init__(self, root, max_bytes=None, link='reflink'):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.link = link
+        self._local = threading.local()
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        del d['_local']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        # One connection per thread, and per process: SQLite connections
+        # must not cross a fork, and may only be used by the thread that
+        # opened them (minc_async runs cached Tasks in an executor).
+        local = self._local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            if not os.path.isdir(self.root):
+                try:
+                    os.makedirs(self.root)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            local.db = sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=60)
+            local.pid = os.getpid()
+            local.db.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key        TEXT PRIMARY KEY,
+                    size       INTEGER,
+                    created    REAL,
+                    last_used  REAL,
+                    hits       INTEGER,
+                    meta       TEXT);
+                CREATE TABLE IF NOT EXISTS hashes (
+                    path       TEXT PRIMARY KEY,
+                    inode      INTEGER,
+                    size       INTEGER,
+                    mtime      REAL,
+                    digest     TEXT);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name       TEXT PRIMARY KEY,
+                    value      INTEGER);
+                CREATE TABLE IF NOT EXISTS objects (
+                    dev        INTEGER,
+                    inode      INTEGER,
+                    key        TEXT,
+                    PRIMARY KEY (dev, inode));''')
+            local.db.commit()
+        return local.db
+
+    def close(self):
+        # This thread's connection.
+        if getattr(self._local, 'db', None) is not None:
+            self._local.db.close()
+            self._local.db = None
+
+    def _count(self, name, n=1):
+        self.db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        self.db.execute('UPDATE counters SET value = value + ? WHERE name = ?', (n, name,))
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, 'objects', key[:2], key)
+
+    def digest(self, fname):
+        """
+        SHA-1 of the content of fname, remembered by inode, size and
+        mtime so that unchanged files are not read again.
+        """
+        from minc_header import file_key
+        path = os.path.abspath(fname)
+        fkey = file_key(path)
+        row = self.db.execute('SELECT inode, size, mtime, digest FROM hashes WHERE path = ?',
+                              (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == tuple(fkey):
+            return row[3]
+        digest = _file_digest(path)
+        self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                        (path,) + tuple(fkey) + (digest,))
+        self.db.commit()
+        return digest
+
+    def key(self, task, outputs=None):
+        """
+        The cache key of task.
+        """
+        from minc import Info
+        if outputs is None:
+            outputs = output_paths(task)
+        description = {'cache_version': CACHE_VERSION,
+                       'task':          task.__class__.__name__,
+                       'minc':          Info.version(),
+                       'cmdline':       _masked_cmdline(task, outputs),
+                       'extras':        _extras(task),
+                       'inputs':        [self.digest(p) for p in task._cache_input_paths()],
+                      }
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """
+        The metadata of entry key (and mark it used), or None.
+        """
+        row = self.db.execute('SELECT meta FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is not None and not os.path.isdir(self._entry_dir(key)):
+            # Removed behind our back.
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            row = None
+        if row is None:
+            self._count('misses')
+            self.db.commit()
+            return None
+        self.db.execute('UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?',
+                        (time.time(), key,))
+        self._count('hits')
+        self.db.commit()
+        return json.loads(row[0])
+
+    def restore(self, key, outputs):
+        """
+        Put the cached outputs of entry key at the paths in outputs.
+        """
+        d = self._entry_dir(key)
+        for (name, dest) in outputs.items():
+            link_or_copy(os.path.join(d, name), dest, self.link)
+
+    def store(self, key, outputs, meta=None):
+        """
+        Copy (by reflink where possible) the files in outputs into the
+        cache as entry key, then evict old entries if over the cap.
+        """
+        d = self._entry_dir(key)
+        if os.path.isdir(d):
+            return
+        parent = os.path.dirname(d)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Build the entry under a temporary name and rename it into
+        # place, so that readers never see half an entry.
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        size = 0
+        try:
+            for (name, src) in outputs.items():
+                dst = os.path.join(tmp, name)
+                # Never hardlink here: the task's own output would then
+                # become the (read-only) cached object.
+                link_or_copy(src, dst, 'copy' if self.link == 'copy' else 'reflink')
+                os.chmod(dst, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                size += os.path.getsize(dst)
+            os.rename(tmp, d)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if os.path.isdir(d):
+                # Another process stored the same result first.
+                return
+            raise
+
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, 0, ?)',
+                        (key, size, now, now, json.dumps(meta or {}),))
+        for name in outputs:
+            st = os.stat(os.path.join(d, name))
+            self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', (st.st_dev, st.st_ino, key,))
+        self._count('stores')
+        self.db.commit()
+        self.evict()
+
+    def _remove(self, key):
+        d = self._entry_dir(key)
+        if os.path.isdir(d):
+            for f in os.listdir(d):
+                os.chmod(os.path.join(d, f), stat.S_IRUSR | stat.S_IWUSR)
+            shutil.rmtree(d, ignore_errors=True)
+        self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self.db.execute('DELETE FROM objects WHERE key = ?', (key,))
+
+    def is_object(self, path):
+        """
+        Whether path is (a hard link to) one of the cached objects.
+        """
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        if st.st_nlink < 2:
+            return False
+        return self.db.execute('SELECT 1 FROM objects WHERE dev = ? AND inode = ?',
+                               (st.st_dev, st.st_ino,)).fetchone() is not None
+
+    def unlink_objects(self, outputs):
+        """
+        Remove the files in outputs that are cached objects, restored
+        by hardlink, so that a tool writing to the path (a shell >
+        redirect, -clobber) cannot modify the cache through it.
+        """
+        for path in outputs.values():
+            if self.is_object(path):
+                os.remove(path)
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache is no larger
+        than max_bytes (default: the cap it was opened with). Returns
+        the number of entries removed.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return 0
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        removed = 0
+        if total > max_bytes:
+            for (key, size) in self.db.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+                if total <= max_bytes:
+                    break
+                self._remove(key)
+                total -= size
+                removed += 1
+            self._count('evictions', removed)
+            self.db.commit()
+        return removed
+
+    def clear(self):
+        for (key,) in self.db.execute('SELECT key FROM entries').fetchall():
+            self._remove(key)
+        self.db.execute('DELETE FROM counters')
+        self.db.commit()
+
+    def stats(self):
+        """
+        Counts of hits, misses, stores and evictions since the cache was
+        created (or cleared), and its current number of entries and
+        size in bytes.
+        """
+        stats = dict.fromkeys(['hits', 'misses', 'stores', 'evictions'], 0)
+        stats.update(self.db.execute('SELECT name, value FROM counters').fetchall())
+        entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        stats['entries'] = entries
+        stats['bytes'] = size
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else None
+        return stats
+
+    def run(self, task, runtime):
+        """
+        Run task (through its _execute()) unless its result is cached;
+        called from MincTaskMixin._run_interface.
+        """
+        outputs = output_paths(task)
+        key = self.key(task, outputs)
+
+        meta = self.lookup(key)
+        if meta is not None:
+            self.restore(key, outputs)
+            runtime.returncode = 0
+            runtime.stdout = meta.get('stdout', '')
+            runtime.stderr = meta.get('stderr', '')
+            runtime.cached = key
+            return runtime
+
+        if self.link == 'hardlink':
+            self.unlink_objects(outputs)
+        runtime = task._execute(runtime)
+        if runtime.returncode == 0 and all(os.path.exists(p) for p in outputs.values()):
+            self.store(key, outputs, {'cmdline':  task.cmdline,
+                                      'stdout':   getattr(runtime, 'stdout', None) or '',
+                                      'stderr':   getattr(runtime, 'stderr', None) or '',
+                                     })
+        return runtime
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: run a MINC Task described by a JSON spec.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Usage:
+#
+#     python minc_cli.py spec.json              run, printing each Task's outputs as a JSON line
+#     python minc_cli.py --dry-run spec.json    print the command lines only
+#     python minc_cli.py --check                exit status 0 if the MINC tools are installed
+#
+# A spec is a JSON object, or a list of them ('-' reads it from stdin):
+#
+#     {"task": "ConvertTask",
+#      "inputs": {"input_file": "a.mnc", "output_file": "b.mnc", "two": true},
+#      "cache": "/scratch/minc-cache"}
+#
+# "cache" (see minc_cache), "scratch" (see minc_scratch) and "profile"
+# (ConvertTask, see minc_tune) are optional. JSON has no tuples, so a
+# list given for an input that is not a list trait (voxel_range,
+# precision as [4, 8], ...) becomes a tuple.
+#
+# --check does not import nipype, and neither does anything else until
+# the first spec is read, which keeps short cluster jobs cheap.
+
+import json
+import sys
+
+import minc
+
+def _str(value):
+    # The Task traits want byte strings on Python 2.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_str(k), _str(v)) for (k, v) in value.items())
+    return value
+
+def task_class(name):
+    if not (name in minc._LAZY_NAMES and name.endswith('Task')):
+        raise ValueError('unknown task %r' % (name,))
+    return getattr(minc, name)
+
+def task_inputs(cls, inputs):
+    """
+    The spec's inputs as the Task takes them: byte strings, and tuples
+    for tuple-valued inputs.
+    """
+    from nipype.interfaces.base import traits
+    spec = cls.input_spec().traits()
+    result = {}
+    for (name, value) in _str(inputs).items():
+        t = spec.get(name)
+        if t is None:
+            raise ValueError('%s has no input %r' % (cls.__name__, name,))
+        if isinstance(value, list) and not t.is_trait_type(traits.List):
+            value = tuple(value)
+        result[name] = value
+    return result
+
+def read_specs(fname):
+    if fname == '-':
+        specs = json.load(sys.stdin)
+    else:
+        with open(fname) as f:
+            specs = json.load(f)
+    return specs if isinstance(specs, list) else [specs]
+
+def build(spec):
+    """
+    The Task for one spec.
+    """
+    cls = task_class(spec['task'])
+    kwargs = task_inputs(cls, spec.get('inputs', {}))
+    for name in ('cache', 'scratch'):
+        if spec.get(name) is not None:
+            kwargs[name] = _str(spec[name])
+    if spec.get('profile') is not None:
+        kwargs['profile'] = _str(spec['profile'])
+    return cls(**kwargs)
+
+def render(spec):
+    """
+    The command line for one spec, without building the Task.
+    """
+    import minc_argv
+    cls = task_class(spec['task'])
+    return minc_argv.renderer(cls).cmdline(task_inputs(cls, spec.get('inputs', {})))
+
+def run(spec):
+    """
+    Run one spec; returns its defined outputs.
+    """
+    from nipype.interfaces.base import isdefined
+    result = build(spec).run()
+    return dict((k, v) for (k, v) in result.outputs.get().items() if isdefined(v))
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Run MINC Tasks from JSON specs.')
+    parser.add_argument('spec', nargs='?', help="JSON file with a spec or a list of specs, or '-'")
+    parser.add_argument('--dry-run', action='store_true', help='print the command lines, do not run')
+    parser.add_argument('--check', action='store_true', help='only check that the MINC tools are installed')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        version = minc.Info.version()
+        if version is None:
+            print >>sys.stderr, 'MINC tools not found'
+            return 1
+        print json.dumps(version, sort_keys=True)
+        return 0
+
+    if args.spec is None:
+        parser.error('a spec is required')
+
+    for spec in read_specs(args.spec):
+        try:
+            if args.dry_run:
+                print render(spec)
+            else:
+                print json.dumps(run(spec), sort_keys=True)
+        except Exception as e:
+            print >>sys.stderr, '%s: %s' % (spec.get('task'), e,)
+            return 1
+        sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
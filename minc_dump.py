@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: parse the data section of mincdump output into numpy arrays
+#           as it streams from the pipe.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# mincdump without -h prints every value of every variable as CDL text,
+# which for an image is gigabytes. DumpTask.iter_variables() runs
+# mincdump with the Task's options (variables, coordinate_data,
+# annotations_*, precision, line_length, ...) and parses its stdout as it
+# arrives, yielding each variable as a numpy array when its last value
+# has been read:
+#
+#      image =
+#       1, 2, 3, 4,       // image(0,0, 0-3)
+#       5, 6, 7, 8 ;      // image(0,1, 0-3)
+#
+# The text is read chunk_size bytes at a time and never kept beyond the
+# line being parsed, so memory use is the arrays themselves plus one
+# chunk. Lines of numbers longer than a chunk (a large -l) are cut at a
+# comma.
+#
+# Arrays have the shape the header gives the variable and the type it
+# declares; integer variables with signtype "unsigned" (stored signed
+# in netCDF 3, and printed that way) are returned unsigned. A '_' (a
+# fill value) becomes the variable's _FillValue, or the netCDF default
+# fill for its type. char variables come back as strings.
+
+from minc import DEFAULT_CHUNK_SIZE, _StdOutStream, _require_numpy, np
+
+_cdl_dtypes = {'byte':   'i1', 'ubyte':  'u1',
+               'short':  'i2', 'ushort': 'u2',
+               'int':    'i4', 'uint':   'u4', 'long': 'i4',
+               'int64':  'i8', 'uint64': 'u8',
+               'float':  'f4', 'real':   'f4',
+               'double': 'f8',
+              }
+
+# netCDF's default fill values, by numpy type code.
+_default_fills = {'i1': -127, 'u1': 255,
+                  'i2': -32767, 'u2': 65535,
+                  'i4': -2147483647, 'u4': 4294967295,
+                  'i8': -9223372036854775806, 'u8': 18446744073709551614,
+                  'f4': 9.9692099683868690e+36, 'f8': 9.9692099683868690e+36,
+                 }
+
+def _lines(chunks, chunk_size):
+    """
+    Lines of text from an iterator of byte strings, holding at most
+    about chunk_size bytes of an unfinished line.
+    """
+    carry = b''
+    for buf in chunks:
+        parts = (carry + buf).split(b'\n')
+        carry = parts.pop()
+        for p in parts:
+            yield p.decode('utf-8', 'replace')
+        if len(carry) > chunk_size and b'"' not in carry:
+            # Not inside an annotation, whose commas are not separators.
+            i = carry.find(b'//')
+            cut = (carry if i < 0 else carry[:i]).rfind(b',') + 1
+            if cut > 0:
+                yield carry[:cut].decode('utf-8', 'replace')
+                carry = carry[cut:]
+    if carry:
+        yield carry.decode('utf-8', 'replace')
+
+class _Variable(object):
+    """
+    A variable being read from the data section.
+    """
+
+    def __init__(self, name, declaration, dimensions):
+        self.name = name
+        self.type = declaration['type']
+        self.attributes = declaration['attributes']
+        self.text = [] if self.type == 'char' else None
+        if self.text is None:
+            self.data = np.empty(tuple(dimensions[d] for d in declaration['dims']),
+                                 dtype=np.dtype(_cdl_dtypes[self.type]))
+            self.flat = self.data.reshape(-1)
+            self.n = 0
+
+    def _values(self, tokens):
+        try:
+            return np.array(tokens, dtype=self.data.dtype)
+        except ValueError:
+            import minc_header
+            fill = self.attributes.get('_FillValue', _default_fills[self.data.dtype.str[1:]])
+            return np.array([fill if t == '_' else minc_header._parse_number(t) for t in tokens],
+                            dtype=self.data.dtype)
+
+    def add(self, text):
+        if self.text is not None:
+            self.text.append(text)
+            return
+        tokens = text.replace(',', ' ').split()
+        if not tokens:
+            return
+        if self.n + len(tokens) > self.flat.size:
+            raise ValueError('%s: more than the %d values its dimensions allow' % (self.name, self.flat.size,))
+        self.flat[self.n:self.n + len(tokens)] = self._values(tokens)
+        self.n += len(tokens)
+
+    def finish(self):
+        if self.text is not None:
+            import minc_header
+            return minc_header.parse_values(' '.join(self.text))
+        if self.n != self.flat.size:
+            raise ValueError('%s: %d values, expected %d' % (self.name, self.n, self.flat.size,))
+        if self.data.dtype.kind == 'i' and self.attributes.get('signtype', '').strip() == 'unsigned':
+            return self.data.view(self.data.dtype.str.replace('i', 'u'))
+        return self.data
+
+def parse_chunks(chunks, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Parse mincdump output, given as an iterator of byte strings. The
+    first item yielded is the parsed header (minc_header.parse_cdl);
+    then (name, value) for each variable in the data section, in the
+    order mincdump prints them.
+    """
+    import minc_header
+    _require_numpy()
+    lines = _lines(chunks, chunk_size)
+
+    header = []
+    for line in lines:
+        if line.strip() == 'data:':
+            break
+        header.append(line)
+    parsed = minc_header.parse_cdl('\n'.join(header))
+    yield parsed
+
+    dimensions, variables = parsed['dimensions'], parsed['variables']
+    current = None
+    for line in lines:
+        if current is None or current.text is None:
+            # Numbers only: anything after // is an annotation.
+            i = line.find('//')
+            if i >= 0:
+                line = line[:i]
+        else:
+            line = minc_header._strip_comment(line)
+
+        if current is None:
+            s = line.strip()
+            if not s or s == '}':
+                continue
+            name, eq, line = s.partition('=')
+            name = name.strip()
+            if not eq or name not in variables:
+                raise ValueError('cannot parse mincdump data line %r' % s)
+            current = _Variable(name, variables[name], dimensions)
+
+        end = line.rfind(';')
+        if end < 0:
+            current.add(line)
+            continue
+        current.add(line[:end])
+        yield current.name, current.finish()
+        current = None
+
+    if current is not None:
+        raise ValueError('mincdump output ends inside %s' % current.name)
+
+def iter_variables(argv, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Run a mincdump argv and yield (name, value) for each variable in
+    its data section, parsed straight from the pipe.
+    """
+    stream = _StdOutStream(argv, chunk_size)
+    try:
+        def chunks():
+            while True:
+                buf = stream.stdout.read(chunk_size)
+                if not buf:
+                    return
+                yield buf
+        records = parse_chunks(chunks(), chunk_size)
+        next(records)
+        for record in records:
+            yield record
+        stream.finish()
+    finally:
+        # Also reached if the consumer stops early.
+        if stream.proc.returncode is None:
+            stream.kill()
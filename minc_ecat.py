@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: frame-parallel minctoecat for dynamic (4D) series, behind
+#           ToEcatTask(frames_per_job=...).
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# minctoecat converts a dynamic series one frame after another in a
+# single process. to_ecat() instead cuts the time dimension into ranges
+# of frames_per_job frames (mincreshape -dimrange), converts the ranges
+# in a process pool and joins the resulting ECAT7 files into one.
+#
+# An ECAT7 file is a 512-byte main header followed by 512-byte records:
+# a chain of directory records, starting at record 2, each holding up to
+# 31 entries (matrix number, first record, last record, status), and
+# the matrices themselves (an image subheader record followed by the
+# voxel data). Matrix numbers carry the frame number in their low 9
+# bits. Joining the pieces means
+#
+#   - the main header of the first piece, with num_frames set to the
+#     total; every piece must have the same main header otherwise,
+#   - every matrix copied verbatim, subheader included, with the frame
+#     number in its matrix number shifted by the frames before its piece,
+#   - the directory rebuilt the way the ECAT matrix library lays it out
+#     when the matrices are written one after another: a new directory
+#     record is appended after the last matrix when the current one is
+#     full. Each piece is checked against this layout before it is used.
+#
+# Each frame's subheader is computed by minctoecat from that frame
+# alone: its scale factor from the frame's voxels, its start time and
+# length from the time dimension (which mincreshape keeps), and its
+# decay correction factor from those and the isotope half-life, or not
+# at all with no_decay_corr_fctr, which is passed on to every piece like
+# the other options. The joined file is then byte-identical to the one
+# a serial run writes. Each piece is converted under the base names of
+# the real input and output, in a directory of its own, so that header
+# fields recording them agree too. bench_minc.py --ecat-frames measures
+# the speed-up and compares the two outputs byte for byte.
+
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+from minc import DEFAULT_CHUNK_SIZE, image_layout, isdefined
+
+BLOCK_SIZE = 512
+FIRST_DIR_BLOCK = 2
+DIR_ENTRIES = 31
+
+# Main header field (big-endian short).
+NUM_FRAMES_OFFSET = 354
+
+FRAME_MASK = 0x1FF
+
+def _ints(block):
+    return list(struct.unpack('>128i', block))
+
+def _block(ints):
+    return struct.pack('>128i', *(list(ints) + [0] * (128 - len(ints))))
+
+def _read_record(f, record):
+    f.seek((record - 1) * BLOCK_SIZE)
+    block = f.read(BLOCK_SIZE)
+    if len(block) != BLOCK_SIZE:
+        raise ValueError('%s: record %d is past the end of the file' % (f.name, record,))
+    return block
+
+def num_frames(main_header):
+    return struct.unpack('>h', main_header[NUM_FRAMES_OFFSET:NUM_FRAMES_OFFSET + 2])[0]
+
+def set_num_frames(main_header, n):
+    return main_header[:NUM_FRAMES_OFFSET] + struct.pack('>h', n) + main_header[NUM_FRAMES_OFFSET + 2:]
+
+def read_directory(f):
+    """
+    The matrix directory of an open ECAT7 file, as a list of (matnum,
+    first record, last record, status) in directory order.
+    """
+    entries = []
+    record, seen = FIRST_DIR_BLOCK, set()
+    while record not in seen:
+        seen.add(record)
+        block = _ints(_read_record(f, record))
+        nused = block[3]
+        if not 0 <= nused <= DIR_ENTRIES:
+            raise ValueError('%s: bad directory record %d' % (f.name, record,))
+        entries += [tuple(block[4 + 4 * i:8 + 4 * i]) for i in range(nused)]
+        record = block[1]
+        if record == FIRST_DIR_BLOCK:
+            return entries
+    raise ValueError('%s: directory records form a loop' % f.name)
+
+def directory_layout(matrices):
+    """
+    Lay out matrices, a list of (matnum, nblocks) with nblocks the
+    records after the subheader, as the ECAT matrix library does when
+    they are written in order. Returns (directory, entries, nrecords):
+    the directory records as (record, list of 128 ints), the entries
+    (matnum, first, last, status), and the length of the file in
+    records.
+    """
+    directory, entries = [], []
+    record = FIRST_DIR_BLOCK
+    current = [DIR_ENTRIES, FIRST_DIR_BLOCK, 0, 0]
+    nxt = record + 1
+    for (matnum, nblocks) in matrices:
+        if current[3] == DIR_ENTRIES:
+            current[1] = nxt
+            directory.append((record, current))
+            current = [DIR_ENTRIES, FIRST_DIR_BLOCK, record, 0]
+            record, nxt = nxt, nxt + 1
+        entry = (matnum, nxt, nxt + nblocks, 1)
+        current += list(entry)
+        current[0] -= 1
+        current[3] += 1
+        entries.append(entry)
+        nxt += nblocks + 1
+    directory.append((record, current))
+    return ([(r, ints + [0] * (128 - len(ints))) for (r, ints) in directory],
+            entries, nxt - 1)
+
+def _check_layout(f, entries):
+    directory, expected, nrecords = directory_layout([(e[0], e[2] - e[1]) for e in entries])
+    ok = expected == entries
+    for (record, ints) in directory:
+        ok = ok and _ints(_read_record(f, record)) == ints
+    f.seek(0, os.SEEK_END)
+    if not ok or f.tell() != nrecords * BLOCK_SIZE:
+        raise ValueError('%s: not laid out like a serially written ECAT7 file; convert it in one piece'
+                         % f.name)
+
+def _copy(src, dst, nbytes, chunk_size=DEFAULT_CHUNK_SIZE):
+    while nbytes > 0:
+        buf = src.read(min(nbytes, chunk_size))
+        if not buf:
+            raise ValueError('%s: truncated matrix' % src.name)
+        dst.write(buf)
+        nbytes -= len(buf)
+
+def join(pieces, output_file):
+    """
+    Join ECAT7 files holding consecutive frame ranges of one series, in
+    order, into output_file.
+    """
+    files = [open(p, 'rb') for p in pieces]
+    try:
+        mains, matrices, sources = [], [], []
+        offset = 0
+        for f in files:
+            main = f.read(BLOCK_SIZE)
+            entries = read_directory(f)
+            _check_layout(f, entries)
+            nframes = num_frames(main)
+            if mains and set_num_frames(main, 0) != set_num_frames(mains[0], 0):
+                raise ValueError('%s: main header differs from that of %s' % (f.name, files[0].name,))
+            for (matnum, first, last, _) in entries:
+                frame = (matnum & FRAME_MASK) + offset
+                if not 1 <= matnum & FRAME_MASK <= nframes or frame > FRAME_MASK:
+                    raise ValueError('%s: matrix %#x is not in frames 1 to %d' % (f.name, matnum, nframes,))
+                matrices.append(((matnum & ~FRAME_MASK) | frame, last - first))
+                sources.append((f, first))
+            mains.append(main)
+            offset += nframes
+
+        directory, entries, _ = directory_layout(matrices)
+        tmp = output_file + '.tmp%d' % os.getpid()
+        try:
+            with open(tmp, 'wb') as out:
+                out.write(set_num_frames(mains[0], offset))
+                for (record, ints) in directory:
+                    out.seek((record - 1) * BLOCK_SIZE)
+                    out.write(_block(ints))
+                for ((f, first), (_, start, last, _)) in zip(sources, entries):
+                    f.seek((first - 1) * BLOCK_SIZE)
+                    out.seek((start - 1) * BLOCK_SIZE)
+                    _copy(f, out, (last - start + 1) * BLOCK_SIZE)
+            os.rename(tmp, output_file)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    finally:
+        for f in files:
+            f.close()
+
+def frame_ranges(nframes, frames_per_job):
+    return [(s, min(frames_per_job, nframes - s)) for s in range(0, nframes, frames_per_job)]
+
+def _convert(job):
+    """
+    Cut one frame range out of the input with mincreshape and convert it
+    with minctoecat. Returns the ECAT file.
+    """
+    import minc
+
+    input_file, output_file, start, count, piece_dir, flags = job
+    os.mkdir(piece_dir)
+    piece = os.path.join(piece_dir, os.path.basename(input_file))
+    argv = ['mincreshape', '-quiet', '-dimrange', 'time=%d,%d' % (start, count), input_file, piece]
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed (exit code %d): %s' % (' '.join(argv), proc.returncode, out.strip(),))
+
+    ecat = os.path.join(piece_dir, os.path.basename(output_file))
+    task = minc.ToEcatTask(input_file=piece, output_file=ecat, cache=False, scratch=False, **flags)
+    runtime = task.run().runtime
+    if runtime.returncode != 0:
+        raise RuntimeError('%s failed: %s' % (task.cmdline, runtime.stderr,))
+    os.remove(piece)
+    return ecat
+
+def to_ecat(input_file, output_file, frames_per_job=None, processes=None, workdir=None, **flags):
+    """
+    Convert a dynamic series with minctoecat, frames_per_job frames at a
+    time in a pool of processes (default: the number of CPUs, and the
+    frames split evenly between them). flags are ToEcatTask inputs such
+    as no_decay_corr_fctr. The pieces are kept in a temporary directory
+    in workdir (default: next to output_file).
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    layout = image_layout(input_file)
+    if 'time' not in layout.dimnames:
+        raise ValueError('%s has no time dimension' % input_file)
+    nframes = layout.shape[layout.dimnames.index('time')]
+    if nframes > FRAME_MASK:
+        raise ValueError('%s: %d frames, ECAT7 allows %d' % (input_file, nframes, FRAME_MASK,))
+    if frames_per_job is None:
+        frames_per_job = int(math.ceil(nframes / float(processes)))
+    if frames_per_job < 1:
+        raise ValueError('frames_per_job must be at least 1')
+
+    tmp = tempfile.mkdtemp(dir=workdir or os.path.dirname(os.path.abspath(output_file)),
+                           prefix='minctoecat-frames-')
+    try:
+        jobs = [(input_file, output_file, start, count, os.path.join(tmp, 'frames%d' % start), flags)
+                for (start, count) in frame_ranges(nframes, frames_per_job)]
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            pieces = pool.map(_convert, jobs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        join(pieces, output_file)
+    finally:
+        shutil.rmtree(tmp)
+
+def run_task(inputs, output_file):
+    """
+    Run to_ecat() with the options of a ToEcatInputSpec.
+    """
+    flags = dict((name, True) for (name, spec) in inputs.traits().items()
+                 if spec.argstr and getattr(inputs, name) is True)
+    if isdefined(inputs.frame_processes):
+        flags['processes'] = inputs.frame_processes
+    to_ecat(inputs.input_file, output_file, frames_per_job=inputs.frames_per_job, **flags)
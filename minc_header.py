@@ -0,0 +1,647 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: MINC headers as structured data, parsed from 'mincdump -h'
+#           (or read through HDF5 for MINC2), and a persistent index of
+#           them for whole archives.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# mincdump -h prints the header in netCDF CDL, e.g.
+#
+#     netcdf foo {
+#     dimensions:
+#             zspace = 10 ;
+#             time = UNLIMITED ; // (3 currently)
+#     variables:
+#             double zspace ;
+#                     zspace:step = 1.5 ;
+#                     zspace:direction_cosines = 0., 0., 1. ;
+#             short image(zspace, yspace, xspace) ;
+#                     image:valid_range = 0., 4095. ;
+#
+#     // global attributes:
+#                     :history = "first line\n",
+#                             "second line\n" ;
+#     }
+
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import subprocess
+from collections import OrderedDict
+
+# netCDF types that can start a variable declaration.
+CDL_TYPES = ('char', 'byte', 'ubyte', 'short', 'ushort', 'int', 'uint', 'long',
+             'int64', 'uint64', 'float', 'real', 'double', 'string',)
+
+# Default direction cosines of the spatial dimensions.
+DEFAULT_COSINES = {'xspace': [1.0, 0.0, 0.0],
+                   'yspace': [0.0, 1.0, 0.0],
+                   'zspace': [0.0, 0.0, 1.0],
+                  }
+
+MINC_SUFFIXES = ('.mnc',)
+
+# Tolerances for comparing steps, starts and direction cosines, as
+# abs(a - b) <= GEOMETRY_ATOL + GEOMETRY_RTOL * abs(b).
+GEOMETRY_RTOL = 1e-5
+GEOMETRY_ATOL = 1e-6
+
+_currently_re = re.compile(r'//\s*\((\d+)\s+currently\)')
+_number_re = re.compile(r'^([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)[bBsSfFlLuU]*$')
+
+def _strip_comment(line):
+    """
+    Remove a // comment that is not inside a string.
+    """
+    in_string = False
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == '\\' and in_string:
+            i += 2
+            continue
+        if c == '"':
+            in_string = not in_string
+        elif c == '/' and not in_string and line[i:i + 2] == '//':
+            return line[:i]
+        i += 1
+    return line
+
+def _statements(lines):
+    """
+    Yield (section, statement) for each ';'-terminated statement, with
+    comments removed, where section is 'dimensions', 'variables' or
+    'data'.
+    """
+    section = None
+    buf = []
+    in_string = False
+    for line in lines:
+        stripped = line.strip()
+        if not in_string and not buf:
+            if stripped in ('dimensions:', 'variables:', 'data:'):
+                section = stripped[:-1]
+                continue
+            if stripped.startswith('netcdf ') or stripped in ('}', ''):
+                continue
+            if stripped.startswith('//'):
+                continue
+
+        m = _currently_re.search(line) if section == 'dimensions' else None
+        line = _strip_comment(line)
+
+        start = 0
+        i = 0
+        while i < len(line):
+            c = line[i]
+            if c == '\\' and in_string:
+                i += 2
+                continue
+            if c == '"':
+                in_string = not in_string
+            elif c == ';' and not in_string:
+                buf.append(line[start:i])
+                stmt = ' '.join(b.strip() for b in buf if b.strip())
+                if m is not None:
+                    stmt += ' currently %s' % m.group(1)
+                yield section, stmt
+                buf = []
+                start = i + 1
+            i += 1
+        if line[start:].strip():
+            buf.append(line[start:])
+
+_escapes = {'n': '\n', 't': '\t', 'r': '\r', '0': '\0'}
+
+def _unescape(s):
+    return re.sub(r'\\(.)', lambda m: _escapes.get(m.group(1), m.group(1)), s)
+
+def parse_values(text):
+    """
+    Values of an attribute: a str if the attribute is text (pieces of a
+    string split across lines are joined), a number if there is one
+    value and a list of numbers otherwise.
+    """
+    strings = []
+    numbers = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '"':
+            j = i + 1
+            while j < len(text) and text[j] != '"':
+                j += 2 if text[j] == '\\' else 1
+            strings.append(_unescape(text[i + 1:j]))
+            i = j + 1
+        elif c in ', \t\n':
+            i += 1
+        else:
+            j = i
+            while j < len(text) and text[j] not in ', \t\n':
+                j += 1
+            numbers.append(_parse_number(text[i:j]))
+            i = j
+    if strings:
+        return ''.join(strings)
+    if len(numbers) == 1:
+        return numbers[0]
+    return numbers
+
+def _parse_number(tok):
+    low = tok.lower()
+    if low in ('nan', 'nanf', '-nan', '-nanf'):
+        return float('nan')
+    if low in ('inf', 'infinity', 'infinityf', '+inf', '+infinity', '+infinityf'):
+        return float('inf')
+    if low in ('-inf', '-infinity', '-infinityf'):
+        return float('-inf')
+    m = _number_re.match(tok)
+    if m is None:
+        raise ValueError('cannot parse CDL value %r' % tok)
+    t = m.group(1)
+    if '.' in t or 'e' in t or 'E' in t:
+        return float(t)
+    return int(t)
+
+def parse_cdl(text):
+    """
+    Parse the header part of mincdump output into
+
+        {'name':       'foo',
+         'dimensions': OrderedDict(name -> length),
+         'variables':  OrderedDict(name -> {'type': 'short',
+                                            'dims': ['zspace', ...],
+                                            'attributes': OrderedDict(...)}),
+         'attributes': OrderedDict(global attributes)}
+
+    """
+    lines = text.split('\n')
+    name = None
+    for l in lines:
+        if l.startswith('netcdf '):
+            name = l[len('netcdf '):].rstrip('{ \t')
+            break
+
+    dimensions = OrderedDict()
+    variables = OrderedDict()
+    attributes = OrderedDict()
+
+    for (section, stmt) in _statements(lines):
+        if section == 'dimensions':
+            lhs, rhs = [x.strip() for x in stmt.split('=', 1)]
+            if rhs.startswith('UNLIMITED'):
+                m = re.search(r'currently (\d+)', rhs)
+                dimensions[lhs] = int(m.group(1)) if m else 0
+            else:
+                dimensions[lhs] = int(rhs)
+        elif section == 'variables':
+            head = stmt.split('=', 1)[0]
+            if '=' in stmt and ':' in head:
+                var, att = head.split(':', 1)
+                value = parse_values(stmt.split('=', 1)[1])
+                target = attributes if var.strip() == '' else \
+                         variables.setdefault(var.strip(), {'type': None, 'dims': [],
+                                                            'attributes': OrderedDict()})['attributes']
+                target[att.strip()] = value
+            else:
+                m = re.match(r'^(\w+)\s+([^\s(]+)\s*(?:\((.*)\))?$', stmt)
+                if m is None or m.group(1) not in CDL_TYPES:
+                    raise ValueError('cannot parse CDL declaration %r' % stmt)
+                dims = [d.strip() for d in (m.group(3) or '').split(',') if d.strip()]
+                v = variables.setdefault(m.group(2), {'type': None, 'dims': [],
+                                                      'attributes': OrderedDict()})
+                v['type'], v['dims'] = m.group(1), dims
+        elif section == 'data':
+            break
+
+    return {'name':         name,
+            'dimensions':   dimensions,
+            'variables':    variables,
+            'attributes':   attributes,
+           }
+
+class MincHeader(object):
+    """
+    The header of a MINC file.
+
+    dimnames, shape, steps, starts and direction_cosines describe the
+    image variable, slowest-varying dimension first. datatype/signtype
+    are the MINC storage type of the image and valid_range its valid
+    voxel range (None if the file does not set one). attributes maps
+    variable names to their attributes, with the global attributes under
+    ''; dimensions maps every dimension to its length.
+
+    """
+
+    FIELDS = ('dimnames', 'shape', 'steps', 'starts', 'direction_cosines',
+              'datatype', 'signtype', 'valid_range', 'dimensions', 'attributes',)
+
+    def __init__(self, **kwargs):
+        for f in self.FIELDS:
+            setattr(self, f, kwargs.get(f))
+
+    def __repr__(self):
+        return 'MincHeader(%s, %s, %s)' % (','.join(self.dimnames), self.shape, self.datatype,)
+
+    def __eq__(self, other):
+        return isinstance(other, MincHeader) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def ndim(self):
+        return len(self.dimnames)
+
+    def dimension(self, name):
+        """
+        step, start and direction_cosines of one image dimension.
+        """
+        i = self.dimnames.index(name)
+        return {'step':                 self.steps[i],
+                'start':                self.starts[i],
+                'direction_cosines':    self.direction_cosines[i],
+               }
+
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(**d)
+        h.shape = tuple(h.shape)
+        return h
+
+    @classmethod
+    def from_parsed(cls, parsed):
+        """
+        Build a MincHeader from the output of parse_cdl().
+        """
+        variables = parsed['variables']
+        if 'image' not in variables:
+            raise ValueError('no image variable in header')
+        image = variables['image']
+        dimnames = list(image['dims'])
+
+        attributes = OrderedDict()
+        attributes[''] = dict(parsed['attributes'])
+        for (name, v) in variables.items():
+            attributes[name] = dict(v['attributes'])
+
+        def dimattr(d, att, default):
+            return variables.get(d, {}).get('attributes', {}).get(att, default)
+
+        datatype = image['type']
+        signtype = image['attributes'].get('signtype',
+                                           'unsigned' if datatype == 'byte' else 'signed')
+        valid_range = image['attributes'].get('valid_range')
+        if valid_range is not None:
+            valid_range = [float(min(valid_range)), float(max(valid_range))]
+
+        return cls(dimnames=dimnames,
+                   shape=tuple(int(parsed['dimensions'][d]) for d in dimnames),
+                   steps=[float(dimattr(d, 'step', 1.0)) for d in dimnames],
+                   starts=[float(dimattr(d, 'start', 0.0)) for d in dimnames],
+                   direction_cosines=[dimattr(d, 'direction_cosines', DEFAULT_COSINES.get(d))
+                                      for d in dimnames],
+                   datatype=datatype,
+                   signtype=signtype.strip(),
+                   valid_range=valid_range,
+                   dimensions=dict(parsed['dimensions']),
+                   attributes=dict(attributes))
+
+    @classmethod
+    def from_minc2(cls, fname):
+        """
+        Build a MincHeader through HDF5, without running mincdump.
+        """
+        import minc_io
+        with minc_io.Minc2Volume(fname) as vol:
+            layout = vol.layout()
+            variables = vol.variables()
+            dims = dict((d, vol.dimension(d)) for d in layout.dimnames)
+            vr = vol.image.attrs.get('valid_range')
+
+        return cls(dimnames=list(layout.dimnames),
+                   shape=tuple(layout.shape),
+                   steps=[float(dims[d].get('step', 1.0)) for d in layout.dimnames],
+                   starts=[float(dims[d].get('start', 0.0)) for d in layout.dimnames],
+                   direction_cosines=[dims[d].get('direction_cosines', DEFAULT_COSINES.get(d))
+                                      for d in layout.dimnames],
+                   datatype=layout.vartype,
+                   signtype=layout.signtype,
+                   valid_range=None if vr is None else [float(min(vr)), float(max(vr))],
+                   dimensions=dict(zip(layout.dimnames, layout.shape)),
+                   attributes=variables)
+
+def dump_header(fname):
+    """
+    The output of mincdump -h on fname, read from the pipe.
+    """
+    import minc
+    argv = minc._stdout_argv(minc.DumpTask(input_file=fname, header_data=True))
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed: %s' % (' '.join(argv), err.decode('utf-8', 'replace').strip(),))
+    return out.decode('utf-8', 'replace')
+
+def read_header(fname, backend='auto'):
+    """
+    The MincHeader of fname. backend 'auto' reads MINC2 files through
+    HDF5 when h5py is available and runs mincdump -h otherwise; 'hdf5'
+    and 'mincdump' force one or the other.
+    """
+    if backend not in ('auto', 'hdf5', 'mincdump'):
+        raise ValueError('unknown backend %r' % backend)
+    if backend != 'mincdump':
+        import minc_io
+        if backend == 'hdf5' or (minc_io.available() and minc_io.is_minc2(fname)):
+            return MincHeader.from_minc2(fname)
+    return MincHeader.from_parsed(parse_cdl(dump_header(fname)))
+
+def file_key(fname):
+    """
+    (inode, size, mtime) of fname; a header is re-read when this
+    changes.
+    """
+    st = os.stat(fname)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def find_minc_files(root, suffixes=MINC_SUFFIXES):
+    """
+    All MINC files under root, sorted.
+    """
+    out = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(suffixes):
+                out.append(os.path.join(dirpath, f))
+    return out
+
+def _extract(job):
+    fname, backend = job
+    try:
+        key = file_key(fname)
+        return fname, key, read_header(fname, backend).to_dict(), None
+    except Exception as e:
+        return fname, None, None, '%s: %s' % (e.__class__.__name__, e,)
+
+class HeaderIndex(object):
+    """
+    A persistent index of MINC headers in a SQLite database, keyed by
+    absolute path and validated against inode, size and mtime, so that
+    re-scanning an archive only re-reads the files that changed.
+    """
+
+    def __init__(self, dbfile, backend='auto'):
+        self.dbfile = dbfile
+        self.backend = backend
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS headers (
+                               path   TEXT PRIMARY KEY,
+                               inode  INTEGER,
+                               size   INTEGER,
+                               mtime  REAL,
+                               header TEXT)''')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+    def _lookup(self, path, key):
+        row = self.db.execute('SELECT inode, size, mtime, header FROM headers WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None or tuple(row[:3]) != tuple(key):
+            return None
+        return MincHeader.from_dict(json.loads(row[3]))
+
+    def _store(self, path, key, header_dict):
+        self.db.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)',
+                        (path,) + tuple(key) + (json.dumps(header_dict),))
+
+    def get(self, fname):
+        """
+        The header of fname, from the index if it is up to date and read
+        (and stored) otherwise.
+        """
+        path = os.path.abspath(fname)
+        key = file_key(path)
+        h = self._lookup(path, key)
+        if h is None:
+            h = read_header(path, self.backend)
+            self._store(path, key, h.to_dict())
+            self.db.commit()
+        return h
+
+    def scan(self, paths, processes=None, prune=False):
+        """
+        Bring the index up to date for paths (files, or directories to
+        search for MINC files), reading the headers of new and changed
+        files in a process pool. With prune, entries under the scanned
+        directories whose files are gone are removed.
+
+        Returns (headers, stats): a dict of path -> MincHeader and a dict
+        with counts of 'unchanged', 'updated', 'removed' files and
+        'failed', a dict of path -> error message.
+        """
+        if isinstance(paths, (str, type(u''))):
+            paths = [paths]
+
+        files = []
+        roots = []
+        for p in paths:
+            p = os.path.abspath(p)
+            if os.path.isdir(p):
+                roots.append(p)
+                files += find_minc_files(p)
+            else:
+                files.append(p)
+
+        headers = {}
+        todo = []
+        failed = {}
+        for f in files:
+            try:
+                key = file_key(f)
+            except OSError as e:
+                failed[f] = '%s: %s' % (e.__class__.__name__, e,)
+                continue
+            h = self._lookup(f, key)
+            if h is None:
+                todo.append(f)
+            else:
+                headers[f] = h
+
+        stats = {'unchanged': len(headers), 'updated': 0, 'removed': 0, 'failed': failed}
+
+        if todo:
+            jobs = [(f, self.backend) for f in todo]
+            if processes == 1 or len(todo) == 1:
+                results = map(_extract, jobs)
+                pool = None
+            else:
+                pool = multiprocessing.Pool(processes)
+                results = pool.imap_unordered(_extract, jobs, chunksize=max(1, len(jobs) // 64))
+            try:
+                for (f, key, d, err) in results:
+                    if err is not None:
+                        stats['failed'][f] = err
+                        continue
+                    self._store(f, key, d)
+                    headers[f] = MincHeader.from_dict(d)
+                    stats['updated'] += 1
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+        if prune and roots:
+            seen = set(files)
+            for (path,) in self.db.execute('SELECT path FROM headers').fetchall():
+                if path not in seen and any(path.startswith(r + os.sep) for r in roots):
+                    self.db.execute('DELETE FROM headers WHERE path = ?', (path,))
+                    stats['removed'] += 1
+
+        self.db.commit()
+        return headers, stats
+
+def read_headers(fnames, processes=None, backend='auto', index=None):
+    """
+    The headers of fnames, read in a process pool (or through index, a
+    HeaderIndex, which only re-reads files that changed). Returns
+    (headers, failed): dicts of path -> MincHeader and path -> error
+    message, keyed by the names as given.
+    """
+    fnames = list(fnames)
+    if index is not None:
+        paths = dict((f, os.path.abspath(f)) for f in fnames)
+        found, stats = index.scan(sorted(set(paths.values())), processes=processes)
+        headers = dict((f, found[p]) for (f, p) in paths.items() if p in found)
+        failed = dict((f, stats['failed'][p]) for (f, p) in paths.items() if p in stats['failed'])
+        return headers, failed
+
+    headers, failed = {}, {}
+    jobs = [(f, backend) for f in sorted(set(fnames))]
+    if processes == 1 or len(jobs) < 2:
+        results = map(_extract, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_extract, jobs, chunksize=max(1, len(jobs) // 64))
+    try:
+        for (f, _, d, err) in results:
+            if err is None:
+                headers[f] = MincHeader.from_dict(d)
+            else:
+                failed[f] = err
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return headers, failed
+
+def _close(a, b, rtol, atol):
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, (list, tuple)):
+        return (isinstance(b, (list, tuple)) and len(a) == len(b)
+                and all(_close(x, y, rtol, atol) for (x, y) in zip(a, b)))
+    return abs(float(a) - float(b)) <= atol + rtol * abs(float(b))
+
+def geometry_mismatch(header, reference, rtol=GEOMETRY_RTOL, atol=GEOMETRY_ATOL):
+    """
+    How header's image geometry differs from reference's, as a short
+    message, or None if they match: the same dimensions in the same
+    order and lengths, and steps, starts and direction cosines within
+    the tolerances.
+    """
+    if list(header.dimnames) != list(reference.dimnames):
+        return 'dimensions %s, expected %s' % (','.join(header.dimnames), ','.join(reference.dimnames),)
+    if tuple(header.shape) != tuple(reference.shape):
+        return 'shape %s, expected %s' % (tuple(header.shape), tuple(reference.shape),)
+    for (field, label) in (('steps', 'step'), ('starts', 'start'), ('direction_cosines', 'direction_cosines')):
+        for (d, a, b) in zip(header.dimnames, getattr(header, field), getattr(reference, field)):
+            if not _close(a, b, rtol, atol):
+                return '%s:%s is %s, expected %s' % (d, label, a, b,)
+    return None
+
+def group_by_geometry(fnames, processes=None, backend='auto', index=None,
+                      rtol=GEOMETRY_RTOL, atol=GEOMETRY_ATOL):
+    """
+    Split fnames into groups of files with matching geometry (see
+    geometry_mismatch), reading only their headers, in parallel (see
+    read_headers). Each file is compared against the first file of each
+    group in turn.
+
+    Returns (groups, failed): groups is a list of lists of file names,
+    in input order within a group and largest group first; failed maps
+    the files whose headers could not be read to the error.
+    """
+    fnames = list(fnames)
+    headers, failed = read_headers(fnames, processes=processes, backend=backend, index=index)
+    groups = []
+    for f in fnames:
+        if f not in headers:
+            continue
+        for g in groups:
+            if geometry_mismatch(headers[f], headers[g[0]], rtol, atol) is None:
+                g.append(f)
+                break
+        else:
+            groups.append([f])
+    groups.sort(key=len, reverse=True)
+    return groups, failed
+
+class GeometryError(ValueError):
+    """
+    Raised by check_geometry(). mismatched maps each offending file to
+    what is wrong with it.
+    """
+
+    def __init__(self, reference, mismatched):
+        self.reference = reference
+        self.mismatched = mismatched
+        shown = sorted(mismatched.items())[:10]
+        more = len(mismatched) - len(shown)
+        ValueError.__init__(self, '%d file(s) do not match the geometry of %s:\n%s%s'
+                            % (len(mismatched), reference,
+                               '\n'.join('    %s: %s' % (f, why) for (f, why) in shown),
+                               '\n    ... and %d more' % more if more > 0 else '',))
+
+def check_geometry(fnames, processes=None, backend='auto', index=None,
+                   rtol=GEOMETRY_RTOL, atol=GEOMETRY_ATOL):
+    """
+    Check, from the headers alone, that every file in fnames has the
+    geometry of the first, as mincaverage -check_dimensions does after
+    opening them all. Raises GeometryError naming every file that does
+    not (or whose header cannot be read).
+    """
+    fnames = list(fnames)
+    if not fnames:
+        return
+    headers, failed = read_headers(fnames, processes=processes, backend=backend, index=index)
+    mismatched = dict(failed)
+    reference = headers.get(fnames[0])
+    if reference is not None:
+        for f in fnames[1:]:
+            if f in headers:
+                why = geometry_mismatch(headers[f], reference, rtol, atol)
+                if why is not None:
+                    mismatched[f] = why
+    if mismatched:
+        raise GeometryError(fnames[0], mismatched)
@@ -0,0 +1,621 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: in-process access to MINC2 (HDF5) files, for when running
+#           minctoraw/mincdump and copying everything through a pipe
+#           is more than we need.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# The layout of a MINC2 file, as far as we care here:
+#
+#     /minc-2.0                       global attributes (ident, history, ...)
+#     /minc-2.0/dimensions/xspace     one (empty) dataset per dimension, with
+#                                     attributes length, step, start,
+#                                     direction_cosines, ...
+#     /minc-2.0/image/0/image         voxel data, attribute dimorder
+#                                     ("zspace,yspace,xspace") and valid_range
+#     /minc-2.0/image/0/image-max     real value of the top and bottom of
+#     /minc-2.0/image/0/image-min     valid_range, per slice (their own
+#                                     dimorder) or for the whole volume
+#     /minc-2.0/info/<name>           patient, study, acquisition, ...
+#
+# MINC1 files are NetCDF and are not handled here; callers fall back to
+# the command-line tools for those.
+
+import os
+import subprocess
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from minc import ImageLayout, image_layout, _StdOutStream
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+NETCDF_SIGNATURE = b'CDF'
+
+MINC2_ROOT = '/minc-2.0'
+IMAGE_PATH = MINC2_ROOT + '/image/0/image'
+
+def available():
+    """
+    True if the in-process backend can be used at all.
+    """
+    return h5py is not None and np is not None
+
+def is_minc2(fname):
+    """
+    Does fname look like an HDF5 (MINC2) file? The HDF5 superblock may
+    sit after a user block at offset 0, 512, 1024, 2048, ...
+    """
+    try:
+        with open(fname, 'rb') as f:
+            offset = 0
+            while True:
+                f.seek(offset)
+                sig = f.read(len(HDF5_SIGNATURE))
+                if sig == HDF5_SIGNATURE:
+                    return True
+                if len(sig) < len(HDF5_SIGNATURE):
+                    return False
+                offset = 512 if offset == 0 else offset * 2
+    except (IOError, OSError):
+        return False
+
+def is_minc1(fname):
+    """
+    Does fname look like a NetCDF (MINC1) file?
+    """
+    try:
+        with open(fname, 'rb') as f:
+            return f.read(len(NETCDF_SIGNATURE)) == NETCDF_SIGNATURE
+    except (IOError, OSError):
+        return False
+
+def _require():
+    if not available():
+        raise ImportError('h5py and numpy are required for in-process MINC2 access')
+
+def _attr_value(v):
+    """
+    Attribute values as plain Python: strings as str, scalars as
+    float/int and arrays as lists.
+    """
+    if isinstance(v, bytes):
+        return v.decode('utf-8', 'replace').rstrip('\x00')
+    if isinstance(v, np.ndarray):
+        if v.dtype.kind in 'SU':
+            return ''.join(_attr_value(x) for x in v.ravel())
+        if v.size == 1:
+            return v.ravel()[0].item()
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+def _dimorder(dset):
+    order = dset.attrs.get('dimorder')
+    if order is None:
+        return []
+    return [d for d in _attr_value(order).split(',') if d]
+
+def type_range(dtype):
+    """
+    The default valid range of a numpy integer type, or None for
+    floating-point types.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        return (float(info.min), float(info.max))
+    return None
+
+def round_half_away(x):
+    """
+    Round to the nearest integer, halves away from zero, as libminc does
+    when converting to an integer type.
+    """
+    return np.where(x >= 0, np.floor(x + 0.5), np.ceil(x - 0.5))
+
+class Minc2Volume(object):
+    """
+    The image of a MINC2 file, read in-process through HDF5.
+
+    Voxel data is exposed as a numpy memmap when the image is stored
+    contiguously and uncompressed, so that hyperslabs are zero-copy
+    views of the file; otherwise hyperslabs are read through HDF5,
+    touching only the chunks they overlap.
+
+    """
+
+    def __init__(self, fname):
+        _require()
+        self.fname = fname
+        self.file = h5py.File(fname, 'r')
+        self.image = self.file[IMAGE_PATH]
+        self.dimnames = _dimorder(self.image)
+        self.shape = tuple(self.image.shape)
+
+        if len(self.dimnames) != len(self.shape):
+            raise ValueError('%s: image dimorder does not match its shape' % fname)
+
+        group = self.image.parent
+        self.image_max = group['image-max'] if 'image-max' in group else None
+        self.image_min = group['image-min'] if 'image-min' in group else None
+
+        self._memmap = None
+        self._real_range = None
+
+    def close(self):
+        self._memmap = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def dtype(self):
+        return self.image.dtype
+
+    @property
+    def is_float(self):
+        return self.dtype.kind == 'f'
+
+    def layout(self):
+        """
+        The same information as minc.image_layout(), without running
+        mincinfo.
+        """
+        kind = self.dtype.kind
+        vartype = {1: 'byte', 2: 'short', 4: 'int'}.get(self.dtype.itemsize) if kind in 'iu' \
+                  else {4: 'float', 8: 'double'}[self.dtype.itemsize]
+        signtype = 'unsigned' if kind == 'u' else 'signed'
+        return ImageLayout(list(self.dimnames), self.shape, vartype, signtype)
+
+    @property
+    def valid_range(self):
+        """
+        (min, max) voxel values; the full range of the type if the file
+        does not say. For floating-point images without a valid_range
+        attribute this is None.
+        """
+        vr = self.image.attrs.get('valid_range')
+        if vr is not None:
+            vr = _attr_value(vr)
+            return (float(min(vr)), float(max(vr)))
+        return type_range(self.dtype)
+
+    def dimension(self, name):
+        """
+        Attributes of a dimension variable (step, start,
+        direction_cosines, ...).
+        """
+        return dict((k, _attr_value(v))
+                    for (k, v) in self.file[MINC2_ROOT + '/dimensions/' + name].attrs.items())
+
+    def dimension_widths(self, name):
+        """
+        Widths of the samples along a dimension (e.g. frame durations
+        along time), or None if the file does not record them.
+        """
+        path = MINC2_ROOT + '/dimensions/%s-width' % name
+        if path not in self.file:
+            return None
+        return np.asarray(self.file[path][()], dtype=np.float64)
+
+    def variables(self):
+        """
+        All attributes, keyed by MINC variable name the way mincdump
+        presents them ('image', 'image-max', 'xspace', 'patient', ...).
+        Global attributes are under the key ''.
+        """
+        out = {'': dict((k, _attr_value(v)) for (k, v) in self.file[MINC2_ROOT].attrs.items())}
+
+        def add(name, obj):
+            out[name] = dict((k, _attr_value(v)) for (k, v) in obj.attrs.items())
+
+        for group in ['dimensions', 'info']:
+            path = MINC2_ROOT + '/' + group
+            if path in self.file:
+                for (name, obj) in self.file[path].items():
+                    add(name, obj)
+        for (name, obj) in self.image.parent.items():
+            add(name, obj)
+        return out
+
+    def voxels(self):
+        """
+        Voxel data without any conversion, as a read-only memmap if the
+        storage layout allows it and as the HDF5 dataset (read on
+        slicing) otherwise.
+        """
+        if self._memmap is None:
+            offset = None
+            if self.image.chunks is None and self.image.compression is None:
+                offset = self.image.id.get_offset()
+            if offset is not None and self.image.size > 0:
+                self._memmap = np.memmap(self.fname, dtype=self.dtype, mode='r',
+                                         offset=offset, shape=self.shape)
+            else:
+                self._memmap = self.image
+        return self._memmap
+
+    def _slab(self, start, count):
+        if start is None:
+            start = (0,) * len(self.shape)
+        if count is None:
+            count = tuple(n - s for (n, s) in zip(self.shape, start))
+        return tuple(start), tuple(count)
+
+    def read_voxels(self, start=None, count=None):
+        """
+        A hyperslab of voxel values, slowest-varying dimension first.
+        """
+        start, count = self._slab(start, count)
+        sel = tuple(slice(s, s + c) for (s, c) in zip(start, count))
+        return self.voxels()[sel]
+
+    def _scale(self, dset, start, count):
+        """
+        image-max/image-min for a hyperslab, shaped to broadcast against
+        the voxels.
+        """
+        dims = _dimorder(dset)
+        if not dims or dset.shape == ():
+            return float(np.asarray(dset[()]).ravel()[0])
+
+        axes = [self.dimnames.index(d) for d in dims]
+        vals = dset[tuple(slice(start[a], start[a] + count[a]) for a in axes)]
+        vals = np.asarray(vals, dtype=np.float64).transpose(np.argsort(axes))
+        return vals.reshape([count[i] if i in axes else 1 for i in range(len(self.shape))])
+
+    def real_range(self):
+        """
+        (min, max) real value over the whole volume, from image-min and
+        image-max (or valid_range, or the voxels themselves). Computed
+        once: to_raw() asks for it for every hyperslab.
+        """
+        if self._real_range is None:
+            if self.image_min is None or self.image_max is None:
+                vr = self.valid_range
+                if vr is None:
+                    v = self.voxels()
+                    vr = (float(np.nanmin(v)), float(np.nanmax(v)))
+                self._real_range = tuple(vr)
+            else:
+                self._real_range = (float(np.min(self.image_min[()])), float(np.max(self.image_max[()])))
+        return self._real_range
+
+    def _slope_intercept(self, start, count):
+        """
+        slope, intercept such that real = voxel * slope + intercept.
+        """
+        if self.is_float or self.image_max is None or self.image_min is None:
+            return 1.0, 0.0
+        vmin, vmax = self.valid_range
+        imax = self._scale(self.image_max, start, count)
+        imin = self._scale(self.image_min, start, count)
+        slope = (imax - imin) / (vmax - vmin)
+        return slope, imin - slope * vmin
+
+    def read_real(self, start=None, count=None):
+        """
+        A hyperslab of real (scaled) values, as float64.
+        """
+        start, count = self._slab(start, count)
+        v = np.asarray(self.read_voxels(start, count), dtype=np.float64)
+        if self.is_float or self.image_max is None or self.image_min is None:
+            return v
+        slope, intercept = self._slope_intercept(start, count)
+        return v * slope + intercept
+
+    def to_raw(self, dtype=None, normalize=False, out_range=None, start=None, count=None):
+        """
+        A hyperslab converted the way minctoraw converts it.
+
+        dtype is the output type (default: the type of the file),
+        normalize corresponds to -normalize/-nonormalize and out_range
+        to -range. Floating-point output is always real values. Integer
+        output is either the voxel values mapped from the file's valid
+        range to the output range (nonormalize) or the real values mapped
+        from the volume's real range to the output range (normalize;
+        also used for floating-point files), rounded halves away from
+        zero and clamped.
+        """
+        start, count = self._slab(start, count)
+        dtype = self.dtype.newbyteorder('=') if dtype is None else np.dtype(dtype)
+
+        if dtype.kind == 'f':
+            return self.read_real(start, count).astype(dtype)
+
+        if out_range is None:
+            out_range = type_range(dtype)
+        omin, omax = float(min(out_range)), float(max(out_range))
+
+        if normalize or self.is_float:
+            rmin, rmax = self.real_range()
+            norm = (omax - omin) / (rmax - rmin) if rmax != rmin else 0.0
+            slope, intercept = self._slope_intercept(start, count)
+            scale = slope * norm
+            offset = omin + (intercept - rmin) * norm
+        else:
+            vmin, vmax = self.valid_range
+            scale = (omax - omin) / (vmax - vmin)
+            offset = omin - vmin * scale
+
+        v = np.asarray(self.read_voxels(start, count), dtype=np.float64)
+        if dtype == self.dtype and np.all(scale == 1.0) and np.all(offset == 0.0):
+            return np.array(v, dtype=dtype)
+        out = round_half_away(v * scale + offset)
+        return np.clip(out, omin, omax).astype(dtype)
+
+def write_minc2(fname, data, dimnames=None, steps=None, starts=None,
+                dtype=None, valid_range=None, compression=None, chunks=None):
+    """
+    Write a numpy array of real values as a minimal MINC2 file.
+
+    For integer output types the data is quantised per slice of the
+    slowest-varying dimension, with image-max/image-min recording the
+    real range of each slice, as the MINC tools do. This is mainly for
+    building fixtures; it does not copy any header from another file.
+    """
+    _require()
+    data = np.asarray(data)
+    ndim = data.ndim
+    if dimnames is None:
+        dimnames = ['zspace', 'yspace', 'xspace'][-ndim:] if ndim <= 3 \
+                   else ['time', 'zspace', 'yspace', 'xspace'][-ndim:]
+    if steps is None:
+        steps = [1.0] * ndim
+    if starts is None:
+        starts = [0.0] * ndim
+    dtype = np.dtype(data.dtype if dtype is None else dtype)
+
+    with h5py.File(fname, 'w') as f:
+        root = f.create_group(MINC2_ROOT)
+        root.attrs['ident'] = np.string_('nipype-minc')
+        root.attrs['minc_version'] = np.string_('2.0')
+
+        dims = root.create_group('dimensions')
+        cosines = {'xspace': [1.0, 0.0, 0.0], 'yspace': [0.0, 1.0, 0.0], 'zspace': [0.0, 0.0, 1.0]}
+        for (name, n, step, start) in zip(dimnames, data.shape, steps, starts):
+            d = dims.create_dataset(name, data=np.int32(0))
+            d.attrs['length'] = np.int32(n)
+            d.attrs['step'] = np.float64(step)
+            d.attrs['start'] = np.float64(start)
+            d.attrs['spacing'] = np.string_('regular__')
+            d.attrs['alignment'] = np.string_('centre')
+            d.attrs['varid'] = np.string_('MINC standard variable')
+            d.attrs['vartype'] = np.string_('dimension____')
+            if name in cosines:
+                d.attrs['direction_cosines'] = np.array(cosines[name], dtype=np.float64)
+
+        group = root.create_group('image').create_group('0')
+        kw = {}
+        if compression:
+            kw['compression'] = 'gzip'
+            kw['compression_opts'] = compression
+        if chunks or compression:
+            kw['chunks'] = chunks or True
+
+        real = np.asarray(data, dtype=np.float64)
+        if dtype.kind == 'f':
+            voxels = real.astype(dtype)
+            flat = real.reshape(data.shape[0], -1) if ndim > 1 else real.reshape(-1, 1)
+            imax, imin = flat.max(axis=1), flat.min(axis=1)
+            vr = (float(real.min()), float(real.max()))
+        else:
+            vr = valid_range or type_range(dtype)
+            vmin, vmax = vr
+            flat = real.reshape(data.shape[0], -1) if ndim > 1 else real.reshape(-1, 1)
+            imax, imin = flat.max(axis=1), flat.min(axis=1)
+            span = np.where(imax > imin, imax - imin, 1.0)
+            bshape = (-1,) + (1,) * (ndim - 1)
+            v = (real - imin.reshape(bshape)) * ((vmax - vmin) / span).reshape(bshape) + vmin
+            voxels = np.clip(round_half_away(v), vmin, vmax).astype(dtype)
+
+        image = group.create_dataset('image', data=voxels, **kw)
+        image.attrs['dimorder'] = np.string_(','.join(dimnames))
+        image.attrs['valid_range'] = np.array(vr, dtype=np.float64)
+        image.attrs['complete'] = np.string_('true_')
+
+        for (name, vals) in [('image-max', imax), ('image-min', imin)]:
+            s = group.create_dataset(name, data=vals.astype(np.float64))
+            s.attrs['dimorder'] = np.string_(dimnames[0])
+
+    return fname
+
+class ExtractReader(object):
+    """
+    The same reading interface as Minc2Volume for files that it cannot
+    open (MINC1, or no h5py): each hyperslab is a mincextract run, and
+    the header comes from mincinfo.
+    """
+
+    def __init__(self, fname):
+        if np is None:
+            raise ImportError('numpy is required for in-process MINC access')
+        self.fname = fname
+        layout = image_layout(fname)
+        self.dimnames = list(layout.dimnames)
+        self.shape = tuple(layout.shape)
+        self._layout = layout
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def layout(self):
+        return self._layout
+
+    def _mincinfo(self, args):
+        proc = subprocess.Popen(['mincinfo', '-error_string', ''] + args + [self.fname],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError('mincinfo failed on %s: %s' % (self.fname, err.strip(),))
+        return out.decode('utf-8').split('\n')
+
+    def dimension(self, name):
+        attrs = ['step', 'start', 'direction_cosines']
+        args = []
+        for a in attrs:
+            args += ['-attvalue', '%s:%s' % (name, a,)]
+        out = {}
+        for (a, line) in zip(attrs, self._mincinfo(args)):
+            vals = [float(x) for x in line.split()]
+            if len(vals) == 1:
+                out[a] = vals[0]
+            elif vals:
+                out[a] = vals
+        return out
+
+    def dimension_widths(self, name):
+        line = self._mincinfo(['-varvalues', '%s-width' % name])[0]
+        vals = [float(x) for x in line.split()]
+        return np.array(vals) if vals else None
+
+    def read_real(self, start=None, count=None):
+        if start is None:
+            start = (0,) * len(self.shape)
+        if count is None:
+            count = tuple(n - s for (n, s) in zip(self.shape, start))
+        argv = ['mincextract', '-double',
+                '-start', ','.join(str(s) for s in start),
+                '-count', ','.join(str(c) for c in count),
+                self.fname]
+        data = np.empty(count, dtype=np.float64)
+        stream = _StdOutStream(argv)
+        try:
+            stream.readinto(data)
+            stream.finish()
+        except:
+            stream.kill()
+            raise
+        return data
+
+def open_volume(fname):
+    """
+    A reader for fname: Minc2Volume for MINC2 files when h5py is
+    available, ExtractReader otherwise.
+    """
+    if available() and is_minc2(fname):
+        return Minc2Volume(fname)
+    return ExtractReader(fname)
+
+# rawtominc flags giving the order of the spatial dimensions, slowest
+# first.
+_rawtominc_orders = {('zspace', 'yspace', 'xspace'): '-zyx',
+                     ('zspace', 'xspace', 'yspace'): '-zxy',
+                     ('yspace', 'zspace', 'xspace'): '-yzx',
+                     ('yspace', 'xspace', 'zspace'): '-yxz',
+                     ('xspace', 'zspace', 'yspace'): '-xzy',
+                     ('xspace', 'yspace', 'zspace'): '-xyz',
+                    }
+
+class RawToMincWriter(object):
+    """
+    Write a MINC file from real values delivered slab by slab along the
+    slowest-varying dimension, by streaming them into rawtominc. Only
+    whole-slice slabs are accepted, and they must arrive in order.
+
+    geometry maps dimension names to dicts with (optional) step, start
+    and direction_cosines, as returned by the readers' dimension().
+
+    """
+
+    def __init__(self, fname, dimnames, shape, geometry=None,
+                 vartype=None, signtype=None, valid_range=None,
+                 two=False, clobber=False):
+        self.fname = fname
+        self.dimnames = list(dimnames)
+        self.shape = tuple(shape)
+        self.written = 0
+
+        spatial = tuple(d for d in self.dimnames if d != 'time')
+        lead = self.dimnames[:len(self.dimnames) - len(spatial)]
+        if lead not in ([], ['time']) or len(spatial) > 3:
+            raise ValueError('rawtominc cannot write dimensions %s' % ','.join(self.dimnames))
+
+        argv = ['rawtominc', '-double', '-scan_range']
+        argv.append('-clobber' if clobber else '-noclobber')
+        if two:
+            argv.append('-2')
+
+        if len(spatial) == 3:
+            if spatial not in _rawtominc_orders:
+                raise ValueError('rawtominc cannot write dimensions %s' % ','.join(self.dimnames))
+            argv.append(_rawtominc_orders[spatial])
+        elif spatial:
+            # With fewer than three sizes rawtominc uses the fastest
+            # varying dimensions of the orientation.
+            for order, flag in sorted(_rawtominc_orders.items()):
+                if order[-len(spatial):] == spatial:
+                    argv.append(flag)
+                    break
+            else:
+                raise ValueError('rawtominc cannot write dimensions %s' % ','.join(self.dimnames))
+
+        if vartype is not None:
+            argv.append('-o' + vartype)
+            if signtype is not None and vartype not in ('float', 'double'):
+                argv.append('-o' + signtype)
+        if valid_range is not None:
+            argv += ['-orange', repr(float(valid_range[0])), repr(float(valid_range[1]))]
+
+        for (d, g) in sorted((geometry or {}).items()):
+            if d not in spatial:
+                continue
+            axis = d[0]
+            if g.get('step') is not None:
+                argv += ['-%sstep' % axis, repr(float(g['step']))]
+            if g.get('start') is not None:
+                argv += ['-%sstart' % axis, repr(float(g['start']))]
+            if g.get('direction_cosines') is not None:
+                argv += ['-%sdircos' % axis] + [repr(float(c)) for c in g['direction_cosines']]
+
+        argv += [fname] + [str(n) for n in self.shape]
+        self.argv = argv
+        self.existed = os.path.exists(fname)
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stderr=self.stderr)
+
+    def write(self, slab):
+        slab = np.ascontiguousarray(slab, dtype=np.float64)
+        if slab.shape[1:] != self.shape[1:]:
+            raise ValueError('slab of shape %s does not fit %s' % (slab.shape, self.shape,))
+        self.proc.stdin.write(slab.tostring())
+        self.written += slab.shape[0]
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0 or self.written != self.shape[0]:
+            self.stderr.seek(0)
+            raise RuntimeError('%s failed (exit code %d, %d of %d slices written): %s'
+                               % (' '.join(self.argv), self.proc.returncode, self.written,
+                                  self.shape[0], self.stderr.read().decode('utf-8', 'replace'),))
+        self.stderr.close()
+
+    def abort(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        if not self.existed and os.path.exists(self.fname):
+            os.remove(self.fname)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: chain MINC commands (and Python code) through OS pipes,
+#           with no intermediate files.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# A Pipeline is a list of stages, each a StdOutCommandLine task (run
+# without its '> out_file'), another Task, or a plain argv list. Each
+# stage's stdout is connected straight to the next stage's stdin, as in
+# a shell pipeline; the first stage can be fed from a Python iterable and
+# the output of the last goes to a file, a Python callback or a
+# generator. Because every connection is a kernel pipe, a slow consumer
+# blocks its producer (backpressure) and nothing is buffered beyond the
+# pipe buffers and one chunk. Every stage's exit code is collected, as
+# with bash's pipefail.
+#
+# For commands that insist on a file name rather than stdin, named_pipe()
+# gives a FIFO in a private local temporary directory.
+
+import contextlib
+import errno
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+from collections import namedtuple
+
+from nipype.interfaces.base import StdOutCommandLine
+
+from minc import DEFAULT_CHUNK_SIZE, _stdout_argv, _task_argv
+
+PipelineResult = namedtuple('PipelineResult', ['argvs', 'returncodes', 'stderr', 'nbytes'])
+
+class PipelineError(RuntimeError):
+    def __init__(self, result):
+        self.result = result
+        lines = []
+        for (argv, code, err) in zip(result.argvs, result.returncodes, result.stderr):
+            if code != 0:
+                lines.append('%s: exit code %d' % (' '.join(argv), code,))
+                if err.strip():
+                    lines.append('    ' + err.strip().replace('\n', '\n    '))
+        RuntimeError.__init__(self, 'pipeline failed:\n' + '\n'.join(lines))
+
+def stage_argv(stage):
+    """
+    The argv of a pipeline stage: a StdOutCommandLine task (without its
+    output redirection), any other CommandLine task, or a list.
+    """
+    if isinstance(stage, (list, tuple)):
+        return list(stage)
+    if isinstance(stage, StdOutCommandLine):
+        return _stdout_argv(stage)
+    if hasattr(stage, 'cmdline'):
+        return _task_argv(stage)
+    raise TypeError('cannot make a pipeline stage from %r' % (stage,))
+
+def _restore_sigpipe():
+    # Python ignores SIGPIPE and the children inherit that, so a
+    # producer whose consumer has gone would see EPIPE errors instead
+    # of quietly dying as it does in a shell.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+@contextlib.contextmanager
+def named_pipe(name='fifo', dir=None):
+    """
+    A FIFO in a fresh private temporary directory (on local disk unless
+    dir says otherwise), removed afterwards.
+    """
+    d = tempfile.mkdtemp(prefix='minc-pipe-', dir=dir)
+    try:
+        path = os.path.join(d, name)
+        os.mkfifo(path, 0o600)
+        yield path
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+class Pipeline(object):
+    """
+    Stages connected by pipes. source, if given, is an iterable of byte
+    strings written to the first stage's stdin (from a thread, so it may
+    block on a full pipe without stalling the reader).
+    """
+
+    def __init__(self, stages, source=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        if not stages:
+            raise ValueError('a pipeline needs at least one stage')
+        self.argvs = [stage_argv(s) for s in stages]
+        self.source = source
+        self.chunk_size = chunk_size
+        self.procs = []
+        self._stderr = []
+        self._feeder = None
+        self._feed_error = None
+        self.nbytes = 0
+        self.result = None
+
+    def _start(self, stdout):
+        last = len(self.argvs) - 1
+        try:
+            for (i, argv) in enumerate(self.argvs):
+                if i > 0:
+                    stdin = self.procs[-1].stdout
+                elif self.source is not None:
+                    stdin = subprocess.PIPE
+                else:
+                    stdin = None
+                err = tempfile.TemporaryFile()
+                self._stderr.append(err)
+                p = subprocess.Popen(argv, stdin=stdin, stdout=stdout if i == last else subprocess.PIPE,
+                                     stderr=err, preexec_fn=_restore_sigpipe, close_fds=True)
+                if i > 0:
+                    # Only the child holds the read end now, so that the
+                    # producer sees SIGPIPE if the consumer exits early.
+                    self.procs[-1].stdout.close()
+                self.procs.append(p)
+        except:
+            self.kill()
+            raise
+
+        if self.source is not None:
+            self._feeder = threading.Thread(target=self._feed)
+            self._feeder.daemon = True
+            self._feeder.start()
+
+    def _feed(self):
+        stdin = self.procs[0].stdin
+        try:
+            for chunk in self.source:
+                stdin.write(chunk)
+        except IOError as e:
+            # The first stage stopped reading; its exit code says why.
+            if e.errno != errno.EPIPE:
+                self._feed_error = e
+        except Exception as e:
+            self._feed_error = e
+        finally:
+            try:
+                stdin.close()
+            except IOError:
+                pass
+
+    def kill(self):
+        for p in self.procs:
+            if p.poll() is None:
+                p.kill()
+        for p in self.procs:
+            p.wait()
+
+    def _finish(self, check):
+        if self._feeder is not None:
+            self._feeder.join()
+        codes = [p.wait() for p in self.procs]
+        stderr = []
+        for err in self._stderr:
+            err.seek(0)
+            stderr.append(err.read().decode('utf-8', 'replace'))
+            err.close()
+        result = self.result = PipelineResult(self.argvs, codes, stderr, self.nbytes)
+        if self._feed_error is not None:
+            raise self._feed_error
+        if check and any(codes):
+            raise PipelineError(result)
+        return result
+
+    def stream(self, check=True):
+        """
+        Run the pipeline, yielding the last stage's stdout in chunks of
+        at most chunk_size bytes. Raises PipelineError at the end if a
+        stage failed (and check is set); otherwise the PipelineResult is
+        left in self.result. If the consumer stops early, all stages are
+        killed.
+        """
+        self._start(subprocess.PIPE)
+        fd = self.procs[-1].stdout.fileno()
+        done = False
+        try:
+            while True:
+                chunk = os.read(fd, self.chunk_size)
+                if not chunk:
+                    break
+                self.nbytes += len(chunk)
+                yield chunk
+            done = True
+        finally:
+            self.procs[-1].stdout.close()
+            if not done:
+                self.kill()
+        self._finish(check)
+
+    def run(self, sink=None, check=True):
+        """
+        Run the pipeline to completion. sink is where the last stage's
+        stdout goes: a file name or a file object (written by the stage
+        itself, without passing through Python), a callable taking each
+        chunk, or None to discard it. Returns a PipelineResult; nbytes
+        counts the output bytes seen by Python (0 for file sinks).
+        """
+        if isinstance(sink, (str, type(u''))):
+            with open(sink, 'wb') as f:
+                return self.run(f, check)
+
+        if hasattr(sink, 'fileno'):
+            sink.flush()
+            self._start(sink)
+            return self._finish(check)
+
+        for chunk in self.stream(check):
+            if sink is not None:
+                sink(chunk)
+        return self.result
+
+def pipe(*stages, **kwargs):
+    """
+    Shorthand: pipe(task, ['cmd', 'arg'], sink=callback) runs the stages
+    as a Pipeline. Keyword arguments are sink, source, check and
+    chunk_size.
+    """
+    sink = kwargs.pop('sink', None)
+    check = kwargs.pop('check', True)
+    return Pipeline(list(stages), **kwargs).run(sink, check)
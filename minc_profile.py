@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: per-run resource accounting for the MINC Task classes.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Every Task run goes through MincTaskMixin._run_interface, which hands
+# it to run() below. When at least one sink is registered (add_sink(),
+# the profiling() context manager, or $MINC_PROFILE_JSONL), each run
+# produces a record with:
+#
+#     wall time; user and system CPU, split between this Python process
+#     and the tools it ran (getrusage deltas); peak RSS; bytes read and
+#     written (/proc/self/io deltas, which include reaped children); the
+#     cmdline, number and total size of the input files, exit code and
+#     whether the result came from the cache.
+#
+# Peak RSS of a tool cannot be had from getrusage once other tools have
+# run (RUSAGE_CHILDREN keeps the largest ever), so while a run is in
+# progress a thread samples VmHWM of our descendants from /proc. Nor can
+# this process's: ru_maxrss is its lifetime peak, so the same thread
+# samples its VmRSS, and its growth is the larger of how far that rose
+# above where the run started and how far ru_maxrss rose. The record
+# has the larger of the tools' peak and that growth. Runs shorter than
+# the sampling interval may show only the Python side.
+
+import json
+import os
+import resource
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.05
+
+_sinks = []
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+def sinks():
+    s = list(_sinks)
+    fname = os.environ.get('MINC_PROFILE_JSONL')
+    if fname:
+        s.append(_env_sink(fname))
+    return s
+
+_env_sinks = {}
+
+def _env_sink(fname):
+    if fname not in _env_sinks:
+        _env_sinks[fname] = JsonlSink(fname)
+    return _env_sinks[fname]
+
+class profiling(object):
+    """
+    with profiling(sink): ... records the Task runs inside the block.
+    Without a sink, a MemorySink is created; it is what 'as' binds.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = MemorySink() if sink is None else sink
+
+    def __enter__(self):
+        add_sink(self.sink)
+        return self.sink
+
+    def __exit__(self, *args):
+        remove_sink(self.sink)
+
+class JsonlSink(object):
+    """
+    Append each record as one JSON line. Each line is a single write()
+    on a file opened for appending, so several processes can share the
+    file.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def records(self):
+        return read_jsonl(self.fname)
+
+class MemorySink(object):
+    """
+    Keep the records in a list.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def summary(self, top=10):
+        return summary(self.records, top)
+
+def read_jsonl(fname):
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def proc_io():
+    """
+    The counters of /proc/self/io as ints, or {} where there is none.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return dict((k, int(v)) for (k, v) in (line.split(':') for line in f if ':' in line))
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _children():
+    """
+    pid -> parent pid of every process, from /proc.
+    """
+    parents = {}
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % d) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # The command name is in parentheses and may contain spaces.
+        fields = stat[stat.rfind(')') + 2:].split()
+        parents[int(d)] = int(fields[1])
+    return parents
+
+def descendants(pid=None):
+    pid = os.getpid() if pid is None else pid
+    parents = _children()
+    found = set([pid])
+    changed = True
+    while changed:
+        changed = False
+        for (p, pp) in parents.items():
+            if pp in found and p not in found:
+                found.add(p)
+                changed = True
+    found.discard(pid)
+    return found
+
+def _status_kb(pid, field):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+def vm_hwm_kb(pid):
+    return _status_kb(pid, 'VmHWM')
+
+def vm_rss_kb(pid):
+    return _status_kb(pid, 'VmRSS')
+
+class RssSampler(threading.Thread):
+    """
+    Track the largest VmHWM among our descendants, and the largest
+    VmRSS of this process, until stop().
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak_kb = 0
+        self.self_peak_kb = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if not os.path.isdir('/proc'):
+            return
+        pid = os.getpid()
+        while not self._stop_event.is_set():
+            for child in descendants():
+                self.peak_kb = max(self.peak_kb, vm_hwm_kb(child))
+            self.self_peak_kb = max(self.self_peak_kb, vm_rss_kb(pid))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def _input_sizes(task):
+    sizes = []
+    try:
+        paths = task._cache_input_paths()
+    except Exception:
+        paths = []
+    for p in paths:
+        try:
+            sizes.append(os.path.getsize(p))
+        except OSError:
+            pass
+    return sizes
+
+def _cmdline(task):
+    try:
+        return task.cmdline
+    except Exception:
+        return None
+
+def run(task, runtime, execute):
+    """
+    execute(runtime), recording its resource use if any sink is
+    registered.
+    """
+    targets = sinks()
+    if not targets:
+        return execute(runtime)
+
+    sizes = _input_sizes(task)
+    record = {'task':           task.__class__.__name__,
+              'cmd':            task.cmd,
+              'cmdline':        _cmdline(task),
+              'pid':            os.getpid(),
+              'start':          time.time(),
+              'input_files':    len(sizes),
+              'input_bytes':    sum(sizes),
+              'returncode':     None,
+              'cached':         False,
+              'error':          None,
+             }
+
+    io0 = proc_io()
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    child0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss0 = vm_rss_kb(os.getpid())
+    sampler = RssSampler()
+    sampler.start()
+    t0 = time.time()
+    try:
+        runtime = execute(runtime)
+        record['returncode'] = runtime.returncode
+        record['cached'] = bool(getattr(runtime, 'cached', False))
+        return runtime
+    except Exception as e:
+        record['error'] = '%s: %s' % (e.__class__.__name__, e,)
+        raise
+    finally:
+        wall = time.time() - t0
+        sampler.stop()
+        self1 = resource.getrusage(resource.RUSAGE_SELF)
+        child1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io1 = proc_io()
+
+        child_rss = child1.ru_maxrss if child1.ru_maxrss > child0.ru_maxrss else 0
+        python_rss = max(self1.ru_maxrss - self0.ru_maxrss, sampler.self_peak_kb - rss0, 0)
+        record.update({
+            'wall_seconds':         wall,
+            'python_user_seconds':  self1.ru_utime - self0.ru_utime,
+            'python_sys_seconds':   self1.ru_stime - self0.ru_stime,
+            'tool_user_seconds':    child1.ru_utime - child0.ru_utime,
+            'tool_sys_seconds':     child1.ru_stime - child0.ru_stime,
+            'max_rss_kb':           max(sampler.peak_kb, child_rss, python_rss),
+            'tool_max_rss_kb':      max(sampler.peak_kb, child_rss),
+            'python_rss_growth_kb': python_rss,
+        })
+        record['user_seconds'] = record['python_user_seconds'] + record['tool_user_seconds']
+        record['sys_seconds'] = record['python_sys_seconds'] + record['tool_sys_seconds']
+        for k in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+            record[k] = io1[k] - io0[k] if k in io0 and k in io1 else None
+
+        for sink in targets:
+            sink(record)
+
+def summary(records, top=10):
+    """
+    Per-command totals (runs, wall and CPU time, bytes, throughput in
+    input MB per wall second, peak RSS) sorted by total wall time, and
+    the top slowest runs.
+    """
+    tools = {}
+    for r in records:
+        t = tools.setdefault(r['cmd'], {'cmd': r['cmd'], 'runs': 0, 'cached': 0, 'failed': 0,
+                                        'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                        'python_seconds': 0.0, 'input_bytes': 0,
+                                        'read_bytes': 0, 'write_bytes': 0, 'max_rss_kb': 0})
+        t['runs'] += 1
+        t['cached'] += bool(r.get('cached'))
+        t['failed'] += bool(r.get('error') or r.get('returncode'))
+        t['wall_seconds'] += r['wall_seconds']
+        t['cpu_seconds'] += r['user_seconds'] + r['sys_seconds']
+        t['python_seconds'] += r['python_user_seconds'] + r['python_sys_seconds']
+        t['input_bytes'] += r['input_bytes']
+        t['read_bytes'] += r.get('read_bytes') or 0
+        t['write_bytes'] += r.get('write_bytes') or 0
+        t['max_rss_kb'] = max(t['max_rss_kb'], r['max_rss_kb'])
+
+    for t in tools.values():
+        w = t['wall_seconds']
+        t['mean_wall_seconds'] = w / t['runs']
+        t['mb_per_second'] = t['input_bytes'] / 1e6 / w if w > 0 else None
+
+    return {'tools':    sorted(tools.values(), key=lambda t: -t['wall_seconds']),
+            'slowest':  sorted(records, key=lambda r: -r['wall_seconds'])[:top],
+           }
+
+def format_summary(s):
+    lines = ['%-12s %5s %9s %9s %9s %9s %9s' % ('tool', 'runs', 'wall s', 'cpu s', 'python s',
+                                                  'MB/s', 'rss MB',)]
+    for t in s['tools']:
+        lines.append('%-12s %5d %9.2f %9.2f %9.2f %9s %9.1f'
+                     % (t['cmd'], t['runs'], t['wall_seconds'], t['cpu_seconds'], t['python_seconds'],
+                        '-' if t['mb_per_second'] is None else '%.2f' % t['mb_per_second'],
+                        t['max_rss_kb'] / 1024.0,))
+    lines.append('')
+    lines.append('slowest runs:')
+    for r in s['slowest']:
+        lines.append('%9.2fs  %s' % (r['wall_seconds'], r['cmdline'] or r['cmd'],))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    import sys
+    for fname in sys.argv[1:]:
+        print format_summary(summary(read_jsonl(fname)))
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: a work queue of MINC Tasks in a SQLite file, shared by
+#           workers on one or more machines.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Usage:
+#
+#     python minc_queue.py queue.db submit specs.json   add the specs (see minc_cli) to the queue
+#     python minc_queue.py queue.db work                run jobs until the queue is empty
+#     python minc_queue.py queue.db status              counts, backlog and throughput as JSON
+#
+# There is no broker: the queue is one SQLite file, and every worker
+# claims jobs from it directly. A job is stored as a minc_cli spec
+# ({"task": "ConvertTask", "inputs": {...}, "cache": ...}), so anything
+# minc_cli can run can be queued; put() also takes a Task and writes
+# the spec for it.
+#
+# A worker claims a job under a lease, and renews the lease with a
+# heartbeat from a background thread while the Task runs. If the worker
+# dies, its lease runs out and another worker takes the job over. A job
+# that fails, or whose lease runs out, goes back to the queue until it
+# has had max_attempts tries, and then stays failed with its last error.
+#
+# To share the queue between machines, put the file on a filesystem
+# with working POSIX locks (NFSv4 or Lustre with flock, not NFSv3), and
+# keep the Task inputs and outputs on a filesystem every node sees.
+
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+QUEUE_VERSION = 1
+
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+# How long status() looks back for the throughput.
+DEFAULT_WINDOW_SECONDS = 300
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid(),)
+
+def task_spec(task):
+    """
+    The minc_cli spec for a Task: its class and the inputs that are set
+    (with cache and scratch, if given as directories).
+    """
+    from nipype.interfaces.base import isdefined
+    inputs = dict((k, list(v) if isinstance(v, tuple) else v)
+                  for (k, v) in task.inputs.get().items() if isdefined(v))
+    spec = {'task': task.__class__.__name__, 'inputs': inputs}
+    for name in ('cache', 'scratch'):
+        value = getattr(task, name, None)
+        if isinstance(value, basestring):
+            spec[name] = value
+        elif value is not None and value is not False:
+            spec[name] = value.root
+    return spec
+
+class Job(object):
+    """
+    A claimed job. spec is the minc_cli spec; attempt counts from 1.
+    """
+
+    def __init__(self, id, spec, attempt, worker):
+        self.id = id
+        self.spec = spec
+        self.attempt = attempt
+        self.worker = worker
+
+    def __repr__(self):
+        return '<Job %d %s attempt %d>' % (self.id, self.spec.get('task'), self.attempt,)
+
+class WorkQueue(object):
+    """
+    A queue of Task specs in the SQLite file fname. Safe to share between
+    processes and machines.
+    """
+
+    def __init__(self, fname, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.fname = os.path.abspath(fname)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._db = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_db'] = None
+        d['_lock'] = None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._lock = threading.RLock()
+
+    @property
+    def db(self):
+        # One connection per process, shared with the heartbeat threads
+        # under self._lock. Transactions are explicit (BEGIN IMMEDIATE),
+        # so that two workers never claim the same job.
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.fname, timeout=60, isolation_level=None,
+                                       check_same_thread=False)
+            self._pid = os.getpid()
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                    spec        TEXT,
+                    status      TEXT,
+                    attempts    INTEGER,
+                    worker      TEXT,
+                    lease_until REAL,
+                    submitted   REAL,
+                    started     REAL,
+                    finished    REAL,
+                    outputs     TEXT,
+                    error       TEXT);
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);''')
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _transaction(self, f):
+        with self._lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = f(db)
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            return result
+
+    def put(self, task):
+        """
+        Queue a Task or a minc_cli spec; returns the job id.
+        """
+        return self.put_many([task])[0]
+
+    def put_many(self, tasks):
+        specs = [t if isinstance(t, dict) else task_spec(t) for t in tasks]
+        now = time.time()
+        def put(db):
+            return [db.execute('INSERT INTO jobs (spec, status, attempts, submitted) VALUES (?, ?, 0, ?)',
+                               (json.dumps(spec, sort_keys=True), 'queued', now,)).lastrowid
+                    for spec in specs]
+        return self._transaction(put)
+
+    def claim(self, worker=None):
+        """
+        The next job for worker, under a lease of lease_seconds; None if
+        there is nothing to do. Jobs whose lease has run out are taken
+        over (or failed, if they are out of attempts).
+        """
+        worker = worker or worker_name()
+        def claim(db):
+            now = time.time()
+            db.execute("UPDATE jobs SET status = 'failed', finished = ?, worker = NULL, "
+                       "error = COALESCE(error, 'lease expired') "
+                       "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                       (now, now, self.max_attempts,))
+            row = db.execute("SELECT id, spec, attempts FROM jobs "
+                             "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                             "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            (id, spec, attempts) = row
+            db.execute("UPDATE jobs SET status = 'running', attempts = ?, worker = ?, lease_until = ?, "
+                       "started = ? WHERE id = ?",
+                       (attempts + 1, worker, now + self.lease_seconds, now, id,))
+            return Job(id, json.loads(spec), attempts + 1, worker)
+        return self._transaction(claim)
+
+    def heartbeat(self, job):
+        """
+        Renew the lease on job. False if the worker has lost it (the
+        lease ran out and another worker took the job).
+        """
+        def heartbeat(db):
+            return db.execute("UPDATE jobs SET lease_until = ? "
+                              "WHERE id = ? AND worker = ? AND status = 'running'",
+                              (time.time() + self.lease_seconds, job.id, job.worker,)).rowcount == 1
+        return self._transaction(heartbeat)
+
+    def complete(self, job, outputs):
+        """
+        Record the outputs of a finished job. False if the worker had
+        lost the lease, in which case nothing is recorded.
+        """
+        def complete(db):
+            return db.execute("UPDATE jobs SET status = 'done', finished = ?, outputs = ?, error = NULL "
+                              "WHERE id = ? AND worker = ? AND status = 'running'",
+                              (time.time(), json.dumps(outputs, sort_keys=True), job.id, job.worker,)).rowcount == 1
+        return self._transaction(complete)
+
+    def fail(self, job, error):
+        """
+        Record a failed attempt: the job is queued again if it has
+        attempts left. False if the worker had lost the lease.
+        """
+        def fail(db):
+            return db.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                              "finished = ?, worker = NULL, error = ? "
+                              "WHERE id = ? AND worker = ? AND status = 'running'",
+                              (self.max_attempts, time.time(), error, job.id, job.worker,)).rowcount == 1
+        return self._transaction(fail)
+
+    def retry_failed(self):
+        """
+        Queue every failed job again, with a fresh set of attempts.
+        Returns how many there were.
+        """
+        return self._transaction(lambda db: db.execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0 WHERE status = 'failed'").rowcount)
+
+    def job(self, id):
+        """
+        Everything recorded about one job, as a dict.
+        """
+        with self._lock:
+            cursor = self.db.execute('SELECT * FROM jobs WHERE id = ?', (id,))
+            row = cursor.fetchone()
+        if row is None:
+            raise KeyError(id)
+        d = dict(zip([c[0] for c in cursor.description], row))
+        d['spec'] = json.loads(d['spec'])
+        d['outputs'] = json.loads(d['outputs']) if d['outputs'] else None
+        return d
+
+    def status(self, window=DEFAULT_WINDOW_SECONDS):
+        """
+        Job counts by status, the backlog (queued or running), the
+        throughput (jobs done per second over the last window seconds,
+        and per worker over the same window) and the age of the oldest
+        queued job.
+        """
+        now = time.time()
+        with self._lock:
+            db = self.db
+            counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            recent = db.execute("SELECT worker, COUNT(*) FROM jobs WHERE status = 'done' AND finished >= ? "
+                                "GROUP BY worker", (now - window,)).fetchall()
+            oldest = db.execute("SELECT MIN(submitted) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            running = db.execute("SELECT worker, COUNT(*) FROM jobs WHERE status = 'running' AND lease_until >= ? "
+                                 "GROUP BY worker", (now,)).fetchall()
+        for s in ('queued', 'running', 'done', 'failed'):
+            counts.setdefault(s, 0)
+        return {'counts': counts,
+                'backlog': counts['queued'] + counts['running'],
+                'throughput': sum(n for (_, n) in recent) / float(window),
+                'workers': dict(recent),
+                'running': dict(running),
+                'oldest_queued_seconds': None if oldest is None else now - oldest,}
+
+class _Heartbeat(threading.Thread):
+    """
+    Renews a job's lease every interval seconds until stopped.
+    """
+
+    def __init__(self, queue, job, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.job = job
+        self.interval = interval
+        self.lost = False
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            if not self.queue.heartbeat(self.job):
+                self.lost = True
+                return
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+class Worker(object):
+    """
+    Runs jobs from a WorkQueue in this process, one at a time.
+    heartbeat is how often the lease is renewed (default: a third of
+    the lease).
+    """
+
+    def __init__(self, queue, name=None, heartbeat=None):
+        self.queue = queue
+        self.name = name or worker_name()
+        self.heartbeat = heartbeat or queue.lease_seconds / 3.0
+        self.done = 0
+        self.failed = 0
+
+    def run_job(self, job):
+        """
+        Run one claimed job and record the result. Returns True if it
+        succeeded.
+        """
+        import minc_cli
+        beat = _Heartbeat(self.queue, job, self.heartbeat)
+        beat.start()
+        try:
+            outputs = minc_cli.run(job.spec)
+        except Exception:
+            beat.stop()
+            self.queue.fail(job, traceback.format_exc())
+            self.failed += 1
+            return False
+        beat.stop()
+        if not self.queue.complete(job, outputs):
+            # The lease ran out and the job went to someone else; their
+            # result is the one that counts.
+            return False
+        self.done += 1
+        return True
+
+    def run(self, max_jobs=None, wait=False, poll=1.0):
+        """
+        Claim and run jobs until the queue has nothing to hand out (or
+        with wait set, forever), or max_jobs have been run. Returns the
+        number of jobs run.
+        """
+        n = 0
+        while max_jobs is None or n < max_jobs:
+            job = self.queue.claim(self.name)
+            if job is None:
+                if not wait:
+                    break
+                time.sleep(poll)
+                continue
+            self.run_job(job)
+            n += 1
+        return n
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='A SQLite work queue of MINC Tasks.')
+    parser.add_argument('queue', help='the queue file')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS, help='lease length in seconds')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('submit', help='queue the specs in a JSON file')
+    p.add_argument('spec', help="JSON file with a spec or a list of specs, or '-'")
+    p = sub.add_parser('work', help='run jobs')
+    p.add_argument('--wait', action='store_true', help='keep polling when the queue is empty')
+    p.add_argument('--max-jobs', type=int)
+    sub.add_parser('status', help='print the queue status as JSON')
+    sub.add_parser('retry', help='queue the failed jobs again')
+    args = parser.parse_args(argv)
+
+    q = WorkQueue(args.queue, args.lease, args.max_attempts)
+    if args.command == 'submit':
+        import minc_cli
+        print json.dumps(q.put_many(minc_cli.read_specs(args.spec)))
+    elif args.command == 'work':
+        w = Worker(q)
+        w.run(max_jobs=args.max_jobs, wait=args.wait)
+        print json.dumps({'worker': w.name, 'done': w.done, 'failed': w.failed}, sort_keys=True)
+    elif args.command == 'status':
+        print json.dumps(q.status(), sort_keys=True)
+    elif args.command == 'retry':
+        print q.retry_failed()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: run many MINC Tasks at once within a memory and CPU budget.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Each submitted Task gets an estimate of its peak memory, from the
+# headers of its inputs (dimensions x storage type) and its options
+# (max_buffer_size_in_kb, chunk, the averaging engine). The scheduler
+# then starts jobs, largest first, whenever the sum of the estimates of
+# the running jobs plus the next one fits in the memory budget and
+# there is a CPU free for it. A job larger than the whole budget runs
+# on its own.
+#
+# The starting estimates are deliberately rough. Every job runs in a
+# forked worker whose peak RSS is measured (minc_profile), and the
+# ratio of measured to estimated memory is kept per command in a
+# MemoryModel, persisted next to the toolchain probe cache. Later
+# estimates are scaled by the largest recent ratio (plus a margin), so
+# the scheduler errs on the side of not swapping.
+
+import json
+import multiprocessing
+import os
+import resource
+import select
+import tempfile
+import time
+import traceback
+
+import minc
+
+MODEL_VERSION = 1
+
+# Ratios kept per command, and the margin added to the largest.
+MODEL_HISTORY = 50
+MODEL_MARGIN = 0.1
+
+# Starting points, in kB: the resident size of a MINC tool before it
+# touches any data, what a forked Python worker adds to that of its
+# parent before it does, and the working buffer of the tools that
+# stream through an image in slabs.
+TOOL_BASE_KB = 8 * 1024
+WORKER_BASE_KB = 16 * 1024
+TOOL_BUFFER_KB = 32 * 1024
+
+# mincaverage and the averaging engine default to this buffer size.
+AVERAGE_BUFFER_KB = 4096
+
+# Leave this fraction of MemAvailable alone when no budget is given.
+DEFAULT_HEADROOM = 0.1
+
+_bytes_per_voxel = {'byte': 1, 'char': 1, 'short': 2, 'int': 4, 'long': 4,
+                    'float': 4, 'double': 8,}
+
+def available_memory_kb():
+    """
+    MemAvailable (or MemTotal) from /proc/meminfo, in kB; None where
+    there is no /proc.
+    """
+    fields = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                fields[name] = int(rest.split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return fields.get('MemAvailable', fields.get('MemTotal'))
+
+_headers = {}
+
+def cached_header(fname):
+    """
+    minc_header.read_header(fname), remembered for as long as the file
+    is unchanged.
+    """
+    import minc_header
+    key = (os.path.abspath(fname), minc_header.file_key(fname))
+    h = _headers.get(key)
+    if h is None:
+        h = _headers[key] = minc_header.read_header(fname)
+    return h
+
+def image_kb(header):
+    """
+    The stored size of the image, in kB.
+    """
+    n = 1
+    for d in header.shape:
+        n *= d
+    return n * _bytes_per_voxel.get(header.datatype, 8) / 1024.0
+
+def slice_kb(header):
+    """
+    The stored size of one slice along the slowest dimension, in kB.
+    """
+    return image_kb(header) / max(1, header.shape[0]) if header.shape else 0.0
+
+def model_key(task):
+    """
+    What the model learns separately: the command, and for mincaverage
+    and minctoecat whether it runs in-process.
+    """
+    if task.cmd == 'mincaverage':
+        inputs = task.inputs
+        if minc.isdefined(inputs.stats_prefix):
+            return 'mincaverage/incremental'
+        if minc.isdefined(inputs.tree_shard_size):
+            return 'mincaverage/tree'
+        if inputs.engine != 'binary':
+            return 'mincaverage/numpy'
+    if task.cmd == 'minctoecat' and minc.isdefined(task.inputs.frames_per_job):
+        return 'minctoecat/frames'
+    return task.cmd
+
+def _get(task, name, default=None):
+    v = getattr(task.inputs, name, None)
+    return v if v is not None and minc.isdefined(v) else default
+
+def raw_estimate_kb(task, header=cached_header):
+    """
+    Starting estimate of the peak RSS of task, in kB, from its inputs'
+    headers (read with header(fname)) and options.
+    """
+    headers = [header(f) for f in task._cache_input_paths()]
+    largest = max([image_kb(h) for h in headers] or [0.0])
+    # One slice, held as doubles.
+    slice_doubles = max([slice_kb(h) * 8 / _bytes_per_voxel.get(h.datatype, 8) for h in headers] or [0.0])
+    key = model_key(task)
+
+    if key.startswith('mincaverage'):
+        buf = _get(task, 'max_buffer_size_in_kb', AVERAGE_BUFFER_KB)
+        if key == 'mincaverage':
+            # The buffer holds at least one slice of every input, and
+            # each open file costs a little.
+            return TOOL_BASE_KB + max(buf, slice_doubles * len(headers)) + 64 * len(headers)
+        # The engine holds a slab of accumulators, the slab being read
+        # and its real-valued copy.
+        working = WORKER_BASE_KB + 3 * buf
+        if key == 'mincaverage/tree':
+            return working * _get(task, 'tree_processes', multiprocessing.cpu_count())
+        return working
+
+    if task.cmd == 'mincconvert':
+        # The HDF5 chunk cache comes on top of the copy buffer.
+        chunk_kb = _get(task, 'chunk', 0) / 1024.0
+        return TOOL_BASE_KB + min(largest, TOOL_BUFFER_KB) + 4 * chunk_kb
+
+    return TOOL_BASE_KB + min(largest, TOOL_BUFFER_KB)
+
+def model_file():
+    """
+    $MINC_MEMORY_MODEL, or memory-model.json in Info.cache_dir().
+    """
+    fname = os.environ.get('MINC_MEMORY_MODEL')
+    if fname:
+        return fname
+    d = minc.Info.cache_dir()
+    return os.path.join(d, 'memory-model.json') if d else None
+
+class MemoryModel(object):
+    """
+    Measured/estimated peak memory ratios per model_key(), and the
+    corrections learnt from them. fname=None uses model_file(); pass
+    False for a model that is not saved.
+    """
+
+    def __init__(self, fname=None, history=MODEL_HISTORY, margin=MODEL_MARGIN):
+        self.fname = model_file() if fname is None else fname
+        self.history = history
+        self.margin = margin
+        self.ratios = {}
+        self._new = {}
+        if self.fname:
+            self.ratios = self._read()
+
+    def _read(self):
+        try:
+            with open(self.fname) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if data.get('model_version') != MODEL_VERSION:
+            return {}
+        return data.get('ratios', {})
+
+    def correction(self, key):
+        """
+        The factor applied to raw estimates for key (1 until something
+        has been measured).
+        """
+        r = self.ratios.get(key)
+        return max(r) * (1.0 + self.margin) if r else 1.0
+
+    def estimate_kb(self, task, header=cached_header):
+        return raw_estimate_kb(task, header) * self.correction(model_key(task))
+
+    def observe(self, key, raw_kb, measured_kb):
+        """
+        Record that a job estimated (before correction) at raw_kb peaked
+        at measured_kb.
+        """
+        if raw_kb <= 0 or not measured_kb:
+            return
+        ratio = float(measured_kb) / raw_kb
+        self._new.setdefault(key, []).append(ratio)
+        r = self.ratios.setdefault(key, [])
+        r.append(ratio)
+        del r[:-self.history]
+
+    def save(self):
+        """
+        Write the ratios, merged with any saved by other processes since
+        we read them. The file is replaced atomically.
+        """
+        if not self.fname:
+            return None
+        ratios = self._read()
+        for (key, new) in self._new.items():
+            ratios[key] = (ratios.get(key, []) + new)[-self.history:]
+        self.ratios = ratios
+        self._new = {}
+        d = os.path.dirname(os.path.abspath(self.fname))
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.memory-model-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'model_version': MODEL_VERSION, 'ratios': self.ratios}, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.fname)
+        return self.fname
+
+class Job(object):
+    """
+    A submitted Task, its estimate and, once run, what happened: status
+    is 'pending', 'ok' or 'failed'; measured_kb is the peak RSS of the
+    run.
+    """
+
+    def __init__(self, task, estimate_kb, raw_kb, cpus, key):
+        self.task = task
+        self.estimate_kb = estimate_kb
+        self.raw_kb = raw_kb
+        self.cpus = cpus
+        self.key = key
+        self.status = 'pending'
+        self.outputs = None
+        self.error = None
+        self.measured_kb = None
+        self.seconds = None
+
+    def __repr__(self):
+        return 'Job(%s, %s, estimate %dkB)' % (self.task.cmd, self.status, self.estimate_kb,)
+
+def _worker(task, conn):
+    import minc_profile
+    try:
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with minc_profile.profiling() as sink:
+            result = task.run()
+        record = sink.records[-1]
+        # The forked worker shares its parent's pages, so count what it
+        # grew by, or the tool's own peak.
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0
+        outputs = dict((k, v) for (k, v) in result.outputs.get().items() if minc.isdefined(v))
+        conn.send({'status':        'ok',
+                   'outputs':       outputs,
+                   'measured_kb':   max(record['tool_max_rss_kb'], grown),
+                  })
+    except Exception:
+        conn.send({'status': 'failed', 'error': traceback.format_exc()})
+    finally:
+        conn.close()
+
+class Scheduler(object):
+    """
+    Run Tasks concurrently within memory_kb (default: MemAvailable less
+    DEFAULT_HEADROOM) and cpus (default: all of them).
+
+        s = Scheduler(memory_kb=16 << 20)
+        for f in files:
+            s.submit(minc.ConvertTask(input_file=f, ...))
+        jobs = s.run()
+
+    model is a MemoryModel (default: the saved one); with learn, it is
+    updated from each run and saved at the end.
+    """
+
+    def __init__(self, memory_kb=None, cpus=None, model=None, learn=True, header=cached_header):
+        if memory_kb is None:
+            avail = available_memory_kb()
+            if avail is None:
+                raise ValueError('cannot read /proc/meminfo; give memory_kb')
+            memory_kb = avail * (1.0 - DEFAULT_HEADROOM)
+        self.memory_kb = memory_kb
+        self.cpus = cpus or multiprocessing.cpu_count()
+        self.model = MemoryModel() if model is None else model
+        self.learn = learn
+        self.header = header
+        self.jobs = []
+
+    def submit(self, task, cpus=None, estimate_kb=None):
+        """
+        Queue task. cpus defaults to tree_processes for tree averaging
+        and 1 otherwise; estimate_kb overrides the model (and the run is
+        then not learnt from).
+        """
+        key = model_key(task)
+        if cpus is None:
+            cpus = _get(task, 'tree_processes', self.cpus) if key == 'mincaverage/tree' else 1
+        cpus = min(cpus, self.cpus)
+        if estimate_kb is None:
+            raw = raw_estimate_kb(task, self.header)
+            estimate_kb = raw * self.model.correction(key)
+        else:
+            raw = None
+        job = Job(task, estimate_kb, raw, cpus, key)
+        self.jobs.append(job)
+        return job
+
+    def _fits(self, job, used_kb, used_cpus, running):
+        if not running:
+            return True
+        return used_kb + job.estimate_kb <= self.memory_kb and used_cpus + job.cpus <= self.cpus
+
+    def run(self, progress=None):
+        """
+        Run every pending job; returns the jobs in submission order.
+        progress(job) is called as each one finishes.
+        """
+        pending = sorted([j for j in self.jobs if j.status == 'pending'], key=lambda j: -j.estimate_kb)
+        running = {}
+        used_kb, used_cpus = 0.0, 0
+        self.peak_kb = 0.0
+
+        while pending or running:
+            for job in list(pending):
+                if self._fits(job, used_kb, used_cpus, running):
+                    pending.remove(job)
+                    parent, child = multiprocessing.Pipe(duplex=False)
+                    p = multiprocessing.Process(target=_worker, args=(job.task, child))
+                    job.started = time.time()
+                    p.start()
+                    child.close()
+                    running[parent.fileno()] = (job, p, parent)
+                    used_kb += job.estimate_kb
+                    used_cpus += job.cpus
+                    self.peak_kb = max(self.peak_kb, used_kb)
+
+            ready, _, _ = select.select(list(running), [], [])
+            for fd in ready:
+                job, p, conn = running.pop(fd)
+                try:
+                    r = conn.recv()
+                except EOFError:
+                    r = None
+                conn.close()
+                p.join()
+                if r is None:
+                    r = {'status': 'failed', 'error': 'worker died (exit code %s)' % p.exitcode}
+                job.status = r['status']
+                job.outputs = r.get('outputs')
+                job.error = r.get('error')
+                job.measured_kb = r.get('measured_kb')
+                job.seconds = time.time() - job.started
+                used_kb -= job.estimate_kb
+                used_cpus -= job.cpus
+                if self.learn and job.status == 'ok' and job.raw_kb:
+                    self.model.observe(job.key, job.raw_kb, job.measured_kb)
+                if progress is not None:
+                    progress(job)
+
+        if self.learn:
+            self.model.save()
+        return self.jobs
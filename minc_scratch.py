@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: node-local scratch space for the inputs and generated outputs
+#           of MINC Tasks.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# With a scratch directory (scratch=<directory or Scratch> on a Task, or
+# $MINC_SCRATCH_DIR), a Task run:
+#
+#     - copies its input files into scratch first (once: a staged copy is
+#       reused while the original is unchanged) and runs on the copies;
+#     - writes generated outputs (ToRawTask and DumpTask without an
+#       out_file, ToEcatTask without an output_file) under scratch rather
+#       than next to the input. Outputs given explicitly are left alone.
+#
+# Everything in scratch is an intermediate, removed least recently used
+# first when the quota ($MINC_SCRATCH_QUOTA, in bytes) would be
+# exceeded, except files in use by a run and files waiting to be copied
+# back. publish() copies a result back to durable storage (by default to
+# where it would have been written without scratch) in a background
+# thread; flush() waits for the copies.
+#
+# Layout of the scratch directory:
+#
+#     index.db                  SQLite: every file, its size, origin and
+#                               last use, and the process pinning it
+#     inputs/<dir hash>/name    staged inputs
+#     outputs/<dir hash>/name   generated outputs
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from Queue import Queue
+from warnings import warn
+
+SCRATCH_VERSION = 1
+
+DEFAULT_COPY_THREADS = 2
+
+def get_scratch(spec):
+    """
+    The Scratch for a task's scratch setting: a Scratch, a directory,
+    False (no scratch) or None, meaning $MINC_SCRATCH_DIR if set (with
+    $MINC_SCRATCH_QUOTA as the quota in bytes).
+    """
+    if spec is False:
+        return None
+    if isinstance(spec, Scratch):
+        return spec
+    if spec is None:
+        spec = os.environ.get('MINC_SCRATCH_DIR')
+        if not spec:
+            return None
+        quota = os.environ.get('MINC_SCRATCH_QUOTA')
+        return _open_scratch(spec, int(quota) if quota else None)
+    return _open_scratch(spec, None)
+
+_scratches = {}
+
+def _open_scratch(root, quota):
+    root = os.path.abspath(root)
+    key = (root, quota)
+    if key not in _scratches:
+        _scratches[key] = Scratch(root, quota)
+    return _scratches[key]
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _makedirs(d):
+    try:
+        os.makedirs(d)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _copy(src, dst):
+    """
+    Copy src to dst through a temporary name in dst's directory, so that
+    dst is never seen half written.
+    """
+    d, name = os.path.split(dst)
+    _makedirs(d)
+    tmp = os.path.join(d, '.%s.tmp%d.%d' % (name, os.getpid(), threading.current_thread().ident,))
+    try:
+        shutil.copyfile(src, tmp)
+        os.rename(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class Transfer(object):
+    """
+    A pending copy of a scratch file back to durable storage.
+    """
+
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the copy; raises its error if it failed. Returns dest.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('copy of %s to %s still running' % (self.src, self.dest,))
+        if self.error is not None:
+            raise self.error
+        return self.dest
+
+class Scratch(object):
+    """
+    A scratch directory with a quota in bytes (None for no quota). Safe
+    to share between processes.
+    """
+
+    def __init__(self, root, quota=None, copy_threads=DEFAULT_COPY_THREADS):
+        self.root = os.path.abspath(root)
+        self.quota = quota
+        self.copy_threads = copy_threads
+        self._db = None
+        self._pid = None
+        self._lock = threading.RLock()
+        self._pins = {}
+        self._queue = None
+        self._threads = []
+        self._transfers = []
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for k in ('_db', '_lock', '_queue', '_threads', '_transfers', '_pins'):
+            d[k] = None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._lock = threading.RLock()
+        self._pins = {}
+        self._threads = []
+        self._transfers = []
+
+    @property
+    def db(self):
+        # One connection per process: SQLite connections must not cross
+        # a fork. The copy-back threads share it, under self._lock.
+        if self._db is None or self._pid != os.getpid():
+            _makedirs(self.root)
+            self._db = sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=60,
+                                       check_same_thread=False)
+            self._pid = os.getpid()
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path       TEXT PRIMARY KEY,
+                    kind       TEXT,
+                    origin     TEXT,
+                    origin_key TEXT,
+                    size       INTEGER,
+                    last_used  REAL,
+                    pin_pid    INTEGER);''')
+            self._db.commit()
+        return self._db
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _place(self, kind, path):
+        d, name = os.path.split(os.path.abspath(path))
+        h = hashlib.sha1(d.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.root, kind, h, name)
+
+    def output_path(self, path):
+        """
+        Where a generated output that would have been path goes instead.
+        """
+        return self._place('outputs', path)
+
+    def staged_path(self, path):
+        return self._place('inputs', path)
+
+    def _register(self, path, kind, origin, origin_key=None):
+        with self._lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (path, kind, origin, origin_key, os.path.getsize(path), time.time(),
+                             os.getpid() if self._pins.get(path) else None))
+            self.db.commit()
+
+    def _touch(self, path):
+        with self._lock:
+            self.db.execute('UPDATE files SET last_used = ? WHERE path = ?', (time.time(), path,))
+            self.db.commit()
+
+    def pin(self, path):
+        """
+        Keep path from being evicted until unpin(path).
+        """
+        with self._lock:
+            self._pins[path] = self._pins.get(path, 0) + 1
+            self.db.execute('UPDATE files SET pin_pid = ? WHERE path = ?', (os.getpid(), path,))
+            self.db.commit()
+
+    def unpin(self, path):
+        with self._lock:
+            n = self._pins.get(path, 0) - 1
+            if n > 0:
+                self._pins[path] = n
+                return
+            self._pins.pop(path, None)
+            self.db.execute('UPDATE files SET pin_pid = NULL, last_used = ? WHERE path = ? AND pin_pid = ?',
+                            (time.time(), path, os.getpid(),))
+            self.db.commit()
+
+    def stage(self, path, pin=False):
+        """
+        A scratch copy of path, made unless an up to date one exists;
+        pinned (see pin()) if pin is set.
+        """
+        import minc_header
+        src = os.path.abspath(path)
+        key = json.dumps(list(minc_header.file_key(src)))
+        dst = self.staged_path(src)
+        with self._lock:
+            row = self.db.execute('SELECT origin_key FROM files WHERE path = ?', (dst,)).fetchone()
+            if row is not None and row[0] == key and os.path.exists(dst):
+                self._touch(dst)
+                if pin:
+                    self.pin(dst)
+                return dst
+        self.evict(extra=os.path.getsize(src))
+        _copy(src, dst)
+        with self._lock:
+            if pin:
+                self._pins[dst] = self._pins.get(dst, 0) + 1
+            self._register(dst, 'input', src, key)
+        return dst
+
+    def evict(self, extra=0, quota=None):
+        """
+        Remove least recently used files that are not pinned until the
+        scratch, plus extra bytes, fits in quota (default: the quota it
+        was opened with). Returns the number of files removed.
+        """
+        if quota is None:
+            quota = self.quota
+        if quota is None:
+            return 0
+        removed = 0
+        with self._lock:
+            rows = self.db.execute('SELECT path, size, pin_pid FROM files ORDER BY last_used').fetchall()
+            total = sum(size for (_, size, _) in rows)
+            for (path, size, pid) in rows:
+                if total + extra <= quota:
+                    break
+                if path in self._pins or (pid is not None and pid != os.getpid() and _alive(pid)):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                total -= size
+                removed += 1
+            self.db.commit()
+        if total + extra > quota:
+            warn('scratch %s: %d bytes in use, over the quota of %d' % (self.root, total + extra, quota,))
+        return removed
+
+    def usage(self):
+        """
+        Number of files and total bytes in scratch.
+        """
+        with self._lock:
+            n, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+        return {'files': n, 'bytes': size}
+
+    def origin(self, path):
+        """
+        Where a scratch file came from, or would have gone without
+        scratch; None if it is not known.
+        """
+        with self._lock:
+            row = self.db.execute('SELECT origin FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def _copy_back(self):
+        while True:
+            t = self._queue.get()
+            try:
+                _copy(t.src, t.dest)
+            except Exception as e:
+                t.error = e
+            finally:
+                self.unpin(t.src)
+                t._done.set()
+                self._queue.task_done()
+
+    def publish(self, path, dest=None):
+        """
+        Copy a scratch file back to dest (default: its origin) in the
+        background. The file stays pinned until the copy is done.
+        Returns a Transfer.
+        """
+        path = os.path.abspath(path)
+        if dest is None:
+            dest = self.origin(path)
+            if dest is None:
+                raise ValueError('%s has no known origin; give dest' % path)
+        t = Transfer(path, os.path.abspath(dest))
+        self.pin(path)
+        with self._lock:
+            if self._queue is None:
+                self._queue = Queue()
+            while len(self._threads) < self.copy_threads:
+                th = threading.Thread(target=self._copy_back)
+                th.daemon = True
+                th.start()
+                self._threads.append(th)
+            self._transfers.append(t)
+        self._queue.put(t)
+        return t
+
+    def flush(self):
+        """
+        Wait for every copy back; raises the first error, if any.
+        """
+        with self._lock:
+            transfers, self._transfers = self._transfers, []
+        errors = []
+        for t in transfers:
+            t._done.wait()
+            if t.error is not None:
+                errors.append(t.error)
+        if errors:
+            raise errors[0]
+
+    def run(self, task, runtime, execute):
+        """
+        execute(runtime) with task's inputs staged and its generated
+        outputs in scratch; called from MincTaskMixin._run_interface.
+        """
+        import minc_cache
+        from nipype.interfaces.base import Undefined, isdefined
+
+        inputs = task.inputs
+        traits = inputs.traits()
+
+        # Fix the generated names before the inputs they derive from
+        # are swapped for the staged copies.
+        generated = {}
+        for name in task._cache_outputs:
+            if traits[name].genfile and not isdefined(getattr(inputs, name)):
+                generated[name] = task._gen_filename(name)
+        saved_scratch, task.scratch = task.scratch, False
+        try:
+            origins = minc_cache.output_paths(task)
+        finally:
+            task.scratch = saved_scratch
+
+        originals = {}
+        staged = []
+        try:
+            for name in task._stage_inputs:
+                v = getattr(inputs, name)
+                if not isdefined(v):
+                    continue
+                originals[name] = v
+                copies = []
+                for f in (v if isinstance(v, (list, tuple)) else [v]):
+                    copies.append(self.stage(f, pin=True))
+                    staged.append(copies[-1])
+                setattr(inputs, name, copies if isinstance(v, (list, tuple)) else copies[0])
+            for (name, path) in generated.items():
+                _makedirs(os.path.dirname(os.path.abspath(path)))
+                setattr(inputs, name, path)
+
+            runtime = execute(runtime)
+        finally:
+            for (name, v) in originals.items():
+                setattr(inputs, name, v)
+            for name in generated:
+                setattr(inputs, name, Undefined)
+            for c in staged:
+                self.unpin(c)
+
+        for (name, path) in generated.items():
+            path = os.path.abspath(path)
+            if os.path.exists(path):
+                self._register(path, 'output', origins.get(name))
+        self.evict()
+        return runtime
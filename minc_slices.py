@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: read slices and hyperslabs of MINC files without converting
+#           the whole volume, with a shared LRU cache of decoded slices.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# A QC viewer asks for the same few orthogonal slices of the same
+# volumes over and over. Going through ToRawTask reads the whole volume
+# each time. A SliceReader reads only the hyperslab asked for, as real
+# values: in-process through HDF5 for MINC2 files when h5py is
+# installed, and with a mincextract -start/-count run otherwise (see
+# minc_io.open_volume).
+#
+#     reader = minc_slices.SliceReader('brain.mnc')
+#     axial = reader.slice('zspace', 60)
+#     block = reader.hyperslab((60, 100, 100), (1, 32, 32))
+#
+# Slices go through a SliceCache, bounded in bytes and shared by every
+# reader and thread in the process (unless a reader is given its own,
+# or cache=False). Entries are keyed on the file's inode, size and mtime
+# as well as its name, so a rewritten file is read again. After each
+# slice() the neighbouring slices along the same axis are read in the
+# background, so stepping through a volume mostly hits the cache. Two
+# threads asking for the same slice share one read.
+#
+# The size of the shared cache is $MINC_SLICE_CACHE_BYTES (default
+# DEFAULT_CACHE_BYTES).
+
+import os
+import threading
+from collections import OrderedDict
+from Queue import LifoQueue
+
+from minc import _require_numpy
+
+DEFAULT_CACHE_BYTES = 256 << 20
+DEFAULT_PREFETCH_THREADS = 2
+
+# Neighbours read ahead on each side of a requested slice.
+DEFAULT_PREFETCH = 1
+
+# Prefetch requests beyond this many waiting are dropped: when someone
+# scrolls quickly the newest requests matter, the oldest do not.
+MAX_PREFETCH_QUEUE = 64
+
+class SliceCache(object):
+    """
+    A thread-safe LRU cache of arrays, holding at most max_bytes, with
+    background loading for prefetch().
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, prefetch_threads=DEFAULT_PREFETCH_THREADS):
+        self.max_bytes = max_bytes
+        self.prefetch_threads = prefetch_threads
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def _lookup(self, key):
+        # With self._lock held.
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value
+            self.hits += 1
+        return value
+
+    def get(self, key, load):
+        """
+        The value for key, from load() if it is not in the cache. If
+        another thread is already loading key, wait for it instead.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            event = self._pending.get(key)
+            if event is None:
+                event = self._pending[key] = threading.Event()
+                self.misses += 1
+                loading = True
+            else:
+                loading = False
+
+        if not loading:
+            event.wait()
+            with self._lock:
+                value = self._lookup(key)
+            if value is not None:
+                return value
+            # The other load failed, or its result did not fit.
+            return load()
+
+        try:
+            value = load()
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            event.set()
+
+    def put(self, key, value):
+        """
+        Add value (anything with .nbytes), evicting the least recently
+        used entries to make room. Values bigger than the whole cache
+        are not kept.
+        """
+        if value.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self._items[key] = value
+            self.bytes += value.nbytes
+            while self.bytes > self.max_bytes:
+                (_, v) = self._items.popitem(last=False)
+                self.bytes -= v.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def _prefetcher(self):
+        while True:
+            (key, load) = self._queue.get()
+            try:
+                self.get(key, load)
+            except Exception:
+                # Only a guess at what is wanted next; a real request
+                # for the slice will report the error.
+                pass
+            finally:
+                self._queue.task_done()
+
+    def prefetch(self, key, load):
+        """
+        Load key in the background, unless it is cached or being loaded.
+        """
+        with self._lock:
+            if key in self._items or key in self._pending:
+                return
+            if self._queue is None:
+                self._queue = LifoQueue()
+            if self._queue.qsize() >= MAX_PREFETCH_QUEUE:
+                return
+            while len(self._threads) < self.prefetch_threads:
+                t = threading.Thread(target=self._prefetcher)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self._queue.put((key, load))
+
+    def join(self):
+        """
+        Wait until the queued prefetches are done.
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            return {'items': len(self._items), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses,}
+
+_shared_cache = None
+
+def get_slice_cache(spec=None):
+    """
+    The SliceCache for a reader's cache setting: a SliceCache, False (no
+    cache) or None, the cache shared by the whole process.
+    """
+    global _shared_cache
+    if spec is False:
+        return None
+    if spec is not None:
+        return spec
+    if _shared_cache is None:
+        size = os.environ.get('MINC_SLICE_CACHE_BYTES')
+        _shared_cache = SliceCache(int(size) if size else DEFAULT_CACHE_BYTES)
+    return _shared_cache
+
+def _open(fname, backend):
+    import minc_io
+    if backend not in ('auto', 'hdf5', 'mincextract'):
+        raise ValueError('unknown backend %r' % backend)
+    if backend == 'hdf5':
+        return minc_io.Minc2Volume(fname)
+    if backend == 'mincextract':
+        return minc_io.ExtractReader(fname)
+    return minc_io.open_volume(fname)
+
+class SliceReader(object):
+    """
+    Slices and hyperslabs of the real values of one MINC file. Safe to
+    use from several threads.
+
+    backend 'auto' reads MINC2 files through HDF5 when h5py is installed
+    and runs mincextract otherwise; 'hdf5' and 'mincextract' force one
+    or the other. prefetch is the number of neighbouring slices read
+    ahead on each side of every slice().
+    """
+
+    def __init__(self, fname, cache=None, prefetch=DEFAULT_PREFETCH, backend='auto'):
+        import minc_header
+        import minc_io
+        _require_numpy()
+        self.fname = os.path.abspath(fname)
+        self.cache = get_slice_cache(cache)
+        self.prefetch = prefetch
+        self._file_key = minc_header.file_key(self.fname)
+        self._vol = _open(self.fname, backend)
+        layout = self._vol.layout()
+        self.dimnames = list(layout.dimnames)
+        self.shape = tuple(layout.shape)
+        # h5py handles must not be used from two threads at once;
+        # mincextract runs can overlap.
+        self._lock = threading.Lock() if isinstance(self._vol, minc_io.Minc2Volume) else None
+
+    def close(self):
+        if self._lock is not None:
+            with self._lock:
+                self._vol.close()
+        else:
+            self._vol.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _axis(self, axis):
+        if not isinstance(axis, int):
+            if axis not in self.dimnames:
+                raise ValueError('%s has no dimension %r' % (self.fname, axis,))
+            axis = self.dimnames.index(axis)
+        if not 0 <= axis < len(self.shape):
+            raise ValueError('axis %d out of range' % axis)
+        return axis
+
+    def hyperslab(self, start, count):
+        """
+        The real values from start, count voxels along each dimension
+        (mincextract's -start/-count), as float64. Not cached.
+        """
+        start, count = tuple(start), tuple(count)
+        if len(start) != len(self.shape) or len(count) != len(self.shape):
+            raise ValueError('start and count need %d values' % len(self.shape))
+        for (s, c, n) in zip(start, count, self.shape):
+            if s < 0 or c < 1 or s + c > n:
+                raise IndexError('start %r count %r out of range for shape %r' % (start, count, self.shape,))
+        if self._lock is None:
+            return self._vol.read_real(start, count)
+        with self._lock:
+            return self._vol.read_real(start, count)
+
+    def _load(self, axis, index):
+        start = [0] * len(self.shape)
+        count = list(self.shape)
+        start[axis], count[axis] = index, 1
+        data = self.hyperslab(start, count)
+        data = data.reshape(self.shape[:axis] + self.shape[axis + 1:])
+        data.setflags(write=False)
+        return data
+
+    def _key(self, axis, index):
+        return (self.fname, self._file_key, axis, index)
+
+    def slice(self, axis, index):
+        """
+        The slice at index along axis (a dimension name or number), with
+        that dimension dropped. The array is shared with the cache, and
+        read-only.
+        """
+        axis = self._axis(axis)
+        if index < 0:
+            index += self.shape[axis]
+        if not 0 <= index < self.shape[axis]:
+            raise IndexError('slice %d out of range for %s' % (index, self.dimnames[axis],))
+        if self.cache is None:
+            return self._load(axis, index)
+
+        data = self.cache.get(self._key(axis, index), lambda: self._load(axis, index))
+        for d in range(self.prefetch, 0, -1):
+            for j in (index + d, index - d):
+                if 0 <= j < self.shape[axis]:
+                    self.cache.prefetch(self._key(axis, j), lambda j=j: self._load(axis, j))
+        return data
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: voxel statistics of MINC volumes in one streaming pass:
+#           summaries per volume (optionally inside a mask or per
+#           label), and per-voxel statistics across volumes.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Min/max, mean, SD, histograms and percentiles each used to be a
+# separate run of a MINC tool over every volume. stats() reads each
+# volume once, in the same slabs and through the same readers as the
+# averaging engine (minc_io.open_volume: HDF5 for MINC2 files,
+# mincextract otherwise), and from that one pass produces
+#
+#     - a Summary of every input: count, min, max, mean, SD, a histogram
+#       and approximate quantiles, over the voxels inside the mask (or
+#       one Summary per label of a label volume);
+#     - a Summary of all the inputs pooled;
+#     - per-voxel mean, SD, min and max across the inputs, written as
+#       MINC files. The mean and SD are those of AverageTask's
+#       output_file and sdfile.
+#
+# Summaries are mergeable: merge() gives the same counts, moments,
+# histogram and sketch as one pass over both sets of voxels would (up
+# to rounding), and they round-trip through JSON (save()/load()). So a
+# large study can be summarised in parallel shards, e.g. one minc_queue
+# job per subject, and combined afterwards.
+#
+# Quantiles come from a QuantileSketch (the DDSketch of Masson et al.,
+# 2019): values are counted in logarithmically sized buckets, so every
+# quantile is within relative_accuracy of a true value, the size of the
+# sketch depends only on the range of the data, and two sketches merge
+# by adding counts. Exact histograms need their range up front
+# (bins=, range=); without one, histogram() is worked out from the
+# sketch.
+#
+# NaNs are missing values, as in the averaging engine.
+
+import json
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import minc_io
+from minc_average import Accumulator, AverageEngine
+
+SUMMARY_VERSION = 1
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_BINS = 100
+
+# Values closer to zero than this count as zero in the sketch.
+SKETCH_MIN_VALUE = 1e-12
+
+def _require():
+    if np is None:
+        raise ImportError('numpy is required for voxel statistics')
+
+class QuantileSketch(object):
+    """
+    Mergeable approximate quantiles: each quantile() is within
+    relative_accuracy of the true value.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def _bucket(self, store, values):
+        if values.size == 0:
+            return
+        keys = np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+        keys, counts = np.unique(keys, return_counts=True)
+        for (k, n) in zip(keys.tolist(), counts.tolist()):
+            store[k] = store.get(k, 0) + n
+
+    def add(self, values):
+        """
+        Count an array of values (no NaNs).
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        pos = values > SKETCH_MIN_VALUE
+        neg = values < -SKETCH_MIN_VALUE
+        self._bucket(self.positive, values[pos])
+        self._bucket(self.negative, -values[neg])
+        self.zeros += int(values.size - np.count_nonzero(pos) - np.count_nonzero(neg))
+        self.count += int(values.size)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('cannot merge sketches of different accuracy')
+        for (mine, theirs) in ((self.positive, other.positive), (self.negative, other.negative)):
+            for (k, n) in theirs.items():
+                mine[k] = mine.get(k, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _buckets(self):
+        """
+        (value, count) of every bucket, in increasing order of value.
+        """
+        for k in sorted(self.negative, reverse=True):
+            yield -self._value(k), self.negative[k]
+        if self.zeros:
+            yield 0.0, self.zeros
+        for k in sorted(self.positive):
+            yield self._value(k), self.positive[k]
+
+    def quantile(self, q):
+        """
+        The q-quantile (0 <= q <= 1); None if the sketch is empty.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError('quantile must be between 0 and 1')
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for (value, n) in self._buckets():
+            seen += n
+            if seen > rank:
+                return value
+        return value
+
+    def to_dict(self):
+        return {'relative_accuracy':    self.relative_accuracy,
+                'positive':             dict((str(k), n) for (k, n) in self.positive.items()),
+                'negative':             dict((str(k), n) for (k, n) in self.negative.items()),
+                'zeros':                self.zeros,
+                'count':                self.count,
+               }
+
+    @classmethod
+    def from_dict(cls, d):
+        s = cls(d['relative_accuracy'])
+        s.positive = dict((int(k), n) for (k, n) in d['positive'].items())
+        s.negative = dict((int(k), n) for (k, n) in d['negative'].items())
+        s.zeros = d['zeros']
+        s.count = d['count']
+        return s
+
+class Summary(object):
+    """
+    Count, min, max, mean, SD, histogram and quantiles of a set of
+    voxel values, built up by add() and merge().
+
+    With range=(lo, hi) the histogram is exact, over bins equal bins
+    from lo to hi, with the values outside counted in underflow and
+    overflow. Without, histogram() is estimated from the sketch.
+    """
+
+    def __init__(self, bins=DEFAULT_BINS, range=None, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        _require()
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.bins = bins
+        self.range = None if range is None else (float(min(range)), float(max(range)))
+        self.counts = None if range is None else np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, values):
+        """
+        Add an array of values; NaNs are skipped.
+        """
+        x = np.asarray(values, dtype=np.float64).ravel()
+        x = x[~np.isnan(x)]
+        n = x.size
+        if n == 0:
+            return
+        lo, hi = float(x.min()), float(x.max())
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+        # Chan et al., as Accumulator.merge.
+        mean = float(x.mean())
+        m2 = float(((x - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+        if self.counts is not None:
+            rlo, rhi = self.range
+            self.underflow += int(np.count_nonzero(x < rlo))
+            self.overflow += int(np.count_nonzero(x > rhi))
+            self.counts += np.histogram(x, bins=self.bins, range=self.range)[0]
+        self.sketch.add(x)
+
+    def merge(self, other):
+        if self.range != other.range or (self.range is not None and self.bins != other.bins):
+            raise ValueError('cannot merge summaries with different histograms')
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.min, self.max = other.min, other.max
+        else:
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.count = total
+        if self.counts is not None:
+            self.counts += other.counts
+            self.underflow += other.underflow
+            self.overflow += other.overflow
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def sd(self):
+        """
+        Sample standard deviation (0 with fewer than two values).
+        """
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(max(self.m2 / (self.count - 1), 0.0))
+
+    def quantile(self, q):
+        """
+        Approximate q-quantile, clamped to the exact min and max.
+        """
+        v = self.sketch.quantile(q)
+        if v is None:
+            return None
+        return min(max(v, self.min), self.max)
+
+    def percentiles(self, ps=(1, 5, 25, 50, 75, 95, 99)):
+        return dict((p, self.quantile(p / 100.0)) for p in ps)
+
+    def histogram(self, bins=None, range=None):
+        """
+        (counts, edges) as numpy.histogram gives them. Exact for the
+        range the Summary was made with, and estimated from the sketch
+        otherwise (bins defaults to the Summary's, range to min..max).
+        """
+        bins = bins or self.bins
+        if self.counts is not None and range is None and bins == self.bins:
+            return self.counts.copy(), np.linspace(self.range[0], self.range[1], self.bins + 1)
+        if range is None:
+            range = (self.min, self.max) if self.count else (0.0, 1.0)
+        buckets = list(self.sketch._buckets())
+        values = np.array([v for (v, _) in buckets])
+        weights = np.array([n for (_, n) in buckets])
+        values = np.clip(values, self.min, self.max) if self.count else values
+        return np.histogram(values, bins=bins, range=range, weights=weights)
+
+    def to_dict(self):
+        return {'version':      SUMMARY_VERSION,
+                'count':        self.count,
+                'min':          self.min,
+                'max':          self.max,
+                'mean':         self.mean,
+                'm2':           self.m2,
+                'sd':           self.sd,
+                'bins':         self.bins,
+                'range':        None if self.range is None else list(self.range),
+                'counts':       None if self.counts is None else self.counts.tolist(),
+                'underflow':    self.underflow,
+                'overflow':     self.overflow,
+                'sketch':       self.sketch.to_dict(),
+               }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != SUMMARY_VERSION:
+            raise ValueError('unsupported summary version %r' % (d.get('version'),))
+        s = cls(d['bins'], d['range'], d['sketch']['relative_accuracy'])
+        for k in ('count', 'min', 'max', 'mean', 'm2', 'underflow', 'overflow'):
+            setattr(s, k, d[k])
+        if d['counts'] is not None:
+            s.counts = np.array(d['counts'], dtype=np.int64)
+        s.sketch = QuantileSketch.from_dict(d['sketch'])
+        return s
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, sort_keys=True)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as f:
+            return cls.from_dict(json.load(f))
+
+def merge(summaries):
+    """
+    One Summary of all of summaries (which are left alone).
+    """
+    summaries = list(summaries)
+    out = Summary.from_dict(summaries[0].to_dict())
+    for s in summaries[1:]:
+        out.merge(s)
+    return out
+
+class _VoxelStats(object):
+    """
+    Per-voxel mean/SD (as AverageTask) and min/max across inputs, for
+    one slab.
+    """
+
+    def __init__(self, shape):
+        self.acc = Accumulator(shape)
+        self.min = np.full(shape, np.nan)
+        self.max = np.full(shape, np.nan)
+
+    def add(self, x, w):
+        self.acc.add(x, w)
+        self.min = np.fmin(self.min, x)
+        self.max = np.fmax(self.max, x)
+
+def _writer(engine, fname, vartype, signtype, valid_range, two, clobber):
+    return minc_io.RawToMincWriter(fname, engine.out_dimnames, engine.out_shape,
+                                   geometry=engine.geometry(),
+                                   vartype=vartype, signtype=signtype, valid_range=valid_range,
+                                   two=two, clobber=clobber)
+
+def stats(input_files, mask_file=None, labels=False, output_file=None, sdfile=None,
+          min_file=None, max_file=None, weights=None, bins=DEFAULT_BINS, range=None,
+          relative_accuracy=DEFAULT_RELATIVE_ACCURACY, binarize=False, binrange=None,
+          binvalue=None, max_buffer_size_in_kb=4096, check_dimensions=True,
+          vartype=None, signtype=None, valid_range=None, two=False, clobber=False):
+    """
+    Statistics of input_files in one pass. Returns a dict with
+
+        'inputs'    a Summary per input (with labels set, a dict of
+                    label to Summary per input)
+        'pooled'    the Summaries of all inputs merged (per label)
+
+    and writes the per-voxel mean (output_file), SD (sdfile), min
+    (min_file) and max (max_file) across the inputs, those that are
+    given, as mincaverage would write its output and sdfile.
+
+    Only voxels where mask_file is above 0.5 are summarised; with labels
+    set, mask_file is a label volume and every non-zero label gets its
+    own Summaries. The per-voxel outputs cover every voxel. weights,
+    binarize and the output type options are as for the averaging
+    engine (minc_average.average).
+    """
+    _require()
+    if labels and mask_file is None:
+        raise ValueError('labels needs a mask_file with the labels')
+
+    def summary():
+        return Summary(bins, range, relative_accuracy)
+
+    readers = [minc_io.open_volume(f) for f in input_files]
+    mask = None
+    writers = []
+    try:
+        engine = AverageEngine(readers, weights=weights, binarize=binarize, binrange=binrange,
+                               binvalue=binvalue, max_buffer_size_in_kb=max_buffer_size_in_kb,
+                               check_dimensions=check_dimensions)
+        if mask_file is not None:
+            mask = minc_io.open_volume(mask_file)
+            if tuple(mask.shape) != engine.shape:
+                raise ValueError('mask %s has shape %s, expected %s' % (mask_file, mask.shape, engine.shape,))
+
+        if vartype is None:
+            layout = readers[0].layout()
+            vartype, signtype = layout.vartype, layout.signtype
+        writers = [None if f is None else _writer(engine, f, vartype, signtype, valid_range, two, clobber)
+                   for f in (output_file, sdfile, min_file, max_file)]
+
+        per_input = [{} if labels else summary() for _ in readers]
+        for (s, c) in engine.slabs():
+            voxel = _VoxelStats((c,) + engine.out_shape[1:])
+            if mask is not None:
+                start = [0] * len(engine.shape)
+                count = list(engine.shape)
+                start[0], count[0] = s, c
+                m = mask.read_real(start, count)
+                if labels:
+                    m = np.rint(np.nan_to_num(m)).astype(np.int64)
+                    groups = [(int(l), m == l) for l in np.unique(m) if l != 0]
+                else:
+                    groups = [(None, m > 0.5)]
+            for (i, w) in enumerate(engine.weights):
+                x = engine.read(i, s, c)
+                voxel.add(x, w)
+                if mask is None:
+                    per_input[i].add(x)
+                elif not labels:
+                    per_input[i].add(x[groups[0][1]])
+                else:
+                    for (label, inside) in groups:
+                        if label not in per_input[i]:
+                            per_input[i][label] = summary()
+                        per_input[i][label].add(x[inside])
+            for (w, values) in zip(writers, (voxel.acc.mean, voxel.acc.sd(), voxel.min, voxel.max)):
+                if w is not None:
+                    w.write(values)
+
+        for w in writers:
+            if w is not None:
+                w.close()
+    except:
+        for w in writers:
+            if w is not None:
+                w.abort()
+        raise
+    finally:
+        for r in readers:
+            r.close()
+        if mask is not None:
+            mask.close()
+
+    if labels:
+        found = sorted(set(l for d in per_input for l in d))
+        pooled = dict((l, merge([d[l] for d in per_input if l in d])) for l in found)
+    else:
+        pooled = merge(per_input)
+    return {'inputs': per_input, 'pooled': pooled}
+
+def volume_stats(fname, mask_file=None, labels=False, **options):
+    """
+    The Summary (or with labels, dict of label to Summary) of one
+    volume; options as for stats().
+    """
+    return stats([fname], mask_file=mask_file, labels=labels, **options)['inputs'][0]
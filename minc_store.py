@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: a chunked, compressed array store for the voxels of a MINC
+#           file, for reading slices and small regions quickly.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# minctoraw writes one flat blob, so reading a slice or a small region
+# of it means reading the whole file (or working out offsets by hand,
+# slice by slice). ToRawTask.to_store() writes the same voxels as a
+# store instead:
+#
+#     foo.chunks/index.json       shape, dtype, chunk shape and grid,
+#                                 compression, and the dimension names,
+#                                 steps, starts and direction cosines
+#     foo.chunks/chunks/0.0.0     one file per chunk, C order, zlib
+#     foo.chunks/chunks/0.0.1     compressed or not; chunks at the end
+#     ...                         of a dimension are cut to fit
+#
+# The chunk holding a voxel is found by integer division, and each chunk
+# is a separate file, so a read touches only the chunks it needs. A read
+# that spans several chunks decodes them in a pool of threads (zlib lets
+# go of the GIL while it works).
+#
+#     store = minc_store.Store('foo.chunks')
+#     qc = store[60]                  # one slice along the first dimension
+#     roi = store[:, 100:110, 50:70]
+#     store.voxel_to_world((60, 0, 0))
+
+import json
+import multiprocessing
+import os
+import shutil
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from minc import _require_numpy, np
+
+STORE_VERSION = 1
+
+# Chunks are up to this many voxels along each dimension.
+DEFAULT_CHUNK_EDGE = 64
+
+DEFAULT_COMPRESSION = 'zlib'
+DEFAULT_LEVEL = 1
+
+COMPRESSIONS = (None, 'zlib',)
+
+def default_chunks(shape, edge=DEFAULT_CHUNK_EDGE):
+    return tuple(min(n, edge) for n in shape)
+
+def _grid(shape, chunks):
+    return tuple((n + c - 1) // c for (n, c) in zip(shape, chunks))
+
+def _chunk_name(key):
+    return '.'.join(str(k) for k in key)
+
+def _encode(data, compression, level):
+    buf = data.tostring()
+    if compression == 'zlib':
+        return zlib.compress(buf, level)
+    return buf
+
+def _geometry(header, ndim):
+    """
+    The voxel to world part of the index, from a MincHeader (or None).
+    """
+    if header is None:
+        return {}
+    if header.ndim != ndim:
+        raise ValueError('header has %d dimensions, the data %d' % (header.ndim, ndim,))
+    return {'dimnames':             list(header.dimnames),
+            'steps':                list(header.steps),
+            'starts':               list(header.starts),
+            'direction_cosines':    [None if c is None else list(c) for c in header.direction_cosines],
+           }
+
+def write_store(path, slices, shape, dtype, chunks=None, compression=DEFAULT_COMPRESSION,
+                level=DEFAULT_LEVEL, header=None, threads=None):
+    """
+    Write a store at path (replacing anything there) from slices, an
+    iterator of (index, array) pairs along the first dimension as
+    ToRawTask.iter_slices(slice_dims=len(shape) - 1) gives them. Only
+    one row of chunks is held in memory at a time. header, a MincHeader,
+    supplies the voxel to world information. Returns the Store.
+    """
+    _require_numpy()
+    if compression not in COMPRESSIONS:
+        raise ValueError('unknown compression %r' % (compression,))
+    shape = tuple(int(n) for n in shape)
+    dtype = np.dtype(dtype)
+    chunks = default_chunks(shape) if chunks is None else tuple(int(c) for c in chunks)
+    if len(chunks) != len(shape) or min(chunks) < 1:
+        raise ValueError('chunks %r do not fit shape %r' % (chunks, shape,))
+    grid = _grid(shape, chunks)
+
+    index = {'version':     STORE_VERSION,
+             'shape':       list(shape),
+             'dtype':       dtype.str,
+             'chunks':      list(chunks),
+             'grid':        list(grid),
+             'compression': compression,
+            }
+    index.update(_geometry(header, len(shape)))
+
+    parent, name = os.path.split(os.path.abspath(path))
+    tmp = os.path.join(parent, '.%s.tmp%d' % (name, os.getpid(),))
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(os.path.join(tmp, 'chunks'))
+
+    pool = ThreadPool(threads or multiprocessing.cpu_count())
+    try:
+        def write(job):
+            (key, data) = job
+            with open(os.path.join(tmp, 'chunks', _chunk_name(key)), 'wb') as f:
+                f.write(_encode(np.ascontiguousarray(data), compression, level))
+
+        slab = np.empty((chunks[0],) + shape[1:], dtype=dtype)
+        filled = 0
+        row = 0
+        for (_, data) in slices:
+            slab[filled] = data
+            filled += 1
+            if filled == chunks[0] or row * chunks[0] + filled == shape[0]:
+                jobs = []
+                for rest in np.ndindex(*grid[1:]):
+                    sl = tuple(slice(k * c, (k + 1) * c) for (k, c) in zip(rest, chunks[1:]))
+                    jobs.append(((row,) + rest, slab[(slice(0, filled),) + sl]))
+                pool.map(write, jobs)
+                row += 1
+                filled = 0
+        if row != grid[0] or filled:
+            raise RuntimeError('expected %d slices, got %d' % (shape[0], row * chunks[0] + filled,))
+    except:
+        shutil.rmtree(tmp)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(os.path.join(tmp, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    return Store(path)
+
+def from_array(path, data, **kwargs):
+    """
+    Write a numpy array as a store; keyword arguments as write_store.
+    """
+    return write_store(path, ((i, data[i]) for i in range(data.shape[0])), data.shape, data.dtype, **kwargs)
+
+class Store(object):
+    """
+    A store written by write_store(), opened for reading. Index it like
+    a numpy array, with integers and slices (step 1), or use read().
+    """
+
+    def __init__(self, path, threads=None):
+        _require_numpy()
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, 'index.json')) as f:
+            self.index = json.load(f)
+        if self.index.get('version') != STORE_VERSION:
+            raise ValueError('%s: unsupported store version %r' % (path, self.index.get('version'),))
+        self.shape = tuple(self.index['shape'])
+        self.dtype = np.dtype(str(self.index['dtype']))
+        self.chunks = tuple(self.index['chunks'])
+        self.grid = tuple(self.index['grid'])
+        self.compression = self.index['compression']
+        self.threads = threads or multiprocessing.cpu_count()
+        self._pool = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def chunk_key(self, voxel):
+        """
+        The key (position in the chunk grid) of the chunk holding voxel.
+        """
+        return tuple(v // c for (v, c) in zip(voxel, self.chunks))
+
+    def chunk_path(self, key):
+        return os.path.join(self.path, 'chunks', _chunk_name(key))
+
+    def chunk_shape(self, key):
+        return tuple(min(c, n - k * c) for (k, c, n) in zip(key, self.chunks, self.shape))
+
+    def read_chunk(self, key):
+        """
+        The voxels of one chunk.
+        """
+        with open(self.chunk_path(key), 'rb') as f:
+            buf = f.read()
+        if self.compression == 'zlib':
+            buf = zlib.decompress(buf)
+        return np.frombuffer(buf, dtype=self.dtype).reshape(self.chunk_shape(key))
+
+    def read_chunks(self, keys):
+        """
+        read_chunk() for each key, decoded in parallel.
+        """
+        keys = list(keys)
+        if len(keys) < 2 or self.threads < 2:
+            return [self.read_chunk(k) for k in keys]
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        return self._pool.map(self.read_chunk, keys)
+
+    def read(self, start=None, count=None):
+        """
+        The block of voxels from start, count voxels along each
+        dimension (default: everything).
+        """
+        start = tuple(start) if start is not None else (0,) * self.ndim
+        count = tuple(count) if count is not None else tuple(n - s for (n, s) in zip(self.shape, start))
+        for (s, c, n) in zip(start, count, self.shape):
+            if s < 0 or c < 0 or s + c > n:
+                raise IndexError('start %r count %r out of range for shape %r' % (start, count, self.shape,))
+        out = np.empty(count, dtype=self.dtype)
+        if 0 in count:
+            return out
+
+        first = self.chunk_key(start)
+        last = self.chunk_key([s + c - 1 for (s, c) in zip(start, count)])
+        keys = list(np.ndindex(*[l - f + 1 for (f, l) in zip(first, last)]))
+        keys = [tuple(f + k for (f, k) in zip(first, key)) for key in keys]
+        for (key, data) in zip(keys, self.read_chunks(keys)):
+            src, dst = [], []
+            for (k, c, s, n) in zip(key, self.chunks, start, count):
+                lo = max(s, k * c)
+                hi = min(s + n, (k + 1) * c)
+                src.append(slice(lo - k * c, hi - k * c))
+                dst.append(slice(lo - s, hi - s))
+            out[tuple(dst)] = data[tuple(src)]
+        return out
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        if len(item) > self.ndim:
+            raise IndexError('too many indices')
+        item = item + (slice(None),) * (self.ndim - len(item))
+        start, count, squeeze = [], [], []
+        for (axis, (i, n)) in enumerate(zip(item, self.shape)):
+            if isinstance(i, slice):
+                lo, hi, step = i.indices(n)
+                if step != 1:
+                    raise IndexError('only slices with step 1 are supported')
+                start.append(lo)
+                count.append(max(0, hi - lo))
+            else:
+                i = int(i)
+                if i < 0:
+                    i += n
+                if not 0 <= i < n:
+                    raise IndexError('index %d out of range for dimension %d' % (i, axis,))
+                start.append(i)
+                count.append(1)
+                squeeze.append(axis)
+        data = self.read(start, count)
+        return data.reshape([c for (axis, c) in enumerate(count) if axis not in squeeze])
+
+    def to_array(self):
+        return self.read()
+
+    def voxel_to_world(self, voxel):
+        """
+        World (x, y, z) coordinates of a voxel index, from the steps,
+        starts and direction cosines of the spatial dimensions. Needs a
+        store written with a header.
+        """
+        if 'steps' not in self.index:
+            raise ValueError('%s has no voxel to world information' % self.path)
+        world = [0.0, 0.0, 0.0]
+        for (v, step, start, cosines) in zip(voxel, self.index['steps'], self.index['starts'],
+                                             self.index['direction_cosines']):
+            if cosines is None:
+                continue
+            for j in range(3):
+                world[j] += (start + v * step) * cosines[j]
+        return tuple(world)
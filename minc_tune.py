@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: pick mincconvert compression/chunk settings by measurement.
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# Each (compression, chunk) setting is applied to a set of sample
+# volumes with ConvertTask; the outputs are then read back the way the
+# workload reads them and timed, and their sizes are recorded. The
+# settings that are not beaten on both read time and size (the Pareto
+# front) are kept, one of them is recommended, and the result is saved
+# as a profile that ConvertTask(profile=True) picks up.
+#
+# Read times are the best of several repeats, so they measure a warm
+# page cache; with one sample file per setting that is the fair
+# comparison, but cold reads from slow storage favour smaller files
+# more than these numbers suggest.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import minc
+
+WORKLOADS = ('full', 'slices', 'header')
+
+DEFAULT_COMPRESSIONS = (0, 1, 4, 9)
+DEFAULT_CHUNKS = (0, 1 << 14, 1 << 16, 1 << 18)
+
+def read_full(fname, backend='auto'):
+    minc.ToRawTask(input_file=fname, nonormalize=True).to_array(backend=backend)
+
+def read_slices(fname, backend='auto'):
+    for _ in minc.ToRawTask(input_file=fname, nonormalize=True).iter_slices(backend=backend):
+        pass
+
+def read_header(fname, backend='auto'):
+    import minc_header
+    minc_header.read_header(fname, 'mincdump' if backend == 'subprocess' else backend)
+
+READERS = {'full':      read_full,
+           'slices':    read_slices,
+           'header':    read_header,
+          }
+
+def time_read(fname, workload='full', repeats=3, backend='auto'):
+    """
+    Best wall time, in seconds, of repeats reads of fname.
+    """
+    if workload not in READERS:
+        raise ValueError('unknown workload %r, expected one of %s' % (workload, WORKLOADS,))
+    best = None
+    for _ in range(repeats):
+        t0 = time.time()
+        READERS[workload](fname, backend)
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+def sweep(samples, workload='full', compressions=DEFAULT_COMPRESSIONS, chunks=DEFAULT_CHUNKS,
+          repeats=3, two=True, backend='auto', workdir=None):
+    """
+    Convert each sample with every (compression, chunk) pair and time
+    reading the results. Returns one trial dict per setting, with the
+    total output size and total read time over all samples.
+    """
+    if not samples:
+        raise ValueError('need at least one sample volume')
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='minc-tune-')
+
+    trials = []
+    try:
+        for compression in compressions:
+            for chunk in chunks:
+                trial = {'compression':     compression,
+                         'chunk':           chunk,
+                         'bytes':           0,
+                         'read_seconds':    0.0,
+                         'convert_seconds': 0.0,
+                        }
+                for (i, sample) in enumerate(samples):
+                    out = os.path.join(workdir, 'c%d_k%d_%d.mnc' % (compression, chunk, i,))
+                    task = minc.ConvertTask(input_file=sample, output_file=out, two=two,
+                                            clobber=True, compression=compression)
+                    if chunk:
+                        task.inputs.chunk = chunk
+
+                    t0 = time.time()
+                    runtime = task.run().runtime
+                    trial['convert_seconds'] += time.time() - t0
+                    if runtime.returncode != 0 or not os.path.exists(out):
+                        raise RuntimeError('%s failed (exit code %s): %s'
+                                           % (task.cmdline, runtime.returncode, runtime.stderr,))
+
+                    trial['bytes'] += os.path.getsize(out)
+                    trial['read_seconds'] += time_read(out, workload, repeats, backend)
+                    os.remove(out)
+                trials.append(trial)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return trials
+
+def pareto(trials):
+    """
+    The trials not dominated on (read_seconds, bytes): no other trial
+    is at least as good on both and better on one. Sorted fastest
+    first.
+    """
+    def dominates(a, b):
+        return (a['read_seconds'] <= b['read_seconds'] and a['bytes'] <= b['bytes']
+                and (a['read_seconds'] < b['read_seconds'] or a['bytes'] < b['bytes']))
+
+    front = [t for t in trials if not any(dominates(u, t) for u in trials)]
+    return sorted(front, key=lambda t: (t['read_seconds'], t['bytes']))
+
+def recommend(front, slowdown=0.1):
+    """
+    From a Pareto front, the smallest setting whose read time is within
+    a fraction slowdown of the fastest.
+    """
+    fastest = min(t['read_seconds'] for t in front)
+    ok = [t for t in front if t['read_seconds'] <= fastest * (1.0 + slowdown)]
+    return min(ok, key=lambda t: (t['bytes'], t['read_seconds']))
+
+def save_profile(profile, fname=None):
+    """
+    Write a profile where ConvertTask looks for it (or to fname). The
+    file is replaced atomically.
+    """
+    if fname is None:
+        fname = minc.convert_profile_file()
+    if fname is None:
+        raise ValueError('no profile file: set $MINC_CONVERT_PROFILE or $MINC_PROBE_CACHE_DIR')
+
+    d = os.path.dirname(os.path.abspath(fname))
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    fd, tmp = tempfile.mkstemp(dir=d, prefix='.convert-profile-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(profile, f, indent=1, sort_keys=True)
+    os.rename(tmp, fname)
+    return fname
+
+def tune(samples, workload='full', compressions=DEFAULT_COMPRESSIONS, chunks=DEFAULT_CHUNKS,
+         repeats=3, slowdown=0.1, two=True, backend='auto', save=True, fname=None):
+    """
+    Sweep, find the Pareto front and recommend a setting; with save,
+    also write the profile for ConvertTask. Returns the profile.
+    """
+    trials = sweep(samples, workload, compressions, chunks, repeats, two, backend)
+    front = pareto(trials)
+    best = recommend(front, slowdown)
+
+    profile = {'profile_version':   minc.CONVERT_PROFILE_VERSION,
+               'workload':          workload,
+               'samples':           [os.path.abspath(s) for s in samples],
+               'created':           time.time(),
+               'compression':       best['compression'],
+               'chunk':             best['chunk'] or None,
+               'pareto':            front,
+               'trials':            trials,
+              }
+    if save:
+        save_profile(profile, fname)
+    return profile
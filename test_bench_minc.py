@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the benchmark harness
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_bench_minc.py
+
+import os
+import shutil
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, skipif)
+
+import bench_minc
+import minc
+import minc_io
+from test_minc import _FakeToolchain
+from test_minc_ecat import _series, _tools
+
+no_h5py = not minc_io.available()
+
+def _result(wall, cmdline=1e-4):
+    return {'task': 'ToRawTask', 'backend': 'hdf5', 'fixture': 'small-3d-uint8', 'status': 'ok',
+            'wall_seconds': wall, 'cpu_seconds': wall, 'cmdline_seconds': cmdline, 'peak_rss_kb': 1000}
+
+def test_compare():
+    baseline = {'run_id': 'a', 'results': [_result(1.0)]}
+    yield assert_equal, bench_minc.compare([_result(1.1)], baseline), []
+    yield assert_equal, [m for (_, m, _, _) in bench_minc.compare([_result(2.0)], baseline)], \
+                        ['cpu_seconds', 'wall_seconds']
+
+    # Tiny absolute differences are noise.
+    yield assert_equal, bench_minc.compare([_result(1.0, cmdline=1.5e-4)], baseline), []
+
+@skipif(no_h5py)
+def test_run_and_history():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        outdir = os.path.join(tmpdir, 'out')
+        os.makedirs(outdir)
+        fixtures = bench_minc.make_fixtures(tmpdir, sizes=[('tiny', (4, 5, 6))], dtypes=['int16'], frames=2)
+        yield assert_equal, [f.name for f in fixtures], ['tiny-3d-int16', 'tiny-4d-int16']
+
+        results = bench_minc.run(fixtures, outdir, selected=['ToRawTask', 'DumpTask'])
+        hdf5 = [r for r in results if r['backend'] == 'hdf5']
+        yield assert_equal, len(hdf5), 4
+        yield assert_equal, set(r['status'] for r in hdf5), set(['ok'])
+        yield assert_true, all(r['peak_rss_kb'] > 0 and r['cmdline_seconds'] > 0 for r in hdf5)
+        yield assert_equal, [r['bytes_out'] for r in hdf5 if r['task'] == 'ToRawTask'], [4 * 5 * 6 * 2, 2 * 4 * 5 * 6 * 2]
+
+        history = os.path.join(tmpdir, 'history.jsonl')
+        for run_id in ['first', 'second']:
+            bench_minc.append_history(history, {'run_id': run_id, 'results': results})
+        records = bench_minc.read_history(history)
+        yield assert_equal, bench_minc.find_baseline('previous', records)['run_id'], 'second'
+        yield assert_equal, bench_minc.find_baseline('first', records)['run_id'], 'first'
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_cmdline_batch():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').close()
+        batch = [dict(input_file=inp, output_file='out%d.mnc' % i, two=True) for i in range(20)]
+        t = bench_minc.cmdline_batch_seconds(minc.ConvertTask, batch)
+        yield assert_equal, sorted(t), ['minc_argv', 'task']
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_ecat_speedup():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _tools(fake.bindir)
+        inp = os.path.join(tmpdir, 'pet.mnc')
+        _series(inp, 12)
+        r = bench_minc.ecat_speedup(inp, tmpdir, processes=2)
+        yield assert_true, r['identical']
+        yield assert_true, r['speedup'] > 0
+        yield assert_equal, os.listdir(tmpdir), ['pet.mnc']
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def test_import_time():
+    r = bench_minc.import_result('minc', repeats=1)
+    yield assert_equal, r['status'], 'ok'
+    yield assert_true, r['wall_seconds'] > 0
+    yield assert_equal, r['nipype'], False
+    yield assert_equal, bench_minc.import_result('_minc_tasks', repeats=1)['nipype'], True
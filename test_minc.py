@@ -12,8 +12,14 @@
 # FIXME How do we get line numbers of the failing tests from nosetests!?
 
 import os
+import shutil
+import sys
+import stat
+import subprocess
+import tempfile
+import time
 
-from nipype.testing import (assert_equal, assert_true, assert_raises,
+from nipype.testing import (assert_equal, assert_true, assert_false, assert_raises,
                             assert_not_equal, skipif)
 
 # FIXME change these to nipype.interfaces.minc later
@@ -35,3 +41,201 @@ def test_mincversion():
         yield assert_true, ver['libminc']               >= '2.2.00'
         yield assert_true, ver['netcdf'].split(' ')[0]  >= '4.1.3'
         yield assert_true, ver['hdf5']                  >= '1.8.8'
+
+def _fake_tool(bindir, name, script, interpreter='/bin/sh'):
+    """
+    Write an executable script called name into bindir. Used to
+    exercise code that shells out to MINC without needing MINC.
+    """
+    fname = os.path.join(bindir, name)
+    with open(fname, 'w') as f:
+        f.write('#!%s\n' % interpreter + script)
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR)
+    return fname
+
+FAKE_VERSION = """
+echo x >> "${0%/*}/calls"
+echo "program: 2.2.00"
+echo "libminc: 2.2.00"
+echo "netcdf : 4.1.3 of Jan  1 2013"
+echo "HDF5   : 1.8.8"
+"""
+
+FAKE_CONVERT_HELP = """
+echo "Command-specific options:"
+echo " -clobber:       Overwrite existing file."
+echo " -2:             Create a MINC 2 output file."
+echo " -compress:      Set the compression level, from 0 (disabled) to 9 (maximum)."
+echo " -chunk:         Default value: -1.79769e+308"
+exit 1
+"""
+
+class _FakeToolchain(object):
+    """
+    A temporary directory of fake MINC tools, put on $PATH, with the
+    toolchain probe cache pointed at a scratch directory.
+    """
+
+    def __init__(self):
+        self.bindir = tempfile.mkdtemp()
+        self.cachedir = tempfile.mkdtemp()
+        self.saved = dict((k, os.environ.get(k)) for k in ['PATH', 'MINC_PROBE_CACHE_DIR'])
+        os.environ['PATH'] = self.bindir
+        os.environ['MINC_PROBE_CACHE_DIR'] = self.cachedir
+        minc.Info.clear_cache()
+
+    def calls(self):
+        try:
+            return len(open(os.path.join(self.bindir, 'calls')).readlines())
+        except IOError:
+            return 0
+
+    def close(self):
+        for (k, v) in self.saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        minc.Info.clear_cache()
+        shutil.rmtree(self.bindir)
+        shutil.rmtree(self.cachedir)
+
+def test_probe_cached():
+    fake = _FakeToolchain()
+    try:
+        mincinfo = _fake_tool(fake.bindir, 'mincinfo', FAKE_VERSION)
+
+        yield assert_equal, minc.Info.version()['minc'], '2.2.00'
+        yield assert_equal, minc.Info.version()['netcdf'], '4.1.3 of Jan  1 2013'
+        yield assert_true, check_minc()
+        yield assert_equal, fake.calls(), 1
+
+        # A new process only has the on-disk cache.
+        minc.Info.clear_cache()
+        yield assert_equal, minc.Info.version()['hdf5'], '1.8.8'
+        yield assert_equal, fake.calls(), 1
+
+        # Replacing the binary invalidates the cache.
+        t = time.time() + 10
+        os.utime(mincinfo, (t, t))
+        yield assert_equal, minc.Info.version()['hdf5'], '1.8.8'
+        yield assert_equal, fake.calls(), 2
+    finally:
+        fake.close()
+
+def test_probe_flags():
+    fake = _FakeToolchain()
+    try:
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_VERSION)
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT_HELP)
+
+        yield assert_true,  minc.Info.supports('mincconvert', '-compress')
+        yield assert_true,  minc.Info.supports('mincconvert', '-2')
+        yield assert_false, minc.Info.supports('mincconvert', '-1')
+        yield assert_false, minc.Info.supports('mincconvert', '-template')
+        yield assert_false, minc.Info.supports('minctoraw', '-normalize')
+    finally:
+        fake.close()
+
+def test_probe_no_minc():
+    fake = _FakeToolchain()
+    try:
+        yield assert_equal, minc.Info.version(), None
+        yield assert_true, no_minc()
+        yield assert_false, minc.Info.supports('mincconvert', '-2')
+    finally:
+        fake.close()
+
+# A 2x3x4 unsigned short volume holding 0..23.
+FAKE_LAYOUT = """
+case "$*" in
+    *-vardims*) echo "zspace yspace xspace"; echo short; echo unsigned ;;
+    *)          echo 2; echo 3; echo 4 ;;
+esac
+"""
+
+FAKE_TORAW = """
+import struct, sys
+open(sys.argv[-1]).close()
+if '-float' in sys.argv:
+    sys.stdout.write(struct.pack('=24f', *[i / 2.0 for i in range(24)]))
+else:
+    sys.stdout.write(struct.pack('=24H', *range(24)))
+"""
+
+@skipif(minc.np is None)
+def test_toraw_to_array():
+    fake = _FakeToolchain()
+    try:
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_LAYOUT)
+        _fake_tool(fake.bindir, 'minctoraw', FAKE_TORAW, sys.executable)
+
+        toraw = minc.ToRawTask(input_file=__file__, nonormalize=True)
+        data = toraw.to_array(chunk_size=5)
+        yield assert_equal, data.dtype, minc.np.dtype('uint16')
+        yield assert_equal, data.shape, (2, 3, 4)
+        yield assert_equal, data.ravel().tolist(), list(range(24))
+
+        toraw = minc.ToRawTask(input_file=__file__, nonormalize=True, write_float=True)
+        yield assert_equal, toraw.raw_dtype(), minc.np.dtype('float32')
+        yield assert_equal, toraw.to_array()[1, 2, 3], 11.5
+
+        # The flag that comes last on the command line wins.
+        toraw = minc.ToRawTask(input_file=__file__, nonormalize=True, write_byte=True, write_short=True)
+        yield assert_equal, toraw.raw_dtype(), minc.np.dtype('int16')
+    finally:
+        fake.close()
+
+@skipif(minc.np is None)
+def test_toraw_iter_slices():
+    fake = _FakeToolchain()
+    try:
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_LAYOUT)
+        _fake_tool(fake.bindir, 'minctoraw', FAKE_TORAW, sys.executable)
+
+        toraw = minc.ToRawTask(input_file=__file__, nonormalize=True)
+        slices = list(toraw.iter_slices())
+        yield assert_equal, [i for (i, _) in slices], [(0,), (1,)]
+        yield assert_equal, slices[1][1].shape, (3, 4)
+        yield assert_equal, slices[1][1][0, 0], 12
+
+        rows = list(toraw.iter_slices(slice_dims=1))
+        yield assert_equal, len(rows), 6
+        yield assert_equal, rows[-1][0], (1, 2)
+
+        # File names are passed whole, spaces and quotes included.
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "scan 1 'a\".mnc")
+            shutil.copy(__file__, fname)
+            spaced = minc.ToRawTask(input_file=fname, nonormalize=True)
+            yield assert_equal, minc._stdout_argv(spaced), ['minctoraw', '-nonormalize', fname]
+            yield assert_equal, [i for (i, _) in spaced.iter_slices()], [(0,), (1,)]
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # Stopping early must not leave the child behind.
+        it = toraw.iter_slices()
+        next(it)
+        it.close()
+
+        # Too short a stream is an error.
+        _fake_tool(fake.bindir, 'minctoraw', 'printf abc', '/bin/sh')
+        yield assert_raises, RuntimeError, toraw.to_array
+    finally:
+        fake.close()
+
+def test_lazy_import():
+    # A fresh interpreter, since this one has loaded the Task classes.
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = ("import sys, minc; minc.check_minc(); minc.Info.cache_dir(); "
+             "print 'nipype' in sys.modules, minc.tasks_loaded(); "
+             "minc.ConvertTask; print 'nipype' in sys.modules, minc.tasks_loaded()")
+    out = subprocess.check_output([sys.executable, '-c', probe], cwd=here)
+    yield assert_equal, out.split(), ['False', 'False', 'True', 'True']
+
+    import _minc_tasks
+    yield assert_true, minc.ConvertTask is _minc_tasks.ConvertTask
+    public = set(n for n in dir(_minc_tasks) if n.endswith(('Task', 'Spec', 'Mixin')))
+    yield assert_equal, public - minc._LAZY_NAMES, set()
+    yield assert_raises, AttributeError, getattr, minc, 'NoSuchTask'
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the fast command line renderer
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_argv.py
+
+import itertools
+import os
+import shutil
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises)
+
+import minc
+import minc_argv
+
+CASES = [
+    (minc.ConvertTask, [dict(input_file='a.mnc', output_file='b.mnc'),
+                        dict(input_file='a.mnc', output_file='b.mnc', two=True, clobber=True),
+                        dict(input_file='a.mnc', output_file='b.mnc', compression=4, chunk=65536),
+                        dict(input_file='a.mnc', output_file='b.mnc', template=False, two=True),
+                        dict(input_file='a.mnc'),
+                       ]),
+    (minc.CopyTask, [dict(input_file='a.mnc', output_file='b.mnc'),
+                     dict(input_file='a.mnc', output_file='b.mnc', pixel_values=True, real_values=False),
+                    ]),
+    (minc.ToEcatTask, [dict(input_file='sub/a.mnc'),
+                       dict(input_file='a.mnc', output_file='x.v', ignore_patient_variable=True, voxels_as_integers=True),
+                      ]),
+    (minc.ToRawTask, [dict(input_file='a.mnc', nonormalize=True),
+                      dict(input_file='a.mnc', normalize=True, write_short=True, write_signed=True,
+                           write_range=(0.0, 1.5), out_file='x.raw'),
+                      dict(input_file='a.mnc'),
+                      dict(input_file='a.mnc', normalize=True, nonormalize=True),
+                     ]),
+    (minc.DumpTask, [dict(input_file='a.mnc'),
+                     dict(input_file='a.mnc', header_data=True, out_file='h.txt'),
+                     dict(input_file='a.mnc', precision=3, variables=['image', 'xspace'], line_length=120),
+                     dict(input_file='a.mnc', precision=(4, 8), annotations_brief='f', netcdf_name='foo'),
+                     dict(input_file='a.mnc', coordinate_data=True, header_data=True),
+                    ]),
+    (minc.AverageTask, [dict(input_files=['a.mnc', 'b.mnc', 'c.mnc'], output_file='avg.mnc'),
+                        dict(input_files=['a.mnc'], output_file='avg.mnc', clobber=True, two=True,
+                             format_float=True, nonormalize=True, sdfile='sd.mnc', copy_header=True),
+                        dict(foo='files.txt', output_file='avg.mnc', voxel_range=(0, 100),
+                             binarize=True, binrange=(0.5, 1.5), binvalue=2.0, quiet=True),
+                        dict(input_files=['a.mnc', 'b.mnc'], output_file='avg.mnc',
+                             weights=['0.25', '0.75'], avgdim='zspace', width_weighted=True,
+                             max_buffer_size_in_kb=1024, debug=True),
+                        dict(input_files=['a.mnc'], output_file='avg.mnc', args='-extra 1',
+                             tree_shard_size=4, tree_fanin=3),
+                        dict(output_file='avg.mnc'),
+                        dict(input_files=['a.mnc'], output_file='avg.mnc', width_weighted=True),
+                        dict(input_files=['a.mnc'], output_file='avg.mnc', tree_fanin=3),
+                        dict(input_files=['a.mnc'], foo='files.txt', output_file='avg.mnc'),
+                       ]),
+]
+
+# Inputs must exist for the Tasks to accept them.
+_cwd = None
+_tmpdir = None
+
+def setup_module():
+    global _cwd, _tmpdir
+    _cwd = os.getcwd()
+    _tmpdir = tempfile.mkdtemp()
+    os.chdir(_tmpdir)
+    os.mkdir('sub')
+    for f in ['a.mnc', 'b.mnc', 'c.mnc', 'a b.mnc', "it's.mnc", 'sub/a.mnc', 'files.txt',
+              'in0.mnc', 'in1.mnc', 'in2.mnc']:
+        open(f, 'w').close()
+
+def teardown_module():
+    os.chdir(_cwd)
+    shutil.rmtree(_tmpdir)
+
+def _outcome(f):
+    try:
+        return f()
+    except (IOError, ValueError) as e:
+        return e.__class__
+
+def test_same_as_cmdline():
+    for (task_class, batch) in CASES:
+        for params in batch:
+            expected = _outcome(lambda: task_class(**params).cmdline)
+            got = _outcome(lambda: minc_argv.renderer(task_class).cmdline(params))
+            yield assert_equal, got, expected
+
+def test_error_messages():
+    r = minc_argv.renderer(minc.AverageTask)
+    try:
+        r.cmdline(dict(input_files=['a.mnc'], output_file='avg.mnc', width_weighted=True))
+    except ValueError as e:
+        try:
+            minc.AverageTask(input_files=['a.mnc'], output_file='avg.mnc', width_weighted=True).cmdline
+        except ValueError as f:
+            yield assert_equal, str(e), str(f)
+
+    r = minc_argv.renderer(minc.ConvertTask)
+    yield assert_raises, ValueError, r.cmdline, dict(output_file='b.mnc')
+
+def test_batch():
+    # Every combination of a few flags, rendered in one batch with keys
+    # in various orders.
+    flags = ['clobber', 'two', 'template']
+    batch = []
+    for n in range(len(flags) + 1):
+        for chosen in itertools.combinations(flags, n):
+            for i in range(3):
+                params = dict((f, True) for f in chosen)
+                params.update(input_file='in%d.mnc' % i, output_file='out%d.mnc' % i)
+                batch.append(params)
+    got = minc_argv.cmdlines(minc.ConvertTask, batch)
+    yield assert_equal, got, [minc.ConvertTask(**p).cmdline for p in batch]
+    yield assert_equal, len(minc_argv.renderer(minc.ConvertTask)._plans) >= 2 ** len(flags), True
+
+def test_argv():
+    task = minc.DumpTask(input_file='a b.mnc', precision=(4, 8), variables=['image'])
+    params = dict(input_file='a b.mnc', precision=(4, 8), variables=['image'])
+    yield assert_equal, minc_argv.renderer(minc.DumpTask).argv(params), minc._stdout_argv(task)
+    yield assert_equal, minc._stdout_argv(task), ['mincdump', '-p', '4,8', '-v', 'image', 'a b.mnc']
+
+    # Values are whole; the free-form args are split.
+    params = dict(input_file="it's.mnc", output_file='b c.mnc', args='-x "y z"')
+    yield assert_equal, minc._task_argv(minc.ConvertTask(**params)), \
+                        ['mincconvert', '-x', 'y z', "it's.mnc", 'b c.mnc']
+    yield assert_equal, minc_argv.renderer(minc.ConvertTask).argv(params), \
+                        minc._task_argv(minc.ConvertTask(**params))
+    yield assert_equal, minc_argv.argvs(minc.ConvertTask, [dict(input_file='a.mnc', output_file='b.mnc', two=True)]), \
+                        [['mincconvert', '-2', 'a.mnc', 'b.mnc']]
+
+def test_unsupported():
+    class Custom(minc.ConvertTask):
+        def _format_arg(self, name, spec, value):
+            return super(Custom, self)._format_arg(name, spec, value)
+    yield assert_raises, NotImplementedError, minc_argv.ArgvRenderer, Custom
+    yield assert_true, minc_argv.renderer(minc.DumpTask) is minc_argv.renderer(minc.DumpTask)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the asyncio execution API
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_async.py
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_async
+import minc_io
+from test_minc import _FakeToolchain, _fake_tool
+
+no_trollius = minc_async.asyncio is None
+no_h5py = not minc_io.available()
+
+if not no_trollius:
+    from trollius import From, Return
+    asyncio = minc_async.asyncio
+
+# Logs its start and end times and pid, waits for the number of seconds
+# given in the input file, then copies it.
+FAKE_CONVERT = """
+import os, shutil, sys, time
+log = os.path.join(os.path.dirname(sys.argv[-1]), 'log')
+with open(log, 'a') as f:
+    f.write('start %f %d\\n' % (time.time(), os.getpid()))
+time.sleep(float(open(sys.argv[-2]).read()))
+shutil.copy(sys.argv[-2], sys.argv[-1])
+with open(log, 'a') as f:
+    f.write('end %f %d\\n' % (time.time(), os.getpid()))
+if 'fail' in sys.argv[-1]:
+    sys.stderr.write('no good\\n')
+    sys.exit(4)
+"""
+
+FAKE_TORAW = """
+import sys
+for i in range(100):
+    sys.stdout.write(b'z' * 10000)
+"""
+
+def _setup():
+    fake = _FakeToolchain()
+    _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+    _fake_tool(fake.bindir, 'minctoraw', FAKE_TORAW, sys.executable)
+    tmpdir = tempfile.mkdtemp()
+    return fake, tmpdir
+
+def _input(tmpdir, name, seconds):
+    fname = os.path.join(tmpdir, name)
+    open(fname, 'w').write(str(seconds))
+    return fname
+
+def _log(tmpdir):
+    return [line.split() for line in open(os.path.join(tmpdir, 'out', 'log'))]
+
+@skipif(no_trollius)
+def test_run():
+    fake, tmpdir = _setup()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        os.makedirs(os.path.join(tmpdir, 'out'))
+        inp = _input(tmpdir, 'in.mnc', 0.2)
+        tasks = [minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, 'out', '%d.mnc' % i))
+                 for i in range(6)]
+
+        minc_async.set_concurrency(2)
+        outputs = minc_async.run_sync(minc_async.run_all(tasks), loop)
+        yield assert_equal, [o['output_file'] for o in outputs], [t.inputs.output_file for t in tasks]
+        yield assert_true, all(os.path.exists(o['output_file']) for o in outputs)
+
+        # Never more than two at once.
+        running = peak = 0
+        for (event, t, pid) in sorted(_log(tmpdir), key=lambda e: float(e[1])):
+            running += 1 if event == 'start' else -1
+            peak = max(peak, running)
+        yield assert_equal, peak, 2
+
+        # StdOut tasks write to the same file .run() would.
+        toraw = minc.ToRawTask(input_file=inp, nonormalize=True)
+        outputs = minc_async.run_sync(minc_async.run(toraw), loop)
+        yield assert_equal, outputs['output_file'], os.path.join(tmpdir, 'in.raw')
+        yield assert_equal, os.path.getsize(outputs['output_file']), 1000000
+
+        chunks = []
+        n = minc_async.run_sync(minc_async.stream(minc.ToRawTask(input_file=inp, nonormalize=True),
+                                                  chunks.append, chunk_size=4096), loop)
+        yield assert_equal, n, 1000000
+        yield assert_true, max(len(c) for c in chunks) <= 4096
+
+        failing = minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, 'out', 'fail.mnc'))
+        try:
+            minc_async.run_sync(minc_async.run(failing), loop)
+        except minc_async.TaskFailed as e:
+            yield assert_equal, e.returncode, 4
+            yield assert_true, 'no good' in e.stderr
+        else:
+            yield assert_true, False
+    finally:
+        minc_async.set_concurrency(minc_async.DEFAULT_CONCURRENCY)
+        loop.close()
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def _gone(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+@skipif(no_trollius)
+def test_timeout_and_cancel():
+    fake, tmpdir = _setup()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        os.makedirs(os.path.join(tmpdir, 'out'))
+        slow = _input(tmpdir, 'slow.mnc', 30)
+        task = minc.ConvertTask(input_file=slow, output_file=os.path.join(tmpdir, 'out', 'a.mnc'))
+
+        t0 = time.time()
+        yield assert_raises, asyncio.TimeoutError, minc_async.run_sync, minc_async.run(task, timeout=0.5), loop
+        yield assert_true, time.time() - t0 < 10
+        pid = int(_log(tmpdir)[-1][2])
+        yield assert_true, _gone(pid)
+
+        @asyncio.coroutine
+        def cancel_soon():
+            job = asyncio.async(minc_async.run(task), loop=loop)
+            yield From(asyncio.sleep(0.5, loop=loop))
+            job.cancel()
+            try:
+                yield From(job)
+            except asyncio.CancelledError:
+                raise Return(True)
+            raise Return(False)
+
+        yield assert_true, minc_async.run_sync(cancel_soon(), loop)
+        pid = int(_log(tmpdir)[-1][2])
+        yield assert_true, _gone(pid)
+    finally:
+        loop.close()
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+@skipif(no_trollius)
+def test_executor():
+    import minc_cache
+    fake, tmpdir = _setup()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        os.makedirs(os.path.join(tmpdir, 'out'))
+        cache = minc_cache.ResultCache(os.path.join(tmpdir, 'cache'))
+        tasks = [minc.ConvertTask(input_file=_input(tmpdir, 'in%d.mnc' % i, '0.2' + '0' * i),
+                                  output_file=os.path.join(tmpdir, 'out', '%d.mnc' % i), cache=cache)
+                 for i in range(3)]
+        yield assert_true, all(minc_async._in_process(t) for t in tasks)
+
+        # Cached runs go through the executor, within the limit.
+        minc_async.set_concurrency(1)
+        minc_async.run_sync(minc_async.run_all(tasks), loop)
+        running = peak = 0
+        for (event, t, pid) in sorted(_log(tmpdir), key=lambda e: float(e[1])):
+            running += 1 if event == 'start' else -1
+            peak = max(peak, running)
+        yield assert_equal, peak, 1
+
+        # A timeout is raised at once, but cannot stop the run, which
+        # keeps its slot until it finishes.
+        slow = minc.ConvertTask(input_file=_input(tmpdir, 'slow.mnc', 1),
+                                output_file=os.path.join(tmpdir, 'out', 'slow.mnc'), cache=cache)
+        t0 = time.time()
+        yield assert_raises, asyncio.TimeoutError, minc_async.run_sync, minc_async.run(slow, timeout=0.2), loop
+        yield assert_true, time.time() - t0 < 0.9
+        yield assert_true, not os.path.exists(slow.inputs.output_file)
+
+        quick = minc.ConvertTask(input_file=_input(tmpdir, 'quick.mnc', 0),
+                                 output_file=os.path.join(tmpdir, 'out', 'quick.mnc'), cache=cache)
+        minc_async.run_sync(minc_async.run(quick), loop)
+        yield assert_true, time.time() - t0 >= 1
+        yield assert_true, os.path.exists(slow.inputs.output_file)
+
+        # A tool failing in the executor raises TaskFailed too.
+        failing = minc.ConvertTask(input_file=_input(tmpdir, 'failing.mnc', 0.01), cache=cache,
+                                   output_file=os.path.join(tmpdir, 'out', 'fail.mnc'))
+        try:
+            minc_async.run_sync(minc_async.run(failing), loop)
+        except minc_async.TaskFailed as e:
+            yield assert_equal, e.returncode, 4
+            yield assert_true, 'no good' in e.stderr
+            yield assert_true, e.cmdline.startswith('mincconvert')
+        else:
+            yield assert_true, False
+
+        # Other errors are raised as they are.
+        missing = minc.ConvertTask(input_file=quick.inputs.input_file, cache=cache,
+                                   output_file=os.path.join(tmpdir, 'no', 'such', 'dir.mnc'))
+        _fake_tool(fake.bindir, 'mincconvert', 'exit 0')
+        yield assert_raises, IOError, minc_async.run_sync, minc_async.run(missing), loop
+
+        # Semaphores do not keep closed loops alive.
+        other = asyncio.new_event_loop()
+        minc_async._semaphore(other)
+        other.close()
+        minc_async._semaphore(loop)
+        yield assert_true, other not in minc_async._semaphores
+    finally:
+        minc_async.set_concurrency(minc_async.DEFAULT_CONCURRENCY)
+        loop.close()
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+@skipif(no_trollius or no_h5py)
+def test_in_process():
+    import numpy as np
+    from test_minc_io import FAKE_RAWTOMINC
+    fake, tmpdir = _setup()
+    _fake_tool(fake.bindir, 'rawtominc', FAKE_RAWTOMINC, sys.executable)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        fnames = [os.path.join(tmpdir, 'vol%d.mnc' % i) for i in range(3)]
+        for (i, f) in enumerate(fnames):
+            minc_io.write_minc2(f, np.full((2, 3, 4), float(i)), dtype='float64')
+
+        # stats_prefix has no argstr: run as a command line, it would
+        # be mincaverage (not on the fake PATH) ignoring it.
+        prefix = os.path.join(tmpdir, 'stats')
+        task = minc.AverageTask(input_files=fnames, output_file=os.path.join(tmpdir, 'avg.mnc'),
+                                stats_prefix=prefix)
+        yield assert_true, minc_async._in_process(task)
+        outputs = minc_async.run_sync(minc_async.run(task), loop)
+        yield assert_equal, outputs['output_file'], os.path.join(tmpdir, 'avg.mnc')
+        yield assert_true, os.path.exists(prefix + '.json')
+
+        # The subprocess path checks geometry before starting mincaverage.
+        import minc_header
+        minc_io.write_minc2(fnames[2], np.zeros((2, 3, 5)), dtype='float64')
+        task = minc.AverageTask(input_files=fnames, output_file=os.path.join(tmpdir, 'avg2.mnc'),
+                                check_geometry=True)
+        yield assert_true, not minc_async._in_process(task)
+        yield assert_raises, minc_header.GeometryError, minc_async.run_sync, minc_async.run(task), loop
+    finally:
+        loop.close()
+        fake.close()
+        shutil.rmtree(tmpdir)
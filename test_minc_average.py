@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the in-process averaging engine
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_average.py
+
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_io
+import minc_average
+from minc import no_minc
+
+no_h5py = not minc_io.available()
+
+if not no_h5py:
+    import h5py
+    import numpy as np
+
+def _volumes(tmpdir, n=4, shape=(5, 3, 4)):
+    rng = np.random.RandomState(0)
+    fnames, datas = [], []
+    for i in range(n):
+        data = rng.uniform(0, 100, size=shape)
+        fname = os.path.join(tmpdir, 'vol%d.mnc' % i)
+        minc_io.write_minc2(fname, data, dtype='float64')
+        fnames.append(fname)
+        datas.append(data)
+    return fnames, np.array(datas)
+
+def _run(engine):
+    means, sds = [], []
+    for (_, acc) in engine:
+        means.append(acc.mean)
+        sds.append(acc.sd())
+    return np.concatenate(means), np.concatenate(sds)
+
+@skipif(no_h5py)
+def test_accumulator():
+    rng = np.random.RandomState(1)
+    x = rng.normal(size=(6, 10))
+    w = rng.uniform(1, 2, size=6)
+
+    a = minc_average.Accumulator((10,))
+    for (xi, wi) in zip(x, w):
+        a.add(xi, wi)
+    yield assert_true, np.allclose(a.mean, np.average(x, axis=0, weights=w))
+
+    # Merging two halves is the same as one pass.
+    b = minc_average.Accumulator((10,))
+    c = minc_average.Accumulator((10,))
+    for (xi, wi) in zip(x[:2], w[:2]):
+        b.add(xi, wi)
+    for (xi, wi) in zip(x[2:], w[2:]):
+        c.add(xi, wi)
+    b.merge(c)
+    yield assert_true, np.allclose(b.mean, a.mean)
+    yield assert_true, np.allclose(b.sd(), a.sd())
+
+    # Equal weights give the sample standard deviation.
+    d = minc_average.Accumulator((10,))
+    for xi in x:
+        d.add(xi)
+    yield assert_true, np.allclose(d.sd(), x.std(axis=0, ddof=1))
+
+    # NaNs are missing values.
+    e = minc_average.Accumulator((1,))
+    for v in [1.0, np.nan, 3.0]:
+        e.add(np.array([v]))
+    yield assert_equal, e.mean.tolist(), [2.0]
+    yield assert_equal, e.count.tolist(), [2.0]
+
+@skipif(no_h5py)
+def test_accumulator_remove():
+    rng = np.random.RandomState(2)
+    x = rng.normal(size=(5, 10))
+    x[1, 3] = np.nan
+    w = rng.uniform(1, 2, size=5)
+
+    a = minc_average.Accumulator((10,))
+    for (xi, wi) in zip(x, w):
+        a.add(xi, wi)
+    a.remove(x[1], w[1])
+    a.remove(x[4], w[4])
+    b = minc_average.Accumulator((10,))
+    for i in (0, 2, 3):
+        b.add(x[i], w[i])
+    yield assert_true, np.allclose(a.mean, b.mean)
+    yield assert_true, np.allclose(a.sd(), b.sd())
+    yield assert_equal, a.count.tolist(), b.count.tolist()
+
+    for i in (0, 2, 3):
+        a.remove(x[i], w[i])
+    yield assert_equal, (a.weight.max(), a.mean.max(), a.m2.max()), (0.0, 0.0, 0.0)
+
+@skipif(no_h5py)
+def test_engine():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames, data = _volumes(tmpdir)
+        readers = [minc_io.open_volume(f) for f in fnames]
+
+        # A 1kb buffer forces several slabs.
+        engine = minc_average.AverageEngine(readers, max_buffer_size_in_kb=1)
+        yield assert_true, len(engine.slabs()) > 1
+        mean, sd = _run(engine)
+        yield assert_true, np.allclose(mean, data.mean(axis=0))
+        yield assert_true, np.allclose(sd, data.std(axis=0, ddof=1))
+
+        w = [1.0, 2.0, 3.0, 4.0]
+        mean, _ = _run(minc_average.AverageEngine(readers, weights=w))
+        yield assert_true, np.allclose(mean, np.average(data, axis=0, weights=w))
+
+        mean, _ = _run(minc_average.AverageEngine(readers, normalize=True))
+        means = data.reshape(len(data), -1).mean(axis=1)
+        factors = means.mean() / means
+        yield assert_true, np.allclose(mean, (data * factors[:, None, None, None]).mean(axis=0))
+
+        mean, _ = _run(minc_average.AverageEngine(readers, binarize=True, binrange=(20, 60)))
+        yield assert_true, np.allclose(mean, ((data >= 20) & (data <= 60)).mean(axis=0))
+
+        mean, _ = _run(minc_average.AverageEngine(readers, binarize=True, binvalue=50))
+        yield assert_true, np.allclose(mean, ((data >= 49.5) & (data <= 50.5)).mean(axis=0))
+
+        yield assert_raises, ValueError, minc_average.AverageEngine, readers, [1.0]
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_engine_avgdim():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames, data = _volumes(tmpdir, n=2, shape=(3, 2, 4, 5))
+        widths = np.array([1.0, 2.0, 5.0])
+        for f in fnames:
+            with h5py.File(f, 'r+') as h:
+                h['/minc-2.0/dimensions'].create_dataset('time-width', data=widths)
+        readers = [minc_io.open_volume(f) for f in fnames]
+
+        engine = minc_average.AverageEngine(readers, avgdim='time', max_buffer_size_in_kb=1)
+        yield assert_equal, engine.out_dimnames, ['zspace', 'yspace', 'xspace']
+        mean, _ = _run(engine)
+        yield assert_true, np.allclose(mean, data.mean(axis=(0, 1)))
+
+        engine = minc_average.AverageEngine(readers, avgdim='time', width_weighted=True)
+        mean, _ = _run(engine)
+        w = np.tile(widths, 2)
+        expected = np.average(data.reshape((6,) + data.shape[2:]), axis=0, weights=w)
+        yield assert_true, np.allclose(mean, expected)
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_check_dimensions():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        a = minc_io.write_minc2(os.path.join(tmpdir, 'a.mnc'), np.zeros((2, 3, 4)))
+        b = minc_io.write_minc2(os.path.join(tmpdir, 'b.mnc'), np.zeros((2, 3, 5)))
+        c = minc_io.write_minc2(os.path.join(tmpdir, 'c.mnc'), np.zeros((2, 3, 4)), steps=[1, 1, 2])
+        readers = [minc_io.open_volume(f) for f in [a, b, c]]
+
+        yield assert_raises, ValueError, minc_average.AverageEngine, readers[:2]
+        yield assert_raises, ValueError, minc_average.AverageEngine, [readers[0], readers[2]]
+        engine = minc_average.AverageEngine([readers[0], readers[2]], check_dimensions=False)
+        yield assert_equal, engine.out_shape, (2, 3, 4)
+
+        # With check_geometry the headers are compared before anything runs.
+        import minc_header
+        task = minc.AverageTask(input_files=[a, b, c], output_file=os.path.join(tmpdir, 'avg.mnc'),
+                                check_geometry=True, engine='numpy')
+        yield assert_raises, minc_header.GeometryError, task.run
+        yield assert_equal, task.cmdline.split()[1:], [a, b, c, os.path.join(tmpdir, 'avg.mnc')]
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py or no_minc)
+def test_same_as_mincaverage():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames, data = _volumes(tmpdir)
+        for (name, kwargs) in [('plain',  {}),
+                               ('weighted', {'weights': ['1', '2', '3', '4']}),
+                               ('binary', {'binarize': True, 'binrange': (20., 60.)}),
+                              ]:
+            out = {}
+            for engine in ['binary', 'numpy']:
+                out[engine] = os.path.join(tmpdir, '%s_%s.mnc' % (name, engine,))
+                minc.AverageTask(input_files=fnames, output_file=out[engine],
+                                 sdfile=out[engine].replace('.mnc', '_sd.mnc'),
+                                 format_double=True, clobber=True, engine=engine,
+                                 **kwargs).run()
+            a = minc.ToRawTask(input_file=out['binary'], nonormalize=True, write_double=True).to_array()
+            b = minc.ToRawTask(input_file=out['numpy'],  nonormalize=True, write_double=True).to_array()
+            yield assert_true, np.allclose(a, b, rtol=1e-5, atol=1e-6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _partial(prefix):
+    p = minc_average.Partial(prefix)
+    acc = p.slab(0, p.shape[0])
+    p.close()
+    return acc
+
+@skipif(no_h5py)
+def test_tree_reduce():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames, data = _volumes(tmpdir, n=7)
+        readers = [minc_io.open_volume(f) for f in fnames]
+        w = [1.0, 2.0, 3.0, 1.0, 2.0, 3.0, 4.0]
+
+        for (kwargs, fanin) in [({}, 2),
+                                ({'weights': w}, 3),
+                                ({'normalize': True}, 2),
+                                ({'binarize': True, 'binrange': (20, 60)}, 2),
+                               ]:
+            mean, sd = _run(minc_average.AverageEngine(readers, **kwargs))
+
+            workdir = tempfile.mkdtemp(dir=tmpdir)
+            prefix = minc_average.tree_reduce(fnames, workdir, shard_size=2, fanin=fanin,
+                                              processes=2, max_buffer_size_in_kb=1, **kwargs)
+            acc = _partial(prefix)
+            yield assert_true, np.allclose(acc.mean, mean)
+            yield assert_true, np.allclose(acc.sd(), sd)
+            yield assert_equal, acc.count.max(), 7
+
+            # Only the final shard is left behind.
+            yield assert_equal, len(os.listdir(workdir)), len(minc_average.Partial.FIELDS)
+
+        yield assert_raises, ValueError, minc_average.tree_reduce, fnames, tmpdir, None, False, 0
+        yield assert_raises, ValueError, minc_average.tree_reduce, fnames, tmpdir, [1.0]
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_cohort():
+    from test_minc import _FakeToolchain, _fake_tool
+    from test_minc_io import FAKE_RAWTOMINC
+
+    def read(fname):
+        with open(fname, 'rb') as f:
+            f.readline()
+            return np.frombuffer(f.read(), dtype=np.float64).reshape(data.shape[1:])
+
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    open_volume = minc_io.open_volume
+    opened = []
+    def counting_open(fname):
+        opened.append(fname)
+        return open_volume(fname)
+    try:
+        _fake_tool(fake.bindir, 'rawtominc', FAKE_RAWTOMINC, sys.executable)
+        fnames, data = _volumes(tmpdir, n=6)
+        prefix = os.path.join(tmpdir, 'stats')
+        out, sd = os.path.join(tmpdir, 'avg.mnc'), os.path.join(tmpdir, 'sd.mnc')
+
+        minc.AverageTask(input_files=fnames[:4], output_file=out, sdfile=sd, stats_prefix=prefix,
+                         max_buffer_size_in_kb=1, clobber=True).run()
+        yield assert_true, np.allclose(read(out), data[:4].mean(axis=0))
+        yield assert_true, np.allclose(read(sd), data[:4].std(axis=0, ddof=1))
+
+        # Two added and one removed: four volume reads for the update
+        # (the first input, to check the others against) and one more
+        # for the geometry of the output.
+        minc_io.open_volume = counting_open
+        keep = [0, 2, 3, 4, 5]
+        added, removed = minc_average.incremental_average([fnames[i] for i in keep], out, prefix,
+                                                          sdfile=sd, max_buffer_size_in_kb=1, clobber=True)
+        yield assert_equal, (added, removed), (fnames[4:], [fnames[1]])
+        yield assert_equal, len(opened), 5
+        yield assert_true, np.allclose(read(out), data[keep].mean(axis=0))
+        yield assert_true, np.allclose(read(sd), data[keep].std(axis=0, ddof=1))
+        yield assert_equal, sorted(f for f in os.listdir(tmpdir) if f.startswith('stats')), \
+                            ['stats.2.%s.npy' % f for f in sorted(minc_average.Partial.FIELDS)] + ['stats.json']
+
+        # Nothing changed, nothing read but the output geometry.
+        del opened[:]
+        yield assert_equal, minc_average.incremental_average([fnames[i] for i in keep], out, prefix,
+                                                             clobber=True), ([], [])
+        yield assert_equal, len(opened), 1
+
+        # A new weight is the old one removed and the new one added.
+        w = [1.0, 1.0, 3.0, 1.0, 1.0]
+        added, removed = minc_average.incremental_average([fnames[i] for i in keep], out, prefix,
+                                                          weights=w, clobber=True)
+        yield assert_equal, (added, removed), ([fnames[3]], [fnames[3]])
+        yield assert_true, np.allclose(read(out), np.average(data[keep], axis=0, weights=w))
+
+        # Other options, or an input that has changed, rebuild the state.
+        del opened[:]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            added, removed = minc_average.incremental_average(fnames[:3], out, prefix, clobber=True,
+                                                              binarize=True, binrange=(20, 60))
+        yield assert_equal, len(caught), 1
+        yield assert_equal, (added, removed), (fnames[:3], [])
+        yield assert_true, np.allclose(read(out), ((data[:3] >= 20) & (data[:3] <= 60)).mean(axis=0))
+
+        minc_io.write_minc2(fnames[1], data[1] + 1, dtype='float64')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            added, removed = minc_average.incremental_average(fnames[:2], out, prefix, clobber=True,
+                                                              binarize=True, binrange=(20, 60))
+        yield assert_equal, (len(caught), added), (1, fnames[:2])
+
+        yield assert_raises, ValueError, minc_average.incremental_average, fnames, out, prefix, None, None, True
+        yield assert_raises, ValueError, minc_average.incremental_average, [], out, prefix
+    finally:
+        minc_io.open_volume = open_volume
+        fake.close()
+        shutil.rmtree(tmpdir)
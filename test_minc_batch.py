@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the batch conversion driver
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_batch.py
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from nipype.testing import (assert_equal, assert_true, assert_false, assert_raises)
+
+import minc_batch
+from test_minc import _FakeToolchain, _fake_tool
+
+FAKE_CONVERT = """
+import shutil, sys
+if 'bad' in sys.argv[-2]:
+    open(sys.argv[-1], 'w').write('partial')
+    sys.exit(1)
+shutil.copy(sys.argv[-2], sys.argv[-1])
+"""
+
+def _tree(root):
+    for f in ['a.mnc', 'sub/b.mnc', 'sub/deeper/c.mnc', 'sub/readme.txt']:
+        fname = os.path.join(root, f)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        open(fname, 'w').write(f * 100)
+
+def test_plan_and_manifest():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src, dst = os.path.join(tmpdir, 'src'), os.path.join(tmpdir, 'dst')
+        _tree(src)
+        jobs = minc_batch.plan_tree(src, dst)
+        yield assert_equal, [os.path.relpath(o, dst) for (_, o) in jobs], \
+                            ['a.mnc', os.path.join('sub', 'b.mnc'), os.path.join('sub', 'deeper', 'c.mnc')]
+
+        manifest = os.path.join(tmpdir, 'manifest.tsv')
+        open(manifest, 'w').write('# input\toutput\nsrc/a.mnc\tout/a2.mnc\n')
+        yield assert_equal, minc_batch.read_manifest(manifest), \
+                            [(os.path.join(tmpdir, 'src/a.mnc'), os.path.join(tmpdir, 'out/a2.mnc'))]
+
+        manifest = os.path.join(tmpdir, 'manifest.json')
+        open(manifest, 'w').write('[{"input": "/x.mnc", "output": "/y.mnc"}, ["/p.mnc", "/q.mnc"]]')
+        yield assert_equal, minc_batch.read_manifest(manifest), [('/x.mnc', '/y.mnc'), ('/p.mnc', '/q.mnc')]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_convert_batch():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+        src, dst = os.path.join(tmpdir, 'src'), os.path.join(tmpdir, 'dst')
+        _tree(src)
+        jobs = minc_batch.plan_tree(src, dst)
+
+        seen = []
+        report = minc_batch.convert_batch(jobs, processes=2, progress=seen.append,
+                                          two=True, compression=4)
+        s = report.summary()
+        yield assert_equal, (s['converted'], s['skipped'], s['failed']), (3, 0, 0)
+        yield assert_equal, len(seen), 3
+        yield assert_equal, s['in_bytes'], s['out_bytes']
+        yield assert_true, open(os.path.join(dst, 'sub', 'b.mnc')).read().startswith('sub/b.mnc')
+        yield assert_true, 'converted' in report.format()
+
+        # Nothing to do the second time round, until an input changes.
+        report = minc_batch.convert_batch(jobs, processes=2, two=True)
+        yield assert_equal, len(report.skipped), 3
+
+        t = time.time() + 10
+        os.utime(jobs[0][0], (t, t))
+        report = minc_batch.convert_batch(jobs, processes=1, two=True)
+        yield assert_equal, [r['input'] for r in report.converted], [jobs[0][0]]
+
+        report = minc_batch.convert_batch(jobs, processes=1, force=True)
+        yield assert_equal, len(report.converted), 3
+
+        # A failed conversion leaves neither the output nor the temporary file.
+        bad = os.path.join(src, 'bad.mnc')
+        open(bad, 'w').write('x')
+        report = minc_batch.convert_batch([(bad, os.path.join(dst, 'bad.mnc'))], processes=1)
+        yield assert_equal, len(report.failed), 1
+        yield assert_equal, sorted(f for f in os.listdir(dst) if 'bad' in f), []
+
+        yield assert_raises, ValueError, lambda: minc_batch.convert_batch(jobs, clobber=True)
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the Task result cache
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_cache.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_false, assert_raises)
+
+import minc
+import minc_cache
+from test_minc import _FakeToolchain, _fake_tool
+
+# Copies the input and records each call.
+FAKE_TOOL = """
+import shutil, sys
+with open(%r, 'a') as f:
+    f.write(' '.join(sys.argv) + '\\n')
+if sys.argv[0].endswith('minctoraw'):
+    sys.stdout.write(open(sys.argv[-1]).read().upper())
+else:
+    shutil.copy(sys.argv[-2], sys.argv[-1])
+"""
+
+def _ncalls(fname):
+    return len(open(fname).readlines()) if os.path.exists(fname) else 0
+
+def test_link_or_copy():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'src')
+        open(src, 'w').write('data')
+        for link in ['hardlink', 'reflink', 'copy']:
+            dst = os.path.join(tmpdir, link)
+            open(dst, 'w').write('stale')
+            how = minc_cache.link_or_copy(src, dst, link)
+            yield assert_equal, open(dst).read(), 'data'
+            yield assert_true, how in ('hardlink', 'reflink', 'copy')
+        yield assert_equal, minc_cache.link_or_copy(src, os.path.join(tmpdir, 'c'), 'copy'), 'copy'
+        yield assert_raises, ValueError, minc_cache.link_or_copy, src, os.path.join(tmpdir, 'x'), 'bogus'
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_cache():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        calls = os.path.join(tmpdir, 'calls')
+        for tool in ['mincconvert', 'minctoraw']:
+            _fake_tool(fake.bindir, tool, FAKE_TOOL % calls, sys.executable)
+        cache = minc_cache.ResultCache(os.path.join(tmpdir, 'cache'))
+
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('volume one')
+
+        def convert(out, **kwargs):
+            kwargs.setdefault('cache', cache)
+            return minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, out),
+                                    two=True, clobber=True, **kwargs).run()
+
+        convert('a.mnc')
+        yield assert_equal, _ncalls(calls), 1
+
+        # Same input, different output path: restored, not run.
+        result = convert('b.mnc')
+        yield assert_equal, _ncalls(calls), 1
+        yield assert_equal, open(os.path.join(tmpdir, 'b.mnc')).read(), 'volume one'
+        yield assert_true, os.path.exists(result.outputs.output_file)
+        yield assert_true, getattr(result.runtime, 'cached', None)
+
+        # The input is keyed by content, not by name.
+        moved = os.path.join(tmpdir, 'moved.mnc')
+        shutil.copy(inp, moved)
+        minc.ConvertTask(input_file=moved, output_file=os.path.join(tmpdir, 'c.mnc'),
+                         two=True, clobber=True, cache=cache).run()
+        yield assert_equal, _ncalls(calls), 1
+
+        # Different options or content are misses.
+        convert('d.mnc', compression=4)
+        yield assert_equal, _ncalls(calls), 2
+        open(inp, 'w').write('volume two, longer')
+        convert('e.mnc')
+        yield assert_equal, _ncalls(calls), 3
+        yield assert_equal, open(os.path.join(tmpdir, 'e.mnc')).read(), 'volume two, longer'
+
+        convert('f.mnc', cache=False)
+        yield assert_equal, _ncalls(calls), 4
+
+        s = cache.stats()
+        yield assert_equal, (s['hits'], s['misses'], s['stores'], s['entries']), (2, 3, 3, 3)
+
+        # Generated stdout outputs are cached too.
+        for out in ['x.raw', 'y.raw']:
+            minc.ToRawTask(input_file=inp, nonormalize=True, out_file=os.path.join(tmpdir, out),
+                           cache=cache).run()
+        yield assert_equal, _ncalls(calls), 5
+        yield assert_equal, open(os.path.join(tmpdir, 'y.raw')).read(), 'VOLUME TWO, LONGER'
+
+        # $MINC_RESULT_CACHE turns caching on for every task, and the
+        # size cap evicts the least recently used entries.
+        os.environ['MINC_RESULT_CACHE'] = os.path.join(tmpdir, 'envcache')
+        os.environ['MINC_RESULT_CACHE_SIZE'] = '30'
+        try:
+            for (content, out) in [('first volume', 'g.mnc'), ('second volume', 'h.mnc'),
+                                   ('third volume', 'i.mnc')]:
+                open(inp, 'w').write(content)
+                convert(out, cache=None)
+            envcache = minc_cache.get_cache(None)
+            s = envcache.stats()
+            yield assert_equal, (s['entries'], s['evictions']), (2, 1)
+            yield assert_true, s['bytes'] <= 30
+
+            open(inp, 'w').write('first volume')
+            n = _ncalls(calls)
+            convert('j.mnc', cache=None)
+            yield assert_equal, _ncalls(calls), n + 1
+        finally:
+            del os.environ['MINC_RESULT_CACHE']
+            del os.environ['MINC_RESULT_CACHE_SIZE']
+
+        cache.clear()
+        yield assert_equal, cache.stats()['entries'], 0
+        objects = os.path.join(tmpdir, 'cache', 'objects')
+        yield assert_equal, [d for d in os.listdir(objects) if os.listdir(os.path.join(objects, d))], []
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def _cached_objects(root):
+    objects = {}
+    for (dirpath, _, fnames) in os.walk(os.path.join(root, 'objects')):
+        for f in fnames:
+            objects[os.path.join(dirpath, f)] = open(os.path.join(dirpath, f)).read()
+    return objects
+
+def test_restored_outputs_overwritten():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        calls = os.path.join(tmpdir, 'calls')
+        for tool in ['mincconvert', 'minctoraw']:
+            _fake_tool(fake.bindir, tool, FAKE_TOOL % calls, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        tasks = [lambda out, **kw: minc.ConvertTask(input_file=inp, output_file=out, clobber=True, **kw),
+                 lambda out, **kw: minc.ToRawTask(input_file=inp, nonormalize=True, out_file=out, **kw)]
+
+        for link in ['reflink', 'hardlink']:
+            root = os.path.join(tmpdir, 'cache-' + link)
+            cache = minc_cache.ResultCache(root, link=link)
+            for (k, make) in enumerate(tasks):
+                open(inp, 'w').write('cached volume')
+                out = os.path.join(tmpdir, '%s%d.out' % (link, k,))
+                make(os.path.join(tmpdir, 'first.out'), cache=cache).run()
+                make(out, cache=cache).run()
+                before = _cached_objects(root)
+
+                # A run writing over the restored output must leave the
+                # cache entry alone: with a hardlink restore, only the
+                # cache knows the output is its object.
+                open(inp, 'w').write('new volume')
+                make(out, cache=cache if link == 'hardlink' else False).run()
+                after = _cached_objects(root)
+                yield assert_equal, dict((f, after.get(f)) for f in before), before
+                yield assert_equal, open(out).read().lower(), 'new volume'
+        yield assert_equal, cache.stats()['hits'], 2
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+# mincconvert without -clobber: refuses to overwrite its output.
+FAKE_NOCLOBBER = """
+import os, shutil, sys
+if '-clobber' not in sys.argv and os.path.exists(sys.argv[-1]):
+    sys.stderr.write('%s exists, use -clobber\\n' % sys.argv[-1])
+    sys.exit(1)
+shutil.copy(sys.argv[-2], sys.argv[-1])
+"""
+
+def test_user_hardlinks_kept():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_NOCLOBBER, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('new volume')
+        out = os.path.join(tmpdir, 'out.mnc')
+        backup = os.path.join(tmpdir, 'backup.mnc')
+        open(out, 'w').write('precious')
+        os.link(out, backup)
+
+        # An output with a second link (a backup, a snapshot) that is
+        # not a cached object is the tool's to refuse.
+        cache = minc_cache.ResultCache(os.path.join(tmpdir, 'cache'), link='hardlink')
+        for c in [False, cache]:
+            task = minc.ConvertTask(input_file=inp, output_file=out, cache=c, scratch=False)
+            yield assert_raises, RuntimeError, task.run
+            yield assert_true, os.path.samefile(out, backup)
+            yield assert_equal, open(out).read(), 'precious'
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
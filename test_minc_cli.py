@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the JSON spec command line entry point
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_cli.py
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+
+from nipype.testing import (assert_equal, assert_true, assert_raises)
+
+import minc
+import minc_cli
+from test_minc import _FakeToolchain, _fake_tool, FAKE_VERSION
+
+FAKE_CONVERT = """
+import shutil, sys
+shutil.copy(sys.argv[-2], sys.argv[-1])
+"""
+
+def _main(argv):
+    saved = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        code = minc_cli.main(argv)
+        return code, sys.stdout.getvalue()
+    finally:
+        sys.stdout = saved
+
+def test_cli():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        yield assert_equal, _main(['--check'])[0], 1
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_VERSION)
+        minc.Info.clear_cache()
+        code, out = _main(['--check'])
+        yield assert_equal, (code, json.loads(out)['minc']), (0, '2.2.00')
+
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('volume')
+        out_file = os.path.join(tmpdir, 'out.mnc')
+        specs = [{'task': 'ConvertTask', 'inputs': {'input_file': inp, 'output_file': out_file, 'two': True}},
+                 {'task': 'DumpTask', 'inputs': {'input_file': inp, 'precision': [4, 8]}},
+                 {'task': 'AverageTask', 'inputs': {'input_files': [inp], 'output_file': out_file,
+                                                    'binrange': [0.5, 1.5]}},
+                ]
+        spec_file = os.path.join(tmpdir, 'specs.json')
+        json.dump(specs, open(spec_file, 'w'))
+
+        code, out = _main(['--dry-run', spec_file])
+        yield assert_equal, code, 0
+        yield assert_equal, out.splitlines(), [
+            'mincconvert -2 %s %s' % (inp, out_file,),
+            'mincdump -p 4,8 %s > %s' % (inp, os.path.join(tmpdir, 'in.txt'),),
+            'mincaverage -binrange 0.5 1.5 %s %s' % (inp, out_file,)]
+
+        json.dump(specs[0], open(spec_file, 'w'))
+        code, out = _main([spec_file])
+        yield assert_equal, code, 0
+        yield assert_equal, json.loads(out)['output_file'], out_file
+        yield assert_equal, open(out_file).read(), 'volume'
+
+        json.dump({'task': 'ConvertTask', 'inputs': {'input_file': inp, 'bogus': 1}}, open(spec_file, 'w'))
+        yield assert_equal, _main([spec_file])[0], 1
+        yield assert_raises, ValueError, minc_cli.task_class, 'Info'
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for streaming mincdump data into numpy arrays
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_dump.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_dump
+from test_minc import _FakeToolchain, _fake_tool
+
+np = minc.np
+
+SAMPLE_DUMP = r'''netcdf foo {
+dimensions:
+	zspace = 2 ;
+	yspace = 2 ;
+	xspace = 3 ;
+variables:
+	double zspace ;
+		zspace:step = 1.5 ;
+	double xspace(xspace) ;
+	short image(zspace, yspace, xspace) ;
+		image:signtype = "unsigned" ;
+		image:_FillValue = 7s ;
+	char patient ;
+		patient:full_name = "x" ;
+	float image-max(zspace) ;
+
+// global attributes:
+		:history = "a; b" ;
+data:
+
+ zspace = 0 ;
+
+ xspace = -1.5, 0, 1.5 ;
+
+ image =
+  0, 1, 2,   // image(0,0, 0-2)
+  3, -1, _,  // image(0,1, 0-2)
+  6, 7, 8,
+  9, 10, 11 ;
+
+ patient = "J. Doe; 42" ;
+
+ image-max = 1.5, NaNf ;
+}
+'''
+
+def _expected_image():
+    image = np.arange(12, dtype='uint16').reshape(2, 2, 3)
+    image[0, 1, 1] = 65535
+    image[0, 1, 2] = 7
+    return image
+
+@skipif(np is None)
+def test_parse():
+    text = SAMPLE_DUMP.encode('utf-8')
+    for chunk_size in (7, 64, 1 << 20):
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        records = list(minc_dump.parse_chunks(iter(chunks), chunk_size))
+        header, values = records[0], dict(records[1:])
+        yield assert_equal, list(header['dimensions']), ['zspace', 'yspace', 'xspace']
+        yield assert_equal, [n for (n, _) in records[1:]], ['zspace', 'xspace', 'image', 'patient', 'image-max']
+        yield assert_equal, values['zspace'].shape, ()
+        yield assert_equal, values['xspace'].tolist(), [-1.5, 0.0, 1.5]
+        yield assert_equal, values['image'].dtype, np.dtype('uint16')
+        yield assert_true, np.array_equal(values['image'], _expected_image())
+        yield assert_equal, values['patient'], 'J. Doe; 42'
+        yield assert_true, np.isnan(values['image-max'][1])
+
+    # A line longer than a chunk is cut at a comma.
+    long = SAMPLE_DUMP.replace('  0, 1, 2,   // image(0,0, 0-2)\n  3, -1, _,  // image(0,1, 0-2)\n  6, 7, 8,\n',
+                               '  0, 1, 2, 3, -1, _, 6, 7, 8,\n')
+    records = dict(list(minc_dump.parse_chunks(iter([long.encode('utf-8')]), 4))[1:])
+    yield assert_true, np.array_equal(records['image'], _expected_image())
+
+    bad = SAMPLE_DUMP.replace('9, 10, 11 ;', '9, 10, 11, 12 ;')
+    yield assert_raises, ValueError, list, minc_dump.parse_chunks(iter([bad.encode('utf-8')]))
+    bad = SAMPLE_DUMP.replace('9, 10, 11 ;', '9, 10 ;')
+    yield assert_raises, ValueError, list, minc_dump.parse_chunks(iter([bad.encode('utf-8')]))
+    bad = SAMPLE_DUMP[:SAMPLE_DUMP.index('10, 11 ;')]
+    yield assert_raises, ValueError, list, minc_dump.parse_chunks(iter([bad.encode('utf-8')]))
+
+# Prints the sample, logging its arguments.
+FAKE_MINCDUMP = """
+import os, sys
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'args'), 'w') as f:
+    f.write(' '.join(sys.argv[1:]))
+sys.stdout.write(%r)
+"""
+
+@skipif(np is None)
+def test_dump_task():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincdump', FAKE_MINCDUMP % SAMPLE_DUMP, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').close()
+
+        task = minc.DumpTask(input_file=inp, variables=['image', 'xspace'], precision=(4, 8),
+                             annotations_brief='c')
+        arrays = task.to_arrays(chunk_size=16)
+        yield assert_true, np.array_equal(arrays['image'], _expected_image())
+        args = open(os.path.join(fake.bindir, 'args')).read().split()
+        yield assert_equal, args, ['-b', 'c', '-p', '4,8', '-v', 'image,xspace', inp]
+        yield assert_equal, os.listdir(tmpdir), ['in.mnc']
+
+        # Stopping early kills mincdump.
+        it = task.iter_variables()
+        yield assert_equal, next(it)[0], 'zspace'
+        it.close()
+
+        _fake_tool(fake.bindir, 'mincdump', 'exit 1')
+        yield assert_raises, RuntimeError, task.to_arrays
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the frame-parallel ToEcatTask
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_ecat.py
+
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_async
+import minc_ecat
+from test_minc import _FakeToolchain, _fake_tool
+
+# The fake "MINC" files are JSON: {"frames": [[start, length, [voxels]], ...]}.
+FAKE_MINCINFO = """
+import json, sys
+args, fname = sys.argv[1:-1], sys.argv[-1]
+frames = json.load(open(fname)).get('frames')
+dims = ['zspace', 'yspace', 'xspace'] if frames is None else ['time', 'zspace', 'yspace', 'xspace']
+while args:
+    a = args.pop(0)
+    if a == '-error_string':
+        args.pop(0)
+    elif a == '-vardims':
+        args.pop(0)
+        print(' '.join(dims))
+    elif a == '-vartype':
+        args.pop(0)
+        print('short')
+    elif a == '-attvalue':
+        args.pop(0)
+        print('signed')
+    elif a == '-dimlength':
+        print(len(frames) if args.pop(0) == 'time' else 1)
+"""
+
+FAKE_MINCRESHAPE = """
+import json, sys
+start, count = [int(x) for x in sys.argv[3].split('=')[1].split(',')]
+frames = json.load(open(sys.argv[4]))['frames'][start:start + count]
+json.dump({'frames': frames}, open(sys.argv[5], 'w'))
+"""
+
+# Writes an ECAT7-shaped file: one matrix per frame, entered in the
+# directory the way the ECAT matrix library's mat_enter does.
+FAKE_MINCTOECAT = """
+import json, math, os, struct, sys
+inp, out = sys.argv[-2], sys.argv[-1]
+frames = json.load(open(inp))['frames']
+halflife = 6586.2
+
+main = bytearray(512)
+main[0:9] = b'MATRIX72v'
+name = os.path.basename(inp)[:32].encode('ascii')
+main[14:14 + len(name)] = name
+main[74:78] = struct.pack('>f', halflife)
+main[354:356] = struct.pack('>h', len(frames))
+
+f = open(out, 'w+b')
+f.write(bytes(main))
+f.write(struct.pack('>128i', *([31, 2, 0, 0] + [0] * 124)))
+
+def read(rec):
+    f.seek((rec - 1) * 512)
+    return list(struct.unpack('>128i', f.read(512)))
+
+def write(rec, ints):
+    f.seek((rec - 1) * 512)
+    f.write(struct.pack('>128i', *ints))
+
+def enter(matnum, nblks):
+    dirblk = 2
+    d = read(dirblk)
+    while True:
+        nxtblk = dirblk + 1
+        for i in range(4, 128, 4):
+            if d[i] == 0:
+                d[i:i + 4] = [matnum, nxtblk, nxtblk + nblks, 1]
+                d[0] -= 1
+                d[3] += 1
+                write(dirblk, d)
+                return nxtblk
+            nxtblk = d[i + 2] + 1
+        if d[1] != 2:
+            dirblk = d[1]
+            d = read(dirblk)
+        else:
+            d[1] = nxtblk
+            write(dirblk, d)
+            d = [31, 2, dirblk, 0] + [0] * 124
+            write(nxtblk, d)
+            dirblk = nxtblk
+
+for (i, (start, length, voxels)) in enumerate(frames):
+    data = struct.pack('>%dh' % len(voxels), *voxels)
+    nblks = (len(data) + 511) // 512
+    sub = bytearray(512)
+    sub[0:2] = struct.pack('>h', 6)
+    sub[26:30] = struct.pack('>f', max(voxels) / 32767.0)
+    sub[46:50] = struct.pack('>i', length)
+    sub[50:54] = struct.pack('>i', start)
+    decay = 1.0
+    if '-no_decay_corr_fctr' not in sys.argv:
+        decay = math.exp(math.log(2) * start / 1000.0 / halflife)
+    sub[80:84] = struct.pack('>f', decay)
+    rec = enter(i + 1 | 0x01010000, nblks)
+    f.seek((rec - 1) * 512)
+    f.write(bytes(sub) + data + b'\\0' * (nblks * 512 - len(data)))
+f.close()
+"""
+
+def _series(fname, nframes):
+    frames = [[1000 * 60 * i, 60000, [(i * 7 + j) % 30000 for j in range(100 + 97 * (i % 5))]]
+              for i in range(nframes)]
+    json.dump({'frames': frames}, open(fname, 'w'))
+
+def _tools(bindir):
+    _fake_tool(bindir, 'mincinfo', FAKE_MINCINFO, sys.executable)
+    _fake_tool(bindir, 'mincreshape', FAKE_MINCRESHAPE, sys.executable)
+    _fake_tool(bindir, 'minctoecat', FAKE_MINCTOECAT, sys.executable)
+
+def test_directory_layout():
+    directory, entries, nrecords = minc_ecat.directory_layout([(k + 1, 2) for k in range(32)])
+    # 31 matrices of 3 records after the main header and directory,
+    # then a second directory record and the last matrix.
+    yield assert_equal, [r for (r, _) in directory], [2, 3 + 31 * 3]
+    yield assert_equal, directory[0][1][:4], [0, 3 + 31 * 3, 0, 31]
+    yield assert_equal, directory[1][1][:8], [30, 2, 2, 1, 32, 97, 99, 1]
+    yield assert_equal, entries[0], (1, 3, 5, 1)
+    yield assert_equal, nrecords, 99
+
+def test_to_ecat():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _tools(fake.bindir)
+        inp = os.path.join(tmpdir, 'pet.mnc')
+        _series(inp, 40)
+
+        for flags in ({}, {'no_decay_corr_fctr': True}):
+            serial = os.path.join(tmpdir, 'serial.v')
+            minc.ToEcatTask(input_file=inp, output_file=serial, **flags).run()
+            expected = open(serial, 'rb').read()
+            for n in (1, 7, 31, 40):
+                out = os.path.join(tmpdir, 'out%d.v' % n)
+                minc.ToEcatTask(input_file=inp, output_file=out, frames_per_job=n,
+                                frame_processes=3, **flags).run()
+                yield assert_equal, open(out, 'rb').read(), expected
+                os.remove(out)
+            os.remove(serial)
+        yield assert_equal, sorted(os.listdir(tmpdir)), ['pet.mnc']
+
+        # The output name is generated as for a serial run.
+        task = minc.ToEcatTask(input_file=inp, frames_per_job=16)
+        task.run()
+        yield assert_true, os.path.exists(os.path.join(tmpdir, 'pet.v'))
+
+        static = os.path.join(tmpdir, 'static.mnc')
+        json.dump({}, open(static, 'w'))
+        yield assert_raises, ValueError, minc_ecat.to_ecat, static, os.path.join(tmpdir, 'static.v'), 2
+        yield assert_raises, ValueError, minc_ecat.to_ecat, inp, os.path.join(tmpdir, 'x.v'), 0
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def test_join_checks():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _tools(fake.bindir)
+        pieces = []
+        for k in range(2):
+            inp = os.path.join(tmpdir, 'a%d.mnc' % k)
+            _series(inp, 3)
+            pieces.append(os.path.join(tmpdir, 'a%d.v' % k))
+            minc.ToEcatTask(input_file=inp, output_file=pieces[-1]).run()
+
+        # The pieces name different source files.
+        out = os.path.join(tmpdir, 'out.v')
+        yield assert_raises, ValueError, minc_ecat.join, pieces, out
+        yield assert_true, not os.path.exists(out)
+
+        # A directory that is not laid out serially.
+        with open(pieces[0], 'r+b') as f:
+            f.seek(512 + 4 * 5)
+            f.write(struct.pack('>i', 4))
+        yield assert_raises, ValueError, minc_ecat.join, pieces[:1], out
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+@skipif(minc_async.asyncio is None)
+def test_async():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    loop = minc_async.asyncio.new_event_loop()
+    try:
+        _tools(fake.bindir)
+        inp = os.path.join(tmpdir, 'pet.mnc')
+        _series(inp, 10)
+        serial = os.path.join(tmpdir, 'serial.v')
+        minc.ToEcatTask(input_file=inp, output_file=serial).run()
+
+        # minc_async runs frame-parallel conversions through run(), not
+        # as one minctoecat command line.
+        out = os.path.join(tmpdir, 'out.v')
+        task = minc.ToEcatTask(input_file=inp, output_file=out, frames_per_job=3, frame_processes=2)
+        yield assert_true, minc_async._in_process(task)
+        minc_async.run_sync(minc_async.run(task, loop=loop), loop)
+        yield assert_equal, open(out, 'rb').read(), open(serial, 'rb').read()
+    finally:
+        loop.close()
+        fake.close()
+        shutil.rmtree(tmpdir)
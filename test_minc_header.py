@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for MINC header parsing and the header index
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_header.py
+
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from nipype.testing import (assert_equal, assert_true, assert_false, assert_raises, skipif)
+
+import minc
+import minc_io
+import minc_header
+from test_minc import _FakeToolchain, _fake_tool
+
+no_h5py = not minc_io.available()
+
+SAMPLE_CDL = r'''netcdf foo {
+dimensions:
+	time = UNLIMITED ; // (3 currently)
+	zspace = 10 ;
+	yspace = 20 ;
+	xspace = 30 ;
+variables:
+	int rootvariable ;
+		rootvariable:varid = "MINC standard variable" ;
+		rootvariable:vartype = "group________" ;
+	double time(time) ;
+		time:units = "s" ;
+	double zspace ;
+		zspace:varid = "MINC standard variable" ;
+		zspace:spacing = "regular__" ;
+		zspace:step = 2.5 ;
+		zspace:start = -12.5 ;
+		zspace:direction_cosines = 0., 0., 1. ;
+	double yspace ;
+		yspace:step = -1. ;
+		yspace:start = 9.5 ;
+	double xspace ;
+		xspace:step = 1. ;
+		xspace:start = -14.5 ;
+		xspace:direction_cosines = 0.999, 0.01, 0. ;
+	short image(time, zspace, yspace, xspace) ;
+		image:parent = "rootvariable" ;
+		image:valid_range = 0., 4095. ;
+		image:signtype = "unsigned" ;
+		image:complete = "true_" ;
+	double image-max(time, zspace) ;
+		image-max:_FillValue = 1. ;
+	double image-min(time, zspace) ;
+		image-min:_FillValue = NaN ;
+	byte mask ;
+		mask:valid_range = 0b, 1b ;
+		mask:comments = "a; tricky // string with \"quotes\"" ;
+
+// global attributes:
+		:ident = "carlo:host:2013.01.01" ;
+		:history = "Mon Jan  1 2013>>> rawtominc out.mnc\n",
+			"Tue Jan  2 2013>>> mincconvert in.mnc out.mnc\n" ;
+}
+'''
+
+def test_parse_cdl():
+    parsed = minc_header.parse_cdl(SAMPLE_CDL)
+    yield assert_equal, parsed['name'], 'foo'
+    yield assert_equal, list(parsed['dimensions'].items()), \
+                        [('time', 3), ('zspace', 10), ('yspace', 20), ('xspace', 30)]
+    image = parsed['variables']['image']
+    yield assert_equal, image['type'], 'short'
+    yield assert_equal, image['dims'], ['time', 'zspace', 'yspace', 'xspace']
+    yield assert_equal, image['attributes']['valid_range'], [0.0, 4095.0]
+
+    mask = parsed['variables']['mask']['attributes']
+    yield assert_equal, mask['valid_range'], [0, 1]
+    yield assert_equal, mask['comments'], 'a; tricky // string with "quotes"'
+    yield assert_true, math.isnan(parsed['variables']['image-min']['attributes']['_FillValue'])
+
+    history = parsed['attributes']['history']
+    yield assert_equal, history.split('\n')[1], 'Tue Jan  2 2013>>> mincconvert in.mnc out.mnc'
+
+def test_header():
+    h = minc_header.MincHeader.from_parsed(minc_header.parse_cdl(SAMPLE_CDL))
+    yield assert_equal, h.dimnames, ['time', 'zspace', 'yspace', 'xspace']
+    yield assert_equal, h.shape, (3, 10, 20, 30)
+    yield assert_equal, h.steps, [1.0, 2.5, -1.0, 1.0]
+    yield assert_equal, h.starts, [0.0, -12.5, 9.5, -14.5]
+    yield assert_equal, h.direction_cosines[3], [0.999, 0.01, 0.0]
+    yield assert_equal, h.direction_cosines[2], [0.0, 1.0, 0.0]
+    yield assert_equal, (h.datatype, h.signtype), ('short', 'unsigned')
+    yield assert_equal, h.valid_range, [0.0, 4095.0]
+    yield assert_equal, h.attributes['']['ident'], 'carlo:host:2013.01.01'
+
+    again = minc_header.MincHeader.from_dict(h.to_dict())
+    yield assert_equal, again.shape, h.shape
+    yield assert_equal, again.dimension('zspace'), h.dimension('zspace')
+
+@skipif(no_h5py)
+def test_header_minc2():
+    import numpy as np
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = minc_io.write_minc2(os.path.join(tmpdir, 'a.mnc'), np.zeros((2, 3, 4)),
+                                    dtype='uint16', steps=[2.0, 1.0, 0.5], starts=[-1.0, 0.0, 1.0])
+        h = minc_header.read_header(fname)
+        yield assert_equal, h.shape, (2, 3, 4)
+        yield assert_equal, h.steps, [2.0, 1.0, 0.5]
+        yield assert_equal, h.starts, [-1.0, 0.0, 1.0]
+        yield assert_equal, (h.datatype, h.signtype), ('short', 'unsigned')
+        yield assert_equal, h.attributes['image']['dimorder'], 'zspace,yspace,xspace'
+    finally:
+        shutil.rmtree(tmpdir)
+
+FAKE_MINCDUMP = """
+import sys
+with open(%r, 'a') as f:
+    f.write(sys.argv[-1] + '\\n')
+sys.stdout.write(%r)
+"""
+
+def test_index():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        calls = os.path.join(fake.bindir, 'calls')
+        _fake_tool(fake.bindir, 'mincdump', FAKE_MINCDUMP % (calls, SAMPLE_CDL,), sys.executable)
+
+        os.makedirs(os.path.join(tmpdir, 'sub'))
+        files = [os.path.join(tmpdir, 'a.mnc'), os.path.join(tmpdir, 'sub', 'b.mnc'),
+                 os.path.join(tmpdir, 'sub', 'c.mnc')]
+        for f in files:
+            open(f, 'w').write(f)
+        open(os.path.join(tmpdir, 'notes.txt'), 'w').write('not minc')
+
+        dbfile = os.path.join(tmpdir, 'index.db')
+        with minc_header.HeaderIndex(dbfile, backend='mincdump') as index:
+            headers, stats = index.scan(tmpdir, processes=2)
+            yield assert_equal, sorted(headers), files
+            yield assert_equal, stats['updated'], 3
+            yield assert_equal, fake.calls(), 3
+            yield assert_equal, headers[files[1]].shape, (3, 10, 20, 30)
+
+        # A new process sees the index; only the changed file is re-read
+        # and the removed one is pruned.
+        t = time.time() + 10
+        os.utime(files[0], (t, t))
+        os.remove(files[2])
+        with minc_header.HeaderIndex(dbfile, backend='mincdump') as index:
+            headers, stats = index.scan([tmpdir], prune=True)
+            yield assert_equal, (stats['unchanged'], stats['updated'], stats['removed']), (1, 1, 1)
+            yield assert_equal, fake.calls(), 4
+            yield assert_equal, len(index), 2
+
+            yield assert_equal, index.get(files[1]).datatype, 'short'
+            yield assert_equal, fake.calls(), 4
+
+        _fake_tool(fake.bindir, 'mincdump', 'exit 1')
+        t += 10
+        os.utime(files[1], (t, t))
+        with minc_header.HeaderIndex(dbfile, backend='mincdump') as index:
+            headers, stats = index.scan(tmpdir, processes=1)
+            yield assert_equal, list(stats['failed']), [files[1]]
+            yield assert_raises, RuntimeError, minc.DumpTask(input_file=files[1]).header, 'mincdump'
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_geometry():
+    import numpy as np
+    tmpdir = tempfile.mkdtemp()
+    try:
+        def volume(name, shape=(3, 4, 5), steps=None, starts=None):
+            fname = os.path.join(tmpdir, name)
+            minc_io.write_minc2(fname, np.zeros(shape), steps=steps, starts=starts, dtype='float64')
+            return fname
+
+        good = [volume('good%d.mnc' % i) for i in range(4)]
+        shifted = volume('shifted.mnc', starts=[0.0, 0.0, 1.0])
+        nearly = volume('nearly.mnc', starts=[0.0, 0.0, 1e-9])
+        other = volume('other.mnc', shape=(3, 4, 6))
+        broken = os.path.join(tmpdir, 'broken.mnc')
+        open(broken, 'w').write('not minc')
+
+        files = good[:2] + [shifted, nearly, other, broken] + good[2:]
+        groups, failed = minc_header.group_by_geometry(files, processes=2, backend='hdf5')
+        yield assert_equal, groups, [good[:2] + [nearly] + good[2:], [shifted], [other]]
+        yield assert_equal, list(failed), [broken]
+
+        yield assert_equal, minc_header.check_geometry(good + [nearly], processes=1), None
+        try:
+            minc_header.check_geometry(files, processes=2, backend='hdf5')
+        except minc_header.GeometryError as e:
+            yield assert_equal, sorted(e.mismatched), sorted([shifted, other, broken])
+            yield assert_true, 'xspace:start is 1.0, expected 0.0' in str(e)
+            yield assert_true, 'shape (3, 4, 6)' in str(e)
+
+        # Through a header index.
+        with minc_header.HeaderIndex(os.path.join(tmpdir, 'index.db'), backend='hdf5') as index:
+            groups, failed = minc_header.group_by_geometry(files, index=index, processes=1)
+            yield assert_equal, len(groups), 3
+            yield assert_equal, list(failed), [broken]
+
+            # A file that is not there is a failure, not an OSError.
+            missing = os.path.join(tmpdir, 'missing.mnc')
+            headers, failed = minc_header.read_headers([good[0], missing], index=index, processes=1)
+            yield assert_equal, list(headers), [good[0]]
+            yield assert_equal, list(failed), [missing]
+            yield assert_raises, minc_header.GeometryError, minc_header.check_geometry, \
+                [good[0], missing], 1, 'hdf5', index
+    finally:
+        shutil.rmtree(tmpdir)
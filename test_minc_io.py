@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the in-process MINC2 reader
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_io.py
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_false, assert_raises,
+                            assert_almost_equal, skipif)
+
+import minc
+import minc_io
+from minc import no_minc
+from test_minc import _FakeToolchain, _fake_tool
+
+no_h5py = not minc_io.available()
+
+if not no_h5py:
+    import numpy as np
+
+def _volume(tmpdir, name='vol.mnc', dtype='uint16', **kwargs):
+    data = np.arange(2 * 3 * 4, dtype=np.float64).reshape(2, 3, 4) * 0.5 - 1.0
+    fname = os.path.join(tmpdir, name)
+    minc_io.write_minc2(fname, data, dtype=dtype, **kwargs)
+    return fname, data
+
+@skipif(no_h5py)
+def test_detect():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname, _ = _volume(tmpdir)
+        yield assert_true, minc_io.is_minc2(fname)
+        yield assert_false, minc_io.is_minc1(fname)
+        yield assert_false, minc_io.is_minc2(__file__)
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_read_real():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for kwargs in [{}, {'compression': 4}, {'dtype': 'float32'}]:
+            fname, data = _volume(tmpdir, **kwargs)
+            with minc_io.Minc2Volume(fname) as vol:
+                yield assert_equal, vol.dimnames, ['zspace', 'yspace', 'xspace']
+                yield assert_equal, vol.shape, (2, 3, 4)
+                yield assert_true, np.allclose(vol.read_real(), data, atol=1e-3)
+
+                slab = vol.read_real(start=(1, 1, 0), count=(1, 2, 4))
+                yield assert_true, np.allclose(slab, data[1:2, 1:3, :], atol=1e-3)
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_memmap():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname, _ = _volume(tmpdir)
+        with minc_io.Minc2Volume(fname) as vol:
+            yield assert_true, isinstance(vol.voxels(), np.memmap)
+
+        fname, _ = _volume(tmpdir, compression=4)
+        with minc_io.Minc2Volume(fname) as vol:
+            yield assert_false, isinstance(vol.voxels(), np.memmap)
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py)
+def test_to_raw():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname, data = _volume(tmpdir)
+        with minc_io.Minc2Volume(fname) as vol:
+            # Same type, no normalisation: the voxels themselves.
+            raw = vol.to_raw()
+            yield assert_equal, raw.dtype, np.dtype('uint16')
+            yield assert_equal, raw.tolist(), vol.read_voxels().tolist()
+
+            # Normalised bytes span the whole output range.
+            raw = vol.to_raw(dtype='uint8', normalize=True)
+            yield assert_equal, (raw.min(), raw.max()), (0, 255)
+
+            raw = vol.to_raw(dtype='uint8', normalize=True, out_range=(10, 20))
+            yield assert_equal, (raw.min(), raw.max()), (10, 20)
+
+            yield assert_true, np.allclose(vol.to_raw(dtype='float64'), data, atol=1e-3)
+
+        toraw = minc.ToRawTask(input_file=fname, normalize=True, write_float=True)
+        yield assert_true, np.allclose(toraw.to_array(backend='hdf5'), data, atol=1e-3)
+
+        slices = list(toraw.iter_slices(backend='hdf5'))
+        yield assert_equal, len(slices), 2
+        yield assert_true, np.allclose(slices[1][1], data[1], atol=1e-3)
+
+        # A bad slice_dims leaves no file open.
+        opened = []
+        hdf5_volume = toraw._hdf5_volume
+        toraw._hdf5_volume = lambda backend: opened.append(hdf5_volume(backend)) or opened[-1]
+        yield assert_raises, ValueError, list, toraw.iter_slices(slice_dims=4, backend='hdf5')
+        yield assert_false, opened[0].file.id.valid
+
+        # Without image-min/max and valid_range the real range is read
+        # from the voxels, once rather than for every slice.
+        fname = os.path.join(tmpdir, 'float.mnc')
+        minc_io.write_minc2(fname, data, dtype='float32')
+        with minc_io.h5py.File(fname, 'r+') as f:
+            image = f[minc_io.IMAGE_PATH]
+            del image.attrs['valid_range']
+            del image.parent['image-min'], image.parent['image-max']
+        with minc_io.Minc2Volume(fname) as vol:
+            reads = []
+            voxels = vol.voxels
+            vol.voxels = lambda: reads.append(1) or voxels()
+            raw = [vol.to_raw(dtype='uint8', start=(z, 0, 0), count=(1,) + data.shape[1:])
+                   for z in range(data.shape[0])]
+            yield assert_equal, len(reads), data.shape[0] + 1
+            yield assert_equal, (min(r.min() for r in raw), max(r.max() for r in raw)), (0, 255)
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(no_h5py or no_minc)
+def test_same_as_minctoraw():
+    # The in-process reader must give exactly what minctoraw gives.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        raw = os.path.join(tmpdir, 'vol.raw')
+        np.arange(10 * 11 * 12, dtype='int16').tofile(raw)
+        fname = os.path.join(tmpdir, 'vol.mnc')
+        subprocess.check_call(['rawtominc', '-2', '-short', '-signed', '-oshort', '-scan_range',
+                               '-input', raw, fname, '10', '11', '12'])
+
+        for kwargs in [{'nonormalize': True},
+                       {'normalize': True},
+                       {'normalize': True, 'write_byte': True},
+                       {'nonormalize': True, 'write_byte': True, 'write_range': (0., 100.)},
+                       {'nonormalize': True, 'write_float': True},
+                       {'normalize': True, 'write_double': True},
+                      ]:
+            toraw = minc.ToRawTask(input_file=fname, **kwargs)
+            a = toraw.to_array(backend='hdf5')
+            b = toraw.to_array(backend='subprocess')
+            yield assert_equal, a.dtype, b.dtype
+            yield assert_true, np.array_equal(a, b)
+    finally:
+        shutil.rmtree(tmpdir)
+
+FAKE_RAWTOMINC = """
+import sys
+out = sys.argv[-4]
+with open(out, 'wb') as f:
+    f.write(' '.join(sys.argv[1:]).encode('utf-8') + b'\\n')
+    f.write(sys.stdin.read())
+"""
+
+@skipif(no_h5py)
+def test_rawtominc_writer():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'rawtominc', FAKE_RAWTOMINC, sys.executable)
+        out = os.path.join(tmpdir, 'out.mnc')
+        geometry = {'xspace': {'step': 2.0, 'start': -10.0, 'direction_cosines': [1, 0, 0]}}
+        w = minc_io.RawToMincWriter(out, ['zspace', 'yspace', 'xspace'], (2, 3, 4),
+                                    geometry=geometry, vartype='short', signtype='unsigned')
+        data = np.arange(24, dtype=np.float64).reshape(2, 3, 4)
+        w.write(data[:1])
+        w.write(data[1:])
+        w.close()
+
+        with open(out, 'rb') as f:
+            args = f.readline().decode('utf-8').split()
+            written = np.frombuffer(f.read(), dtype=np.float64)
+        yield assert_equal, args[-4:], [out, '2', '3', '4']
+        yield assert_true, '-oshort' in args and '-ounsigned' in args
+        yield assert_equal, args[args.index('-xstep') + 1], '2.0'
+        yield assert_equal, written.tolist(), list(range(24))
+
+        # Too few slices is an error.
+        w = minc_io.RawToMincWriter(out, ['zspace', 'yspace', 'xspace'], (2, 3, 4), clobber=True)
+        w.write(data[:1])
+        yield assert_raises, RuntimeError, w.close
+
+        yield assert_raises, ValueError, minc_io.RawToMincWriter, out, ['vector_dimension'], (3,)
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the pipe-chaining composer
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_pipe.py
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+
+from nipype.testing import (assert_equal, assert_true, assert_raises)
+
+import minc
+import minc_pipe
+from test_minc import _FakeToolchain, _fake_tool
+
+# Writes n bytes (the first argument, default 1MB) of a repeating
+# pattern; stands in for minctoraw.
+FAKE_PRODUCER = """
+import sys
+n = int(sys.argv[1]) if sys.argv[1].isdigit() else 1 << 20
+block = b'abcdefgh' * 8192
+while n > 0:
+    sys.stdout.write(block[:n])
+    n -= len(block)
+"""
+
+FAKE_UPPER = """
+import sys
+while True:
+    chunk = sys.stdin.read(4096)
+    if not chunk:
+        break
+    sys.stdout.write(chunk.upper())
+"""
+
+# Writes forever, like yes; a shell script, because Python ignores
+# SIGPIPE whatever it inherits.
+FAKE_YES = """
+while :; do echo abcdefgh; done
+"""
+
+# Reads one chunk and quits, like head.
+FAKE_HEAD = """
+import sys
+sys.stdout.write(sys.stdin.read(10))
+"""
+
+FAKE_FAIL = """
+import sys
+sys.stdin.read()
+sys.stderr.write('bad input\\n')
+sys.exit(3)
+"""
+
+def _tools():
+    fake = _FakeToolchain()
+    for (name, script) in [('minctoraw', FAKE_PRODUCER), ('upper', FAKE_UPPER),
+                           ('head', FAKE_HEAD), ('fail', FAKE_FAIL)]:
+        _fake_tool(fake.bindir, name, script, sys.executable)
+    _fake_tool(fake.bindir, 'yes', FAKE_YES)
+    return fake
+
+def test_pipeline():
+    fake = _tools()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('x')
+        toraw = minc.ToRawTask(input_file=inp, nonormalize=True)
+
+        # A Task feeding a command feeding a Python callback; no foo.raw.
+        chunks = []
+        result = minc_pipe.pipe(toraw, ['upper'], sink=chunks.append, chunk_size=10000)
+        data = b''.join(chunks)
+        yield assert_equal, len(data), 1 << 20
+        yield assert_equal, data[:16], b'ABCDEFGHABCDEFGH'
+        yield assert_true, max(len(c) for c in chunks) <= 10000
+        yield assert_equal, result.returncodes, [0, 0]
+        yield assert_equal, result.nbytes, 1 << 20
+        yield assert_equal, os.path.exists(os.path.join(tmpdir, 'in.raw')), False
+
+        # Straight to a file, without passing through Python.
+        out = os.path.join(tmpdir, 'out.raw')
+        result = minc_pipe.Pipeline([toraw]).run(out)
+        yield assert_equal, os.path.getsize(out), 1 << 20
+        yield assert_equal, result.nbytes, 0
+
+        # Fed from Python.
+        source = (b'hello ' for _ in range(100000))
+        p = minc_pipe.Pipeline([['upper']], source=source)
+        n = sum(len(c) for c in p.stream())
+        yield assert_equal, n, 600000
+        yield assert_equal, p.result.returncodes, [0]
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def test_exit_codes():
+    fake = _tools()
+    try:
+        try:
+            minc_pipe.pipe(['minctoraw', '1000', 'x'], ['fail'], ['upper'])
+        except minc_pipe.PipelineError as e:
+            yield assert_equal, e.result.returncodes, [0, 3, 0]
+            yield assert_true, 'bad input' in str(e)
+        else:
+            yield assert_true, False
+
+        # A consumer that stops early leaves its producer to die of
+        # SIGPIPE, as in a shell.
+        result = minc_pipe.pipe(['yes'], ['head'], check=False)
+        yield assert_equal, result.returncodes, [-signal.SIGPIPE, 0]
+
+        # Abandoning the stream kills every stage.
+        p = minc_pipe.Pipeline([['minctoraw', str(64 << 20), 'x'], ['upper']], chunk_size=4096)
+        gen = p.stream()
+        next(gen)
+        gen.close()
+        yield assert_true, all(proc.returncode is not None for proc in p.procs)
+
+        yield assert_raises, ValueError, minc_pipe.Pipeline, []
+        yield assert_raises, TypeError, minc_pipe.stage_argv, 42
+    finally:
+        fake.close()
+
+def test_named_pipe():
+    fake = _tools()
+    try:
+        with minc_pipe.named_pipe() as fifo:
+            got = []
+            reader = threading.Thread(target=lambda: got.append(open(fifo, 'rb').read()))
+            reader.start()
+            minc_pipe.pipe(['minctoraw', '1000', 'x'], sink=fifo)
+            reader.join()
+            yield assert_equal, len(got[0]), 1000
+        yield assert_equal, os.path.exists(fifo), False
+    finally:
+        fake.close()
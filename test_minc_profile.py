@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for per-run resource accounting
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_profile.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises)
+
+import minc
+import minc_profile
+from test_minc import _FakeToolchain, _fake_tool
+
+# Holds 64MB for a while, burns some CPU and writes 1MB.
+FAKE_CONVERT = """
+import sys, time
+hog = bytearray(64 << 20)
+t = time.time()
+while time.time() - t < 0.3:
+    sum(range(1000))
+open(sys.argv[-1], 'wb').write(b'x' * (1 << 20))
+"""
+
+def test_profile():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'wb').write(b'y' * 1000)
+
+        def convert(out):
+            return minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, out),
+                                    clobber=True).run()
+
+        # Nothing is recorded without a sink.
+        convert('a.mnc')
+
+        jsonl = os.path.join(tmpdir, 'profile.jsonl')
+        os.environ['MINC_PROFILE_JSONL'] = jsonl
+        try:
+            with minc_profile.profiling() as sink:
+                convert('b.mnc')
+                convert('c.mnc')
+        finally:
+            del os.environ['MINC_PROFILE_JSONL']
+        convert('d.mnc')
+
+        yield assert_equal, len(sink.records), 2
+        yield assert_equal, len(minc_profile.read_jsonl(jsonl)), 2
+
+        r = sink.records[0]
+        yield assert_equal, (r['task'], r['cmd'], r['returncode']), ('ConvertTask', 'mincconvert', 0)
+        yield assert_true, r['cmdline'].endswith(os.path.join(tmpdir, 'b.mnc'))
+        yield assert_equal, (r['input_files'], r['input_bytes']), (1, 1000)
+        yield assert_true, r['wall_seconds'] >= 0.3
+        yield assert_true, r['tool_user_seconds'] + r['tool_sys_seconds'] >= 0.1
+        yield assert_true, r['tool_max_rss_kb'] >= 64 * 1024
+        if r['wchar'] is not None:
+            yield assert_true, r['wchar'] >= 1 << 20
+
+        s = sink.summary()
+        yield assert_equal, [(t['cmd'], t['runs']) for t in s['tools']], [('mincconvert', 2)]
+        yield assert_true, s['tools'][0]['mb_per_second'] > 0
+        yield assert_equal, len(s['slowest']), 2
+        yield assert_true, 'mincconvert' in minc_profile.format_summary(s)
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+# Holds as many MB as its input says for a while.
+FAKE_HOG = """
+import sys, time
+hog = bytearray(int(open(sys.argv[-2]).read()) << 20)
+time.sleep(0.3)
+open(sys.argv[-1], 'wb').write(b'x')
+"""
+
+def test_rss_per_run():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_HOG, sys.executable)
+        # Raise this process's lifetime peak (ru_maxrss) beforehand.
+        hog = bytearray(256 << 20)
+        del hog
+        with minc_profile.profiling() as sink:
+            for mb in (256, 16):
+                inp = os.path.join(tmpdir, '%d.mnc' % mb)
+                open(inp, 'w').write(str(mb))
+                minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, 'out.mnc'),
+                                 clobber=True).run()
+
+        # The second run's peak is its own, not the largest so far in
+        # this process or its children.
+        big, small = sink.records
+        yield assert_true, big['max_rss_kb'] >= 256 * 1024
+        yield assert_true, small['max_rss_kb'] >= 16 * 1024
+        yield assert_true, small['max_rss_kb'] < 128 * 1024
+        yield assert_true, small['python_rss_growth_kb'] < 64 * 1024
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def test_failure_recorded():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', 'exit 2')
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('x')
+        with minc_profile.profiling() as sink:
+            task = minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, 'out.mnc'))
+            try:
+                task.run()
+            except Exception:
+                pass
+        yield assert_equal, len(sink.records), 1
+        r = sink.records[0]
+        yield assert_true, r['returncode'] == 2 or r['error'] is not None
+        yield assert_equal, minc_profile.summary(sink.records)['tools'][0]['failed'], 1
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the SQLite work queue
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_queue.py
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from nipype.testing import (assert_equal, assert_true, assert_false)
+
+import minc
+import minc_queue
+from test_minc import _FakeToolchain, _fake_tool
+
+# Copies the input, logging which process ran it. An output name with
+# 'flaky' in it fails the first time.
+FAKE_CONVERT = """
+import os, shutil, sys, time
+d = os.path.dirname(sys.argv[0])
+out = sys.argv[-1]
+if 'flaky' in out and not os.path.exists(out + '.tried'):
+    open(out + '.tried', 'w').close()
+    sys.exit(2)
+time.sleep(0.05)
+with open(os.path.join(d, 'log'), 'a') as f:
+    f.write('%d %s\\n' % (os.getppid(), os.path.basename(out)))
+shutil.copy(sys.argv[-2], out)
+"""
+
+def _node(fname, name):
+    # One simulated node: its own process and connection to the queue.
+    w = minc_queue.Worker(minc_queue.WorkQueue(fname, lease_seconds=5), name=name)
+    w.run()
+
+def test_queue():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('volume')
+        fname = os.path.join(tmpdir, 'queue.db')
+        q = minc_queue.WorkQueue(fname, lease_seconds=5)
+
+        names = ['out%02d.mnc' % i for i in range(12)] + ['flaky.mnc']
+        ids = q.put_many([minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, n), two=True)
+                          for n in names])
+        yield assert_equal, q.job(ids[0])['spec']['inputs']['two'], True
+        yield assert_equal, q.status()['backlog'], len(names)
+
+        nodes = [multiprocessing.Process(target=_node, args=(fname, 'node%d' % i)) for i in range(3)]
+        for p in nodes:
+            p.start()
+        for p in nodes:
+            p.join()
+
+        yield assert_equal, [p.exitcode for p in nodes], [0, 0, 0]
+        status = q.status()
+        yield assert_equal, status['counts']['done'], len(names)
+        yield assert_equal, status['backlog'], 0
+        yield assert_true, status['throughput'] > 0
+        yield assert_true, len(status['workers']) > 1
+
+        # Every job ran exactly once (bar the retried one's failure).
+        ran = [line.split()[1] for line in open(os.path.join(fake.bindir, 'log'))]
+        yield assert_equal, sorted(ran), sorted(names)
+        for n in names:
+            yield assert_equal, open(os.path.join(tmpdir, n)).read(), 'volume'
+
+        flaky = q.job(ids[-1])
+        yield assert_equal, flaky['attempts'], 2
+        yield assert_equal, flaky['outputs']['output_file'], os.path.join(tmpdir, 'flaky.mnc')
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def test_leases():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        q = minc_queue.WorkQueue(os.path.join(tmpdir, 'queue.db'), lease_seconds=0.2, max_attempts=2)
+        spec = {'task': 'ConvertTask', 'inputs': {'input_file': 'a.mnc', 'output_file': 'b.mnc'}}
+        id = q.put(spec)
+
+        job = q.claim('dead')
+        yield assert_equal, job.attempt, 1
+        yield assert_equal, q.claim('other'), None
+        yield assert_true, q.heartbeat(job)
+        yield assert_equal, q.status()['running'], {'dead': 1}
+
+        # The worker goes quiet; once its lease is up the job moves on,
+        # and the late result from the first worker is refused.
+        time.sleep(0.3)
+        again = q.claim('other')
+        yield assert_equal, (again.id, again.attempt), (id, 2)
+        yield assert_false, q.heartbeat(job)
+        yield assert_false, q.complete(job, {})
+
+        # Out of attempts: a failure sticks, until retried.
+        yield assert_true, q.fail(again, 'boom')
+        yield assert_equal, q.job(id)['status'], 'failed'
+        yield assert_equal, q.job(id)['error'], 'boom'
+        yield assert_equal, q.claim('other'), None
+        yield assert_equal, q.retry_failed(), 1
+        yield assert_equal, q.claim('other').attempt, 1
+
+        # A lease that runs out on the last attempt fails the job.
+        time.sleep(0.3)
+        q.claim('other')
+        time.sleep(0.3)
+        yield assert_equal, q.claim('other'), None
+        yield assert_equal, q.job(id)['status'], 'failed'
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'queue.db')
+        specs = os.path.join(tmpdir, 'specs.json')
+        json.dump([{'task': 'ConvertTask', 'inputs': {'input_file': 'a.mnc', 'output_file': 'b.mnc'}}] * 2,
+                  open(specs, 'w'))
+        yield assert_equal, minc_queue.main([fname, 'submit', specs]), 0
+        yield assert_equal, minc_queue.WorkQueue(fname).status()['counts']['queued'], 2
+    finally:
+        shutil.rmtree(tmpdir)
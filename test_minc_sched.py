@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the memory-budget scheduler
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_sched.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_false)
+
+import minc
+import minc_sched
+from minc_header import MincHeader
+from test_minc import _FakeToolchain, _fake_tool
+
+# Copies the input, logging when it starts and stops.
+FAKE_CONVERT = """
+import os, shutil, sys, time
+log = os.path.join(os.path.dirname(sys.argv[0]), 'log')
+with open(log, 'a') as f:
+    f.write('start %s %r\\n' % (sys.argv[-1], time.time()))
+time.sleep(0.2)
+shutil.copy(sys.argv[-2], sys.argv[-1])
+with open(log, 'a') as f:
+    f.write('end %s %r\\n' % (sys.argv[-1], time.time()))
+"""
+
+def _header(shape, datatype='short'):
+    return lambda fname: MincHeader(dimnames=['zspace', 'yspace', 'xspace'][-len(shape):],
+                                    shape=shape, datatype=datatype)
+
+def test_estimates():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').close()
+        convert = minc.ConvertTask(input_file=inp, output_file='out.mnc')
+        small = minc_sched.raw_estimate_kb(convert, _header((10, 10, 10)))
+        big = minc_sched.raw_estimate_kb(convert, _header((300, 256, 256)))
+        yield assert_true, small < big
+        # Beyond the copy buffer the image size does not matter.
+        yield assert_equal, big, minc_sched.raw_estimate_kb(convert, _header((400, 256, 256)))
+        convert.inputs.chunk = 1 << 20
+        yield assert_true, minc_sched.raw_estimate_kb(convert, _header((300, 256, 256))) > big
+
+        average = minc.AverageTask(input_files=[inp] * 10, output_file='avg.mnc')
+        yield assert_equal, minc_sched.model_key(average), 'mincaverage'
+        a = minc_sched.raw_estimate_kb(average, _header((10, 512, 512), 'byte'))
+        average.inputs.max_buffer_size_in_kb = 1 << 20
+        yield assert_true, minc_sched.raw_estimate_kb(average, _header((10, 512, 512), 'byte')) > a
+        average.inputs.engine = 'numpy'
+        yield assert_equal, minc_sched.model_key(average), 'mincaverage/numpy'
+        average.inputs.stats_prefix = os.path.join(tmpdir, 'stats')
+        yield assert_equal, minc_sched.model_key(average), 'mincaverage/incremental'
+
+        ecat = minc.ToEcatTask(input_file=inp, output_file='out.v')
+        yield assert_equal, minc_sched.model_key(ecat), 'minctoecat'
+        ecat.inputs.frames_per_job = 8
+        yield assert_equal, minc_sched.model_key(ecat), 'minctoecat/frames'
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_model():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'model.json')
+        m = minc_sched.MemoryModel(fname, margin=0.0)
+        yield assert_equal, m.correction('mincconvert'), 1.0
+        m.observe('mincconvert', 1000, 2000)
+        m.observe('mincconvert', 1000, 1500)
+        yield assert_equal, m.correction('mincconvert'), 2.0
+        m.save()
+
+        # Another process's observations are merged, not overwritten.
+        other = minc_sched.MemoryModel(fname, margin=0.0)
+        m.observe('mincconvert', 1000, 3000)
+        other.observe('minctoraw', 1000, 500)
+        other.save()
+        m.save()
+        yield assert_equal, minc_sched.MemoryModel(fname).ratios, {'mincconvert': [2.0, 1.5, 3.0], 'minctoraw': [0.5]}
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_scheduler():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').write('volume')
+
+        model = minc_sched.MemoryModel(False)
+        s = minc_sched.Scheduler(memory_kb=1000, cpus=4, model=model, header=_header((10, 10, 10)))
+
+        def convert(name):
+            return minc.ConvertTask(input_file=inp, output_file=os.path.join(tmpdir, name))
+
+        # Two big jobs cannot share the budget; the small ones can run
+        # alongside either of them.
+        for (name, kb) in [('big1', 600), ('big2', 600), ('small1', 100), ('small2', 100)]:
+            s.submit(convert(name), estimate_kb=kb)
+        # One more, estimated from its header and learnt from.
+        learnt = s.submit(convert('learnt'))
+        learnt.estimate_kb = 100
+
+        jobs = s.run()
+        yield assert_equal, [j.status for j in jobs], ['ok'] * 5
+        yield assert_true, s.peak_kb <= 1000
+        yield assert_equal, open(jobs[0].outputs['output_file']).read(), 'volume'
+
+        times = {}
+        for line in open(os.path.join(fake.bindir, 'log')):
+            what, name, t = line.split()
+            times.setdefault(os.path.basename(name), {})[what] = float(t)
+        big1, big2 = times['big1'], times['big2']
+        yield assert_true, big1['end'] <= big2['start'] or big2['end'] <= big1['start']
+        yield assert_true, times['small1']['start'] < max(big1['end'], big2['end'])
+
+        yield assert_equal, list(model.ratios), ['mincconvert']
+        yield assert_true, all(j.measured_kb > 0 for j in jobs)
+
+        # A job over the whole budget still runs, on its own.
+        s = minc_sched.Scheduler(memory_kb=1000, cpus=4, model=model, learn=False)
+        job = s.submit(convert('huge'), estimate_kb=5000)
+        s.run()
+        yield assert_equal, job.status, 'ok'
+
+        # A failure is reported, not raised.
+        _fake_tool(fake.bindir, 'mincconvert', 'exit 3')
+        s = minc_sched.Scheduler(memory_kb=1000, cpus=1, model=model, learn=False)
+        job = s.submit(convert('fails'), estimate_kb=10)
+        s.run()
+        yield assert_equal, job.status, 'failed'
+        yield assert_false, job.error is None
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+def test_available_memory():
+    kb = minc_sched.available_memory_kb()
+    yield assert_true, kb is None or kb > 0
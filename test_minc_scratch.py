@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the scratch space manager
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_scratch.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_false, assert_raises)
+
+import minc
+import minc_scratch
+from test_minc import _FakeToolchain, _fake_tool
+
+# Uppercases the input (minctoraw) or copies it (minctoecat), logging the
+# input path it was given.
+FAKE_TOOL = """
+import os, shutil, sys
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'log'), 'a') as f:
+    f.write(sys.argv[-1 if sys.argv[0].endswith('minctoraw') else -2] + '\\n')
+if sys.argv[0].endswith('minctoraw'):
+    sys.stdout.write(open(sys.argv[-1]).read().upper())
+else:
+    shutil.copy(sys.argv[-2], sys.argv[-1])
+"""
+
+def test_scratch():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for tool in ['minctoraw', 'minctoecat']:
+            _fake_tool(fake.bindir, tool, FAKE_TOOL, sys.executable)
+        log = os.path.join(fake.bindir, 'log')
+        durable = os.path.join(tmpdir, 'durable')
+        os.mkdir(durable)
+        inp = os.path.join(durable, 'vol.mnc')
+        open(inp, 'w').write('volume')
+
+        scratch = minc_scratch.Scratch(os.path.join(tmpdir, 'scratch'), quota=30)
+
+        # Generated outputs go to scratch, and the tool reads a staged
+        # copy of the input.
+        toraw = minc.ToRawTask(input_file=inp, nonormalize=True, scratch=scratch)
+        out = toraw._gen_filename('out_file')
+        yield assert_true, out.startswith(scratch.root)
+        toraw.run()
+        yield assert_equal, open(out).read(), 'VOLUME'
+        staged = open(log).read().split()[-1]
+        yield assert_equal, staged, scratch.staged_path(inp)
+        yield assert_equal, toraw.inputs.input_file, inp
+        yield assert_false, os.path.exists(os.path.join(durable, 'vol.raw'))
+        yield assert_equal, scratch.origin(out), os.path.join(durable, 'vol.raw')
+
+        # An explicit output is left alone.
+        explicit = os.path.join(durable, 'explicit.raw')
+        minc.ToRawTask(input_file=inp, nonormalize=True, scratch=scratch, out_file=explicit).run()
+        yield assert_equal, open(explicit).read(), 'VOLUME'
+
+        # The staged copy is reused until the original changes.
+        yield assert_equal, scratch.stage(inp), staged
+        open(inp, 'w').write('volume two')
+        scratch.stage(inp)
+        yield assert_equal, open(staged).read(), 'volume two'
+
+        # Copy back to durable storage in the background.
+        t = scratch.publish(out)
+        yield assert_equal, t.wait(10), os.path.join(durable, 'vol.raw')
+        yield assert_equal, open(t.dest).read(), 'VOLUME'
+        yield assert_raises, ValueError, scratch.publish, staged + '.nothing'
+
+        # Filling up evicts the least recently used file, but not pinned
+        # ones.
+        ecat = minc.ToEcatTask(input_file=inp, scratch=scratch)
+        scratch.pin(out)
+        ecat.run()
+        yield assert_true, os.path.exists(out)
+        yield assert_true, scratch.usage()['bytes'] <= 30
+        scratch.unpin(out)
+        scratch.evict(quota=0)
+        yield assert_false, os.path.exists(out)
+        yield assert_equal, scratch.usage()['bytes'], 0
+
+        # $MINC_SCRATCH_DIR turns scratch on for every task.
+        os.environ['MINC_SCRATCH_DIR'] = os.path.join(tmpdir, 'envscratch')
+        try:
+            yield assert_true, minc.DumpTask(input_file=inp)._gen_filename('out_file').startswith(
+                os.path.join(tmpdir, 'envscratch'))
+            yield assert_equal, minc.DumpTask(input_file=inp, scratch=False)._gen_filename('out_file'), \
+                                os.path.join(durable, 'vol.txt')
+        finally:
+            del os.environ['MINC_SCRATCH_DIR']
+        scratch.close()
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
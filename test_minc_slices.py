@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for hyperslab reads and the slice cache
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_slices.py
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_slices
+from test_minc import _FakeToolchain, _fake_tool, FAKE_LAYOUT
+
+np = minc.np
+
+# A 2x3x4 volume with voxel (z, y, x) = 100z + 10y + x, as doubles; each
+# run is logged with its -start.
+FAKE_EXTRACT = """
+import itertools, os, struct, sys
+args = sys.argv[1:]
+start = [int(s) for s in args[args.index('-start') + 1].split(',')]
+count = [int(c) for c in args[args.index('-count') + 1].split(',')]
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'log'), 'a') as f:
+    f.write('%s\\n' % ','.join(str(s) for s in start))
+ranges = [range(s, s + c) for (s, c) in zip(start, count)]
+values = [100 * z + 10 * y + x for (z, y, x) in itertools.product(*ranges)]
+sys.stdout.write(struct.pack('=%dd' % len(values), *values))
+"""
+
+def _volume():
+    z, y, x = np.indices((2, 3, 4))
+    return 100.0 * z + 10 * y + x
+
+def _runs(fake):
+    fname = os.path.join(fake.bindir, 'log')
+    return open(fname).read().split() if os.path.exists(fname) else []
+
+@skipif(np is None)
+def test_slices():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_LAYOUT)
+        _fake_tool(fake.bindir, 'mincextract', FAKE_EXTRACT, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').close()
+        volume = _volume()
+
+        cache = minc_slices.SliceCache()
+        reader = minc_slices.SliceReader(inp, cache=cache, prefetch=0, backend='mincextract')
+        yield assert_equal, reader.shape, (2, 3, 4)
+        yield assert_true, np.array_equal(reader.hyperslab((1, 1, 2), (1, 2, 2)), volume[1:2, 1:3, 2:4])
+        yield assert_true, np.array_equal(reader.slice('zspace', 1), volume[1])
+        yield assert_true, np.array_equal(reader.slice('yspace', 2), volume[:, 2])
+        yield assert_true, np.array_equal(reader.slice(2, -1), volume[:, :, 3])
+        yield assert_raises, IndexError, reader.slice, 'zspace', 2
+        yield assert_raises, ValueError, reader.slice, 'time', 0
+        yield assert_raises, IndexError, reader.hyperslab, (0, 0, 0), (3, 1, 1)
+
+        # Cached: read again without running mincextract.
+        n = len(_runs(fake))
+        a = reader.slice('zspace', 1)
+        yield assert_equal, len(_runs(fake)), n
+        yield assert_equal, cache.stats()['hits'], 1
+        yield assert_raises, ValueError, a.__setitem__, (0, 0), 1.0
+
+        # Threads asking for the same slice share one read.
+        cache.clear()
+        n = len(_runs(fake))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(reader.slice('xspace', 0)))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        yield assert_equal, len(_runs(fake)), n + 1
+        yield assert_true, all(np.array_equal(r, volume[:, :, 0]) for r in results)
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+@skipif(np is None)
+def test_prefetch():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_LAYOUT)
+        _fake_tool(fake.bindir, 'mincextract', FAKE_EXTRACT, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').close()
+
+        cache = minc_slices.SliceCache()
+        reader = minc_slices.SliceReader(inp, cache=cache, prefetch=1, backend='mincextract')
+        reader.slice('xspace', 1)
+        cache.join()
+        yield assert_equal, sorted(_runs(fake)), ['0,0,0', '0,0,1', '0,0,2']
+        yield assert_true, np.array_equal(reader.slice('xspace', 2), _volume()[:, :, 2])
+        cache.join()
+        yield assert_equal, len(_runs(fake)), 4
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
+
+@skipif(np is None)
+def test_lru():
+    cache = minc_slices.SliceCache(max_bytes=3 * 80)
+    for i in range(4):
+        cache.put(i, np.zeros(10))
+    yield assert_equal, sorted(cache._items), [1, 2, 3]
+    yield assert_equal, cache.bytes, 240
+
+    # A hit makes an entry the most recent.
+    cache.get(1, None)
+    cache.put(4, np.zeros(10))
+    yield assert_equal, sorted(cache._items), [1, 3, 4]
+
+    cache.put(5, np.zeros(100))
+    yield assert_true, 5 not in cache
+    yield assert_equal, cache.get(5, lambda: np.ones(2)).tolist(), [1.0, 1.0]
+    yield assert_true, minc_slices.get_slice_cache() is minc_slices.get_slice_cache()
+    yield assert_equal, minc_slices.get_slice_cache(False), None
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the streaming voxel statistics
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_stats.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc_io
+import minc_stats
+from test_minc import _FakeToolchain, _fake_tool
+from test_minc_io import FAKE_RAWTOMINC
+
+no_h5py = not minc_io.available()
+
+if not no_h5py:
+    import numpy as np
+
+def _read_rawtominc(fname, shape):
+    with open(fname, 'rb') as f:
+        f.readline()
+        return np.frombuffer(f.read(), dtype=np.float64).reshape(shape)
+
+@skipif(no_h5py)
+def test_sketch():
+    rng = np.random.RandomState(0)
+    x = np.concatenate([rng.lognormal(size=5000), -rng.uniform(0, 10, size=2000), np.zeros(100)])
+
+    s = minc_stats.QuantileSketch(0.01)
+    s.add(x)
+    for q in (0.0, 0.01, 0.25, 0.5, 0.9, 0.99, 1.0):
+        true = np.sort(x)[int(q * (x.size - 1))]
+        yield assert_true, abs(s.quantile(q) - true) <= 0.01 * abs(true) + 1e-9
+
+    # Merging two halves counts the same buckets as one pass.
+    a, b = minc_stats.QuantileSketch(0.01), minc_stats.QuantileSketch(0.01)
+    a.add(x[::2])
+    b.add(x[1::2])
+    a.merge(b)
+    yield assert_equal, a.to_dict(), s.to_dict()
+    yield assert_equal, minc_stats.QuantileSketch.from_dict(s.to_dict()).quantile(0.5), s.quantile(0.5)
+    yield assert_raises, ValueError, a.merge, minc_stats.QuantileSketch(0.05)
+
+@skipif(no_h5py)
+def test_summary():
+    rng = np.random.RandomState(1)
+    x = rng.normal(50, 10, size=10000)
+    x[::100] = np.nan
+    valid = x[~np.isnan(x)]
+
+    s = minc_stats.Summary(bins=20, range=(20, 80))
+    for chunk in np.array_split(x, 7):
+        s.add(chunk)
+    yield assert_equal, s.count, valid.size
+    yield assert_equal, (s.min, s.max), (valid.min(), valid.max())
+    yield assert_true, np.allclose(s.mean, valid.mean())
+    yield assert_true, np.allclose(s.sd, valid.std(ddof=1))
+    counts, edges = s.histogram()
+    yield assert_true, np.array_equal(counts, np.histogram(valid, bins=20, range=(20, 80))[0])
+    yield assert_equal, s.underflow + s.overflow + counts.sum(), valid.size
+    yield assert_true, abs(s.quantile(0.5) - np.median(valid)) < 0.01 * np.median(valid) + 0.1
+
+    # Shards merged, through JSON, as one pass.
+    tmpdir = tempfile.mkdtemp()
+    try:
+        parts = []
+        for (k, chunk) in enumerate(np.array_split(x, 3)):
+            p = minc_stats.Summary(bins=20, range=(20, 80))
+            p.add(chunk)
+            p.save(os.path.join(tmpdir, 'part%d.json' % k))
+            parts.append(minc_stats.Summary.load(os.path.join(tmpdir, 'part%d.json' % k)))
+        merged = minc_stats.merge(parts)
+        yield assert_equal, merged.count, s.count
+        yield assert_true, np.allclose([merged.mean, merged.sd], [s.mean, s.sd])
+        yield assert_true, np.array_equal(merged.counts, s.counts)
+        yield assert_equal, merged.sketch.to_dict(), s.sketch.to_dict()
+        yield assert_equal, parts[0].count, np.count_nonzero(~np.isnan(np.array_split(x, 3)[0]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    yield assert_raises, ValueError, minc_stats.Summary(bins=10, range=(0, 1)).merge, minc_stats.Summary()
+
+    # Without a range the histogram comes from the sketch.
+    t = minc_stats.Summary(bins=10)
+    t.add(valid)
+    counts, edges = t.histogram()
+    yield assert_equal, counts.sum(), valid.size
+    yield assert_true, abs(counts[5] - np.histogram(valid, bins=edges)[0][5]) < 0.05 * valid.size
+
+@skipif(no_h5py)
+def test_stats():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'rawtominc', FAKE_RAWTOMINC, sys.executable)
+        rng = np.random.RandomState(2)
+        shape = (6, 4, 5)
+        fnames, datas = [], []
+        for i in range(3):
+            data = rng.uniform(0, 100, size=shape)
+            fname = os.path.join(tmpdir, 'vol%d.mnc' % i)
+            minc_io.write_minc2(fname, data, dtype='float64')
+            fnames.append(fname)
+            datas.append(data)
+        datas = np.array(datas)
+
+        labels = np.zeros(shape)
+        labels[:3] = 1
+        labels[3:, :2] = 2
+        mask_file = os.path.join(tmpdir, 'labels.mnc')
+        minc_io.write_minc2(mask_file, labels, dtype='float64')
+
+        outputs = dict((k, os.path.join(tmpdir, k + '.mnc')) for k in ('mean', 'sd', 'min', 'max'))
+        # A small buffer so that the volumes are read in several slabs.
+        result = minc_stats.stats(fnames, mask_file=mask_file, output_file=outputs['mean'],
+                                  sdfile=outputs['sd'], min_file=outputs['min'], max_file=outputs['max'],
+                                  max_buffer_size_in_kb=1)
+        inside = labels > 0.5
+        for (i, s) in enumerate(result['inputs']):
+            yield assert_equal, s.count, np.count_nonzero(inside)
+            yield assert_true, np.allclose([s.mean, s.sd], [datas[i][inside].mean(), datas[i][inside].std(ddof=1)])
+        pooled = result['pooled']
+        yield assert_equal, pooled.count, 3 * np.count_nonzero(inside)
+        yield assert_equal, pooled.max, datas[:, inside].max()
+
+        yield assert_true, np.allclose(_read_rawtominc(outputs['mean'], shape), datas.mean(axis=0))
+        yield assert_true, np.allclose(_read_rawtominc(outputs['sd'], shape), datas.std(axis=0, ddof=1))
+        yield assert_true, np.allclose(_read_rawtominc(outputs['min'], shape), datas.min(axis=0))
+        yield assert_true, np.allclose(_read_rawtominc(outputs['max'], shape), datas.max(axis=0))
+
+        # Per label.
+        by_label = minc_stats.volume_stats(fnames[0], mask_file=mask_file, labels=True)
+        yield assert_equal, sorted(by_label), [1, 2]
+        yield assert_equal, by_label[2].count, np.count_nonzero(labels == 2)
+        yield assert_true, np.allclose(by_label[2].mean, datas[0][labels == 2].mean())
+        yield assert_raises, ValueError, minc_stats.volume_stats, fnames[0], None, True
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the chunked array store
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_store.py
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_store
+from minc_header import MincHeader
+from test_minc import _FakeToolchain, _fake_tool, FAKE_LAYOUT, FAKE_TORAW
+
+np = minc.np
+
+@skipif(np is None)
+def test_store():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data = np.arange(7 * 9 * 10, dtype='int16').reshape(7, 9, 10)
+        for compression in (None, 'zlib'):
+            path = os.path.join(tmpdir, 'a.chunks')
+            store = minc_store.from_array(path, data, chunks=(3, 4, 5), compression=compression, threads=2)
+            yield assert_equal, store.grid, (3, 3, 2)
+            yield assert_equal, len(os.listdir(os.path.join(path, 'chunks'))), 18
+            yield assert_equal, store.chunk_key((6, 8, 9)), (2, 2, 1)
+            yield assert_equal, store.chunk_shape((2, 2, 1)), (1, 1, 5)
+
+            yield assert_true, np.array_equal(store.to_array(), data)
+            yield assert_true, np.array_equal(store[5], data[5])
+            yield assert_true, np.array_equal(store[-1, 2:7], data[-1, 2:7])
+            yield assert_true, np.array_equal(store[:, 3, 1:9], data[:, 3, 1:9])
+            yield assert_true, np.array_equal(store.read((2, 3, 4), (3, 2, 6)), data[2:5, 3:5, 4:10])
+            yield assert_equal, store[1:1].shape, (0, 9, 10)
+            yield assert_raises, IndexError, lambda: store[7]
+            yield assert_raises, IndexError, lambda: store[::2]
+            store.close()
+
+        # Replaced in place.
+        store = minc_store.from_array(path, data[:2], chunks=(1, 9, 10))
+        yield assert_equal, minc_store.Store(path).shape, (2, 9, 10)
+
+        # Short input leaves nothing behind.
+        slices = ((i, data[i]) for i in range(3))
+        yield assert_raises, RuntimeError, minc_store.write_store, os.path.join(tmpdir, 'b.chunks'), \
+                                           slices, data.shape, data.dtype
+        yield assert_equal, sorted(os.listdir(tmpdir)), ['a.chunks']
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(np is None)
+def test_voxel_to_world():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        header = MincHeader(dimnames=['zspace', 'yspace', 'xspace'], shape=(2, 3, 4),
+                            steps=[2.0, 1.0, -0.5], starts=[-10.0, 0.0, 5.0],
+                            direction_cosines=[[0.0, 0.0, 1.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]],
+                            datatype='short', signtype='unsigned')
+        path = os.path.join(tmpdir, 'a.chunks')
+        store = minc_store.from_array(path, np.zeros((2, 3, 4)), header=header)
+        yield assert_equal, store.voxel_to_world((1, 2, 3)), (3.5, 2.0, -8.0)
+        yield assert_equal, json.load(open(os.path.join(path, 'index.json')))['dimnames'], header.dimnames
+
+        store = minc_store.from_array(path, np.zeros((2, 3, 4)))
+        yield assert_raises, ValueError, store.voxel_to_world, (0, 0, 0)
+    finally:
+        shutil.rmtree(tmpdir)
+
+@skipif(np is None)
+def test_toraw_to_store():
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincinfo', FAKE_LAYOUT)
+        _fake_tool(fake.bindir, 'minctoraw', FAKE_TORAW, sys.executable)
+        inp = os.path.join(tmpdir, 'in.mnc')
+        open(inp, 'w').close()
+        header = MincHeader(dimnames=['zspace', 'yspace', 'xspace'], shape=(2, 3, 4),
+                            steps=[1.0] * 3, starts=[0.0] * 3,
+                            direction_cosines=[None] * 3, datatype='short', signtype='unsigned')
+
+        toraw = minc.ToRawTask(input_file=inp, nonormalize=True)
+        store = toraw.to_store(chunks=(1, 2, 2), header=header, backend='subprocess')
+        yield assert_equal, store.path, os.path.join(tmpdir, 'in.chunks')
+        yield assert_equal, store.dtype, np.dtype('uint16')
+        yield assert_true, np.array_equal(store.to_array(), toraw.to_array(backend='subprocess'))
+        yield assert_equal, store[1, 2].tolist(), [20, 21, 22, 23]
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synopsis: tests for the compression/chunk tuner
+# Author: Carlo Hamalainen <carlo@carlo-hamalainen.net>
+#         http://carlo-hamalainen.net
+
+# To run these tests manually:
+#
+#     nosetests -v test_minc_tune.py
+
+import os
+import shutil
+import sys
+import tempfile
+
+from nipype.testing import (assert_equal, assert_true, assert_raises, skipif)
+
+import minc
+import minc_io
+import minc_tune
+from test_minc import _FakeToolchain, _fake_tool
+
+no_h5py = not minc_io.available()
+
+# Rewrites the input with h5py, gzip level from -compress and one chunk
+# per slice when -chunk is given.
+FAKE_CONVERT = """
+import sys
+sys.path.insert(0, %r)
+import minc_io
+args = sys.argv[1:]
+level = int(args[args.index('-compress') + 1]) if '-compress' in args else 0
+vol = minc_io.Minc2Volume(args[-2])
+data = vol.read_real()
+chunks = (1,) + data.shape[1:] if '-chunk' in args else None
+minc_io.write_minc2(args[-1], data, dtype=vol.dtype, compression=level, chunks=chunks)
+""" % (os.path.dirname(os.path.abspath(__file__)),)
+
+def test_pareto():
+    trials = [{'compression': 0, 'chunk': 0, 'read_seconds': 1.0, 'bytes': 100},
+              {'compression': 1, 'chunk': 0, 'read_seconds': 1.05, 'bytes': 50},
+              {'compression': 4, 'chunk': 0, 'read_seconds': 2.0, 'bytes': 40},
+              {'compression': 9, 'chunk': 0, 'read_seconds': 3.0, 'bytes': 40},
+              {'compression': 0, 'chunk': 1, 'read_seconds': 1.5, 'bytes': 100},
+             ]
+    front = minc_tune.pareto(trials)
+    yield assert_equal, [t['compression'] for t in front], [0, 1, 4]
+    yield assert_equal, minc_tune.recommend(front)['compression'], 1
+    yield assert_equal, minc_tune.recommend(front, slowdown=0.0)['compression'], 0
+    yield assert_equal, minc_tune.recommend(front, slowdown=1.0)['compression'], 4
+
+@skipif(no_h5py)
+def test_tune():
+    import numpy as np
+    fake = _FakeToolchain()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _fake_tool(fake.bindir, 'mincconvert', FAKE_CONVERT, sys.executable)
+        sample = minc_io.write_minc2(os.path.join(tmpdir, 'sample.mnc'),
+                                     np.tile(np.arange(64.0), (4, 64, 1)), dtype='uint16')
+        profile_file = os.path.join(tmpdir, 'profile.json')
+
+        profile = minc_tune.tune([sample], workload='slices', compressions=(0, 9), chunks=(0, 1),
+                                 repeats=1, fname=profile_file)
+        yield assert_equal, len(profile['trials']), 4
+        yield assert_true, profile['pareto']
+        sizes = dict(((t['compression'], t['chunk']), t['bytes']) for t in profile['trials'])
+        yield assert_true, sizes[(9, 0)] < sizes[(0, 0)]
+        yield assert_true, (profile['compression'], profile['chunk'] or 0) in sizes
+
+        # ConvertTask takes its defaults from the profile, but explicit
+        # inputs win.
+        out = os.path.join(tmpdir, 'out.mnc')
+        task = minc.ConvertTask(input_file=sample, output_file=out, profile=profile_file)
+        yield assert_equal, task.inputs.compression, profile['compression']
+        task = minc.ConvertTask(input_file=sample, output_file=out, compression=3, profile=profile_file)
+        yield assert_equal, task.inputs.compression, 3
+
+        os.environ['MINC_CONVERT_PROFILE'] = profile_file
+        try:
+            task = minc.ConvertTask(input_file=sample, output_file=out, profile=True)
+            yield assert_equal, task.inputs.compression, profile['compression']
+        finally:
+            del os.environ['MINC_CONVERT_PROFILE']
+
+        yield assert_raises, ValueError, minc_tune.time_read, sample, 'bogus'
+        yield assert_raises, ValueError, minc_tune.sweep, []
+    finally:
+        fake.close()
+        shutil.rmtree(tmpdir)